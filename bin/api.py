@@ -15,6 +15,7 @@ import jwt
 import ideal_module as idm
 import utils.condor_utils as cndr 
 import utils.api_utils as ap 
+from utils.job_state_store import get_job_state_db
 import impl.dicom_functions as dcm
 # api imports
 from flask import Flask, request, jsonify, Response 
@@ -49,7 +50,7 @@ host_IP = api_cfg['server']['IP host']
 # List of all active jobs. Members will be simulation objects
 max_queue_size = 50
 jobs_list = dict()
-queue = ap.preload_status_overview(ideal_history_cfg,max_size=max_queue_size)
+queue = ap.preload_status_overview(ideal_history_cfg,max_size=max_queue_size,job_state_db=get_job_state_db(log_parser['Paths']))
 
 # register database 
 db = SQLAlchemy(app)
@@ -225,7 +226,7 @@ def stop_job(jobId):
             # kill job control daemon
             try:
                 daemons = cndr.get_job_daemons('job_control_daemon.py')
-                cndr.kill_process(daemons[simulation.workdir])
+                cndr.kill_process(daemons[simulation.workdir],script='job_control_daemon.py')
             except:
                 print('Looks like daemon is not running, not possible to kill it')
             
@@ -236,7 +237,7 @@ def stop_job(jobId):
             # kill job control daemon
             try:
                 daemons = cndr.get_job_daemons('job_control_daemon.py')
-                cndr.kill_process(daemons[simulation.workdir])
+                cndr.kill_process(daemons[simulation.workdir],script='job_control_daemon.py')
             except:
                 print('Looks like daemon is not running, not possible to kill it')
         
@@ -503,6 +503,7 @@ def init_log_daemon_cfg(cfg):
 
     log_cfg['Paths']['global logfile'] =  os.path.join(log_dir, 'IDEAL_general_logs.log')  
     log_cfg['Paths']['cfg_log_file'] = os.path.join(log_dir, 'ideal_history.cfg')  
+    log_cfg['Paths']['job_state_db'] = os.path.join(log_dir, 'ideal_history.sqlite')
     log_cfg['Paths']['log_daemon_logs'] = os.path.join(log_dir, 'log_daemon.log')
     log_cfg['Paths']['completed_dir'] = os.path.join(work_dir, 'old', 'completed')
     log_cfg['Paths']['failed_dir'] = os.path.join(work_dir, 'old', 'failed')
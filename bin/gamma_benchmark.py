@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Validation and benchmark of the gamma index backends on the gamma test corpus
+(see utils.gamma_corpus): small synthetic reference/target dose pairs with known
+pass rates, stored in-repo per corpus version.
+
+Each backend is run on every corpus case with criteria that it supports (only
+the "extended" engine supports local normalization, a maximum search radius
+and a gamma cap). For each case the pass rate is checked against the known
+pass rate and the computation time is recorded. The results are written to a
+JSON file; with one or more "compare" files the times are compared with those
+of earlier runs on the same corpus version.
+
+The exit code is 1 if any backend gives a wrong pass rate, or (with
+--max-slowdown) if the total time of any backend got slower than the given factor.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import logging
+from datetime import datetime
+import numpy as np
+import itk
+from utils import gamma_corpus
+
+logger = logging.getLogger("gamma_benchmark")
+
+def total_seconds(results):
+    """
+    Total time per backend, over the cases that were run.
+    """
+    totals = dict()
+    for r in results:
+        totals[r["backend"]] = totals.get(r["backend"],0.)+r["seconds"]
+    return totals
+
+def compare(results,reference):
+    """
+    Ratio of the times of the backends and cases in `results` and in `reference`, for those that are in
+    both, and of the total time per backend over these cases. Results of another corpus version are not compared.
+    """
+    if results["corpus version"] != reference.get("corpus version"):
+        return dict()
+    ref = dict([((r["backend"],r["case"]),r["seconds"]) for r in reference.get("results",[])])
+    common = [r for r in results["results"] if (r["backend"],r["case"]) in ref]
+    ratios = dict()
+    totals = total_seconds(common)
+    ref_totals = total_seconds([dict(backend=r["backend"],seconds=ref[(r["backend"],r["case"])]) for r in common])
+    for backend,seconds in totals.items():
+        ratios[backend] = seconds/ref_totals[backend] if ref_totals[backend] > 0 else float("inf")
+    return ratios
+
+def print_results(results,references):
+    print("{:10s} {:32s} {:>9s} {:>9s} {:>10s}".format("backend","case","pass rate","expected","time [s]"))
+    for r in results["results"]:
+        print("{:10s} {:32s} {:9.4f} {:9.4f} {:10.4f}{}".format(r["backend"],r["case"],r["pass_rate"],r["expected_pass_rate"],
+                                                                r["seconds"],"" if r["ok"] else "  WRONG PASS RATE"))
+    labels = [os.path.basename(path) for path in references]
+    print("\n{:10s} {:>10s}".format("backend","total [s]")+"".join([" {:>22s}".format(label[-22:]) for label in labels]))
+    for backend,seconds in results["totals"].items():
+        line = "{:10s} {:10.4f}".format(backend,seconds)
+        for path in references:
+            ratio = results["comparisons"][path].get(backend)
+            line += " {:>22s}".format("-" if ratio is None else "x{:.2f}".format(ratio))
+        print(line)
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-b","--backends",nargs="+",default=gamma_corpus.BACKENDS,choices=gamma_corpus.BACKENDS,
+            help="gamma backends to run (default: all)")
+    parser.add_argument("--cases",nargs="+",default=[],
+            help="names of the corpus cases to run (default: all)")
+    parser.add_argument("-V","--corpus-version",type=int,default=gamma_corpus.CORPUS_VERSION,
+            help="corpus version (default: {})".format(gamma_corpus.CORPUS_VERSION))
+    parser.add_argument("-r","--repeat",type=int,default=3,
+            help="number of runs per backend and case, the shortest time is reported (default: 3)")
+    parser.add_argument("-o","--output",default="",
+            help="JSON file to write the results to (default: gamma_benchmark_<date>_<time>.json in the current directory)")
+    parser.add_argument("-c","--compare",default=[],action='append',
+            help="JSON file with the results of an earlier benchmark run, to compare with (can be given several times)")
+    parser.add_argument("-m","--max-slowdown",type=float,default=0.,
+            help="exit with an error if the total time of a backend is more than this factor slower than in the first compare file")
+    parser.add_argument("--generate",default=False,action='store_true',
+            help="(re)generate the corpus of the current version and exit")
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    if args.generate:
+        directory = gamma_corpus.corpus_directory()
+        manifest = gamma_corpus.write_corpus(directory)
+        print("wrote {} cases of gamma corpus version {} to {}".format(len(manifest["cases"]),manifest["version"],directory))
+        sys.exit(0)
+    references = dict()
+    for path in args.compare:
+        with open(path,"r") as fp:
+            references[path] = json.load(fp)
+    directory = gamma_corpus.corpus_directory(args.corpus_version)
+    t0 = time.perf_counter()
+    runs = gamma_corpus.run_corpus(args.backends,directory,repeat=args.repeat,cases=args.cases)
+    results = {"benchmark":"IDEAL gamma index","format version":1,
+               "corpus version":args.corpus_version,
+               "date":datetime.now().isoformat(timespec="seconds"),
+               "host":platform.node(),"platform":platform.platform(),
+               "versions":{"python":platform.python_version(),"numpy":np.__version__,"itk":itk.Version.GetITKVersion()},
+               "parameters":dict([(k,v) for k,v in vars(args).items() if k not in ["output","compare","max_slowdown","generate"]]),
+               "wall [s]":time.perf_counter()-t0,
+               "results":runs,
+               "totals":total_seconds(runs)}
+    results["comparisons"] = dict([(path,compare(results,ref)) for path,ref in references.items()])
+    output = args.output if args.output else "gamma_benchmark_{}.json".format(time.strftime("%Y%m%d_%H%M%S"))
+    with open(output,"w") as fp:
+        json.dump(results,fp,indent=2)
+    print_results(results,args.compare)
+    print("results written to {}".format(output))
+    wrong = ["{} on {}".format(r["backend"],r["case"]) for r in runs if not r["ok"]]
+    if wrong:
+        print("WRONG PASS RATE: {}".format(", ".join(wrong)))
+        sys.exit(1)
+    if args.max_slowdown > 0 and args.compare:
+        slow = [backend for backend,ratio in results["comparisons"][args.compare[0]].items() if ratio > args.max_slowdown]
+        if slow:
+            print("SLOWER than x{} compared to {}: {}".format(args.max_slowdown,args.compare[0],", ".join(slow)))
+            sys.exit(1)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -55,6 +55,8 @@ class ideal_simulation():
         self.cfg = None
         # Simulation statistics
         self.stats = list()
+        # Dose accumulators (one per beam), kept between accuracy checks
+        self.dose_accumulators = dict()
   
     def get_plan_roi_names(self):
          return self.current_details.roinames
@@ -237,7 +239,7 @@ class ideal_simulation():
                 print(f"looks like simulation for {dosemhd} did not start yet (zero dose files)")
                 continue
 
-            dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files)
+            dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files,self.dose_accumulators,owner="ideal_module")
             current_dict[beamname]['n_particles']=dc.tot_n_primaries
             current_dict[beamname]['average uncertainty']=dc.mean_unc_pct
             current_dict['simulation time in minutes'] = sim_time_minutes
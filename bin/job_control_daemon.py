@@ -25,6 +25,7 @@ from filelock import Timeout, SoftFileLock
 from impl.system_configuration import get_sysconfig, system_configuration
 from impl.version import version_info
 from utils.resample_dose import mass_weighted_resampling
+from utils import instrumentation
 import impl.dual_logging as dl
 
 def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
@@ -78,6 +79,7 @@ class dose_monitoring_config:
             self.apply_mask_mhd = apply_mask_mhd
             self.mask_mhd = os.path.join(self.workdir,mask_mhd) if bool(mask_mhd) else None
             self.mass_mhd = os.path.join(self.workdir,mass_mhd) if bool(mass_mhd) else None
+            self.nresamplers = min(cparser.getint("DEFAULT","number of resampling threads",fallback=1),os.cpu_count() or 1)
             self.out_dose_nxyz = np.array([float(w) for w in cparser.defaults().get("dose grid resolution").split()])
             self.sim_dose_nxyz = np.array([float(w) for w in cparser.defaults().get("sim dose resolution").split()])
             self.dose_mhd_list=list()
@@ -155,7 +157,15 @@ class dose_collector:
     @property
     def tot_n_primaries(self):
         return int(self.weightsum)
-    def add(self,dose_file):
+    def read(self,dose_file,skip_nprimaries=None):
+        """
+        Read the number of primaries and the dose (resampled to the output
+        dose grid, if needed) from a dose file, while holding its lock file.
+        Returns a tuple (dose,n_primaries), or `None` if the lock could not
+        be acquired.  The dose is `None` if the number of primaries is too
+        low, or if it is equal to `skip_nprimaries` (then the dose was not
+        changed since the last time it was read).
+        """
         lockfile = dose_file+".lock"
         dose = None
         n_primaries=0
@@ -171,13 +181,15 @@ class dose_collector:
                 n_primaries = self.get_nprimaries(dose_file)
                 if n_primaries<1:
                     logger.warn(f"dose file seems to be based on too few primaries ({n_primaries})")
+                elif n_primaries == skip_nprimaries:
+                    logger.debug(f"number of primaries for {dose_file} did not change since the last update, not reading the dose")
                 elif bool(self.mass) and bool(self.mask):
                     tick = time.time()
                     simdose=itk.imread(dose_file)
                     logger.debug("Time to read dose file: "+str(time.time()-tick)+"s")
                     logger.debug("resampling dose with size {} using mass file of size {} to target size {}".format(itk.size(simdose),itk.size(self.mass),itk.size(self.mask)))
                     tick = time.time()
-                    dose = mass_weighted_resampling(simdose,self.mass,self.mask)
+                    dose = mass_weighted_resampling(simdose,self.mass,self.mask,nthreads=self.cfg.nresamplers)
                     logger.debug("Time for resampling: "+str(time.time()-tick)+"s")
                     del simdose
                 else:
@@ -187,13 +199,19 @@ class dose_collector:
                     logger.debug("read dose with size {}".format(itk.size(dose)))
                 t2=datetime.now()
                 logger.info("acquiring dose data {} file took {} seconds".format(os.path.basename(dose_file),(t2-t1).total_seconds()))
-                if self.wmin>n_primaries:
-                    self.wmin = n_primaries
-                if self.wmax<n_primaries:
-                    self.wmax = n_primaries
         except Timeout:
             logger.warn("failed to acquire lock for {} for 3 seconds, giving up for now".format(dose_file))
+            return None
+        return dose,n_primaries
+    def add(self,dose_file):
+        result = self.read(dose_file)
+        if result is None:
             return
+        dose,n_primaries = result
+        if self.wmin>n_primaries:
+            self.wmin = n_primaries
+        if self.wmax<n_primaries:
+            self.wmax = n_primaries
         if not bool(dose):
             logger.warn("skipping {}".format(dose_file))
             return
@@ -208,19 +226,28 @@ class dose_collector:
         self.weightsum += n_primaries
         self.n += 1
         logger.debug("Time increment variables: "+str(time.time()-tick)+"s")
+    def update(self,dose_files):
+        """
+        Add the dose from all given dose files.
+        """
+        for dose_file in dose_files:
+            self.add(dose_file)
     def estimate_uncertainty(self):
         if self.n < 2:
             return
+        # The sums themselves are not masked, so that more doses can be added to them later.
+        dosesum = self.dosesum
+        dose2sum = self.dose2sum
         if self.mask:
             amask = itk.array_view_from_image(self.mask)
             logger.info("applying mask with {} voxels enabled out of {}".format(np.sum(amask>0),np.prod(amask.shape)))
-            self.dosesum *= amask
-            self.dose2sum *= amask
-        logger.info("dose sum is nonzero in {} voxels".format(np.sum(self.dosesum>0)))
-        logger.info("dose**2 sum is nonzero in {} voxels".format(np.sum(self.dose2sum>0)))
+            dosesum = dosesum * amask
+            dose2sum = dose2sum * amask
+        logger.info("dose sum is nonzero in {} voxels".format(np.sum(dosesum>0)))
+        logger.info("dose**2 sum is nonzero in {} voxels".format(np.sum(dose2sum>0)))
         logger.info("sum of weights is {}, wmin={}, wmax={}".format(self.weightsum,self.wmin,self.wmax))
-        amean = self.dosesum/self.weightsum
-        amean2 = self.dose2sum/self.weightsum
+        amean = dosesum/self.weightsum
+        amean2 = dose2sum/self.weightsum
         avariance = amean2 - amean**2
         m0 = avariance<0
         logger.info("negative variance in {} voxels".format(np.sum(m0)))
@@ -248,10 +275,212 @@ class dose_collector:
         converged = self.mean_unc_pct < self.cfg.unc_goal_pct
         logger.info("'mean uncertainty' = {0:.2f} pct, goal = {1} pct, => {2}".format(self.mean_unc_pct,self.cfg.unc_goal_pct,"CONVERGED" if converged else "CONTINUE"))
 
-def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
+class dose_accumulator(dose_collector):
+    """
+    Incremental version of the dose collector, meant to be kept alive during
+    all polls of the job control daemon. Each subjob regularly overwrites its
+    dose file with the cumulative dose of that subjob. The accumulator
+    remembers which version (modification time, size, number of primaries)
+    of each dose file it has already added to the sums, and on each update
+    it only reads the dose files that changed: the previous contribution of
+    such a file is subtracted from the sums and the new one is added.
+
+    The sums, the index of the added dose files and the latest contribution
+    of each dose file are saved in a checkpoint directory of the `owner` of
+    the accumulator (the job control daemon, or the IDEAL module), so that a
+    restarted owner can continue where the previous one stopped. The
+    contributions are only kept on disk; they are memory mapped when they
+    need to be subtracted.
+    """
+    def __init__(self,cfg,dosemhd,owner="job_control_daemon"):
+        super().__init__(cfg)
+        self.checkpoint_dir = os.path.join(cfg.workdir,"tmp","dose_accumulator",owner,dosemhd.replace(".mhd",""))
+        self.files = dict()
+        self.nslots = 0
+        self.generation = 0
+        self.obsolete = list()
+        self.load_checkpoint()
+    def reset(self):
+        super().reset()
+        self.files = dict()
+        self.nslots = 0
+        self.obsolete = list()
+    def _version(self,dose_file):
+        st = os.stat(dose_file)
+        return (st.st_mtime_ns,st.st_size)
+    def _contribution_path(self,record):
+        return os.path.join(self.checkpoint_dir,"contribution_{}_{}.npy".format(record['slot'],record['nprimaries']))
+    def _fold(self,adose,n_primaries,sign):
+        self.dosesum += sign*adose # n_primaries * (adose / n_primaries)
+        self.dose2sum += sign*(adose**2 / n_primaries) # n_primaries * (adose / n_primaries)**2
+        self.weightsum += sign*n_primaries
+        self.n += sign
+    def _remove(self,dose_file):
+        record = self.files.pop(dose_file)
+        path = self._contribution_path(record)
+        self._fold(np.load(path,mmap_mode='r'),record['nprimaries'],-1)
+        # the contribution is deleted after the next checkpoint no longer refers to it
+        self.obsolete.append(path)
+        logger.debug(f"removed contribution of {dose_file} with {record['nprimaries']} primaries")
+        return record['slot']
+    def update(self,dose_files):
+        """
+        Synchronize the sums with the given list of dose files: files that
+        are no longer in the list are removed from the sums, new and changed
+        files are (re-)added. Files that could not be read (lock time out)
+        keep their previous contribution.
+        Returns the number of dose files that were (re-)read.
+        """
+        tick = time.time()
+        nread = 0
+        changed = False
+        current = set(dose_files)
+        for dose_file in [f for f in self.files if f not in current]:
+            self._remove(dose_file)
+            changed = True
+        for dose_file in dose_files:
+            version = self._version(dose_file)
+            record = self.files.get(dose_file,None)
+            if record is not None and record['version'] == version:
+                continue
+            result = self.read(dose_file,skip_nprimaries=None if record is None else record['nprimaries'])
+            if result is None:
+                continue
+            dose,n_primaries = result
+            if record is not None and record['nprimaries'] == n_primaries:
+                record['version'] = version
+                changed = True
+                continue
+            slot = None
+            if record is not None:
+                slot = self._remove(dose_file)
+                changed = True
+            if dose is None:
+                logger.warn("skipping {}".format(dose_file))
+                continue
+            adose = itk.array_from_image(dose)
+            if adose.shape != self.dosesum.shape:
+                raise RuntimeError("PROGRAMMING ERROR: dose shape {} differs from expected shape {}".format(adose.shape,self.dosesum.shape))
+            if slot is None:
+                slot = self.nslots
+                self.nslots += 1
+            record = dict(version=version,nprimaries=n_primaries,slot=slot)
+            os.makedirs(self.checkpoint_dir,exist_ok=True)
+            np.save(self._contribution_path(record),adose)
+            self._fold(adose,n_primaries,+1)
+            self.files[dose_file] = record
+            nread += 1
+            changed = True
+        nprimaries = [record['nprimaries'] for record in self.files.values()]
+        self.wmin = min(nprimaries,default=np.inf)
+        self.wmax = max(nprimaries,default=-np.inf)
+        self.mean_unc_pct = np.inf
+        if changed:
+            self.save_checkpoint()
+        logger.debug(f"Time to update dose accumulator: {time.time()-tick}s, read {nread} out of {len(dose_files)} dose files")
+        return nread
+    def save_checkpoint(self):
+        """
+        Write the sums and the index of added dose files to the checkpoint directory.
+        Both are first written to temporary files and then renamed, and they are
+        labeled with the same "generation" number, to detect incomplete checkpoints.
+        Then the contributions that are no longer in the index are deleted.
+        """
+        self.generation += 1
+        os.makedirs(self.checkpoint_dir,exist_ok=True)
+        sums = os.path.join(self.checkpoint_dir,"sums.npz")
+        with open(sums+".tmp","wb") as fp:
+            np.savez(fp,dosesum=self.dosesum,dose2sum=self.dose2sum,generation=self.generation)
+        os.replace(sums+".tmp",sums)
+        parser = configparser.RawConfigParser()
+        parser.optionxform = lambda option : option
+        parser['DEFAULT']['generation'] = str(self.generation)
+        parser['DEFAULT']['slots'] = str(self.nslots)
+        for i,(dose_file,record) in enumerate(self.files.items()):
+            parser[str(i)] = {'dose file':dose_file,
+                              'mtime ns':str(record['version'][0]),
+                              'size':str(record['version'][1]),
+                              'nprimaries':str(record['nprimaries']),
+                              'slot':str(record['slot'])}
+        index = os.path.join(self.checkpoint_dir,"index.cfg")
+        with open(index+".tmp","w") as fp:
+            parser.write(fp)
+        os.replace(index+".tmp",index)
+        for path in self.obsolete:
+            if os.path.exists(path):
+                os.remove(path)
+        self.obsolete = list()
+    def load_checkpoint(self):
+        """
+        Restore the sums and the index of added dose files from the checkpoint directory, if it
+        exists and is complete and consistent. Otherwise start with empty sums.
+        Contributions that are not in the index (left by an interrupted update) are deleted.
+        """
+        index = os.path.join(self.checkpoint_dir,"index.cfg")
+        sums = os.path.join(self.checkpoint_dir,"sums.npz")
+        if not (os.path.exists(index) and os.path.exists(sums)):
+            return False
+        try:
+            parser = configparser.RawConfigParser()
+            parser.optionxform = lambda option : option
+            with open(index,"r") as fp:
+                parser.read_file(fp)
+            generation = int(parser['DEFAULT']['generation'])
+            nslots = int(parser['DEFAULT']['slots'])
+            with np.load(sums) as npz:
+                if int(npz['generation']) != generation:
+                    raise RuntimeError(f"generation {int(npz['generation'])} of the sums differs from generation {generation} of the index")
+                dosesum = npz['dosesum']
+                dose2sum = npz['dose2sum']
+            if dosesum.shape != self.dosesum.shape:
+                raise RuntimeError(f"dose shape {dosesum.shape} differs from expected shape {self.dosesum.shape}")
+            files = dict()
+            for i in parser.sections():
+                sec = parser[i]
+                record = dict(version=(sec.getint('mtime ns'),sec.getint('size')),
+                              nprimaries=sec.getint('nprimaries'),
+                              slot=sec.getint('slot'))
+                if not os.path.exists(self._contribution_path(record)):
+                    raise RuntimeError(f"missing contribution for {sec['dose file']}")
+                files[sec['dose file']] = record
+        except Exception as e:
+            logger.warn(f"ignoring dose accumulator checkpoint in {self.checkpoint_dir}: {e}")
+            self.reset()
+            return False
+        self.dosesum = dosesum
+        self.dose2sum = dose2sum
+        self.files = files
+        self.nslots = nslots
+        self.generation = generation
+        nprimaries = [record['nprimaries'] for record in files.values()]
+        self.weightsum = sum(nprimaries)
+        self.n = len(files)
+        self.wmin = min(nprimaries,default=np.inf)
+        self.wmax = max(nprimaries,default=-np.inf)
+        known = set([self._contribution_path(record) for record in files.values()])
+        for npy in glob(os.path.join(self.checkpoint_dir,"contribution_*.npy")):
+            if npy not in known:
+                os.remove(npy)
+        logger.info(f"restored dose accumulator checkpoint with {self.n} dose files and {self.weightsum} primaries")
+        return True
+
+def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files,accumulators=None,owner="job_control_daemon"):
+    """
+    Sum the doses from the given dose files and estimate the statistical uncertainty.
+    If a dictionary `accumulators` is given, then the dose accumulator for `dosemhd`
+    is taken from it (or created and stored in it), so that only the dose files that
+    changed since the previous call need to be read. The `owner` names the checkpoint
+    directory of a new accumulator.
+    """
     tick = time.time()
-    dc=dose_collector(cfg)
+    if accumulators is None:
+        dc=dose_collector(cfg)
+    elif dosemhd in accumulators:
+        dc=accumulators[dosemhd]
+    else:
+        dc=accumulators[dosemhd]=dose_accumulator(cfg,dosemhd,owner)
     logger.debug("Time to create dose collector: "+str(time.time()-tick)+ "s")
+    summable=list()
     ndosefiles=0
     nfinished=0
     ncrashed=0
@@ -266,7 +495,7 @@ def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
                     if 0 == ret:
                         nfinished+=1
                         final_dose_file = os.path.join(cfg.workdir,outputdir,dosemhd)
-                        dc.add(final_dose_file)
+                        summable.append(final_dose_file)
                         logger.debug(f"adding {final_dose_file} to list of summable dose files, because Gate terminated successfully.")
                     else:
                         ncrashed+=1
@@ -274,15 +503,15 @@ def check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files):
             except Exception as e:
                 logger.error(f"gate exit file {retfile} exists but a problem arose when trying to read the return value from it: {e}")
         else:
-            tick1 = time.time()
-            dc.add(dose_file)
-            logger.debug("Time to add single dose file: "+str(time.time()-tick1)+ "s")
-            
+            summable.append(dose_file)
+    with instrumentation.span("add dose files",nfiles=len(summable)) as s:
+        dc.update(summable)
+    logger.debug("Time to add dose files: "+str(s.wall)+ "s")
     logger.info(f"found {ndosefiles} dose files '{dosemhd}'")
     logger.info(f"using {dc.n} for summed dose, {nfinished} jobs have finished successfully, {ncrashed} jobs have crashed.")
-    tick2 = time.time()
-    dc.estimate_uncertainty()
-    logger.debug("Time to check accuracy: " + str(time.time()-tick2) + "s")
+    with instrumentation.span("estimate uncertainty") as s:
+        dc.estimate_uncertainty()
+    logger.debug("Time to check accuracy: " + str(s.wall) + "s")
     logger.debug("Tot time for accuracy: " + str(time.time()-tick) + "s")
             
     return dc
@@ -302,7 +531,9 @@ def periodically_check_statistical_accuracy(cfg):
     logger = dl.create_logger('job_daemon',logfilename)
     #logger = logging.getLogger()
     cfg.polling_interval_seconds = syscfg['stop on script actor time interval [s]'] if cfg.polling_interval_seconds<0 else cfg.polling_interval_seconds
+    instrumentation.start_job_metrics(cfg.workdir,"DAEMON")
     t0 = None
+    accumulators = dict()
     save_curdir=os.path.realpath(os.curdir)
     try:
         #config_logging(cfg)
@@ -326,7 +557,8 @@ def periodically_check_statistical_accuracy(cfg):
                     logger.info(f"starting the clock at t0={t0}")
                     
                 status = f"RUNNING GATE FOR BEAM={beamname}"   
-                dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files)
+                with instrumentation.span("check accuracy",beam=beamname,nfiles=len(dose_files)):
+                    dc = check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files,accumulators)
         
                 sim_time_minutes = (datetime.now()-t0).total_seconds()/60.
                 tmsg = f"Tsim = {sim_time_minutes} minutes (timeout = {cfg.time_out_minutes} minutes)"
@@ -374,6 +606,112 @@ def periodically_check_statistical_accuracy(cfg):
         logger.error(f"job control daemon failed: {e}")
     os.chdir(save_curdir)
 
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+import shutil
+
+class _test_cfg:
+    def __init__(self,workdir,nxyz):
+        self.workdir = workdir
+        self.out_dose_nxyz = np.array(nxyz)
+        self.sim_dose_nxyz = np.array(nxyz)
+        self.mask_mhd = None
+        self.mass_mhd = None
+        self.nresamplers = 1
+        self.unc_goal_pct = 0
+
+class Test_DoseAccumulator(unittest.TestCase):
+    def setUp(self):
+        try:
+            system_configuration.getInstance()
+        except RuntimeError:
+            system_configuration({"n top voxels for mean dose max":5,"dose threshold as fraction in percent of mean dose max":50.})
+        self.tmpdir = tempfile.mkdtemp()
+        self.cfg = _test_cfg(self.tmpdir,[4,3,2])
+        self.dosemhd = "idc-PLAN-beam-Dose.mhd"
+        self.mtime = 1000000000*10**9
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def _write(self,i,nprimaries):
+        """
+        Write the dose of subjob `i` and its number of primaries, return the dose file name and the dose.
+        """
+        outputdir = os.path.join(self.tmpdir,"tmp",f"output.0.{i}")
+        os.makedirs(outputdir,exist_ok=True)
+        dose_file = os.path.join(outputdir,self.dosemhd)
+        adose = np.random.uniform(0.,1.,(2,3,4)).astype(np.float32)*nprimaries
+        itk.imwrite(itk.image_from_array(adose),dose_file)
+        with open(os.path.join(outputdir,"statActor-PLAN-beam.txt"),"w") as fp:
+            fp.write(f"# NumberOfEvents = {nprimaries}\n")
+        # make sure that each version of the dose file has a different modification time
+        self.mtime += 10**9
+        os.utime(dose_file,ns=(self.mtime,self.mtime))
+        return dose_file,adose.astype(float)
+    def _check(self,dc,doses):
+        self.assertEqual(dc.n,len(doses))
+        self.assertEqual(dc.weightsum,sum([n for adose,n in doses]))
+        self.assertTrue(np.allclose(dc.dosesum,sum([adose for adose,n in doses])))
+        self.assertTrue(np.allclose(dc.dose2sum,sum([adose**2/n for adose,n in doses])))
+    def test_add_replace_remove(self):
+        f1,a1 = self._write(1,100)
+        f2,a2 = self._write(2,200)
+        dc = dose_accumulator(self.cfg,self.dosemhd)
+        self.assertEqual(dc.update([f1,f2]),2)
+        self._check(dc,[(a1,100),(a2,200)])
+        self.assertEqual(dc.update([f1,f2]),0)
+        # replace: the old contribution of the changed file is subtracted
+        f1,b1 = self._write(1,300)
+        self.assertEqual(dc.update([f1,f2]),1)
+        self._check(dc,[(b1,300),(a2,200)])
+        self.assertEqual((dc.wmin,dc.wmax),(200,300))
+        # remove
+        self.assertEqual(dc.update([f2]),0)
+        self._check(dc,[(a2,200)])
+        dc.estimate_uncertainty()
+    def test_checkpoint(self):
+        f1,a1 = self._write(1,100)
+        f2,a2 = self._write(2,200)
+        dc = dose_accumulator(self.cfg,self.dosemhd)
+        dc.update([f1,f2])
+        self.assertEqual(sorted(os.listdir(dc.checkpoint_dir)),["contribution_0_100.npy","contribution_1_200.npy","index.cfg","sums.npz"])
+        # restore: unchanged files are not read again
+        dc = dose_accumulator(self.cfg,self.dosemhd)
+        self._check(dc,[(a1,100),(a2,200)])
+        self.assertEqual(dc.update([f1,f2]),0)
+        self._check(dc,[(a1,100),(a2,200)])
+        # another owner has its own checkpoint
+        other = dose_accumulator(self.cfg,self.dosemhd,owner="ideal_module")
+        self.assertNotEqual(other.checkpoint_dir,dc.checkpoint_dir)
+        self.assertEqual(other.n,0)
+        self.assertEqual(other.update([f1]),1)
+        # a changed file from the checkpoint: only that file and new files are read
+        f3,a3 = self._write(3,300)
+        f2,b2 = self._write(2,400)
+        dc = dose_accumulator(self.cfg,self.dosemhd)
+        self.assertEqual(dc.update([f1,f2,f3]),2)
+        self._check(dc,[(a1,100),(b2,400),(a3,300)])
+        self.assertEqual(sorted(os.listdir(dc.checkpoint_dir)),["contribution_0_100.npy","contribution_1_400.npy","contribution_2_300.npy","index.cfg","sums.npz"])
+        # a removed file from the checkpoint is subtracted
+        dc = dose_accumulator(self.cfg,self.dosemhd)
+        self.assertEqual(dc.update([f1,f2]),0)
+        self._check(dc,[(a1,100),(b2,400)])
+        # contributions of an interrupted update are cleaned up
+        np.save(os.path.join(dc.checkpoint_dir,"contribution_7_700.npy"),a1)
+        dc = dose_accumulator(self.cfg,self.dosemhd)
+        self._check(dc,[(a1,100),(b2,400)])
+        self.assertEqual(sorted(os.listdir(dc.checkpoint_dir)),["contribution_0_100.npy","contribution_1_400.npy","index.cfg","sums.npz"])
+        # incomplete checkpoint
+        with open(os.path.join(dc.checkpoint_dir,"index.cfg"),"w") as fp:
+            fp.write("[DEFAULT]\ngeneration = 1\n")
+        dc = dose_accumulator(self.cfg,self.dosemhd)
+        self.assertEqual(dc.n,0)
+        self.assertEqual(len(dc.files),0)
+
+
 if __name__ == '__main__':
 
     # TODO: make it possible to create this config file without command line arguments
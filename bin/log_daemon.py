@@ -1,5 +1,6 @@
 import daemon
 import os
+import sys
 import time
 import logging
 import logging.handlers
@@ -7,9 +8,11 @@ import configparser
 import re
 #from impl.dual_logging import get_last_log_ID
 from utils.condor_utils import *
+from utils.condor_query import condor_queue, process_table, is_local_job
+from utils.job_state_store import job_state_store, get_job_state_db
+from utils.ideal_log_reader import ideal_log_reader
 import utils.api_utils as ap
 import requests
-from filelock import Timeout, SoftFileLock
 from api import Server, app
 
 
@@ -29,6 +32,10 @@ class log_manager:
         self.logfile = cfg['Paths']['Global logfile']
         # global control file for cleaning up and debug purposes
         self.cfg_log_file = cfg['Paths']['Cfg_log_file']
+        # job states; the cfg log file is exported from this database
+        self.store = job_state_store(get_job_state_db(cfg['Paths']))
+        if self.store.count() == 0 and os.path.exists(self.cfg_log_file):
+            self.store.import_cfg(self.cfg_log_file)
         # log daemon logs
         self.log_daemon_logs = cfg['Paths']['Log_daemon_logs']
         # Directory for historical jobs (completed and failed)
@@ -43,8 +50,13 @@ class log_manager:
         
         self.parser = None
         self.log = self.get_log_file(self.log_daemon_logs,'%(asctime)s - %(levelname)s - %(message)s')
+        # incremental reader of the global log file, keeps its byte offset next to the cfg log file
+        self.ideal_log = ideal_log_reader(self.logfile,self.cfg_log_file + '.state')
         self.api_cfg = ap.get_api_cfg(cfg['Paths']['api_cfg'])
         self.syscfg = read_cfg(cfg['Paths']['syscfg'])
+        # condor queue and process table, queried at most once per cycle
+        self.condor_queue = condor_queue()
+        self.processes = process_table()
         
     def get_log_file(self,log_daemon_logs,formatt):
         formatter = logging.Formatter(formatt)
@@ -65,37 +77,29 @@ class log_manager:
     
     # read files is called outside the class to allow easier unittesting    
     def read_files(self): 
-        # Read log_daemon file
-        self.parser = configparser.ConfigParser()
-        try:
-            self.parser.read(self.cfg_log_file)
-        except:
-            raise ImportError("Could not read global cfg file")
+        # New cycle: forget the condor queue and process list of the previous cycle
+        self.condor_queue.refresh()
+        self.processes.refresh()
+        # Load the jobs that are not archived yet from the job state store
+        self.parser = self.store.load_sections(not_status='ARCHIVED')
+        self.loaded = dict([(i,dict(self.parser[i])) for i in self.parser.sections()])
             
-        # Find last ID in log_daemon file
-        if self.parser.sections():
-            last_ID_cfg = int(self.parser.sections()[-1])
-        else: last_ID_cfg = 0
+        # Find last ID in the job state store
+        last_ID_cfg = self.store.last_id()
         
-        # Read IDEAL log file
-        ideal_log_lines = self.read_IDEAL_log(self.logfile)
-        
-        # Find last ID in IDEAL log file
-        ID_lines = [l for l in ideal_log_lines if "IdealID:" in l.split(" ")]
-        if len(ID_lines)>0:
-            last_ID_log = int(ID_lines[-1].split(" ")[1])
-        else: last_ID_log = 0
-        #last_ID_log = int(get_last_log_ID())
+        # Read only the lines that were added to the IDEAL log file since the last cycle
+        records = self.ideal_log.read_new_records()
+        self.log.debug("Read {} new lines from IDEAL log file, last ID is {}".format(self.ideal_log.nlines,self.ideal_log.last_id))
+        new_records = [r for r in records if r['IdealID'] > last_ID_cfg]
 
         # Get daemons. Read daemons before updating config!
         self.log.info("Get job daemons")
-        self.daemons = get_job_daemons("job_control_daemon.py")
+        self.daemons = self.processes.job_daemons("job_control_daemon.py")
             
         # Create new sections for the newly added IDs
-        if last_ID_log > last_ID_cfg:
-            id_range = range(last_ID_cfg+1,last_ID_log+1)
+        if new_records:
             self.log.info("New simulations started. Adding corresponding sections")
-            self.add_id_sections(id_range, ideal_log_lines)
+            self.add_id_sections(new_records)
             # Check for free running daemons
             # NOTE: done here to avoid checking on not up to date cfg file
             self.log.info("Find and kill daemons for failed or untracked jobs")
@@ -105,10 +109,14 @@ class log_manager:
     def update_log_file(self):
             # Wake up to work 
         # Get job status
-            self.log.info("Reading condor queue")
-            self.all_jobs = get_jobs_status()
-            
             parser = self.parser
+            # jobs of the local scheduler backend are not in the condor queue
+            if any([not is_local_job(parser[i]['Condor id']) for i in parser.sections()]):
+                self.log.info("Reading condor queue")
+                self.all_jobs = self.condor_queue.status()
+            else:
+                self.all_jobs = dict()
+            
             for i in parser.sections():
                 if parser[i]['Status'] == 'ARCHIVED':
                     continue
@@ -159,10 +167,23 @@ class log_manager:
             self.archive_logs()
             
     def write_config_file(self):
-            # Dump the new configuration file
-            with open(self.cfg_log_file, 'w') as configfile:
-                    self.parser.write(configfile)
+            # Store the new and changed jobs, one row per job
+            saved = self.store.save_sections(self.parser,self.loaded)
+            self.log.debug("Updated {} jobs".format(len(saved)))
+            # Export the configuration file for compatibility only when jobs were archived,
+            # the other changes are only in the job state store
+            archived = [i for i in saved if self.parser[i]['Status'] == 'ARCHIVED']
+            if archived:
+                self.log.info("Archived {} jobs".format(len(archived)))
+                self.export_history()
+            # The new log records are saved, only now move on in the IDEAL log file
+            self.ideal_log.commit()
             
+    def export_history(self):
+        # Write all jobs from the job state store to the history cfg file
+        self.log.debug("Exporting {}".format(self.cfg_log_file))
+        self.store.export_cfg(self.cfg_log_file)
+
     def update_ideal_status(self,pars_sec):
         cfg = configparser.ConfigParser()
         cfg.read(pars_sec['Simulation settings'])
@@ -171,7 +192,9 @@ class log_manager:
     
 
     def update_job_status(self,pars_sec, all_jobs):
-        if pars_sec['Condor id'] in all_jobs:  # job is in condor_q (running, idle, done, hold)
+        if is_local_job(pars_sec['Condor id']):
+            self.update_local_job_status(pars_sec)
+        elif pars_sec['Condor id'] in all_jobs:  # job is in condor_q (running, idle, done, hold)
             job_id = pars_sec['Condor id']
             pars_sec['Condor status'] = str(all_jobs[job_id])
             self.log.info("Job in condor queue")
@@ -179,7 +202,7 @@ class log_manager:
                 if 'On hold since' not in pars_sec:
                     self.log.debug("Job was put on hold")
                     pars_sec['On hold since'] = time.strftime("%Y-%m-%d %H:%M:%S")
-                if condor_check_run() == 0: # no problems with condor
+                if self.processes.running("condor_master") and self.processes.running("condor_schedd"): # no problems with condor
                     # try to release
                     self.log.debug("Try to release job")
                     ret = release_condor_job(job_id)
@@ -192,19 +215,32 @@ class log_manager:
                             remove_condor_job(job_id) 
                             pars_sec['Condor status'] = self.job_status_dict['killed_by_log_daem']
         else:            
-            if pars_sec['Status'] == 'FINISHED':
-                self.log.info("Job not in the queue because of successful termination")
-                pars_sec['Condor status'] = self.job_status_dict['done']
-            else:
-                 if pars_sec['Condor status'] != self.job_status_dict['checking']:
-                     pars_sec['Condor status'] = self.job_status_dict['checking']
-                     pars_sec['Last checked'] = time.strftime("%Y-%m-%d %H:%M:%S")
-                     self.log.info("Job not in the queue but not terminated. Wait.")
-                 else:
-                     if get_job_age(pars_sec['Last checked'],"%Y-%m-%d %H:%M:%S") > self.dt: # if the job has been checked for longer then an hour
-                         self.log.info("Job not in the queue and still not terminated after {} s. Marked as failed.".format(self.dt))
-                         pars_sec['Condor status'] = self.job_status_dict['unsuccessfull']
+            self.update_ended_job_status(pars_sec)
         self.log.debug("Condor status: {}".format(pars_sec['Condor status']))
+
+    def update_local_job_status(self,pars_sec):
+        # job run by the local scheduler backend: running as long as its DAG runner process runs
+        local_dags = self.processes.local_dags()
+        if pars_sec['Condor id'] in local_dags:
+            self.log.info("Job running on the local machine")
+            pars_sec['Condor status'] = 'RUNNING LOCALLY with pid {}'.format(local_dags[pars_sec['Condor id']])
+        else:
+            self.update_ended_job_status(pars_sec)
+
+    def update_ended_job_status(self,pars_sec):
+        # the job is not in the queue (anymore)
+        if pars_sec['Status'] == 'FINISHED':
+            self.log.info("Job not in the queue because of successful termination")
+            pars_sec['Condor status'] = self.job_status_dict['done']
+        else:
+             if pars_sec['Condor status'] != self.job_status_dict['checking']:
+                 pars_sec['Condor status'] = self.job_status_dict['checking']
+                 pars_sec['Last checked'] = time.strftime("%Y-%m-%d %H:%M:%S")
+                 self.log.info("Job not in the queue but not terminated. Wait.")
+             else:
+                 if get_job_age(pars_sec['Last checked'],"%Y-%m-%d %H:%M:%S") > self.dt: # if the job has been checked for longer then an hour
+                     self.log.info("Job not in the queue and still not terminated after {} s. Marked as failed.".format(self.dt))
+                     pars_sec['Condor status'] = self.job_status_dict['unsuccessfull']
                          
     def update_job_daemon_status(self,pars_sec,daemons):
         if pars_sec['Work_dir'] in daemons:
@@ -229,7 +265,7 @@ class log_manager:
         if self.is_daemon_to_kill(pars_sec):
             pid = pars_sec['Job control daemon'].split(" ")[-1]
             if not test:
-                ret = kill_process(pid)
+                ret = self.processes.kill(pid,script="job_control_daemon.py")
                 if ret != 0:
                     self.log.warning(f"Could not kill daemon with pid {pid}")
             pars_sec['Job control daemon'] = 'Daemon killed'
@@ -239,14 +275,15 @@ class log_manager:
             
             
     def kill_untracked_daemons(self,daemons,test=False):
-        # kill daemons not associated to any job
+        # kill daemons not associated to any job that is not archived yet
+        # (all of them, and the new jobs, are in the parser: no need to query the whole history)
         a = list() # for unittest
         workdirs = [self.parser[p]['Work_dir'] for p in self.parser.sections()]
         for d in daemons.items():
             if d[0] not in workdirs:
                 pid = d[1]
                 if not test:
-                    ret = kill_process(pid)
+                    ret = self.processes.kill(pid,script="job_control_daemon.py")
                     self.log.info("Daemon killed because not connected to any tracked job.\nWorkdir: {}".format(d[0]))
                 else: a.append(pid)
                     
@@ -328,63 +365,10 @@ class log_manager:
 #        os.remove(base_work+'.zip')
 #        pars_sec['Status'] = 'ARCHIVED' 
             
-    def read_IDEAL_log(self, logfilename):
-        lockfile = logfilename + '.lock'
-        lock = SoftFileLock(lockfile)
-        lines = None
-        try:
-            with lock.acquire(timeout=3):
-                with open(logfilename,'r') as f:
-                    lines = f.readlines()
-        except Timeout:
-            print("failed to acquire lock file {} for 3 seconds".format(lockfile))
-        return lines
-            
-    def add_id_sections(self,id_range,lines):
-        # TODO: we are reading the whole file. Better to read obly a buffer with the last N lines?
-        nw = 1 # how many lines after IdealID is the working_dir in the log file
-        nd = 3 # same for submission date
-        ns = 5 # same for user settings
-        nc = 6 # condor id
-        
-        # try:
-        #     with open(self.logfile,'r') as f:
-        #         self.log.info("Try to read general log file")
-        #         lines = f.readlines()
-        # except Exception as e:
-        #     self.log.error(f"Could not read file. Error: {e}")
-            
-        ID_lines = [l for l in lines if ("IdealID:" in l.split(" ") and int(l.split(" ")[1]) in id_range)]
-        
-        #new_ids = [line.split(" ")[1] for line in ID_lines]
-        
-        # Get workdir for missing IDs
-        work_dir_lines = [lines[lines.index(l)+nw][:-1] for l in ID_lines]
-        work_dirs = [line.split(" ")[2] for line in work_dir_lines]
-
-        dates = list()
-        settings = list()
-        condor_ids = list()
-        for line in ID_lines:
-            # Get submission date for missing IDs
-            try:
-                date_line = lines[lines.index(line)+nd][:-1]
-            except Exception as e:
-                self.log.error(f"Problem reading submission date: {e}")
-            if date_line.split(" ")[2] != 'error':
-                dates.append(date_line.split(" ")[3]+" "+date_line.split(" ")[4])
-                # Get settings for missing IDs
-                settings.append(lines[lines.index(line)+ns][:-1])
-                # Get condor cluster ID
-                condor_ids.append(lines[lines.index(line)+nc][:-1].split(" ")[-1])
-            else:
-                dates.append('-')
-                settings.append('-')
-    
-     
-        for i in range(len(id_range)):
-            self.config_template(self.parser,id_range[i],work_dirs[i],dates[i],condor_ids[i],settings[i])
-            self.log.info("Added section with ID: {}".format(id_range[i]))
+    def add_id_sections(self,records):
+        for r in records:
+            self.config_template(self.parser,r['IdealID'],r['Work_dir'],r['Submission date'],r['Condor id'],r['Simulation settings'])
+            self.log.info("Added section with ID: {}".format(r['IdealID']))
         
             
     def config_template(self,config,idealID,workdir,date,condor_id,settings):
@@ -410,6 +394,18 @@ if __name__ == '__main__':
     daemon_cfg = ideal_dir + "/cfg/log_daemon.cfg"
     cfg_parser.read(daemon_cfg)
     
+    import argparse
+    aparser = argparse.ArgumentParser(description="IDEAL log daemon, keeps track of the states of the IDEAL jobs")
+    aparser.add_argument("--export-history",default=False,action='store_true',
+            help="write all jobs from the job state store to the history cfg file and exit (normally this is only done when jobs are archived)")
+    args = aparser.parse_args()
+    if args.export_history:
+        store = job_state_store(get_job_state_db(cfg_parser['Paths']))
+        store.export_cfg(cfg_parser['Paths']['Cfg_log_file'])
+        print("exported {} jobs to {}".format(store.count(),cfg_parser['Paths']['Cfg_log_file']))
+        store.close()
+        sys.exit(0)
+    
     with daemon.DaemonContext():
         manager = log_manager(cfg_parser,ideal_dir)
         
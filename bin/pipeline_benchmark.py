@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Benchmark of the IDEAL overhead, i.e. everything except the Gate simulation.
+
+A synthetic CT, structure set, RT ion plan and TPS plan dose are generated,
+together with a system configuration and commissioning directory (based on the
+template commissioning data), in a scratch directory. Then the IDEAL pipeline
+is run on these data and the following stages are timed separately:
+
+* idc_details:    reading the plan, CT and structure set (IDC_details)
+* job_executor:   staging the Gate work directory, up to the job submission
+* preprocess:     creating the Gate CT, mass and mask images (preprocess_ct_image)
+* dose_collector: polling the (synthetic) dose outputs of the running subjobs
+* postprocess:    summing, resampling and writing the beam doses (post_processing)
+
+Gate itself is not run: the subjob outputs (dose and statistics files) are
+synthetic. No Gate, HTCondor or network access is needed.
+
+The results are written to a JSON file. With one or more "compare" files the
+stage timings are compared with those of earlier benchmark runs.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import getpass
+import platform
+import tempfile
+import configparser
+import logging
+from datetime import datetime
+import numpy as np
+import itk
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+logger = logging.getLogger("pipeline_benchmark")
+
+stage_names = ["idc_details","job_executor","preprocess","dose_collector","postprocess"]
+
+CT_CLASS = "1.2.840.10008.5.1.4.1.1.2"
+RS_CLASS = "1.2.840.10008.5.1.4.1.1.481.3"
+RD_CLASS = "1.2.840.10008.5.1.4.1.1.481.2"
+RP_CLASS = "1.2.840.10008.5.1.4.1.1.481.8"
+BEAMLINE = "ExampleBeamLine"
+CT_PROTOCOL_DESCRIPTION = "IDEAL pipeline benchmark"
+
+################################################################################
+# SYNTHETIC INPUT DATA
+################################################################################
+
+def _new_dataset(sop_class,modality,patient):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = modality
+    for k,v in patient.items():
+        setattr(ds,k,v)
+    return ds
+
+def _ellipse(cx,cy,rx,ry,z,npoints=64):
+    phi = np.linspace(0.,2*np.pi,npoints,endpoint=False)
+    return np.stack((cx+rx*np.cos(phi),cy+ry*np.sin(phi),np.full(npoints,z)),axis=1)
+
+class synthetic_patient(object):
+    """
+    Synthetic patient: an elliptic water cylinder with a dense insert, in air,
+    with a structure set (external, target, insert and a number of small
+    organs), a PBS proton plan and a TPS plan dose on a coarser dose grid.
+    """
+    def __init__(self,ddir,nxyz=(128,128,64),spacing=(2.,2.,2.5),dose_spacing=3.,
+                 nrois=6,nbeams=2,nlayers=20,nspots=200,seed=42):
+        self.ddir = ddir
+        self.nxyz = np.array(nxyz,dtype=int)
+        self.spacing = np.array(spacing,dtype=float)
+        self.origin = -0.5*(self.nxyz-1)*self.spacing
+        self.dose_spacing = float(dose_spacing)
+        self.rng = np.random.default_rng(seed)
+        self.patient = dict(PatientName="Benchmark^Pipeline",PatientID="IDEAL-BENCHMARK",
+                            PatientBirthDate="19700101",PatientSex="O",
+                            StudyInstanceUID=generate_uid(),FrameOfReferenceUID=generate_uid(),
+                            StudyDate="20240101",StudyTime="120000",
+                            ReferringPhysicianName="Benchmark")
+        half = 0.5*self.nxyz*self.spacing
+        # body: elliptic cylinder, excluding the first and last two slices
+        self.body = (0.,0.,0.8*half[0],0.6*half[1])
+        self.insert = (0.35*half[0],0.,0.12*half[0],0.12*half[0])
+        self.target = (-0.1*half[0],0.,0.2*half[0],0.2*half[0])
+        self.zbody = (self.origin[2]+2*self.spacing[2],self.origin[2]+(self.nxyz[2]-3)*self.spacing[2])
+        os.makedirs(ddir,exist_ok=True)
+        self.write_ct()
+        self.write_structure_set(nrois)
+        self.write_plan(nbeams,nlayers,nspots)
+        self.write_plan_dose()
+    def _inside(self,ellipse,x,y):
+        cx,cy,rx,ry = ellipse
+        return ((x-cx)/rx)**2+((y-cy)/ry)**2 < 1.
+    def write_ct(self):
+        nx,ny,nz = self.nxyz
+        x = self.origin[0]+self.spacing[0]*np.arange(nx)
+        y = self.origin[1]+self.spacing[1]*np.arange(ny)
+        z = self.origin[2]+self.spacing[2]*np.arange(nz)
+        yy,xx = np.meshgrid(y,x,indexing='ij')
+        hu = np.full((nz,ny,nx),-1000.)
+        slab = (z>=self.zbody[0]-1e-3)&(z<=self.zbody[1]+1e-3)
+        hu[slab] = np.where(self._inside(self.body,xx,yy),0.,-1000.)
+        hu[slab] = np.where(self._inside(self.insert,xx,yy),800.,hu[slab])
+        hu += self.rng.normal(0.,10.,hu.shape)
+        stored = np.clip(np.round(hu+1024),0,4095).astype(np.int16)
+        self.ct_series_uid = generate_uid()
+        self.ct_slice_uids = list()
+        for k in range(nz):
+            ds = _new_dataset(CT_CLASS,"CT",self.patient)
+            ds.SeriesInstanceUID = self.ct_series_uid
+            ds.SeriesDescription = CT_PROTOCOL_DESCRIPTION
+            ds.InstanceNumber = k+1
+            ds.ImagePositionPatient = [float(self.origin[0]),float(self.origin[1]),float(z[k])]
+            ds.ImageOrientationPatient = [1,0,0,0,1,0]
+            ds.PixelSpacing = [float(self.spacing[1]),float(self.spacing[0])]
+            ds.SliceThickness = float(self.spacing[2])
+            ds.Rows,ds.Columns = int(ny),int(nx)
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = "MONOCHROME2"
+            ds.BitsAllocated = 16
+            ds.BitsStored = 16
+            ds.HighBit = 15
+            ds.PixelRepresentation = 1
+            ds.RescaleIntercept = -1024
+            ds.RescaleSlope = 1
+            ds.PixelData = stored[k].tobytes()
+            ds.save_as(os.path.join(self.ddir,"CT.{:04d}.dcm".format(k)),enforce_file_format=True)
+            self.ct_slice_uids.append(ds.SOPInstanceUID)
+    def write_structure_set(self,nrois):
+        half = 0.5*self.nxyz*self.spacing
+        rois = [("External","EXTERNAL",self.body,self.zbody),
+                ("PTV","PTV",self.target,(-0.3*half[2],0.3*half[2])),
+                ("Insert","ORGAN",self.insert,self.zbody)]
+        for i in range(max(nrois-len(rois),0)):
+            phi = 2*np.pi*i/max(nrois-len(rois),1)
+            organ = (0.4*half[0]*np.cos(phi),0.3*half[1]*np.sin(phi),0.06*half[0],0.06*half[0])
+            rois.append(("Organ_{}".format(i+1),"ORGAN",organ,(-0.5*half[2],0.5*half[2])))
+        ds = _new_dataset(RS_CLASS,"RTSTRUCT",self.patient)
+        ds.StructureSetLabel = "benchmark"
+        refseries = Dataset()
+        refseries.SeriesInstanceUID = self.ct_series_uid
+        refstudy = Dataset()
+        refstudy.ReferencedSOPClassUID = "1.2.840.10008.3.1.2.3.1"
+        refstudy.ReferencedSOPInstanceUID = self.patient["StudyInstanceUID"]
+        refstudy.RTReferencedSeriesSequence = Sequence([refseries])
+        reffor = Dataset()
+        reffor.FrameOfReferenceUID = self.patient["FrameOfReferenceUID"]
+        reffor.RTReferencedStudySequence = Sequence([refstudy])
+        ds.ReferencedFrameOfReferenceSequence = Sequence([reffor])
+        z = self.origin[2]+self.spacing[2]*np.arange(self.nxyz[2])
+        ssrois,contours,observations = list(),list(),list()
+        for nr,(name,roitype,ellipse,(zmin,zmax)) in enumerate(rois,start=1):
+            ssroi = Dataset()
+            ssroi.ROINumber = nr
+            ssroi.ROIName = name
+            ssroi.ReferencedFrameOfReferenceUID = self.patient["FrameOfReferenceUID"]
+            ssrois.append(ssroi)
+            roicontour = Dataset()
+            roicontour.ReferencedROINumber = nr
+            roicontour.ContourSequence = Sequence()
+            for k in np.flatnonzero((z>=zmin-1e-3)&(z<=zmax+1e-3)):
+                points = _ellipse(*ellipse,z[k])
+                imgref = Dataset()
+                imgref.ReferencedSOPClassUID = CT_CLASS
+                imgref.ReferencedSOPInstanceUID = self.ct_slice_uids[k]
+                contour = Dataset()
+                contour.ContourImageSequence = Sequence([imgref])
+                contour.ContourGeometricType = "CLOSED_PLANAR"
+                contour.NumberOfContourPoints = len(points)
+                contour.ContourData = [round(float(v),3) for v in points.flat]
+                roicontour.ContourSequence.append(contour)
+            contours.append(roicontour)
+            obs = Dataset()
+            obs.ObservationNumber = nr
+            obs.ReferencedROINumber = nr
+            obs.RTROIInterpretedType = roitype
+            observations.append(obs)
+        ds.StructureSetROISequence = Sequence(ssrois)
+        ds.ROIContourSequence = Sequence(contours)
+        ds.RTROIObservationsSequence = Sequence(observations)
+        ds.save_as(os.path.join(self.ddir,"RS.benchmark.dcm"),enforce_file_format=True)
+        self.rs_uid = ds.SOPInstanceUID
+        self.roinames = [roi[0] for roi in rois]
+    def write_plan(self,nbeams,nlayers,nspots):
+        ds = _new_dataset(RP_CLASS,"RTPLAN",self.patient)
+        ds.RTPlanLabel = "Benchmark"
+        ds.PlanIntent = "RESEARCH"
+        ds.OperatorsName = "Benchmark"
+        refss = Dataset()
+        refss.ReferencedSOPClassUID = RS_CLASS
+        refss.ReferencedSOPInstanceUID = self.rs_uid
+        ds.ReferencedStructureSetSequence = Sequence([refss])
+        fraction = Dataset()
+        fraction.FractionGroupNumber = 1
+        fraction.NumberOfFractionsPlanned = 30
+        fraction.NumberOfBeams = nbeams
+        fraction.ReferencedBeamSequence = Sequence()
+        beams = list()
+        iso = [float(self.target[0]),float(self.target[1]),0.]
+        for b in range(nbeams):
+            beam = Dataset()
+            beam.BeamNumber = b+1
+            beam.BeamName = "F{}".format(b+1)
+            beam.TreatmentMachineName = BEAMLINE
+            beam.RadiationType = "PROTON"
+            beam.PrimaryDosimeterUnit = "NP"
+            beam.NumberOfRangeShifters = 0
+            beam.NumberOfRangeModulators = 0
+            beam.IonControlPointSequence = Sequence()
+            cumsum = 0.
+            for j in range(nlayers):
+                cp = Dataset()
+                cp.ControlPointIndex = j
+                cp.NominalBeamEnergy = 150.-2.*j
+                cp.ScanSpotTuneID = "3.0"
+                cp.NumberOfPaintings = 1
+                cp.NumberOfScanSpotPositions = nspots
+                xy = self.rng.uniform(-30.,30.,(nspots,2))
+                w = self.rng.uniform(0.1,1.,nspots)
+                cp.ScanSpotPositionMap = [round(float(v),2) for v in xy.flat]
+                cp.ScanSpotMetersetWeights = [round(float(v),4) for v in w]
+                cp.CumulativeMetersetWeight = cumsum
+                cumsum += sum(float(v) for v in cp.ScanSpotMetersetWeights)
+                if j==0:
+                    cp.GantryAngle = 360.*b/nbeams
+                    cp.PatientSupportAngle = 0.
+                    cp.IsocenterPosition = iso
+                    cp.SnoutPosition = 300.
+                beam.IonControlPointSequence.append(cp)
+            beam.FinalCumulativeMetersetWeight = cumsum
+            beam.NumberOfControlPoints = nlayers
+            beams.append(beam)
+            refbeam = Dataset()
+            refbeam.ReferencedBeamNumber = b+1
+            refbeam.BeamMeterset = cumsum
+            fraction.ReferencedBeamSequence.append(refbeam)
+        ds.IonBeamSequence = Sequence(beams)
+        ds.FractionGroupSequence = Sequence([fraction])
+        self.rp_path = os.path.join(self.ddir,"RP.benchmark.dcm")
+        ds.save_as(self.rp_path,enforce_file_format=True)
+        self.rp_uid = ds.SOPInstanceUID
+    def write_plan_dose(self):
+        # dose grid: the bounding box of the external, with the dose voxel size
+        cx,cy,rx,ry = self.body
+        lo = np.array([cx-rx,cy-ry,self.zbody[0]])
+        hi = np.array([cx+rx,cy+ry,self.zbody[1]])
+        n = np.ceil((hi-lo)/self.dose_spacing).astype(int)
+        origin = 0.5*(lo+hi)-0.5*(n-1)*self.dose_spacing
+        x,y,z = [origin[i]+self.dose_spacing*np.arange(n[i]) for i in range(3)]
+        zz,yy,xx = np.meshgrid(z,y,x,indexing='ij')
+        sigma = 0.5*self.target[2]
+        adose = 2.*np.exp(-0.5*((xx-self.target[0])**2+(yy-self.target[1])**2+zz**2)/sigma**2)
+        scaling = float(adose.max())/65535
+        ds = _new_dataset(RD_CLASS,"RTDOSE",self.patient)
+        refplan = Dataset()
+        refplan.ReferencedSOPClassUID = RP_CLASS
+        refplan.ReferencedSOPInstanceUID = self.rp_uid
+        ds.ReferencedRTPlanSequence = Sequence([refplan])
+        ds.DoseUnits = "GY"
+        ds.DoseType = "PHYSICAL"
+        ds.DoseSummationType = "PLAN"
+        ds.DoseGridScaling = scaling
+        ds.ImagePositionPatient = [float(v) for v in origin]
+        ds.ImageOrientationPatient = [1,0,0,0,1,0]
+        ds.PixelSpacing = [self.dose_spacing,self.dose_spacing]
+        ds.SliceThickness = self.dose_spacing
+        ds.GridFrameOffsetVector = [float(v) for v in self.dose_spacing*np.arange(n[2])]
+        ds.NumberOfFrames = int(n[2])
+        ds.Rows,ds.Columns = int(n[1]),int(n[0])
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = np.round(adose/scaling).astype(np.uint16).tobytes()
+        ds.save_as(os.path.join(self.ddir,"RD.benchmark.dcm"),enforce_file_format=True)
+        self.dose_nxyz = n
+
+def write_workspace(topdir,username,njobs):
+    """
+    Create the directories, commissioning data and system configuration file
+    for the benchmark in `topdir`. Returns the path of the system configuration file.
+    """
+    installdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    template = os.path.join(installdir,"docs","commissioning","template_commissioning_data")
+    dirs = dict([(d,os.path.join(topdir,d)) for d in ["input","work","output","logs","commissioning"]])
+    for d in ["input","work","output","logs"]:
+        os.makedirs(dirs[d],exist_ok=True)
+    shutil.copytree(template,dirs["commissioning"])
+    # direct HU-to-material protocol: no Gate needed to generate the HLUT cache
+    with open(os.path.join(dirs["commissioning"],"CT","hlut.conf"),"w") as fp:
+        fp.write("[benchmark protocol]\n")
+        fp.write("-1024,-500 = G4_AIR\n")
+        fp.write("-500,500 = G4_WATER\n")
+        fp.write("500,3000 = G4_GRAPHITE\n")
+        fp.write("SeriesDescription = {}\n".format(CT_PROTOCOL_DESCRIPTION))
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    parser["directories"] = {"input dicom":dirs["input"],
+                             "tmpdir jobs":dirs["work"],
+                             "first output dicom":dirs["output"],
+                             "second output dicom":"",
+                             "logging":dirs["logs"],
+                             "commissioning":dirs["commissioning"]}
+    parser["mc stats"] = {"n minutes per job":"5 20 10080 5",
+                          "n ions per beam":"100 1000000 1000000000 100 default",
+                          "x pct unc in target":"0.1 1. 99. 0.1",
+                          "n top voxels for mean dose max":"100",
+                          "dose threshold as fraction in percent of mean dose max":"50."}
+    parser["simulation"] = {"gate shell environment":os.path.join(topdir,"gate_env.sh"),
+                            "number of cores":str(njobs),
+                            "batch system":"local",
+                            "proton physics list":"QGSP_BIC_HP_EMZ",
+                            "rbe factor protons":"1.1",
+                            "remove dose outside external":"true",
+                            "gamma index parameters dta_mm dd_percent thr_percent def":"3. 3. 5. -1.",
+                            "minimum dose grid resolution [mm]":"0.1",
+                            "run gamma analysis":"false",
+                            "write mhd physical dose":"yes",
+                            "write mhd rbe dose":"yes",
+                            "write mhd plan dose":"yes",
+                            "write dicom physical dose":"yes",
+                            "write dicom rbe dose":"yes",
+                            "write dicom plan dose":"yes"}
+    parser["(tmp) correction factors"] = {"default":"1.0",
+                                          "{} PROTON".format(BEAMLINE):"1.0"}
+    parser["condor memory"] = {"condor memory request minimum [MB]":"1000",
+                               "condor memory request default [MB]":"2000",
+                               "condor memory request maximum [MB]":"8000",
+                               "condor memory fit proton ct":"offset 1200 dosegrid 2.5e-05 ct 1.8e-06",
+                               "condor memory fit proton phantom":"offset 500.0 dosegrid 2.0e-05 nspots 0.0060",
+                               "condor memory fit carbon ct":"offset 1800 dosegrid 5e-05",
+                               "condor memory fit carbon phantom":"offset 1000.0 dosegrid 8.0e-06"}
+    parser["materials"] = {"materials database":"GateMaterials.db",
+                           "hu density tolerance [g/cm3]":"0.01",
+                           "G4_WATER":"1.0",
+                           "G4_AIR":"0.00120479",
+                           "G4_GRAPHITE":"2.21"}
+    parser["user roles"] = {username:"admin"}
+    syscfg_path = os.path.join(topdir,"system.cfg")
+    with open(syscfg_path,"w") as fp:
+        parser.write(fp)
+    return syscfg_path
+
+def _write_subjob_output(outdir,dosemhd,adose,ref,nprimaries,final=False):
+    """
+    Write a Gate-like subjob output: dose image and statistics actor file
+    (and the Gate exit value, for a finished subjob).
+    """
+    os.makedirs(outdir,exist_ok=True)
+    dose = itk.image_from_array(adose)
+    dose.CopyInformation(ref)
+    itk.imwrite(dose,os.path.join(outdir,dosemhd))
+    stattxt = dosemhd.replace("idc-","statActor-").replace("-DoseToWater.mhd",".txt").replace("-Dose.mhd",".txt")
+    with open(os.path.join(outdir,stattxt),"w") as fp:
+        fp.write("# NumberOfRun    = 1\n")
+        fp.write("# NumberOfEvents = {}\n".format(nprimaries))
+        fp.write("# NumberOfTracks = {}\n".format(10*nprimaries))
+        fp.write("# ElapsedTime    = {}\n".format(1e-3*nprimaries+30.))
+        fp.write("# ElapsedTimeWoInit = {}\n".format(1e-3*nprimaries))
+    if final:
+        with open(os.path.join(outdir,"gate_exit_value.txt"),"w") as fp:
+            fp.write("0\n")
+
+class synthetic_gate_outputs(object):
+    """
+    Gate-like dose outputs for all subjobs of all beams, on the simulation
+    dose grid (the preprocessed CT). The dose of each subjob is a gaussian
+    blob with noise that decreases with the number of primaries.
+    """
+    def __init__(self,workdir,mass_mhd,dose_mhd_list,njobs,seed=42):
+        self.workdir = workdir
+        self.ref = itk.imread(mass_mhd)
+        self.dose_mhd_list = dose_mhd_list
+        self.njobs = njobs
+        self.rng = np.random.default_rng(seed)
+        shape = itk.array_view_from_image(self.ref).shape
+        zz,yy,xx = np.meshgrid(*[np.linspace(-1.,1.,n) for n in shape],indexing='ij')
+        self.blob = np.exp(-0.5*(xx**2+yy**2+zz**2)/0.3**2)
+        self.cluster_id = 1000
+    def dose(self,nprimaries):
+        noise = self.rng.normal(0.,1.,self.blob.shape)/np.sqrt(nprimaries*self.blob+1.)
+        return np.float32(np.clip(1e-6*nprimaries*self.blob*(1.+noise),0.,None))
+    def write(self,nprimaries,final=False):
+        """
+        Write the outputs for all subjobs with `nprimaries` primaries each. Running
+        subjobs copy their output to `tmp`, finished subjobs write in their output directory.
+        """
+        for dosemhd in self.dose_mhd_list:
+            for j in range(self.njobs):
+                _write_subjob_output(self.outdir(dosemhd,j,final),dosemhd,self.dose(nprimaries),self.ref,nprimaries,final)
+    def outdir(self,dosemhd,j,final=False):
+        """
+        Output directory of subjob `j` of the beam with dose file `dosemhd`;
+        each beam is a separate cluster, like in a real IDEAL job.
+        """
+        cluster_id = self.cluster_id + self.dose_mhd_list.index(dosemhd)
+        outdir = "output.{}.{}".format(cluster_id,j)
+        return os.path.join(self.workdir,outdir if final else os.path.join("tmp",outdir))
+
+################################################################################
+# PIPELINE STAGES
+################################################################################
+
+class stage_timer(object):
+    """
+    Collect the wall clock times of the benchmark stages.
+    """
+    def __init__(self):
+        self.seconds = dict()
+    def time(self,name):
+        timer = self
+        class _timing(object):
+            def __enter__(self):
+                self.t0 = time.perf_counter()
+            def __exit__(self,*exc):
+                timer.seconds[name] = timer.seconds.get(name,0.) + time.perf_counter()-self.t0
+                return False
+        return _timing()
+
+def run_pipeline(patient,njobs,npolls,nprimaries,seed=42):
+    """
+    Run all stages once on the synthetic patient, return the stage timings and some metrics.
+    """
+    from impl.idc_details import IDC_details
+    from impl.job_executor import job_executor
+    from utils import instrumentation
+    timer = stage_timer()
+    metrics = dict()
+    save_cwd = os.getcwd()
+    try:
+        ###########
+        with timer.time("idc_details"):
+            details = IDC_details()
+            details.SetPlanFilePath(patient.rp_path)
+            details.SetHLUT()
+            details.SetHUOverride("Insert","G4_WATER")
+        if not details.have_CT:
+            raise RuntimeError("benchmark plan was not recognized as a plan with CT")
+        ###########
+        with timer.time("job_executor"):
+            executor = job_executor.create_condor_job_executor(details)
+            workdir = executor.template_gate_work_directory
+            os.chdir(workdir)
+            details.WriteUserSettings(executor.qspecs,time.strftime("%Y-%m-%d %H:%M:%S"),workdir)
+        ###########
+        # imported here, such that their log files end up in the work directory, like in a real job
+        import preprocess_ct_image
+        instrumentation.start_job_metrics(workdir,"PRE")
+        with timer.time("preprocess"), instrumentation.span("preprocessing"):
+            preprocess_ct_image.preprocess("preprocessor.cfg")
+        ###########
+        import job_control_daemon
+        cfg = job_control_daemon.dose_monitoring_config(workdir,getpass.getuser(),uncertainty_goal_percent=1.)
+        outputs = synthetic_gate_outputs(workdir,cfg.mass_mhd,cfg.dose_mhd_list,njobs,seed)
+        accumulators = dict()
+        instrumentation.start_job_metrics(workdir,"DAEMON")
+        for ipoll in range(npolls):
+            outputs.write((ipoll+1)*nprimaries//npolls)
+            with timer.time("dose_collector"):
+                for beamname,dosemhd in zip(cfg.beamname_list,cfg.dose_mhd_list):
+                    dose_files = [os.path.join(outputs.outdir(dosemhd,j),dosemhd) for j in range(njobs)]
+                    with instrumentation.span("check accuracy",beam=beamname,nfiles=len(dose_files)):
+                        dc = job_control_daemon.check_accuracy_for_beam(cfg,beamname,dosemhd,dose_files,accumulators)
+                    metrics["mean uncertainty [%] "+beamname] = float(dc.mean_unc_pct)
+        ###########
+        import postprocess_dose_results
+        outputs.write(nprimaries,final=True)
+        instrumentation.start_job_metrics(workdir,"POST")
+        with timer.time("postprocess"), instrumentation.span("postprocessing"):
+            parser = configparser.ConfigParser()
+            with open("postprocessor.cfg","r") as fp:
+                parser.read_file(fp)
+            plan_dose_dict = dict()
+            cleanup_list = list()
+            for beamname in parser.sections():
+                if beamname=='user logs file':
+                    continue
+                with instrumentation.span("beam",beam=beamname):
+                    ppcfg = postprocess_dose_results.post_proc_config(parser,beamname)
+                    if not postprocess_dose_results.post_processing(ppcfg,plan_dose_dict,cleanup_list):
+                        raise RuntimeError("post processing failed for beam {}".format(beamname))
+        metrics["CT voxels"] = int(np.prod(details.ct_info.size))
+        metrics["simulation dose voxels"] = int(np.prod(details.ct_nvoxels))
+        metrics["output dose voxels"] = int(np.prod(details.GetNVoxels()))
+        metrics["spots"] = int(sum(beam.nspots for beam in details.bs_info.beams))
+        metrics["work directory"] = workdir
+        # break down of the stages, from the metrics file of the job
+        records = instrumentation.read_job_metrics(instrumentation.current_job_metrics().path)
+        metrics["spans [s]"] = dict([("{} {}".format(stage,name),t["wall"]) for (stage,name),t in instrumentation.job_totals(records).items()])
+    finally:
+        instrumentation.stop_job_metrics()
+        os.chdir(save_cwd)
+    return timer.seconds,metrics
+
+################################################################################
+# RESULTS
+################################################################################
+
+def summarize(runs):
+    """
+    Median, minimum and maximum time of each stage over all runs.
+    """
+    summary = dict()
+    for name in stage_names+["total"]:
+        values = [run[name] for run in runs if name in run]
+        if values:
+            summary[name] = {"median":float(np.median(values)),"min":float(np.min(values)),"max":float(np.max(values))}
+    return summary
+
+def compare(results,reference):
+    """
+    Ratio of the median stage times in `results` and in `reference`, for the
+    stages that are in both.
+    """
+    ratios = dict()
+    for name,stats in results["stages"].items():
+        if name in reference.get("stages",{}):
+            ref = reference["stages"][name]["median"]
+            ratios[name] = stats["median"]/ref if ref > 0 else float("inf")
+    return ratios
+
+def print_results(results,references):
+    labels = [os.path.basename(path) for path in references]
+    print("{:16s} {:>10s}".format("stage","time [s]")+"".join([" {:>22s}".format(label[-22:]) for label in labels]))
+    for name,stats in results["stages"].items():
+        line = "{:16s} {:10.3f}".format(name,stats["median"])
+        for path in references:
+            ratio = results["comparisons"][path].get(name)
+            line += " {:>22s}".format("-" if ratio is None else "x{:.2f}".format(ratio))
+        print(line)
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o","--output",default="",
+            help="JSON file to write the results to (default: pipeline_benchmark_<date>_<time>.json in the current directory)")
+    parser.add_argument("-c","--compare",default=[],action='append',
+            help="JSON file with the results of an earlier benchmark run, to compare with (can be given several times)")
+    parser.add_argument("-m","--max-slowdown",type=float,default=0.,
+            help="exit with an error if a stage is slower than this factor times the same stage in the (first) compared run")
+    parser.add_argument("-w","--workdir",default="",
+            help="scratch directory for the synthetic data and the job directories (default: a temporary directory)")
+    parser.add_argument("-k","--keep",default=False,action='store_true',
+            help="do not remove the scratch directory afterwards")
+    parser.add_argument("-r","--repeat",type=int,default=1,
+            help="number of times to run the pipeline")
+    parser.add_argument("--ct-size",type=int,nargs=3,default=[128,128,64],
+            help="number of CT voxels in x, y and z")
+    parser.add_argument("--ct-spacing",type=float,nargs=3,default=[2.,2.,2.5],
+            help="CT voxel size in mm")
+    parser.add_argument("--dose-spacing",type=float,default=3.,
+            help="voxel size of the TPS (and output) dose in mm")
+    parser.add_argument("--nrois",type=int,default=6,
+            help="number of ROIs in the structure set (at least 3)")
+    parser.add_argument("--nbeams",type=int,default=2,
+            help="number of beams in the plan")
+    parser.add_argument("--nlayers",type=int,default=20,
+            help="number of energy layers per beam")
+    parser.add_argument("--nspots",type=int,default=200,
+            help="number of spots per energy layer")
+    parser.add_argument("-j","--njobs",type=int,default=8,
+            help="number of (synthetic) Gate subjobs per beam")
+    parser.add_argument("--npolls",type=int,default=4,
+            help="number of times the dose collector polls the subjob outputs")
+    parser.add_argument("--nprimaries",type=int,default=100000,
+            help="final number of primaries per subjob")
+    parser.add_argument("--seed",type=int,default=42,
+            help="seed for the random numbers in the synthetic data")
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    references = dict()
+    for path in args.compare:
+        with open(path,"r") as fp:
+            references[path] = json.load(fp)
+    topdir = os.path.realpath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="ideal_pipeline_benchmark.")
+    os.makedirs(topdir,exist_ok=True)
+    username = getpass.getuser()
+    try:
+        syscfg_path = write_workspace(topdir,username,args.njobs)
+        from impl.system_configuration import get_sysconfig
+        syscfg = get_sysconfig(filepath=syscfg_path,username=username,
+                               want_logfile=os.path.join(topdir,"logs","pipeline_benchmark.log"))
+        # do not write the benchmark jobs in the log of the real IDEAL jobs
+        import impl.job_executor
+        from impl.version import tag as version_tag
+        high_log = logging.getLogger("high_log")
+        high_log.handlers.clear()
+        high_log.addHandler(logging.FileHandler(os.path.join(topdir,"logs","high_level.log")))
+        t0 = time.perf_counter()
+        patient = synthetic_patient(os.path.join(topdir,"input","patient"),args.ct_size,args.ct_spacing,args.dose_spacing,
+                                    args.nrois,args.nbeams,args.nlayers,args.nspots,args.seed)
+        tsynth = time.perf_counter()-t0
+        runs = list()
+        for i in range(args.repeat):
+            if i > 0:
+                # the job directory names have a time stamp with a resolution of one second
+                time.sleep(1.0-time.time()%1.0)
+            seconds,metrics = run_pipeline(patient,args.njobs,args.npolls,args.nprimaries,args.seed)
+            seconds["total"] = sum(seconds.values())
+            runs.append(seconds)
+            print("run {}/{}: {:.3f} s".format(i+1,args.repeat,seconds["total"]))
+    finally:
+        if not args.keep:
+            shutil.rmtree(topdir,ignore_errors=True)
+    results = {"benchmark":"IDEAL pipeline","format version":1,
+               "date":datetime.now().isoformat(timespec="seconds"),
+               "host":platform.node(),"platform":platform.platform(),
+               "versions":{"python":platform.python_version(),"numpy":np.__version__,
+                           "itk":itk.Version.GetITKVersion(),"pydicom":pydicom.__version__,
+                           "ideal":version_tag},
+               "parameters":dict([(k,v) for k,v in vars(args).items() if k not in ["output","compare","workdir","keep","max_slowdown"]]),
+               "synthetic data [s]":tsynth,
+               "metrics":metrics,
+               "runs":runs,
+               "stages":summarize(runs),
+               "comparisons":dict([(path,compare({"stages":summarize(runs)},ref)) for path,ref in references.items()])}
+    output = args.output if args.output else "pipeline_benchmark_{}.json".format(time.strftime("%Y%m%d_%H%M%S"))
+    with open(output,"w") as fp:
+        json.dump(results,fp,indent=2)
+    print_results(results,args.compare)
+    print("results written to {}".format(output))
+    if args.max_slowdown > 0 and args.compare:
+        slow = [name for name,ratio in results["comparisons"][args.compare[0]].items() if ratio > args.max_slowdown]
+        if slow:
+            print("SLOWER than x{} compared to {}: {}".format(args.max_slowdown,args.compare[0],", ".join(slow)))
+            sys.exit(1)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -16,7 +16,7 @@ import tarfile
 import shutil
 from glob import glob
 from datetime import datetime
-from utils.gamma_index import get_gamma_index
+from utils.gamma_index import get_gamma_index, gamma_index_3d_pass_rate
 
 if False:
     logging.basicConfig(level=logging.DEBUG)
@@ -32,6 +32,8 @@ else:
     logger.addHandler(fh)
 
 from utils.resample_dose import mass_weighted_resampling
+from utils.job_outputs import get_job_stats, sum_job_outputs
+from utils import instrumentation
 
 def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
     if bool(user_cfg):
@@ -113,12 +115,18 @@ def image_2_dicom_dose(img_dose,dose_dcm_template,my_dose_dcm,physical=True):
         #pydicom.write_file(my_dose_dcm.replace(".dcm","D.dcm"),dose_dcm,False)
         #logger.info("wrote A,B,C,D DICOM file: {}".format(my_dose_dcm))
         logger.debug("going to write to file: {}".format(my_dose_dcm))
-        pydicom.write_file(my_dose_dcm,dose_dcm,False)
+        pydicom.dcmwrite(my_dose_dcm,dose_dcm,False)
         logger.info("wrote DICOM file: {}".format(my_dose_dcm))
     except Exception as e:
         logger.info("something went wrong: {}".format(e))
 
-def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_final):
+def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_final,mode="map",nworkers=0):
+    """
+    Compare the dose `dose_sum_final` with the TPS dose in `ref_dose_path`. In "map" mode the
+    gamma index distribution is saved, in "pass rate" mode only the failing voxels (mask) are
+    saved and the pass rate is returned. With a positive `nworkers`, the gamma index distribution
+    is computed by that many worker processes.
+    """
     ushort_imgref=itk.imread(ref_dose_path)
     aimgref=itk.array_from_image(ushort_imgref)*float(pydicom.dcmread(ref_dose_path).DoseGridScaling)
     imgref=itk.image_from_array(np.float32(aimgref))
@@ -127,8 +135,17 @@ def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_fi
     if not npar==4:
         raise ValueError(f"wrong number gamma index parameters ({npar}, should be 4)")
     dta_mm,dd_percent,dosethr,defgamma = gamma_parameters.tolist()
+    if mode == "pass rate":
+        pass_rate,fail=gamma_index_3d_pass_rate(imgref,dose_sum_final,dta=dta_mm,dd=dd_percent,ddpercent=True,
+                                                threshold=dosethr,verbose=False,threshold_percent=True)
+        logger.info("gamma pass rate {:.2f}% ({} mm, {}%, threshold {}%)".format(100.*pass_rate,dta_mm,dd_percent,dosethr))
+        itk.imwrite(fail,mhd_dose_final.replace(".mhd","_gamma_fail.mhd"))
+        itk.imwrite(imgref,mhd_dose_final.replace(".mhd","_tpsdose.mhd"))
+        return pass_rate
+    engine_kwargs = dict(engine="parallel",nworkers=nworkers) if nworkers > 0 else dict()
     g=get_gamma_index(ref=imgref,
                       target=dose_sum_final,
+                      **engine_kwargs,
                       dta=dta_mm,
                       dd=dd_percent,
                       ddpercent=True,
@@ -138,6 +155,7 @@ def run_gamma_analysis(ref_dose_path,gamma_parameters,dose_sum_final,mhd_dose_fi
                       threshold_percent=True)
     itk.imwrite(g,mhd_dose_final.replace(".mhd","_gamma.mhd"))
     itk.imwrite(imgref,mhd_dose_final.replace(".mhd","_tpsdose.mhd"))
+    return None
 
 def update_plan_dose(pdd,label,beam_dose_image):
     # 'pdd' is plan dose dictionary
@@ -158,35 +176,6 @@ def update_plan_dose(pdd,label,beam_dose_image):
         img_plandose.CopyInformation(beam_dose_image)
         pdd[label] = img_plandose
 
-def get_job_stats(mhd):
-    """
-    This function assumes that each output directory contains the output of
-    exactly one GATE run, with one dose actor output (mhd file) and one stat
-    actor output (txt file).
-    """
-    stats=glob(os.path.join(os.path.dirname(mhd),"stat*.txt"))
-    gate_exit_value_txt=glob(os.path.join(os.path.dirname(mhd),"gate_exit_value.txt"))
-    logger.debug("stat files: {}".format("\n".join(stats)))
-    if not 1 == len(stats):
-        raise RuntimeError("cannot retrieve number of primaries for {}".format(mhd) + \
-                           "got {} associated stat actor files: {}".format(len(stats),"\n".join(stats)))
-    if not 1 == len(gate_exit_value_txt):
-        raise RuntimeError("cannot retrieve gate exit value for {}".format(mhd))
-    gate_exit_value=0
-    with open(gate_exit_value_txt[0],"r") as gev:
-        line=gev.readline()
-        gate_exit_value=int(line.strip())
-    statfilepath=stats[0]
-    stats_dict={"StatsFile":statfilepath}
-    hash_key_val=re.compile(r'^#\s*(\b.*\S)\s*=\s*(\b.*\b)\s*$')
-    with open(statfilepath,"r") as sf:
-        stats_dict.update(dict([hash_key_val.search(line).groups() for line in sf if hash_key_val.search(line) is not None ]))
-        n = int(stats_dict.get('NumberOfEvents',-1))
-        if n>=0:
-            logger.info("{} got {} primaries".format(mhd,n))
-            return stats_dict,gate_exit_value
-    raise RuntimeError("N primaries not found for {}".format(mhd))
-
 def compress_jobdata(cfg,outputdirs,statfiles):
         try:
             logger.debug("start logging of tarball compression of {} output directories".format(len(outputdirs)))
@@ -269,55 +258,20 @@ def post_processing(cfg,pdd,cul):
     logger.debug("going to sum all {} doses and do some rescaling".format(len(mhdlist)))
     logger.debug("first dose file is {}".format(mhdlist[0]))
     logger.debug("type first dose file is {}".format(type(mhdlist[0])))
-    dose0=itk.imread(mhdlist[0])
+    with instrumentation.span("sum job outputs"):
+        joboutputs = sum_job_outputs(mhdlist,nworkers=cfg.nreaders)
+    nMC = joboutputs.nMC
+    nBADretval = joboutputs.nBADretval
+    nBADzeronmc = joboutputs.nBADzeronmc
+    tCPUbrutto = joboutputs.tCPUbrutto
+    tCPUnetto = joboutputs.tCPUnetto
+    statfiles = joboutputs.statfiles
+    dose0 = joboutputs.dose
+    if dose0 is None:
+        logger.error("failed to read any dose for beam '{}'".format(cfg.origname))
+        return False
     logger.debug("dose distribution has orig={} spacing={} size={}".format(dose0.GetOrigin(),dose0.GetSpacing(),dose0.GetLargestPossibleRegion().GetSize()))
     adose=itk.GetArrayFromImage(dose0)
-    statdict,retval=get_job_stats(mhdlist[0])
-    nMC=int(statdict['NumberOfEvents'])
-    nBADretval=0
-    nBADzeronmc=0
-    tCPUbrutto=0.
-    tCPUnetto=0.
-    statfiles=[statdict['StatsFile']]
-    logger.debug("adding dose from {} primaries, Gate return value was {}".format(nMC,retval))
-    if retval != 0:
-        logger.error("return value {} means that something went WRONG, Gate did not terminate normally".format(retval))
-        nBADretval += 1
-    elif nMC <= 0:
-        logger.error("ZERO ({}) primaries from mhd={}".format(nMCjob,mhd))
-        nBADzeronmc += 1
-    else:
-        tCPUbrutto += float(statdict['ElapsedTime'])
-        tCPUnetto += float(statdict['ElapsedTimeWoInit'])
-    for mhd in mhdlist[1:]:
-        logger.debug("next dose file is {}".format(mhd))
-        try:
-            dose=itk.imread(mhd)
-            statdict,retval = get_job_stats(mhd)
-            nMCjob = int(statdict['NumberOfEvents'])
-            statfiles.append(statdict['StatsFile'])
-            #nMCjob,statfile,retval = nprimaries(mhd)
-            #statfiles.append(statfile)
-            logger.debug("adding dose from {} primaries, Gate return value was {}".format(nMCjob,retval))
-            # FIXME: such errors should be reported in the final result
-            if retval != 0:
-                nBADretval += 1
-                raise RuntimeError("return value {} means that something went WRONG, Gate did not terminate normally".format(retval))
-            # FIXME: such errors should be reported in the final result
-            elif nMCjob <= 0:
-                nBADzeronmc += 1
-                raise RuntimeError("ZERO ({}) primaries from mhd={}".format(nMCjob,mhd))
-            nMC += nMCjob
-            tCPUbrutto += float(statdict['ElapsedTime'])
-            tCPUnetto += float(statdict['ElapsedTimeWoInit'])
-            assert bool(tuple(dose0.GetLargestPossibleRegion().GetSize()) == tuple(dose.GetLargestPossibleRegion().GetSize())), str("sizes {} and {} don't match".format(dose0.GetLargestPossibleRegion().GetSize(),dose.GetLargestPossibleRegion().GetSize()))
-            assert bool(np.allclose(tuple(dose0.GetOrigin()), tuple(dose.GetOrigin()))), str("origins don't match")  # TODO: check that this sufficiently allows rounding differences
-            assert bool(np.allclose(tuple(dose0.GetSpacing()),tuple(dose.GetSpacing()))), str("spacings don't match") # TODO: check that this sufficiently allows rounding differences
-            adose += itk.GetArrayViewFromImage(dose)
-            logger.debug("max dose (unscaled) is now {}".format(np.max(adose)))
-        except Exception as e:
-            # FIXME: such errors should be reported in the final result
-            logger.error("something went wrong while processing {}: {}".format(mhd,e))
     if nMC <= 0:
         logger.error("failed to find any primaries for beam '{}', cannot scale any dose.".format(cfg.origname))
         return False
@@ -351,10 +305,9 @@ def post_processing(cfg,pdd,cul):
             mass_img=itk.imread(cfg.mass_mhd)
             logger.debug("dose_sum has dimsize={} mass has dimsize={}".format(np.array(itk.size(dose_sum_rescaled)),np.array(itk.size(mass_img))))
             logger.debug("going to resample from voxels with spacing {} to voxels with spacing {}".format(dose_sum_rescaled.GetSpacing(),dose_resampled_ref.GetSpacing()))
-            t0=datetime.now()
-            dose_physical = mass_weighted_resampling(dose_sum_rescaled,mass_img,dose_resampled_ref)
-            t1=datetime.now()
-            logger.debug("resampling took {} seconds".format((t1-t0).total_seconds()))
+            with instrumentation.span("resampling") as s:
+                dose_physical = mass_weighted_resampling(dose_sum_rescaled,mass_img,dose_resampled_ref,nthreads=cfg.nresamplers)
+            logger.debug("resampling took {} seconds".format(s.wall))
         except Exception as e:
             # whatever goes wrong, it should be reported in the log file
             logger.error(f"something when wrong during resampling: {e}")
@@ -411,8 +364,10 @@ def post_processing(cfg,pdd,cul):
         if cfg.gamma_analysis:
             try:
                 logger.debug("going to run gamma analysis, using ref dose = {}".format(cfg.ref_dose_path))
-                t0=datetime.now()
-                run_gamma_analysis(cfg.ref_dose_path,cfg.gamma_parameters,dose_sum_final,mhd_dose_final)
+                with instrumentation.span("gamma index") as s:
+                    pass_rate = run_gamma_analysis(cfg.ref_dose_path,cfg.gamma_parameters,dose_sum_final,mhd_dose_final,cfg.gamma_mode,cfg.ngammaworkers)
+                    if pass_rate is not None:
+                        s.attrs["pass rate"] = pass_rate
                 #ushort_imgref=itk.imread(cfg.ref_dose_path)
                 #aimgref=itk.GetArrayFromImage(ushort_imgref)*float(pydicom.dcmread(cfg.ref_dose_path).DoseGridScaling)
                 #imgref=itk.GetImageFromArray(np.float32(aimgref))
@@ -423,8 +378,7 @@ def post_processing(cfg,pdd,cul):
                 #g=get_gamma_index(ref=imgref,target=dose_sum_final,dta=dta_mm,dd=dd_percent, ddpercent=True,threshold=dosethr,defvalue=defgamma,verbose=False)
                 #itk.imwrite(g,mhd_dose_final.replace(".mhd","_gamma.mhd"))
                 #itk.imwrite(imgref,mhd_dose_final.replace(".mhd","_tpsdose.mhd"))
-                t1=datetime.now()
-                logger.debug("gamma index calculation took {} seconds".format((t1-t0).total_seconds()))
+                logger.debug("gamma index calculation took {} seconds".format(s.wall))
             except Exception as e:
                 logger.error("something went wrong when attempting to compute the gamma index distribution: {}".format(e))
     else:
@@ -472,8 +426,12 @@ class post_proc_config:
         self.nFractions=sec.getint("nfractions")
         self.dcm_beam_in=sec.get("dcm template")
         self.mass_mhd = sec.get("mass mhd","")
+        self.nreaders = sec.getint("number of dose reader threads",fallback=4)
+        self.nresamplers = min(sec.getint("number of resampling threads",fallback=1),os.cpu_count() or 1)
         # MFA 11/16/22
         self.gamma_analysis = sec.getboolean("run gamma analysis")
+        self.gamma_mode = sec.get("gamma analysis mode","map")
+        self.ngammaworkers = sec.getint("number of gamma workers",fallback=0)
         self.debug = sec.getboolean("debug")
         
         self.write_mhd_unscaled_dose = sec.getboolean("write mhd unscaled dose")
@@ -513,9 +471,14 @@ class post_proc_config:
 ######################################################################################
 # MAIN
 ######################################################################################
-if __name__ == '__main__':
+def postprocess(cfgpath="postprocessor.cfg"):
+    """
+    Run the postprocessing of all beams as configured in the postprocessing
+    config file `cfgpath`, which is written by `IDC_details.WritePostProcessingConfigFile`.
+    Returns True if the postprocessing of all beams was successful.
+    """
     parser=configparser.ConfigParser()
-    with open("postprocessor.cfg","r") as fp:
+    with open(cfgpath,"r") as fp:
         parser.read_file(fp)
     ok = True
     plan_dose_dict = dict()
@@ -528,12 +491,12 @@ if __name__ == '__main__':
     for beamname in parser.sections():
         if beamname=='default' or beamname=='user logs file':
             continue
-        t0 = datetime.now()
-        cfg = post_proc_config(parser,beamname)
-        # TODO: the post_processing now also includes the archiving (making a tarball of) the output directories of all subjobs. Maybe this needs to be separated.
-        success = post_processing(cfg,plan_dose_dict,cleanup_list)
-        t1 = datetime.now()
-        dt = (t1-t0).total_seconds()
+        with instrumentation.span("beam",beam=beamname) as s:
+            cfg = post_proc_config(parser,beamname)
+            # TODO: the post_processing now also includes the archiving (making a tarball of) the output directories of all subjobs. Maybe this needs to be separated.
+            success = post_processing(cfg,plan_dose_dict,cleanup_list)
+            s.ok = success
+        dt = s.wall
         if success:
             logger.info('SUCCESSFUL post processing (including the archiving of job data) of beam "{}" took {} seconds'.format(cfg.origname,dt))
         else:
@@ -546,7 +509,8 @@ if __name__ == '__main__':
             if cfg.dicom_plan_dose != "":
                 logger.debug(f"going to write {label} PLAN dose to DICOM")
                 plan_dose_dcm = str(os.path.join(str(cfg.output_dicom1), cfg.dicom_plan_dose.replace("PLAN.dcm",f"PLAN-{label}.dcm")))
-                image_2_dicom_dose(img_dose,cfg.dcm_plan_in,plan_dose_dcm,physical)
+                with instrumentation.span("plan dose dicom",label=label):
+                    image_2_dicom_dose(img_dose,cfg.dcm_plan_in,plan_dose_dcm,physical)
                 mhd_gamma = plan_dose_dcm[:-4]+".mhd"
                 logger.debug(f"finished writing {label} PLAN dose to DICOM")
             if cfg.mhd_plan_dose != "":
@@ -557,16 +521,18 @@ if __name__ == '__main__':
                 logger.debug(f"finished writing {label} PLAN dose to MHD")
             if cfg.ref_physical_plan_dose_path != "" and label.upper() == "PHYSICAL" and cfg.gamma_analysis:
                 logger.debug("start gamma index calculation PHYSICAL PLAN DOSE")
-                t0=datetime.now()
-                run_gamma_analysis(cfg.ref_physical_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma)
-                t1=datetime.now()
-                logger.debug("gamma index calculation PHYSICAL PLAN DOSE took {} seconds".format((t1-t0).total_seconds()))
+                with instrumentation.span("plan gamma index",label=label) as s:
+                    pass_rate = run_gamma_analysis(cfg.ref_physical_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma,cfg.gamma_mode,cfg.ngammaworkers)
+                    if pass_rate is not None:
+                        s.attrs["pass rate"] = pass_rate
+                logger.debug("gamma index calculation PHYSICAL PLAN DOSE took {} seconds".format(s.wall))
             elif cfg.ref_effective_plan_dose_path != "" and label.upper() == "RBE" and cfg.gamma_analysis:
                 logger.debug("start gamma index calculation EFFECTIVE PLAN DOSE")
-                t0=datetime.now()
-                run_gamma_analysis(cfg.ref_effective_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma)
-                t1=datetime.now()
-                logger.debug("gamma index calculation EFFECTIVE PLAN DOSE took {} seconds".format((t1-t0).total_seconds()))
+                with instrumentation.span("plan gamma index",label=label) as s:
+                    pass_rate = run_gamma_analysis(cfg.ref_effective_plan_dose_path,cfg.gamma_parameters,img_dose,mhd_gamma,cfg.gamma_mode,cfg.ngammaworkers)
+                    if pass_rate is not None:
+                        s.attrs["pass rate"] = pass_rate
+                logger.debug("gamma index calculation EFFECTIVE PLAN DOSE took {} seconds".format(s.wall))
         if cfg.output_dicom2:
             update_user_logs(cfg.user_cfg,status=f"DOSE POSTPROCESSING OK, COPYING DATA")
             try:
@@ -579,15 +545,14 @@ if __name__ == '__main__':
             logger.info("no second copy of dicom output")
         update_user_logs(cfg.user_cfg,status=f"POSTPROCESSING OK, CLEANING UP")
         logger.info("going to clean up the 'tmp' directory")
-        t0=datetime.now()
         tmp=os.path.join(os.curdir,'tmp')
-        shutil.rmtree(tmp)
-        t1=datetime.now()
-        logger.info("cleaning up the 'tmp' directory {} successful and took {} seconds".format("was NOT" if os.path.exists(tmp) else "was", (t1-t0).total_seconds()))
-        for outputdirs,statfiles in cleanup_list:
-            compress_jobdata(cfg,outputdirs,statfiles)
-        t2=datetime.now()
-        logger.info("compressing all output directories took {} seconds".format((t2-t1).total_seconds()))
+        with instrumentation.span("clean up tmp") as s:
+            shutil.rmtree(tmp)
+        logger.info("cleaning up the 'tmp' directory {} successful and took {} seconds".format("was NOT" if os.path.exists(tmp) else "was", s.wall))
+        with instrumentation.span("compress job data") as s:
+            for outputdirs,statfiles in cleanup_list:
+                compress_jobdata(cfg,outputdirs,statfiles)
+        logger.info("compressing all output directories took {} seconds".format(s.wall))
         # TODO i'm trying to send the files (i.e. put them on a specific folder for now)
 #        if api_cfg['receiver'].getboolean('send result'):
 #            try:
@@ -612,5 +577,11 @@ if __name__ == '__main__':
     else:
         update_user_logs(cfg.user_cfg,status=f"BEAM DOSE POST PROCESSING FAILED")
         logger.warn("NOT going to clean up the 'tmp' directory, to allow debugging of the reported errors")
+    return ok
+
+if __name__ == '__main__':
+    instrumentation.start_job_metrics(os.getcwd(),"POST")
+    with instrumentation.span("postprocessing") as s:
+        s.ok = postprocess()
 
 # vim: set et softtabstop=4 sw=4 smartindent:
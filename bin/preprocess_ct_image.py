@@ -29,13 +29,15 @@ import numpy as np
 #import SimpleITK as sitk
 import itk
 from datetime import datetime
-from utils.roi_utils import region_of_interest, list_roinames
+from utils.roi_utils import region_of_interest, list_roinames, get_label_map
 from utils.bounding_box import bounding_box
 from utils.ct_dicom_to_img import ct_image_from_dicom
 from utils.crop import crop_and_pad_image
 from utils.mass_image import create_mass_image
+from utils import instrumentation
 
 current_action=""
+user_logs=""
 
 def update_user_logs(user_cfg,status,section="DEFAULT",changes=dict()):
     # this function is used in three places, maybe I should upgrade it to a module
@@ -70,7 +72,8 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
 
     # step 1: obtain original CT and structure set from DICOM
     current_action="reading original CT"
-    ct_orig = itk.imread(mhd_orig_ct)
+    with instrumentation.span("read CT"):
+        ct_orig = itk.imread(mhd_orig_ct)
     act_orig = itk.GetArrayFromImage(ct_orig)
     current_action="reading structure set"
     structure_set = pydicom.dcmread(os.path.join(str(rpdir),str(ssdcm)))
@@ -94,39 +97,32 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
     act_orig[mask] = hu_max
 
     # step 2c: enforce air outside of external
-    current_action="overriding voxels outside external ROI with G4_AIR"
+    # step 2d: apply other HU overrides
+    # Both steps are done with one label map for the external and the override ROIs, rasterized in one go.
+    # In the label map, later ROIs have priority, so the result is the same as first setting air outside the
+    # external and then applying the overrides one by one, in the order of the HU override list.
+    current_action="overriding voxels outside external ROI with G4_AIR and materials inside given ROIs"
     ext_roi = region_of_interest(ds=structure_set,roi_id=external)
-    ext_mask = ext_roi.get_mask(ct_orig,corrected=False)
-    ext_array = itk.GetArrayViewFromImage(ext_mask)>0
-    act_orig[np.logical_not(ext_array)] = hu_air
-    ntot = np.prod(ext_array.shape)
-    nin = np.sum(ext_array)
+    override_rois = [(roiname,huval) for roiname,huval in HUoverride.items() if roiname[0] != "!"]
+    rois = [ext_roi] + [region_of_interest(ds=structure_set,roi_id=roiname) for roiname,huval in override_rois]
+    with instrumentation.span("label map",nrois=len(rois)):
+        labels,counts = get_label_map(rois,ct_orig)
+    alabels = itk.GetArrayViewFromImage(labels)
+    if not act_orig.flags.contiguous:
+        act_orig=np.ascontiguousarray(act_orig)
+    # label 0: outside all ROIs (air), label 1: inside external only (no override), label k>1: override ROI k-1
+    hu_labels = np.array([hu_air,0]+[huval for roiname,huval in override_rois]).astype(act_orig.dtype)
+    override = alabels!=1
+    act_orig[override] = hu_labels[alabels[override]]
+    ntot = np.prod(alabels.shape)
+    nin = counts[0]
     nout = ntot-nin
     update_user_logs(user_logs,"PREPROCESSING AIR OVERRIDE COMPLETE",section="CT",
             changes={"orig ct nr voxels [total,external,air]":f"{ntot},{nin},{nout}"})
-
-    # step 2d: apply other HU overrides
-    current_action="overriding materials inside given ROIs"
-    n_override=0
-    n_rois=0
-    for roiname,huval in HUoverride.items():
-        if roiname[0] == "!":
-            continue
-        roi = region_of_interest(ds=structure_set,roi_id=roiname)
-        mask = roi.get_mask(ct_orig,corrected=False)
-        aroi = itk.GetArrayViewFromImage(mask)>0
-        logger.debug("applying material override HU={} inside ROI '{}' on {} voxels".format(int(huval),roiname,np.sum(aroi)))
-        logger.debug("aroi is contiguous: {}".format("YES" if aroi.flags.contiguous else "NO"))
-        if not aroi.flags.contiguous:
-            aroi=np.ascontiguousarray(aroi)
-            logger.debug("NOW aroi is contiguous: {}".format("YES" if aroi.flags.contiguous else "NO"))
-        logger.debug("act_orig is contiguous: {}".format("YES" if act_orig.flags.contiguous else "NO"))
-        if not act_orig.flags.contiguous:
-            act_orig=np.ascontiguousarray(act_orig)
-            logger.debug("NOW act_orig is contiguous: {}".format("YES" if act_orig.flags.contiguous else "NO"))
-        act_orig[aroi] = huval
-        n_override += np.sum(aroi)
-        n_rois += 1
+    for (roiname,huval),n in zip(override_rois,counts[1:]):
+        logger.debug("applied material override HU={} inside ROI '{}' on {} voxels".format(int(huval),roiname,n))
+    n_override=np.sum(counts[1:])
+    n_rois=len(override_rois)
     logger.debug("converting ct array back to ITK image")
     ct_hu_overrides = itk.GetImageFromArray(act_orig)
     logger.debug("copying information")
@@ -163,7 +159,8 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
     #ibbmax = np.array(ct_padded.TransformPhysicalPointToIndex(ct_bb.maxcorner-0.01))+1
     ibbmin,ibbmax = ct_bb.indices_in_image(ct_padded)
     logger.debug("size of padded CT: {}, going to crop-and-pad from index {} to index {}".format(np.array(ct_padded.GetLargestPossibleRegion().GetSize()),ibbmin,ibbmax))
-    ct_overrides = crop_and_pad_image(ct_padded,ibbmin,ibbmax,hu_air)
+    with instrumentation.span("crop and pad"):
+        ct_overrides = crop_and_pad_image(ct_padded,ibbmin,ibbmax,hu_air)
     logger.debug("finished crop and pad")
     update_user_logs(user_logs,"PREPROCESSING CROPPING/PADDING COMPLETE")
 
@@ -175,8 +172,9 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
     spacing = dose_grid_size / dose_grid_nvoxels
     dose_grid_dummy.SetOrigin(dose_grid_center-0.5*dose_grid_size+0.5*spacing)
     dose_grid_dummy.SetSpacing(spacing)
-    dose_grid_mask=ext_roi.get_mask(dose_grid_dummy,corrected=False)
-    itk.imwrite(dose_grid_mask,mhd_dose_grid_mask)
+    with instrumentation.span("dose mask"):
+        dose_grid_mask=ext_roi.get_mask(dose_grid_dummy,corrected=False)
+        itk.imwrite(dose_grid_mask,mhd_dose_grid_mask)
     logger.debug("finished creationg of dose mask for performing 'no dose outside of external' filter")
     update_user_logs(user_logs,"PREPROCESSING DOSE MASK COMPLETE")
 
@@ -184,21 +182,28 @@ def GetMCPatientCTImage(rpdir,ssdcm,ctuid,HUoverride,HU_override_density,hlut_pa
     # step 6: write output
     current_action="writing preprocessed CT image"
     logger.debug("writing cropped, padded and overridden CT image to {}".format(mhd_overrides))
-    itk.imwrite(ct_overrides,mhd_overrides)
+    with instrumentation.span("write CT"):
+        itk.imwrite(ct_overrides,mhd_overrides)
     mhd_mass=mhd_overrides.replace(".mhd","_mass.mhd")
     current_action="creating mass file"
-    mass_image = create_mass_image(ct_overrides,hlut_path,overrides=HU_override_density)
-    logger.debug("writing corresponding mass image to {}".format(mhd_mass))
-    current_action="writing mass file"
-    itk.imwrite(mass_image,mhd_mass)
+    with instrumentation.span("mass image"):
+        mass_image = create_mass_image(ct_overrides,hlut_path,overrides=HU_override_density)
+        logger.debug("writing corresponding mass image to {}".format(mhd_mass))
+        current_action="writing mass file"
+        itk.imwrite(mass_image,mhd_mass)
     update_user_logs(user_logs,"PREPROCESSING COMPLETE")
 
-if __name__ == '__main__':
+def preprocess(cfgpath="preprocessor.cfg"):
+    """
+    Run the preprocessing as configured in the preprocessing config file
+    `cfgpath`, which is written by `IDC_details.WritePreProcessingConfigFile`.
+    """
+    global user_logs
     parser=configparser.RawConfigParser()
     parser.optionxform = lambda option : option
     logger.debug('going to read CT and dose grid specs from preprocesssing config file')
     try:
-        with open("preprocessor.cfg","r") as fp:
+        with open(cfgpath,"r") as fp:
             parser.read_file(fp)
         user_logs            = parser['user logs file']['path']
         dicom                = parser['dicom']
@@ -245,4 +250,9 @@ if __name__ == '__main__':
         update_user_logs(user_logs,f"PREPROCESSING FAILED WHILE {current_action}, check preprocessor.log")
         raise
 
+if __name__ == '__main__':
+    instrumentation.start_job_metrics(os.getcwd(),"PRE")
+    with instrumentation.span("preprocessing"):
+        preprocess()
+
 # vim: set et softtabstop=4 sw=4 smartindent:
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Generate the HLUT cache (interpolated materials database and HU-to-material
+table) for all Schneider type CT protocols in hlut.conf, in parallel, such that
+the first IDEAL jobs with a new CT protocol or density tolerance do not have to
+wait for it.
+"""
+
+import sys
+import logging
+from impl.system_configuration import get_sysconfig
+from impl.hlut_conf import hlut_conf
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-v","--verbose",default=False,action='store_true',
+            help="be verbose")
+    parser.add_argument("-S","--sysconfig",default="",
+            help="alternative system configuration file (default is <installdir>/cfg/system.cfg")
+    parser.add_argument("-t","--hutol",type=float,default=None,
+            help="density tolerance value in g/cm3 (default: from the system configuration)")
+    parser.add_argument("-j","--jobs",type=int,default=0,
+            help="number of Gate jobs to run in parallel (default: number of cores)")
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    sysconfig = get_sysconfig(filepath = args.sysconfig,
+                              verbose  = args.verbose,
+                              debug    = False,
+                              want_logfile = "")
+    logger = logging.getLogger()
+    results = hlut_conf.getInstance().prewarm_cache(hutol=args.hutol,nworkers=args.jobs)
+    failed = [name for name,(ok,cache_dir) in results.items() if not ok]
+    for name,(ok,cache_dir) in results.items():
+        print("{:8s} {} {}".format("OK" if ok else "FAILED",name,cache_dir))
+    sys.exit(1 if failed else 0)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
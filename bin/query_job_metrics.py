@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Summarize the stage metrics (time, memory and I/O per span) that IDEAL jobs
+record in their metrics file (ideal_metrics.jsonl in the work directory), as
+percentiles over the completed jobs. With "--group-by version" the percentiles
+are given per IDEAL version, to see which stage got slower (or faster) after
+an update.
+"""
+
+import os
+import sys
+import json
+from utils import instrumentation
+
+# short name, unit and scale factor for printing
+quantity_units = {"wall":("wall","s",1.),"cpu":("cpu","s",1.),"peak_rss_mb":("rss","MB",1.),
+                  "read_bytes":("read","MB",2.**-20),"write_bytes":("write","MB",2.**-20)}
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths",nargs="*",
+            help="metrics files, work directories, job directories or directories with jobs (default: the 'tmpdir jobs' directory of the system configuration)")
+    parser.add_argument("-S","--sysconfig",default="",
+            help="alternative system configuration file (default is <installdir>/cfg/system.cfg")
+    parser.add_argument("-a","--all",default=False,action='store_true',
+            help="include jobs that did not (yet) complete the postprocessing")
+    parser.add_argument("-s","--since",default="",
+            help="only include jobs that started on or after this date (YYYY-MM-DD)")
+    parser.add_argument("-g","--group-by",default="",choices=["","version","host"],
+            help="give the percentiles for each IDEAL version or host separately")
+    parser.add_argument("-p","--percentiles",type=float,nargs="+",default=[50,90,95],
+            help="percentiles to compute (default: 50 90 95)")
+    parser.add_argument("-q","--quantities",nargs="+",default=["wall","peak_rss_mb"],choices=list(quantity_units.keys()),
+            help="quantities to summarize (default: wall peak_rss_mb)")
+    parser.add_argument("-j","--json",default=False,action='store_true',
+            help="print the summary as JSON instead of a table")
+    args = parser.parse_args()
+    return args
+
+def print_table(summary,percentiles,quantities):
+    pnames = ["p{:g}".format(p) for p in percentiles]
+    header = "{:9s} {:45s} {:>5s}".format("stage","span","njobs")
+    for q in quantities:
+        short,unit,scale = quantity_units[q]
+        header += "".join([" {:>14s}".format("{} {}[{}]".format(short,p,unit)) for p in pnames])
+    for group,spans in summary.items():
+        if group is not None:
+            print("\n=== {} ===".format(group))
+        print(header)
+        for (stage,name),stats in spans.items():
+            line = "{:9s} {:45s} {:5d}".format(stage,name[-45:],stats["njobs"])
+            for q in quantities:
+                short,unit,scale = quantity_units[q]
+                values = stats.get(q,{})
+                line += "".join([" {:14.3g}".format(scale*values[p]) if p in values else " {:>14s}".format("-") for p in pnames])
+            print(line)
+
+if __name__ == '__main__':
+    args = get_args()
+    paths = args.paths
+    if not paths:
+        from impl.system_configuration import get_sysconfig
+        sysconfig = get_sysconfig(filepath = args.sysconfig,
+                                  verbose  = False,
+                                  debug    = False,
+                                  want_logfile = "")
+        paths = [sysconfig['tmpdir jobs']]
+    files = list()
+    for path in paths:
+        files += [path] if os.path.isfile(path) else instrumentation.find_job_metrics_files(path)
+    jobs = dict()
+    nincomplete = 0
+    for f in files:
+        records = instrumentation.read_job_metrics(f)
+        if args.since and min([r.get("start","") for r in records],default="") < args.since:
+            continue
+        if not args.all and not instrumentation.job_completed(records):
+            nincomplete += 1
+            continue
+        jobs[f] = records
+    print("found {} metrics files, {} jobs selected, {} incomplete jobs skipped".format(len(files),len(jobs),nincomplete),file=sys.stderr)
+    summary = instrumentation.summarize_jobs(jobs,args.percentiles,args.quantities,group_by=args.group_by or None)
+    if args.json:
+        print(json.dumps(dict([("all" if group is None else str(group),[dict(stage=stage,span=name,**stats) for (stage,name),stats in spans.items()])
+                               for group,spans in summary.items()]),indent=2))
+    else:
+        print_table(summary,args.percentiles,args.quantities)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -6,6 +6,6 @@ if __name__ == '__main__':
 	pids = get_pids(daemon)
 	
 	for pid in pids:
-		kill_process(pid)
+		kill_process(pid,script=daemon)
 		  
 
@@ -6,12 +6,14 @@ from impl.beamline_model import beamline_model
 from impl.hlut_conf import hlut_conf
 from impl.system_configuration import system_configuration
 from utils.dose_info import dose_info
+from utils.dicom_index import dicom_index
 from utils.beamset_info import beam_info
 from glob import glob
 
 class dicom_files:
     def __init__(self,rp_path):
         self.dcm_dir =  os.path.dirname(rp_path) # directory with all dicom files
+        self.dcm_index = dicom_index(self.dcm_dir) # header-only index of the dicom files
         # RP
         print("Get RP file")
         self.rp_path = rp_path
@@ -21,7 +23,7 @@ class dicom_files:
         self.beams = [beam_info(b,i,self.beam_numbers_corrupt) for i,b in enumerate(self.rp_data.IonBeamSequence)]
         # RD
         print("Get RD files")
-        self.rds = dose_info.get_dose_files(self.dcm_dir,self.uid) #dictionary with dose[BeamNr]= doseObj containing dose image and so on. One for each RD file
+        self.rds = dose_info.get_dose_files(self.dcm_dir,self.uid,index=self.dcm_index) #dictionary with dose[BeamNr]= doseObj containing dose image and so on. One for each RD file
         # RS
         print("Get RS file")
         self.rs_data = None
@@ -96,34 +98,14 @@ class dicom_files:
     def get_RS_file(self):
         ss_ref_uid = self.rp_data.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID
         print("going to try to find the file with structure set with UID '{}'".format(ss_ref_uid))
-        nskip=0
-        ndcmfail=0
-        nwrongtype=0
-        nfiles=len([s for s in os.listdir(self.dcm_dir)])
-        for s in os.listdir(self.dcm_dir):
-            if s[-4:].lower() != '.dcm':
-                nskip+=1
-                print("no .dcm suffix: {}".format(s))
-                continue
-            try:
-                #print(s)
-                ds = pydicom.dcmread(os.path.join(self.dcm_dir,s))
-                dcmtype = ds.SOPClassUID.name
-            except:
-                ndcmfail+=1
-                continue
-            if dcmtype == "RT Structure Set Storage" and ss_ref_uid == ds.SOPInstanceUID:
-                print("found structure set for CT: {}".format(s))
-                self.rs_data = ds
-                self.rs_path = os.path.join(self.dcm_dir,s)
-                break
-            else:
-                nwrongtype+=1
-                #print("rejected structure set for CT: {}".format(s))
-                #print("because it as a wrong SOP class ID: {}".format(dcmtype))
-                #print("AND/OR because it has the wrong SOP Instance UID: {} != {}".format(ds.SOPInstanceUID,ss_ref_uid))
+        for s in self.dcm_index.find(SOPClassName="RT Structure Set Storage",SOPInstanceUID=ss_ref_uid):
+            print("found structure set for CT: {}".format(s))
+            self.rs_data = pydicom.dcmread(os.path.join(self.dcm_dir,s))
+            self.rs_path = os.path.join(self.dcm_dir,s)
+            break
         if self.rs_data is None:
-            raise RuntimeError("could not find structure set with UID={}; skipped {} with wrong suffix, got {} with 'dcm' suffix but pydicom could not read it, got {} with wrong class UID and/or instance UID. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,nskip,ndcmfail,nwrongtype))
+            nfail = len(self.dcm_index.find(readable="no"))
+            raise RuntimeError("could not find structure set with UID={}; got {} files with 'dcm' suffix, pydicom could not read {} of them, the others have the wrong class UID and/or instance UID. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,len(self.dcm_index),nfail))
 
     def get_CT_files(self):
         dcmseries_reader = itk.GDCMSeriesFileNames.New(Directory=self.dcm_dir)
@@ -145,11 +127,14 @@ class dicom_files:
             for suid in ids:
                 #flist = sitk.ImageSeriesReader_GetGDCMSeriesFileNames(ddir,suid)
                 flist = dcmseries_reader.GetFileNames(suid)
-                f0 = pydicom.dcmread(flist[0])
-                if not hasattr(f0,'SOPClassUID'):
+                if flist[0] in self.dcm_index:
+                    descr = self.dcm_index.header(flist[0])["SOPClassName"]
+                else:
+                    f0 = pydicom.dcmread(flist[0],stop_before_pixels=True)
+                    descr = f0.SOPClassUID.name if hasattr(f0,'SOPClassUID') else ""
+                if not descr:
                     logger.warn("weird, file {} has no SOPClassUID".format(os.path.basename(flist[0])))
                     continue
-                descr = pydicom.uid.UID_dictionary[f0.SOPClassUID][0]
                 if descr == 'CT Image Storage':
                     print('found CT series id {}'.format(suid))
                     ctid.append(suid)
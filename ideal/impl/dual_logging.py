@@ -115,7 +115,12 @@ def create_logger(loggerName, filepath):
     return logger
         
 
-def get_high_level_logfile():
+def get_global_logfile_path():
+    """
+    Path of the high level log file, as configured in the log daemon
+    configuration file, or None if IDEAL was installed without log daemon
+    configuration (e.g. on a test machine).
+    """
     this_cmd = os.path.abspath(__file__)
     impl_dir = os.path.dirname(this_cmd)
     ideal_dir = os.path.dirname(impl_dir)
@@ -123,7 +128,16 @@ def get_high_level_logfile():
     cfg = configparser.ConfigParser()
 
     cfg.read(os.path.join(install_dir,'cfg/log_daemon.cfg'))
-    logfilename= cfg['Paths']['global logfile']
+    if not cfg.has_option('Paths','global logfile'):
+        return None
+    return cfg['Paths']['global logfile']
+
+def get_high_level_logfile():
+    logfilename = get_global_logfile_path()
+    logger = logging.getLogger("high_log")
+    if logfilename is None:
+        logging.getLogger(__name__).debug("no log daemon configuration, high level logs are not saved")
+        return logger
     # Get file handler to high level log file
     lockfile = logfilename + '.lock'
     lock = SoftFileLock(lockfile)
@@ -143,14 +157,9 @@ def get_high_level_logfile():
     return logger
 
 def get_last_log_ID():
-    this_cmd = os.path.abspath(__file__)
-    impl_dir = os.path.dirname(this_cmd)
-    ideal_dir = os.path.dirname(impl_dir)
-    install_dir = os.path.dirname(ideal_dir)
-    cfg = configparser.ConfigParser()
-
-    cfg.read(os.path.join(install_dir,'cfg/log_daemon.cfg'))
-    logfilename= cfg['Paths']['global logfile']
+    logfilename = get_global_logfile_path()
+    if logfilename is None:
+        return 0
     
     lockfile = logfilename + '.lock'
     lock = SoftFileLock(lockfile)
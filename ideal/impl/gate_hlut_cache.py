@@ -5,14 +5,38 @@
 #   See LICENSE for further details
 # -----------------------------------------------------------------------------
 
+"""
+This module takes care of the "HLUT cache": for each combination of Schneider
+density and composition tables and density tolerance value, Gate is used (once)
+to generate an interpolated materials database and a HU-to-material table,
+which are saved in a cache directory ``CT/cache/<hash>/<tolerance>`` in the
+commissioning data directory.
+
+Several IDEAL jobs (threads or processes) may need the same HLUT at the same
+time. The ``hlut_cache_manager`` makes sure that every cache directory is
+generated only once: concurrent requests within one process wait for the same
+generation, different processes are serialized with a lock file per cache
+entry (an OS lock, which is released when the process holding it dies). The tables are generated in a temporary directory which is renamed to
+the final cache directory only after a successful generation, so that a cache
+directory is either complete or does not exist.
+"""
+
 import os,stat
 import hashlib
 import shutil
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from filelock import FileLock, Timeout
 import logging
 from impl.system_configuration import system_configuration
 logger=logging.getLogger(__name__)
 
+HUMATDB = 'patient-HUmaterials.db'
+HU2MATTXT = 'patient-HU2mat.txt'
+
 def hlut_hash(density,composition):
     h4sh = hashlib.md5()
     for f in [density,composition]:
@@ -23,59 +47,292 @@ def hlut_hash(density,composition):
                 h4sh.update(bytes(line,encoding='utf-8'))
     return h4sh.hexdigest()
 
-def hlut_cache_dir(density,composition,HUtol,create=False):
-    syscfg = system_configuration.getInstance()
-    h4sh = hlut_hash(density,composition)
-    cache_dir = os.path.join(syscfg['CT'],'cache',h4sh,str(HUtol))
-    if os.path.isdir(cache_dir):
-        return cache_dir
-    elif create:
-        os.makedirs(cache_dir,exist_ok=True)
-        # store original density and composition files
+def hlut_cache_complete(cache_dir):
+    """
+    Check that the cache directory exists and contains both generated files.
+    """
+    return os.path.exists(os.path.join(cache_dir,HUMATDB)) and os.path.exists(os.path.join(cache_dir,HU2MATTXT))
+
+def hlut_cache_dir(density,composition,HUtol):
+    """
+    The complete cache directory for the given HLUT tables, or None if it was not generated yet.
+    """
+    return get_hlut_cache_manager().lookup(density,composition,HUtol)
+
+class gate_hlut_generator(object):
+    """
+    Default generator for the HLUT cache: run the ``hlut_gen_cache.mac`` Gate
+    macro for a given density file, composition file and density tolerance,
+    with the output files in a given directory. The generator script is written
+    in the output directory (not in a fixed location in /tmp), such that several
+    generations can run at the same time.
+    """
+    def __call__(self,density,composition,HUtol,db,outdir):
+        syscfg = system_configuration.getInstance()
+        if db is None:
+            materialsdb = os.path.join(syscfg['commissioning'],syscfg['materials database'])
+        else:
+            materialsdb = db
+        hlut_gen_cache_mac = os.path.join(syscfg['config dir'],'hlut_gen_cache.mac')
+        adict = dict([("MATERIALS_DB",              materialsdb),
+                      ("SCHNEIDER_COMPOSITION_FILE",composition),
+                      ("SCHNEIDER_DENSITY_FILE",    density),
+                      ("DENSITY_TOLERANCE",         HUtol),
+                      ("MATERIALS_INTERPOLATED",    os.path.join(outdir,HUMATDB)),
+                      ("HU2MAT_TABLE",              os.path.join(outdir,HU2MATTXT))])
+        aliases = "".join(["[{},{}]".format(name,val) for name,val in adict.items()])
+        gensh = os.path.join(outdir,"hlut_gen_cache.sh")
+        tstart = datetime.now()
+        fd,gate_log = tempfile.mkstemp(prefix=tstart.strftime("hlut_gen_cache_%y_%m_%d_%H_%M_%S_"),suffix=".log",dir=syscfg['logging'])
+        os.close(fd)
+        with open(gensh,"w") as gensh_fh:
+            gensh_fh.write("#!/usr/bin/env bash\n")
+            gensh_fh.write("set -e\n")
+            gensh_fh.write("set -x\n")
+            gensh_fh.write("source {}\n".format(syscfg['gate_env.sh']))
+            gensh_fh.write("time Gate -a{} {} >& {}\n".format(aliases,hlut_gen_cache_mac,gate_log))
+        os.chmod(gensh,stat.S_IREAD|stat.S_IRWXU)
+        ret = subprocess.call([gensh])
+        tend = datetime.now()
+        os.remove(gensh)
+        logger.info("return code: {}, job took {} seconds".format(ret,(tend-tstart).total_seconds()))
+        logger.info("logs are in: {}".format(gate_log))
+        return ret==0
+
+class hlut_cache_manager(object):
+    """
+    Generate HLUT cache directories on demand, at most once per cache entry.
+
+    The `generator` is a callable `generator(density,composition,HUtol,db,outdir)`
+    which writes the two HLUT files in `outdir` and returns True on success; by
+    default Gate is run with `gate_hlut_generator`. A lock file next to the
+    cache directory is held during generation; `lock_timeout` (seconds) is
+    passed to the lock, the default -1 means: wait as long as it takes. The
+    lock is released by the OS if the generating process dies, a leftover lock
+    file does not block.
+    """
+    def __init__(self,cache_root,generator=None,lock_timeout=-1):
+        self.cache_root = cache_root
+        self.generator = gate_hlut_generator() if generator is None else generator
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+        self._pending = dict()
+    def cache_dir(self,density,composition,HUtol):
+        return os.path.join(self.cache_root,hlut_hash(density,composition),str(HUtol))
+    def lookup(self,density,composition,HUtol):
+        """
+        Return the cache directory if it is complete, None otherwise.
+        """
+        cache_dir = self.cache_dir(density,composition,HUtol)
+        return cache_dir if hlut_cache_complete(cache_dir) else None
+    def get(self,density,composition,HUtol,db=None):
+        """
+        Return a tuple (success, cache_dir), generating the cache directory if
+        necessary. If another thread is already generating the same cache
+        directory, wait for it and return its result.
+        """
+        cache_dir = self.cache_dir(density,composition,HUtol)
+        if hlut_cache_complete(cache_dir):
+            return True, cache_dir
+        with self._lock:
+            future = self._pending.get(cache_dir,None)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._pending[cache_dir] = future
+        if not owner:
+            logger.debug("waiting for generation of {} by another thread".format(cache_dir))
+            return future.result(), cache_dir
+        try:
+            success = self._generate(density,composition,HUtol,db,cache_dir)
+            future.set_result(success)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(cache_dir)
+        return success, cache_dir
+    def _generate(self,density,composition,HUtol,db,cache_dir):
         cache_parent = os.path.dirname(cache_dir)
-        # copying the input files so that you know to which protocol this cache dir corresponds
-        shutil.copy(density,os.path.join(cache_parent,os.path.basename(density)))
-        shutil.copy(composition,os.path.join(cache_parent,os.path.basename(composition)))
-        return cache_dir
-    # TODO: alternatively, throw something...
-    return None
+        os.makedirs(cache_parent,exist_ok=True)
+        lockfile = cache_dir+".lock"
+        try:
+            lock = FileLock(lockfile,timeout=self.lock_timeout)
+            lock.acquire()
+        except Timeout:
+            raise RuntimeError("timeout after {} seconds while waiting for {}: another process is generating the HLUT cache {}".format(self.lock_timeout,lockfile,cache_dir))
+        with lock:
+            if hlut_cache_complete(cache_dir):
+                logger.debug("{} was generated by another process".format(cache_dir))
+                return True
+            # copying the input files so that you know to which protocol this cache dir corresponds
+            for f in [density,composition]:
+                fd,tmpf = tempfile.mkstemp(prefix=".tmp.",dir=cache_parent)
+                os.close(fd)
+                shutil.copy(f,tmpf)
+                os.replace(tmpf,os.path.join(cache_parent,os.path.basename(f)))
+            tmpdir = tempfile.mkdtemp(prefix=".{}.tmp.".format(HUtol),dir=cache_parent)
+            logger.info("generating cache for {} and {} with density tolerance {} g/cm3".format(density,composition,HUtol))
+            logger.info("cache dir: {}".format(cache_dir))
+            try:
+                ret = self.generator(density,composition,HUtol,db,tmpdir)
+                dbl_chk = hlut_cache_complete(tmpdir)
+                logger.info("generator returned {}, new HLUT cache files {} exist.".format(ret,("DO" if dbl_chk else "DO NOT")))
+                success = bool(ret) and dbl_chk
+                if success:
+                    if os.path.isdir(cache_dir):
+                        # incomplete leftover from an earlier (failed) attempt
+                        shutil.rmtree(cache_dir)
+                    os.rename(tmpdir,cache_dir)
+            finally:
+                if os.path.isdir(tmpdir):
+                    shutil.rmtree(tmpdir,ignore_errors=True)
+        return success
+    def prewarm(self,tables,nworkers=None):
+        """
+        Generate the cache directories for a list of (density,composition,HUtol)
+        tuples, running up to `nworkers` generations in parallel (default: the
+        number of cores). Returns a list with a (success,cache_dir) tuple for
+        each input tuple. Failures are logged, not raised.
+        """
+        def prewarm_one(table):
+            try:
+                return self.get(*table)
+            except Exception as e:
+                logger.error("failed to generate HLUT cache for {}: {}".format(table,e))
+                return False, None
+        nworkers = nworkers if nworkers else os.cpu_count()
+        with ThreadPoolExecutor(max_workers=max(1,nworkers)) as pool:
+            return list(pool.map(prewarm_one,tables))
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_hlut_cache_manager():
+    """
+    The HLUT cache manager for the cache directory of the current system
+    configuration (created on first use).
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            syscfg = system_configuration.getInstance()
+            _manager = hlut_cache_manager(os.path.join(syscfg['CT'],'cache'))
+        return _manager
 
 def generate_hlut_cache(density,composition,HUtol,db=None):
-    syscfg = system_configuration.getInstance()
-    cache_dir = hlut_cache_dir(density,composition,HUtol,create=True)
-    if db is None:
-        materialsdb = os.path.join(syscfg['commissioning'],syscfg['materials database'])
-    else:
-        materialsdb = db
-    hlut_gen_cache_mac = os.path.join(syscfg['config dir'],'hlut_gen_cache.mac')
-    humatdb = os.path.join(cache_dir,'patient-HUmaterials.db')
-    hu2mattxt = os.path.join(cache_dir,'patient-HU2mat.txt')
-    adict = dict([("MATERIALS_DB",              materialsdb),
-                  ("SCHNEIDER_COMPOSITION_FILE",composition),
-                  ("SCHNEIDER_DENSITY_FILE",    density),
-                  ("DENSITY_TOLERANCE",         HUtol),
-                  ("MATERIALS_INTERPOLATED",    humatdb),
-                  ("HU2MAT_TABLE",              hu2mattxt)])
-    aliases = "".join(["[{},{}]".format(name,val) for name,val in adict.items()])
-    gensh = os.path.join("/tmp","hlut_gen_cache.sh")
-    tstart = datetime.now()
-    gate_log = os.path.join(syscfg['logging'],tstart.strftime("hlut_gen_cache_%y_%m_%d_%H_%M_%S.log"))
-    with open(gensh,"w") as gensh_fh:
-        gensh_fh.write("#!/usr/bin/env bash\n")
-        gensh_fh.write("set -e\n")
-        gensh_fh.write("set -x\n")
-        gensh_fh.write("source {}\n".format(syscfg['gate_env.sh']))
-        gensh_fh.write("time Gate -a{} {} >& {}\n".format(aliases,hlut_gen_cache_mac,gate_log))
-    os.chmod(gensh,stat.S_IREAD|stat.S_IRWXU)
-    logger.info("generating cache for {} and {} with density tolerance {} g/cm3".format(density,composition,HUtol))
-    logger.info("cache dir: {}".format(cache_dir))
-    #ret=os.system( gensh + " >& " + gate_log )
-    ret=os.system( gensh )
-    tend=datetime.now()
-    dbl_chk = os.path.exists(humatdb) and os.path.exists(hu2mattxt)
-    logger.info("return code: {}, job took {} seconds, new HLUT cache files {} exist.".format(ret,(tend-tstart).total_seconds(),("DO" if dbl_chk else "DO NOT")))
-    logger.info("logs are in: {}".format(gate_log))
-    success = (ret==0) and dbl_chk
-    return success, cache_dir
+    return get_hlut_cache_manager().get(density,composition,HUtol,db)
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import time
+import sys
+
+class _test_generator(object):
+    """
+    Stub generator: writes dummy HLUT files instead of running Gate.
+    """
+    def __init__(self,delay=0.,fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.ncalls = 0
+        self.nrunning = 0
+        self.maxrunning = 0
+        self.lock = threading.Lock()
+    def __call__(self,density,composition,HUtol,db,outdir):
+        with self.lock:
+            self.ncalls += 1
+            self.nrunning += 1
+            self.maxrunning = max(self.maxrunning,self.nrunning)
+        time.sleep(self.delay)
+        with open(os.path.join(outdir,HU2MATTXT),"w") as fp:
+            fp.write("-1024 0 G4_AIR\n")
+        if not self.fail:
+            with open(os.path.join(outdir,HUMATDB),"w") as fp:
+                fp.write("[Materials]\n")
+        with self.lock:
+            self.nrunning -= 1
+        return not self.fail
+
+class Test_HLUTCacheManager(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_root = os.path.join(self.tmpdir,"cache")
+        self.tables = list()
+        for i in range(3):
+            density = os.path.join(self.tmpdir,"density{}.txt".format(i))
+            composition = os.path.join(self.tmpdir,"composition{}.txt".format(i))
+            with open(density,"w") as fp:
+                fp.write("-1000 0.0012\n{} 1.0\n".format(i))
+            with open(composition,"w") as fp:
+                fp.write("-1000 G4_AIR\n")
+            self.tables.append((density,composition,0.1))
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_concurrent_get(self):
+        gen = _test_generator(delay=0.2)
+        mgr = hlut_cache_manager(self.cache_root,gen)
+        self.assertIsNone(mgr.lookup(*self.tables[0]))
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda i: mgr.get(*self.tables[0]),range(8)))
+        self.assertEqual(gen.ncalls,1)
+        cache_dir = mgr.cache_dir(*self.tables[0])
+        self.assertTrue(all(ok and d == cache_dir for ok,d in results))
+        self.assertTrue(hlut_cache_complete(cache_dir))
+        self.assertEqual(mgr.lookup(*self.tables[0]),cache_dir)
+        parent = os.path.dirname(cache_dir)
+        # the (OS) lock file stays, it is not held
+        self.assertEqual(sorted(os.listdir(parent)),sorted(["0.1","0.1.lock","density0.txt","composition0.txt"]))
+        # other process (other manager object) finds the complete directory
+        gen2 = _test_generator()
+        self.assertEqual(hlut_cache_manager(self.cache_root,gen2).get(*self.tables[0]),(True,cache_dir))
+        self.assertEqual(gen2.ncalls,0)
+    def test_failure(self):
+        mgr = hlut_cache_manager(self.cache_root,_test_generator(fail=True))
+        ok,cache_dir = mgr.get(*self.tables[1])
+        self.assertFalse(ok)
+        self.assertFalse(os.path.exists(cache_dir))
+        parent = os.path.dirname(cache_dir)
+        self.assertFalse([f for f in os.listdir(parent) if ".tmp." in f])
+        # incomplete leftover from earlier versions gets replaced
+        os.makedirs(cache_dir)
+        mgr.generator = _test_generator()
+        self.assertEqual(mgr.get(*self.tables[1]),(True,cache_dir))
+        self.assertTrue(hlut_cache_complete(cache_dir))
+    def test_lock(self):
+        gen = _test_generator()
+        mgr = hlut_cache_manager(self.cache_root,gen,lock_timeout=1)
+        cache_dir = mgr.cache_dir(*self.tables[2])
+        # a lock file left behind by a killed process does not block
+        os.makedirs(os.path.dirname(cache_dir))
+        with open(cache_dir+".lock","w") as fp:
+            fp.write("")
+        self.assertEqual(mgr.get(*self.tables[2]),(True,cache_dir))
+        self.assertEqual(gen.ncalls,1)
+        # a lock that is held by another process: clear error after the timeout
+        os.remove(os.path.join(cache_dir,HUMATDB))
+        script = "import time\nfrom filelock import FileLock\nwith FileLock('{}'):\n    print('locked',flush=True)\n    time.sleep(10)\n".format(cache_dir+".lock")
+        proc = subprocess.Popen([sys.executable,"-c",script],stdout=subprocess.PIPE,text=True)
+        try:
+            self.assertEqual(proc.stdout.readline().strip(),"locked")
+            with self.assertRaises(RuntimeError):
+                mgr.get(*self.tables[2])
+        finally:
+            proc.kill()
+            proc.wait()
+        self.assertEqual(mgr.get(*self.tables[2]),(True,cache_dir))
+        self.assertEqual(gen.ncalls,2)
+    def test_prewarm(self):
+        gen = _test_generator(delay=0.2)
+        mgr = hlut_cache_manager(self.cache_root,gen)
+        results = mgr.prewarm(self.tables+self.tables,nworkers=3)
+        self.assertEqual(len(results),6)
+        self.assertTrue(all(ok for ok,d in results))
+        self.assertEqual(gen.ncalls,3)
+        self.assertEqual(gen.maxrunning,3)
 
 # vim: set et softtabstop=4 sw=4 smartindent:
@@ -50,7 +50,7 @@ multiple results, an exception is thrown and the user should try again.
 """
 
 from impl.system_configuration import system_configuration
-from impl.gate_hlut_cache import generate_hlut_cache, hlut_cache_dir
+from impl.gate_hlut_cache import generate_hlut_cache, hlut_cache_dir, get_hlut_cache_manager
 import os
 import configparser
 import pydicom
@@ -152,7 +152,7 @@ class hlut:
         if hutol is not None:
             self.hutol = hutol
         if self.type == "Schneider":
-            self.cache_dir = hlut_cache_dir(self.density,self.composition,self.hutol,create=False)
+            self.cache_dir = hlut_cache_dir(self.density,self.composition,self.hutol)
             if self.cache_dir is None:
                 # this will run Gate to run the db/hu2mat generation if necessary
                 ok,self.cache_dir = generate_hlut_cache(self.density,self.composition,self.hutol)
@@ -283,6 +283,21 @@ class hlut_conf:
         return self.__all_hluts.values()
     def items(self):
         return self.__all_hluts.items()
+    def prewarm_cache(self,hutol=None,nworkers=None):
+        """
+        Generate the HU-to-material tables for all Schneider type CT protocols
+        that do not have them in the cache yet, running up to `nworkers` Gate
+        jobs in parallel. Returns a dictionary with for each Schneider protocol
+        name a (success, cache_dir) tuple.
+        """
+        schneiders = [(name,h) for name,h in self.__all_hluts.items() if h.type == "Schneider"]
+        tables = [(h.density,h.composition,h.hutol if hutol is None else hutol) for name,h in schneiders]
+        results = get_hlut_cache_manager().prewarm(tables,nworkers)
+        for (name,h),(ok,cache_dir) in zip(schneiders,results):
+            if ok and hutol is None:
+                h.cache_dir = cache_dir
+            logger.info(f"CT protocol '{name}': cache {'OK' if ok else 'FAILED'} in {cache_dir}")
+        return dict([(name,result) for (name,h),result in zip(schneiders,results)])
     def hlut_match_keyword(self,kw):
         """
         This method compares a user-provided keyword (e.g. from the -c option for
@@ -20,6 +20,8 @@ from impl.hlut_conf import hlut_conf
 from utils.bounding_box import bounding_box
 from utils.roi_utils import region_of_interest, list_roinames
 from utils.ct_dicom_to_img import ct_image_from_dicom
+from utils.ct_volume_cache import ct_volume_cache
+from utils.dicom_index import dicom_index
 from utils.beamset_info import beamset_info
 from utils.crop import crop_image
 from impl.dicom_dose_template import write_dicom_dose_template
@@ -143,36 +145,24 @@ class IDC_details:
             logger.debug("got plan dose info")
             ss_ref_uid = self.rp_dataset.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID
             logger.debug("going to try to find the file with structure set with UID '{}'".format(ss_ref_uid))
-            nskip=0
-            ndcmfail=0
-            nwrongtype=0
-            nfiles=len([s for s in os.listdir(rpdir)])
-            for s in os.listdir(rpdir):
-                if s[-4:].lower() != '.dcm':
-                    nskip+=1
-                    logger.debug("no .dcm suffix: {}".format(s))
-                    continue
-                try:
-                    logger.debug(s)
-                    ds = pydicom.dcmread(os.path.join(rpdir,s))
-                    dcmtype = ds.SOPClassUID.name
-                except:
-                    ndcmfail+=1
-                    continue
-                if dcmtype == "RT Structure Set Storage" and ss_ref_uid == ds.SOPInstanceUID:
-                    logger.debug("found structure set for CT: {}".format(s))
-                    ct_series_uid = ds.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0].RTReferencedSeriesSequence[0].SeriesInstanceUID
-                    self.structure_set = ds
-                    self.structure_set_filename = s
-                    break
-                else:
-                    nwrongtype+=1
-                    logger.debug("rejected structure set for CT: {}".format(s))
-                    logger.debug("because it as a wrong SOP class ID: {}".format(dcmtype))
-                    logger.debug("AND/OR because it has the wrong SOP Instance UID: {} != {}".format(ds.SOPInstanceUID,ss_ref_uid))
+            # header-only index of the plan directory, only the structure set file is read completely
+            dcm_index = dicom_index(rpdir)
+            for s in dcm_index.find(SOPClassName="RT Structure Set Storage",SOPInstanceUID=ss_ref_uid):
+                logger.debug("found structure set for CT: {}".format(s))
+                ds = pydicom.dcmread(os.path.join(rpdir,s))
+                ct_series_uid = ds.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0].RTReferencedSeriesSequence[0].SeriesInstanceUID
+                self.structure_set = ds
+                self.structure_set_filename = s
+                break
             if self.structure_set is None:
-                raise RuntimeError("could not find structure set with UID={}; skipped {} with wrong suffix, got {} with 'dcm' suffix but pydicom could not read it, got {} with wrong class UID and/or instance UID. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,nskip,ndcmfail,nwrongtype))
-            self.ct_info = ct_image_from_dicom(rpdir,uid=ct_series_uid)
+                nfail = len(dcm_index.find(readable="no"))
+                raise RuntimeError("could not find structure set with UID={}; got {} files with 'dcm' suffix, pydicom could not read {} of them, the others have the wrong class UID and/or instance UID. It could well be that this is a commissioning plan without CT and structure set data.".format(ss_ref_uid,len(dcm_index),nfail))
+            syscfg = system_configuration.getInstance()
+            ct_cache_gb = syscfg['ct volume cache size [GB]']
+            ct_cache = ct_volume_cache(os.path.join(syscfg['tmpdir jobs'],".ct_volume_cache"),ct_cache_gb*2**30) if ct_cache_gb > 0 else None
+            ct_nthreads = syscfg['number of ct reader threads']
+            self.ct_info = ct_image_from_dicom(rpdir,uid=ct_series_uid,cache=ct_cache,
+                                               engine="threads" if ct_nthreads > 0 else "serial",nthreads=ct_nthreads)
             logger.debug("image spacing is {}".format(self.ct_info.img.GetSpacing()))
             logger.debug("image size is {}".format(self.ct_info.img.GetLargestPossibleRegion().GetSize()))
             logger.debug("image origin is {}".format(self.ct_info.img.GetOrigin()))
@@ -527,6 +517,8 @@ class IDC_details:
         parser=configparser.RawConfigParser()
         parser.optionxform = lambda option : option
         parser['DEFAULT']["run gamma analysis"]       = str(syscfg["run gamma analysis"])
+        parser['DEFAULT']["gamma analysis mode"]      = syscfg["gamma analysis mode"]
+        parser['DEFAULT']["number of gamma workers"]  = str(syscfg["number of gamma workers"])
         parser['DEFAULT']["debug"]       = str(syscfg["debug"])
         parser['DEFAULT']["first output dicom"]       = self.output_job
         parser['DEFAULT']["second output dicom"]      = self.output_job_2nd
@@ -538,6 +530,8 @@ class IDC_details:
         parser['DEFAULT']["write dicom physical dose"]= str(syscfg["write dicom physical dose"])
         parser['DEFAULT']["write dicom rbe dose"]     = str(syscfg["write dicom rbe dose"])
         parser['DEFAULT']["write unresampled dose"]   = "yes" if self.score_dose_on_full_CT else "no"
+        parser['DEFAULT']["number of dose reader threads"] = str(syscfg["number of dose reader threads"])
+        parser['DEFAULT']["number of resampling threads"] = str(syscfg["number of cores"])
         parser['DEFAULT']["dose grid size"]           = " ".join([str(val) for val in self.dosegrid_size])
         parser['DEFAULT']["dose grid resolution"]     = " ".join([str(val) for val in self.dosegrid_nvoxels])
         if self._CT:
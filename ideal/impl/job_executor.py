@@ -44,6 +44,9 @@ class job_executor(object):
     @property
     def estimated_calculation_time(self):
         return self._ect
+    @property
+    def qspecs(self):
+        return dict(self._qspecs)
     def launch_gate_qt_check(self,beamname):
         return self._launch_gate_qt_check(beamname)
     def launch_subjobs(self):
@@ -67,12 +70,13 @@ import itk
 
 # IDEAL imports
 from utils.gate_pbs_plan_file import gate_pbs_plan_file
-from utils.condor_utils import condor_check_run, condor_id
+from utils import instrumentation
 from impl.beamline_model import beamline_model
 from impl.gate_macro import write_gate_macro_file
 from impl.hlut_conf import hlut_conf
 from impl.idc_enum_types import MCStatType
 from impl.system_configuration import system_configuration
+from impl.scheduler_backend import scheduler_backend
 from impl.dual_logging import get_high_level_logfile, get_last_log_ID
 
 logger = logging.getLogger(__name__)
@@ -92,8 +96,11 @@ class condor_job_executor(job_executor):
         self._set_cleanup_policy(not syscfg['debug'])
         self._mac_files=[]
         self._qspecs={}
+        self._backend = self._get_backend()
         self._generate_RUNGATE_submit_directory()
-        self._populate_RUNGATE_submit_directory()
+        self._metrics = instrumentation.get_job_metrics(self._RUNGATE_submit_directory,"EXECUTOR")
+        with self._metrics.span("populate work directory",nbeams=len(details.beam_names)):
+            self._populate_RUNGATE_submit_directory()
         # update general log file
         high_log.info("IdealID: {}".format(str(get_last_log_ID()+1)))
         high_log.info("Working dir: {}".format(str(self._RUNGATE_submit_directory)))
@@ -118,6 +125,16 @@ class condor_job_executor(job_executor):
         os.mkdir(rungate_dir)
         logger.debug("created template subjob work directory {}".format(rungate_dir))
         self._RUNGATE_submit_directory = rungate_dir
+    def _get_backend(self):
+        syscfg = system_configuration.getInstance()
+        if syscfg['batch system'] == "local":
+            # the job files are the same as for HTCondor, they are just run on this machine
+            cluster_id_file = os.path.join(syscfg['tmpdir jobs'],".ideal_local_cluster_id")
+            backend = scheduler_backend.create("local",nworkers=syscfg['number of local workers'],cluster_id_file=cluster_id_file)
+            logger.debug("jobs will run on the local machine with {} workers".format(backend.nworkers))
+        else:
+            backend = scheduler_backend.create("condor")
+        return backend
     def _get_ncores(self):
         # TODO: make Ncores (number of subjobs for current calculation) flexible:
         # * depending on urgency/priority
@@ -522,13 +539,18 @@ class condor_job_executor(job_executor):
         os.chdir( self._RUNGATE_submit_directory )
         ymd_hms = time.strftime("%Y-%m-%d %H:%M:%S")
         userstuff = self.details.WriteUserSettings(self._qspecs,ymd_hms,self._RUNGATE_submit_directory)
-        on = condor_check_run()
+        on = self._backend.check()
         if on == 0:
-            high_log.info('Condor master and scheduler OK')
+            if self._backend.name == "condor":
+                high_log.info('Condor master and scheduler OK')
+            else:
+                high_log.info('Running on local machine with {} workers'.format(self._backend.nworkers))
         else:
             high_log.error('Condor_master or condor_schedd NOT RUNNING! Exit the program.')
             raise RuntimeError("Condor_master or condor_schedd not running")
-        ret,cid = condor_id( "condor_submit_dag ./RunGATE.dagman")
+        with self._metrics.span("submit",backend=self._backend.name) as s:
+            ret,cid = self._backend.submit("RunGATE.dagman")
+            s.ok = ret==0
         self.submission_date = '-'
         if ret==0:
             msg = "Job submitted at {}\n".format(ymd_hms)
@@ -0,0 +1,424 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module implements the "scheduler backends" that are used by the job
+executor to run a simulation. The job executor always writes the same job
+description files in the Gate work directory: a DAGman file ("RunGATE.dagman")
+with a PRE script (CT preprocessing), the job (an HTCondor submit file,
+"RunGATE.submit", which queues N Gate subjobs per beam) and a POST script
+(dose postprocessing). A backend takes these files and runs them:
+
+* the "condor" backend submits them to HTCondor with `condor_submit_dag`,
+* the "local" backend runs the PRE script, the subjobs and the POST script on
+  the submission machine, with a bounded number of subjobs running at the same
+  time. The subjobs are run in the same way as HTCondor would do it: with the
+  same arguments (including the cluster and process ID, from which the Gate
+  run script computes the random seed and the `output.<cluster>.<proc>` output
+  directory) and the same stdout/stderr log files. Subjobs of a beam for which
+  the job control daemon has already written a STOP flag are not started.
+  The job ID of a local DAG is "local.<cluster ID>", so that it cannot be
+  mistaken for an HTCondor cluster ID (the log daemon does not look for local
+  jobs in the Condor queue).
+
+The local backend is meant for testing, benchmarking and for running IDEAL on a
+single workstation without an HTCondor pool.
+"""
+
+import os
+import sys
+import re
+import abc
+import shlex
+import time
+import threading
+import subprocess
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+from filelock import SoftFileLock
+import logging
+logger=logging.getLogger(__name__)
+
+from utils.condor_utils import condor_check_run, condor_id
+from utils.condor_query import local_job_id
+
+class scheduler_backend(abc.ABC):
+    """
+    Base class of the scheduler backends.
+    """
+    names = ["condor","local"]
+    @staticmethod
+    def create(name,**kwargs):
+        """
+        Create the backend with the given name ("condor" or "local"). The
+        keyword arguments are passed to the constructor of the backend.
+        """
+        if name == "condor":
+            return condor_backend(**kwargs)
+        elif name == "local":
+            return local_backend(**kwargs)
+        raise ValueError("unknown scheduler backend '{}', should be 'condor' or 'local'".format(name))
+    @abc.abstractmethod
+    def check(self):
+        """
+        Returns 0 if the backend is ready to accept jobs, -1 otherwise.
+        """
+    @abc.abstractmethod
+    def submit(self,dagfile):
+        """
+        Submit the DAG described in `dagfile` (in the current working
+        directory). Returns the return value of the submission (0 for success)
+        and the job ID of the Gate subjobs (as a string).
+        """
+
+class condor_backend(scheduler_backend):
+    name = "condor"
+    def check(self):
+        return condor_check_run()
+    def submit(self,dagfile):
+        return condor_id("condor_submit_dag ./{}".format(dagfile))
+
+class local_backend(scheduler_backend):
+    """
+    Run the DAG on the local machine, with at most `nworkers` Gate subjobs at
+    the same time (default: number of CPUs). The cluster IDs are taken from a
+    counter in `cluster_id_file`, so that different jobs get different random
+    seeds and output directory names. The job ID that is returned by `submit`
+    is the cluster ID with the "local." prefix.
+    """
+    name = "local"
+    def __init__(self,nworkers=None,cluster_id_file=None):
+        self.nworkers = int(nworkers) if nworkers else (os.cpu_count() or 1)
+        if self.nworkers < 1:
+            raise ValueError("number of local workers should be positive, got {}".format(nworkers))
+        self.cluster_id_file = cluster_id_file if cluster_id_file else os.path.join(os.path.expanduser("~"),".ideal_local_cluster_id")
+        self._start_lock = threading.Lock()
+        self._last_start = 0.
+    def check(self):
+        return 0
+    def next_cluster_id(self):
+        """
+        Increment and return the cluster ID counter.
+        """
+        with SoftFileLock(self.cluster_id_file + ".lock").acquire(timeout=10):
+            cluster_id = 0
+            if os.path.exists(self.cluster_id_file):
+                with open(self.cluster_id_file,"r") as fp:
+                    cluster_id = int(fp.read().strip() or 0)
+            cluster_id += 1
+            with open(self.cluster_id_file,"w") as fp:
+                fp.write("{}\n".format(cluster_id))
+        return cluster_id
+    def submit(self,dagfile):
+        """
+        Start a detached process that runs the DAG (see `run`) and return
+        immediately, like `condor_submit_dag`. The output of that process goes
+        to "<dagfile>.local.out". Returns the return value and the job ID.
+        """
+        cluster_id = self.next_cluster_id()
+        env = dict(os.environ)
+        pydir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = pydir + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+        cmd = [sys.executable,os.path.abspath(__file__),"-c",str(cluster_id),"-n",str(self.nworkers),dagfile]
+        logger.debug("starting local DAG: {}".format(" ".join(cmd)))
+        try:
+            with open(dagfile + ".local.out","w") as out:
+                subprocess.Popen(cmd,stdout=out,stderr=subprocess.STDOUT,stdin=subprocess.DEVNULL,env=env,start_new_session=True)
+        except OSError as e:
+            logger.error("failed to start local DAG for {}: {}".format(dagfile,e))
+            return 1,local_job_id(cluster_id)
+        return 0,local_job_id(cluster_id)
+    def run(self,dagfile,cluster_id):
+        """
+        Run the DAG in `dagfile` and wait until it is finished: first the PRE
+        script, then all subjobs of the submit file, then the POST script. If
+        the PRE script fails, then the subjobs and POST script are not run.
+        The scripts and subjobs run in the directory of the DAG file.
+        Returns the return value of the POST script (or of the PRE script, if
+        that failed).
+        """
+        workdir = os.path.dirname(os.path.abspath(dagfile))
+        dag = read_dagman(dagfile)
+        t0 = time.time()
+        if dag["pre"]:
+            logger.info("running PRE script: {}".format(dag["pre"]))
+            ret = subprocess.call(shlex.split(dag["pre"]),cwd=workdir)
+            if ret != 0:
+                logger.error("PRE script failed with return value {}, subjobs and POST script will not run".format(ret))
+                return ret
+        subjobs = read_submit(os.path.join(workdir,dag["submit"]),cluster_id)
+        stop_flags = get_stop_flags(workdir)
+        logger.info("running {} subjobs with cluster ID {} on {} workers".format(len(subjobs),cluster_id,self.nworkers))
+        with ThreadPoolExecutor(max_workers=self.nworkers) as pool:
+            results = list(pool.map(lambda job: self._run_subjob(job,workdir,stop_flags),subjobs))
+        nskipped = results.count(None)
+        nfailed = len([r for r in results if r])
+        logger.info("{} subjobs finished after {:.1f} seconds, {} failed, {} not started because of a STOP flag".format(
+            len(results)-nskipped,time.time()-t0,nfailed,nskipped))
+        ret = 0
+        if dag["post"]:
+            logger.info("running POST script: {}".format(dag["post"]))
+            ret = subprocess.call(shlex.split(dag["post"]),cwd=workdir)
+            logger.info("POST script finished with return value {}".format(ret))
+        return ret
+    def _run_subjob(self,job,workdir,stop_flags):
+        stop_flag = stop_flags.get(job["macfile"],None)
+        if stop_flag and os.path.exists(os.path.join(workdir,stop_flag)):
+            logger.debug("found {}, not starting subjob {}.{}".format(stop_flag,job["cluster"],job["process"]))
+            return None
+        with self._start_lock:
+            # same as next_job_start_delay in HTCondor: avoid that all jobs read their input at the same time
+            delay = self._last_start + job["next_job_start_delay"] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._last_start = time.time()
+        logger.debug("starting subjob {}.{}: {}".format(job["cluster"],job["process"]," ".join(job["command"])))
+        outputs = [os.path.join(workdir,job[k]) if job[k] else os.devnull for k in ("output","error")]
+        for o in outputs:
+            if os.path.dirname(o):
+                os.makedirs(os.path.dirname(o),exist_ok=True)
+        with open(outputs[0],"w") as out, open(outputs[1],"w") as err:
+            ret = subprocess.call(job["command"],cwd=workdir,stdout=out,stderr=err,stdin=subprocess.DEVNULL)
+        if ret != 0:
+            logger.warning("subjob {}.{} exited with return value {}".format(job["cluster"],job["process"],ret))
+        return ret
+
+def read_dagman(dagfile):
+    """
+    Read a single-node DAGman file, as written by the job executor. Returns a
+    dictionary with the PRE script command (or None), the submit file name and
+    the POST script command (or None).
+    """
+    dag = dict(pre=None,submit=None,post=None)
+    with open(dagfile,"r") as fp:
+        for line in fp:
+            words = line.split()
+            if not words or words[0].startswith("#"):
+                continue
+            if words[0].upper() == "JOB" and len(words) >= 3:
+                if dag["submit"] is not None:
+                    raise RuntimeError("DAG file {} has more than one JOB, which is not supported".format(dagfile))
+                dag["submit"] = words[2]
+            elif words[0].upper() == "SCRIPT" and len(words) >= 4 and words[1].upper() in ("PRE","POST"):
+                dag[words[1].lower()] = " ".join(words[3:])
+            else:
+                raise RuntimeError("unsupported line in DAG file {}: '{}'".format(dagfile,line.strip()))
+    if dag["submit"] is None:
+        raise RuntimeError("DAG file {} has no JOB".format(dagfile))
+    return dag
+
+def read_submit(submitfile,cluster_id):
+    """
+    Read an HTCondor submit file, as written by the job executor, and return
+    the list of subjobs, with the `$(CLUSTER)` and `$(PROCESS)` macros
+    substituted. Like in HTCondor, the process IDs are numbered consecutively
+    over all "queue" statements in the file.
+    """
+    settings = dict()
+    subjobs = list()
+    with open(submitfile,"r") as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            words = line.split()
+            if words[0].lower() == "queue":
+                n = int(words[1]) if len(words) > 1 else 1
+                if "executable" not in settings:
+                    raise RuntimeError("submit file {} queues jobs without executable".format(submitfile))
+                for i in range(n):
+                    process_id = len(subjobs)
+                    def subst(value):
+                        value = re.sub(r"\$\(cluster\)",str(cluster_id),value,flags=re.IGNORECASE)
+                        return re.sub(r"\$\(process\)",str(process_id),value,flags=re.IGNORECASE)
+                    arguments = shlex.split(subst(settings.get("arguments","")))
+                    subjobs.append(dict(cluster=str(cluster_id),
+                                        process=str(process_id),
+                                        command=[subst(settings["executable"])]+arguments,
+                                        macfile=arguments[0] if arguments else "",
+                                        output=subst(settings.get("output","")),
+                                        error=subst(settings.get("error","")),
+                                        next_job_start_delay=float(settings.get("next_job_start_delay",0.))))
+            elif "=" in line:
+                key,value = line.split("=",1)
+                settings[key.strip().lower()] = value.strip()
+            else:
+                raise RuntimeError("unsupported line in submit file {}: '{}'".format(submitfile,line))
+    return subjobs
+
+def get_stop_flags(workdir):
+    """
+    Return a dictionary with the name of the STOP flag file (written by the job
+    control daemon) for each Gate macro file, based on the beam sections in the
+    postprocessing configuration file in the work directory.
+    """
+    stop_flags = dict()
+    post_proc_cfg = os.path.join(workdir,"postprocessor.cfg")
+    if not os.path.exists(post_proc_cfg):
+        return stop_flags
+    cparser = configparser.ConfigParser()
+    cparser.optionxform = str
+    cparser.read(post_proc_cfg)
+    for beamname in cparser.sections():
+        if not cparser.has_option(beamname,"macfile") or not cparser.has_option(beamname,"dosemhd"):
+            continue
+        dose2water = cparser.getboolean(beamname,"dose2water",fallback=False)
+        dosemhd = cparser.get(beamname,"dosemhd").replace(".mhd","-DoseToWater.mhd" if dose2water else "-Dose.mhd")
+        stop_flags[cparser.get(beamname,"macfile")] = "STOP_"+dosemhd
+    return stop_flags
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+import shutil
+import stat
+from utils.condor_query import is_local_job
+
+# Fake Gate executable: writes a dose and statistics file in the output
+# directory, records its random seed and keeps track of how many fake Gate
+# processes are running at the same time.
+_fake_gate = """#!{python}
+import os, sys, time
+import numpy as np
+macfile, clusterid, procid = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+seed = 1000*clusterid+procid
+outputdir = "output.{{}}.{{}}".format(clusterid,procid)
+os.makedirs(outputdir)
+os.makedirs("running",exist_ok=True)
+flag = os.path.join("running",outputdir)
+open(flag,"w").close()
+with open(os.path.join("running","max.txt"),"a") as fp:
+    fp.write("{{}}\\n".format(len(os.listdir("running"))-1))
+time.sleep(0.2)
+beam = os.path.basename(macfile).replace(".mac","")
+with open(os.path.join(outputdir,beam+"-Dose.mhd"),"w") as fp:
+    fp.write("ObjectType = Image\\nNDims = 3\\nDimSize = 2 2 2\\nElementSpacing = 1 1 1\\n")
+    fp.write("ElementType = MET_FLOAT\\nElementDataFile = {{}}-Dose.raw\\n".format(beam))
+with open(os.path.join(outputdir,beam+"-Dose.raw"),"wb") as fp:
+    fp.write(np.full(8,seed%97+1,dtype=np.float32).tobytes())
+with open(os.path.join(outputdir,"statActor-"+beam+".txt"),"w") as fp:
+    fp.write("# NumberOfEvents = {{}}\\n# seed = {{}}\\n".format(1000,seed))
+with open(os.path.join(outputdir,"gate_exit_value.txt"),"w") as fp:
+    fp.write("0\\n")
+os.remove(flag)
+print("fake Gate done for", macfile, "with seed", seed)
+"""
+
+class Test_LocalBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.workdir = os.path.join(self.tmpdir,"rungate.0")
+        os.makedirs(os.path.join(self.workdir,"mac"))
+        gate = os.path.join(self.workdir,"FakeGate.py")
+        with open(gate,"w") as fp:
+            fp.write(_fake_gate.format(python=sys.executable))
+        os.chmod(gate,stat.S_IRWXU)
+        for script,name in [("pre.sh","PRE"),("post.sh","POST")]:
+            with open(os.path.join(self.workdir,script),"w") as fp:
+                fp.write("#!/bin/bash\nls -d output.* > {}_done.txt 2>/dev/null\nexit ${{IDEAL_TEST_{}_RET:-0}}\n".format(name.lower(),name))
+            os.chmod(os.path.join(self.workdir,script),stat.S_IRWXU)
+        with open(os.path.join(self.workdir,"RunGATE.submit"),"w") as fp:
+            fp.write("universe = vanilla\n")
+            fp.write("executable = ./FakeGate.py\n")
+            fp.write("output = logs/stdout.$(CLUSTER).$(PROCESS).txt\n")
+            fp.write("error = logs/stderr.$(CLUSTER).$(PROCESS).txt\n")
+            fp.write("next_job_start_delay = 0.01\n")
+            for beam,njobs in [("beam_A",5),("beam_B",3)]:
+                fp.write("request_memory = 1000\n")
+                fp.write("arguments = mac/{}.mac $(CLUSTER) $(PROCESS)\n".format(beam))
+                fp.write("queue {}\n".format(njobs))
+        with open(os.path.join(self.workdir,"RunGATE.dagman"),"w") as fp:
+            fp.write("SCRIPT PRE  rungate ./pre.sh\n")
+            fp.write("JOB         rungate ./RunGATE.submit\n")
+            fp.write("SCRIPT POST rungate ./post.sh\n")
+        with open(os.path.join(self.workdir,"postprocessor.cfg"),"w") as fp:
+            for beam in ["beam_A","beam_B"]:
+                fp.write("[{0}]\nmacfile = mac/{0}.mac\ndosemhd = {0}.mhd\ndose2water = False\n".format(beam))
+        self.backend = local_backend(nworkers=2,cluster_id_file=os.path.join(self.tmpdir,"cluster_id"))
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def _seeds(self):
+        seeds = dict()
+        for d in os.listdir(self.workdir):
+            if d.startswith("output."):
+                with open(os.path.join(self.workdir,d,"gate_exit_value.txt")) as fp:
+                    self.assertEqual(fp.read().strip(),"0")
+                stats = [f for f in os.listdir(os.path.join(self.workdir,d)) if f.startswith("statActor")]
+                self.assertEqual(len(stats),1)
+                with open(os.path.join(self.workdir,d,stats[0])) as fp:
+                    seeds[d] = (stats[0],int(fp.read().split()[-1]))
+        return seeds
+    def test_run(self):
+        self.assertEqual(self.backend.next_cluster_id(),1)
+        cluster_id = self.backend.next_cluster_id()
+        self.assertEqual(cluster_id,2)
+        ret = self.backend.run(os.path.join(self.workdir,"RunGATE.dagman"),cluster_id)
+        self.assertEqual(ret,0)
+        seeds = self._seeds()
+        self.assertEqual(sorted(seeds.keys()),["output.2.{}".format(p) for p in range(8)])
+        for p in range(8):
+            beam = "beam_A" if p < 5 else "beam_B"
+            self.assertEqual(seeds["output.2.{}".format(p)],("statActor-{}.txt".format(beam),2000+p))
+            self.assertTrue(os.path.exists(os.path.join(self.workdir,"logs","stdout.2.{}.txt".format(p))))
+        with open(os.path.join(self.workdir,"pre_done.txt")) as fp:
+            self.assertEqual(fp.read().strip(),"")
+        with open(os.path.join(self.workdir,"post_done.txt")) as fp:
+            self.assertEqual(len(fp.read().split()),8)
+        with open(os.path.join(self.workdir,"running","max.txt")) as fp:
+            self.assertLessEqual(max([int(n) for n in fp.read().split()]),2)
+    def test_stop_flag(self):
+        # subjobs of beam A are not started once the STOP flag is there
+        open(os.path.join(self.workdir,"STOP_beam_A-Dose.mhd"),"w").close()
+        self.assertEqual(self.backend.run(os.path.join(self.workdir,"RunGATE.dagman"),7),0)
+        self.assertEqual(sorted(self._seeds().keys()),["output.7.{}".format(p) for p in range(5,8)])
+    def test_pre_failure(self):
+        os.environ["IDEAL_TEST_PRE_RET"] = "3"
+        try:
+            ret = self.backend.run(os.path.join(self.workdir,"RunGATE.dagman"),1)
+        finally:
+            del os.environ["IDEAL_TEST_PRE_RET"]
+        self.assertEqual(ret,3)
+        self.assertEqual(self._seeds(),dict())
+        self.assertFalse(os.path.exists(os.path.join(self.workdir,"post_done.txt")))
+    def test_submit(self):
+        # detached run, like condor_submit_dag
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            ret,cluster_id = self.backend.submit("RunGATE.dagman")
+        finally:
+            os.chdir(cwd)
+        self.assertEqual((ret,cluster_id),(0,"local.1"))
+        self.assertTrue(is_local_job(cluster_id))
+        post_done = os.path.join(self.workdir,"post_done.txt")
+        for i in range(300):
+            if os.path.exists(post_done):
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(self._seeds()),8)
+    def test_create(self):
+        self.assertTrue(isinstance(scheduler_backend.create("condor"),condor_backend))
+        self.assertTrue(isinstance(scheduler_backend.create("local",nworkers=3),local_backend))
+        with self.assertRaises(ValueError):
+            scheduler_backend.create("slurm")
+        with self.assertRaises(TypeError):
+            scheduler_backend()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="run an IDEAL DAG (PRE script, Gate subjobs, POST script) on the local machine")
+    parser.add_argument("-c","--cluster-id",type=int,required=True,help="cluster ID for the Gate subjobs")
+    parser.add_argument("-n","--nworkers",type=int,default=None,help="maximum number of Gate subjobs running at the same time")
+    parser.add_argument("dagfile",help="DAGman file, as written by the job executor")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG,format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(local_backend(nworkers=args.nworkers).run(args.dagfile,args.cluster_id))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -233,7 +233,14 @@ def get_simulation_install(syscfg,sysprsr,logger):
                           'gamma index parameters dta_mm dd_percent thr_percent def',
                           'stop on script actor time interval [s]',
                           'htcondor next job start delay [s]',
+                          'number of dose reader threads',
+                          'batch system',
+                          'number of local workers',
+                          'ct volume cache size [GB]',
+                          'number of ct reader threads',
                           'run gamma analysis',
+                          'gamma analysis mode',
+                          'number of gamma workers',
                           'write mhd unscaled dose',
                           'write mhd scaled dose',
                           'write mhd physical dose',
@@ -259,8 +266,23 @@ def get_simulation_install(syscfg,sysprsr,logger):
     syscfg["gamma index parameters dta_mm dd_percent thr_percent def"] = simulation.get("gamma index parameters dta_mm dd_percent thr_percent def","")
     syscfg['stop on script actor time interval [s]'] = simulation.getint('stop on script actor time interval [s]',300)
     syscfg['htcondor next job start delay [s]'] = simulation.getfloat('htcondor next job start delay [s]',1.)
+    syscfg['number of dose reader threads'] = simulation.getint('number of dose reader threads',4)
+    syscfg['batch system'] = simulation.get('batch system','condor')
+    if syscfg['batch system'] not in ['condor','local']:
+        msg="unknown batch system in {}: '{}', should be 'condor' or 'local'".format(syscfg['sysconfig'],syscfg['batch system'])
+        logger.error(msg)
+        raise RuntimeError(msg)
+    syscfg['number of local workers'] = simulation.getint('number of local workers',0)
+    syscfg['ct volume cache size [GB]'] = simulation.getfloat('ct volume cache size [GB]',10.)
+    syscfg['number of ct reader threads'] = simulation.getint('number of ct reader threads',0)
     # TODO: check that SoS actor time interval and next job start delay are not crazy
     syscfg['run gamma analysis']=simulation.getboolean('run gamma analysis',False)
+    syscfg['gamma analysis mode']=simulation.get('gamma analysis mode','map')
+    syscfg['number of gamma workers']=simulation.getint('number of gamma workers',0)
+    if syscfg['gamma analysis mode'] not in ['map','pass rate']:
+        msg="unknown gamma analysis mode in {}: '{}', should be 'map' or 'pass rate'".format(syscfg['sysconfig'],syscfg['gamma analysis mode'])
+        logger.error(msg)
+        raise RuntimeError(msg)
     syscfg['write mhd unscaled dose']=simulation.getboolean('write mhd unscaled dose',False)
     syscfg['write mhd scaled dose']=simulation.getboolean('write mhd scaled dose',False)
     syscfg['write mhd physical dose']=simulation.getboolean('write mhd physical dose',False)
@@ -7,6 +7,7 @@ import time
 import base64
 from cryptography.fernet import Fernet
 from urllib.parse import urljoin
+from utils.job_state_store import job_state_store
 
 # status variables
 RUNNING = 'running'
@@ -16,7 +17,16 @@ FINISHED = 'finished'
 WAITING = 'waiting'
 FAILED = 'failed'
 
-def preload_status_overview(ideal_history_cfg,max_size = 50):
+def preload_status_overview(ideal_history_cfg,max_size = 50,job_state_db = None):
+    if job_state_db is not None and os.path.exists(job_state_db):
+        # indexed query of the newest jobs, instead of parsing the whole history
+        store = job_state_store(job_state_db)
+        jobs_list = dict()
+        for i,fields in store.find(limit=max_size+1,newest_first=True):
+            jobID = fields['Work_dir'].split('/')[-2]
+            jobs_list[jobID] = convert_ideal_to_api_status(fields['Status'])
+        store.close()
+        return jobs_list
     cfg = configparser.ConfigParser()
     cfg.read(ideal_history_cfg)
     jobs_list = dict()
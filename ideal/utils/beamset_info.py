@@ -11,6 +11,7 @@ import os
 import re
 import numpy as np
 from utils.dose_info import dose_info
+from utils.spot_store import spot_store
 import logging
 logger=logging.getLogger(__name__)
 
@@ -46,6 +47,7 @@ class spot_info(object):
 class layer_info(object):
     def __init__(self,ctrlpnt,j,cumsumchk=[],verbose=False,keep0=False):
         self._cp = ctrlpnt
+        self._spots = None
         if verbose:
             logger.debug('{}. control point with type {}'.format(j,type(self._cp)))
             for k in self._cp.keys():
@@ -119,9 +121,12 @@ class layer_info(object):
         return self.w
     @property
     def spots(self):
-        return [spot_info(x,y,w) for (x,y,w) in zip(self.x,self.y,self.w)]
+        # created only once, on first use
+        if self._spots is None:
+            self._spots = [spot_info(x,y,w) for (x,y,w) in zip(self.x,self.y,self.w)]
+        return self._spots
     def get_spots(self,t0=None,t1=None):
-        return [spot_info(x,y,w) for (x,y,w) in zip(self.x,self.y,self.w)]
+        return self.spots
 
 class beam_info(object):
     #def __init__(self,beam,rd,i,keep0=False):
@@ -134,6 +139,7 @@ class beam_info(object):
         self._beam_number_is_fishy = override_number # workaround for buggy TPSs, e.g. PDM
         self._index = i # the index in the beam sequence
         self._layers = list()
+        self._spot_store = None
         mswchk = self.FinalCumulativeMetersetWeight
         cumsumchk=[0.]
         logger.debug("going to read all layers")
@@ -260,6 +266,14 @@ class beam_info(object):
     def nspots(self):
         return sum([l.nspots for l in self.layers])
     @property
+    def spot_store(self):
+        """
+        All spots of this beam in numpy arrays, see `utils.spot_store`.
+        """
+        if self._spot_store is None:
+            self._spot_store = spot_store.from_layers(self._layers)
+        return self._spot_store
+    @property
     def mswtot(self):
         return sum([l.mswtot for l in self._layers])
     @property
@@ -299,7 +313,7 @@ class beamset_info(object):
     def __init__(self,rpfp):
         self._warnings = list() # will hopefully stay empty
         self._beam_numbers_corrupt = False # e.g. PDM does not define beam numbers
-        self._rp = pydicom.read_file(rpfp)
+        self._rp = pydicom.dcmread(rpfp)
         self._rpfp = rpfp
         logger.debug("beamset: survived reading DICOM file {}".format(rpfp))
         self._rpdir = os.path.dirname(rpfp)
@@ -0,0 +1,373 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module provides a structured query layer for the HTCondor queue and for
+the local processes (job control daemons, log daemon, Condor daemons). It is
+used by the log daemon and by the helper functions in `utils.condor_utils`.
+
+Instead of parsing the human readable output of ``condor_q`` and ``ps -ef``,
+the queue is queried once with JSON output for all jobs and the processes are
+found by reading the command lines in ``/proc``. The results are cached until
+`refresh` is called, such that one cycle of the log daemon runs one
+``condor_q`` command and one scan of ``/proc``, regardless of the number of
+jobs.
+"""
+
+import os
+import json
+import signal
+import subprocess
+import logging
+logger=logging.getLogger(__name__)
+
+# HTCondor JobStatus codes
+IDLE = 1
+RUNNING = 2
+REMOVED = 3
+COMPLETED = 4
+HELD = 5
+TRANSFERRING_OUTPUT = 6
+SUSPENDED = 7
+
+# prefix of the job IDs of the "local" scheduler backend (impl.scheduler_backend),
+# these jobs are not in the Condor queue
+LOCAL_JOB_PREFIX = "local."
+
+def local_job_id(cluster_id):
+    """
+    Job ID of a DAG that is run by the local scheduler backend with cluster ID `cluster_id`.
+    """
+    return LOCAL_JOB_PREFIX + str(cluster_id)
+
+def is_local_job(job_id):
+    """
+    True if `job_id` is a job ID of the local scheduler backend, rather than a Condor cluster ID.
+    """
+    return str(job_id).startswith(LOCAL_JOB_PREFIX)
+
+class condor_queue(object):
+    """
+    Cached snapshot of the Condor queue. `command` is the condor_q command
+    (list of arguments); the JSON output of that command for all users is
+    parsed into one dictionary (class ad) per job. The snapshot is taken on
+    first use and kept until `refresh` is called.
+    """
+    attributes = ["ClusterId","ProcId","JobStatus","Owner","JobUniverse","DAGManJobId","QDate","EnteredCurrentStatus","HoldReason"]
+    def __init__(self,command=("condor_q",),timeout=120):
+        self.command = list(command)
+        self.timeout = timeout
+        self.ncalls = 0
+        self._jobs = None
+    def refresh(self):
+        """
+        Forget the cached snapshot, the next query runs condor_q again.
+        """
+        self._jobs = None
+    def _query(self):
+        cmd = self.command + ["-allusers","-json","-attributes",",".join(self.attributes)]
+        logger.debug("running {}".format(" ".join(cmd)))
+        self.ncalls += 1
+        proc = subprocess.run(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,timeout=self.timeout,universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError("'{}' failed with exit code {}: {}".format(" ".join(cmd),proc.returncode,proc.stderr.strip()))
+        # an empty queue gives no output at all
+        text = proc.stdout.strip()
+        return json.loads(text) if text else list()
+    def jobs(self):
+        """
+        List of the class ads (dictionaries) of all jobs in the queue.
+        """
+        if self._jobs is None:
+            self._jobs = self._query()
+            logger.debug("got {} jobs from the condor queue".format(len(self._jobs)))
+        return self._jobs
+    def clusters(self):
+        """
+        Dictionary with for every cluster id (string) the list of its job class ads.
+        """
+        clusters = dict()
+        for job in self.jobs():
+            clusters.setdefault(str(job["ClusterId"]),list()).append(job)
+        return clusters
+    def status(self):
+        """
+        Job status per cluster, in the same format as the (older) parsing of
+        the ``condor_q`` batch output: for each cluster id, a dictionary with
+        the proc ID range ('IDs') and the number of jobs that are running,
+        idle, done and on hold, with '_' instead of zero.
+        """
+        jobs_status = dict()
+        for cluster_id,jobs in self.clusters().items():
+            procs = sorted(int(job["ProcId"]) for job in jobs)
+            counts = {"RUN":0,"IDLE":0,"DONE":0,"HOLD":0}
+            for job in jobs:
+                s = job.get("JobStatus")
+                if s in (RUNNING,TRANSFERRING_OUTPUT):
+                    counts["RUN"] += 1
+                elif s in (IDLE,SUSPENDED):
+                    counts["IDLE"] += 1
+                elif s == COMPLETED:
+                    counts["DONE"] += 1
+                elif s == HELD:
+                    counts["HOLD"] += 1
+            status = dict()
+            status["IDs"] = str(procs[0]) if procs[0] == procs[-1] else "{}-{}".format(procs[0],procs[-1])
+            for k in ["RUN","IDLE","DONE","HOLD"]:
+                status[k] = str(counts[k]) if counts[k] else "_"
+            jobs_status[cluster_id] = status
+        return jobs_status
+
+class process_table(object):
+    """
+    Cached list of the local processes and their command lines, read from
+    `proc_dir` (normally ``/proc``). The list is read on first use and kept
+    until `refresh` is called.
+    """
+    def __init__(self,proc_dir="/proc"):
+        self.proc_dir = proc_dir
+        self.nscans = 0
+        self._procs = None
+    def refresh(self):
+        """
+        Forget the cached process list, the next query reads `proc_dir` again.
+        """
+        self._procs = None
+    def _cmdline(self,pid):
+        try:
+            with open(os.path.join(self.proc_dir,str(pid),"cmdline"),"rb") as fp:
+                raw = fp.read()
+        except OSError:
+            # process ended, or is not ours to look at
+            return list()
+        return [a.decode("utf-8","replace") for a in raw.split(b"\0") if a]
+    def processes(self):
+        """
+        Dictionary with the argument list of every process, with the pid (int) as key.
+        """
+        if self._procs is None:
+            self.nscans += 1
+            self._procs = dict()
+            for d in os.listdir(self.proc_dir):
+                if not d.isdigit():
+                    continue
+                argv = self._cmdline(d)
+                if argv:
+                    self._procs[int(d)] = argv
+        return self._procs
+    @staticmethod
+    def is_python_script(argv,script):
+        """
+        True if `argv` is the command line of a python interpreter running `script`
+        (a file name without directory).
+        """
+        if not os.path.basename(argv[0]).startswith("python"):
+            return False
+        return any(os.path.basename(a) == script for a in argv[1:])
+    def running(self,name):
+        """
+        True if a process with executable name `name` is running.
+        """
+        return any(os.path.basename(argv[0]) == name for argv in self.processes().values())
+    def pids(self,script):
+        """
+        Sorted list of the pids of the python processes running `script`.
+        """
+        return sorted(pid for pid,argv in self.processes().items() if self.is_python_script(argv,script))
+    def job_daemons(self,script="job_control_daemon.py"):
+        """
+        Dictionary with the work directory (the value of the -w option) of
+        every running job control daemon as key and its pid as value.
+        """
+        daemons = dict()
+        for pid in self.pids(script):
+            argv = self.processes()[pid]
+            wdir = None
+            for i,a in enumerate(argv):
+                if a in ("-w","--workdir") and i+1 < len(argv):
+                    wdir = argv[i+1]
+                elif a.startswith("--workdir="):
+                    wdir = a.split("=",1)[1]
+            if wdir is None:
+                logger.warning("job control daemon with pid {} has no work directory in its command line {}".format(pid,argv))
+                continue
+            daemons[wdir] = pid
+        return daemons
+    def local_dags(self,script="scheduler_backend.py"):
+        """
+        Dictionary with the job ID of every DAG that is run by the local
+        scheduler backend as key and the pid of its runner as value.
+        """
+        dags = dict()
+        for pid in self.pids(script):
+            argv = self.processes()[pid]
+            for i,a in enumerate(argv):
+                if a in ("-c","--cluster-id") and i+1 < len(argv):
+                    dags[local_job_id(argv[i+1])] = pid
+        return dags
+    def kill(self,pid,script=None,sig=signal.SIGTERM):
+        """
+        Send signal `sig` to process `pid`. If `script` is given, the signal
+        is only sent if the process still runs that script (the pid may have
+        been reused since the process table was read). Returns 0 on success,
+        nonzero otherwise.
+        """
+        pid = int(pid)
+        if script is not None:
+            argv = self._cmdline(pid)
+            if not argv or not self.is_python_script(argv,script):
+                logger.warning("process {} is not running {}, not sending signal {}".format(pid,script,sig))
+                return 1
+        try:
+            os.kill(pid,sig)
+        except OSError as e:
+            logger.warning("could not send signal {} to process {}: {}".format(sig,pid,e))
+            return 1
+        if self._procs is not None:
+            self._procs.pop(pid,None)
+        return 0
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import sys
+import time
+import shutil
+import tempfile
+
+# recorded with "condor_q -allusers -json -attributes ..." (ad order and attributes as in the output):
+# a DAG with the dagman job 800 and the simulation cluster 801 with 12 jobs, one of them held, and a
+# single-job cluster 805 of another user
+_test_condor_q_json = """[
+{
+  "ClusterId": 800, "DAGManJobId": null, "EnteredCurrentStatus": 1663568000, "JobStatus": 2, "JobUniverse": 7, "Owner": "ideal", "ProcId": 0, "QDate": 1663567977
+}
+,
+""" + "\n,\n".join("""{{
+  "ClusterId": 801, "DAGManJobId": 800, "EnteredCurrentStatus": 1663568100, "JobStatus": {}, "JobUniverse": 5, "Owner": "ideal", "ProcId": {}, "QDate": 1663568010{}
+}}""".format(5 if i == 7 else (1 if i > 8 else 2),i,', "HoldReason": "Error from slot1@node3: Failed to execute"' if i == 7 else "") for i in range(12)) + """
+,
+{
+  "ClusterId": 805, "EnteredCurrentStatus": 1663569000, "JobStatus": 1, "JobUniverse": 5, "Owner": "other", "ProcId": 0, "QDate": 1663569000
+}
+]
+"""
+
+class Test_CondorQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.recording = os.path.join(self.tmpdir,"condor_q.json")
+        self.calls = os.path.join(self.tmpdir,"calls.txt")
+        self.fake_condor_q = os.path.join(self.tmpdir,"condor_q")
+        # fake condor_q: log the arguments and replay the recorded output
+        with open(self.fake_condor_q,"w") as fp:
+            fp.write("#!/bin/sh\necho \"$@\" >> '{}'\ncat '{}'\n".format(self.calls,self.recording))
+        os.chmod(self.fake_condor_q,0o755)
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def _record(self,text):
+        with open(self.recording,"w") as fp:
+            fp.write(text)
+    def _ncalls(self):
+        with open(self.calls) as fp:
+            return len(fp.readlines())
+    def test_status(self):
+        self._record(_test_condor_q_json)
+        q = condor_queue(command=[self.fake_condor_q])
+        status = q.status()
+        self.assertEqual(status["801"],{"IDs":"0-11","RUN":"8","IDLE":"3","DONE":"_","HOLD":"1"})
+        self.assertEqual(status["805"],{"IDs":"0","RUN":"_","IDLE":"1","DONE":"_","HOLD":"_"})
+        self.assertEqual(status["800"]["RUN"],"1")
+        self.assertEqual([j["ProcId"] for j in q.clusters()["801"] if j["JobStatus"] == HELD],[7])
+        with open(self.calls) as fp:
+            self.assertEqual(fp.read().split()[:2],["-allusers","-json"])
+    def test_cache(self):
+        self._record(_test_condor_q_json)
+        q = condor_queue(command=[self.fake_condor_q])
+        for i in range(5):
+            self.assertEqual(len(q.jobs()),14)
+            self.assertEqual(len(q.status()),3)
+        self.assertEqual((q.ncalls,self._ncalls()),(1,1))
+        # next cycle: the queue is empty now
+        self._record("")
+        q.refresh()
+        self.assertEqual(q.status(),dict())
+        self.assertEqual(self._ncalls(),2)
+    def test_local_job_ids(self):
+        self.assertEqual(local_job_id(3),"local.3")
+        self.assertTrue(is_local_job("local.3"))
+        self.assertFalse(is_local_job("801"))
+        self.assertFalse(is_local_job(801))
+        self._record(_test_condor_q_json)
+        self.assertNotIn(local_job_id(801),condor_queue(command=[self.fake_condor_q]).status())
+    def test_failure(self):
+        q = condor_queue(command=["sh","-c","echo 'Failed to fetch ads from schedd' >&2; exit 1","condor_q"])
+        with self.assertRaises(RuntimeError):
+            q.jobs()
+
+class Test_ProcessTable(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        procs = {"1":["/sbin/init"],
+                 "210":["/usr/sbin/condor_master","-f"],
+                 "211":["condor_schedd","-f"],
+                 "4001":["/usr/bin/python3","/opt/IDEAL/bin/job_control_daemon.py","-l","ideal","-t","10","-d","-w","/data/work/pat1/rungate.1"],
+                 "4002":["python3","/opt/IDEAL/bin/job_control_daemon.py","-d","--workdir=/data/work/pat2/rungate.2"],
+                 "4003":["vim","/opt/IDEAL/bin/job_control_daemon.py"],
+                 "4004":["/usr/bin/python3","/opt/IDEAL/bin/log_daemon.py"],
+                 "4005":["/usr/bin/python3","/opt/IDEAL/bin/stop_log_daemon.py"],
+                 "4006":["/usr/bin/python3","/opt/IDEAL/ideal/impl/scheduler_backend.py","-c","3","-n","4","RunGATE.dagman"]}
+        for pid,argv in procs.items():
+            os.makedirs(os.path.join(self.tmpdir,pid))
+            with open(os.path.join(self.tmpdir,pid,"cmdline"),"wb") as fp:
+                fp.write(b"\0".join(bytes(a,encoding="utf-8") for a in argv)+b"\0")
+        # kernel thread: empty command line
+        os.makedirs(os.path.join(self.tmpdir,"2"))
+        open(os.path.join(self.tmpdir,"2","cmdline"),"w").close()
+        os.makedirs(os.path.join(self.tmpdir,"self"))
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_fake_proc(self):
+        procs = process_table(self.tmpdir)
+        self.assertEqual(procs.job_daemons(),{"/data/work/pat1/rungate.1":4001,"/data/work/pat2/rungate.2":4002})
+        self.assertEqual(procs.pids("log_daemon.py"),[4004])
+        self.assertTrue(procs.running("condor_master"))
+        self.assertTrue(procs.running("condor_schedd"))
+        self.assertFalse(procs.running("condor_startd"))
+        self.assertEqual(procs.local_dags(),{"local.3":4006})
+        self.assertEqual(procs.nscans,1)
+        procs.refresh()
+        procs.pids("log_daemon.py")
+        self.assertEqual(procs.nscans,2)
+    def test_real_proc(self):
+        if not os.path.isdir("/proc/self"):
+            self.skipTest("no /proc file system")
+        script = os.path.join(self.tmpdir,"job_control_daemon.py")
+        with open(script,"w") as fp:
+            fp.write("import time\ntime.sleep(60)\n")
+        child = subprocess.Popen([sys.executable,script,"-w",self.tmpdir])
+        try:
+            procs = process_table()
+            # right after the fork the child may not have exec'ed python yet
+            for i in range(100):
+                if procs.job_daemons():
+                    break
+                time.sleep(0.05)
+                procs.refresh()
+            self.assertEqual(procs.job_daemons(),{self.tmpdir:child.pid})
+            # refuses to kill a process that does not run the given script
+            self.assertNotEqual(procs.kill(child.pid,script="log_daemon.py"),0)
+            self.assertEqual(procs.kill(child.pid,script="job_control_daemon.py"),0)
+            self.assertEqual(child.wait(timeout=10),-signal.SIGTERM)
+        finally:
+            if child.poll() is None:
+                child.kill()
+                child.wait()
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -3,6 +3,7 @@ import os
 import time
 import shutil
 from zipfile import ZipFile
+from utils.condor_query import condor_queue, process_table
 
 def shell_output_ret(shell_command):
     output = subprocess.getstatusoutput(shell_command) # Byte object
@@ -16,8 +17,8 @@ def shell_output(shell_command):
 	
 def condor_check_run():
     # TODO: check if all machines are connected (nr of expected machine should be known)
-    ret, out = shell_output_ret("ps -ef | grep condor")
-    if "condor_master" in out and "condor_schedd" in out:
+    procs = process_table()
+    if procs.running("condor_master") and procs.running("condor_schedd"):
         return 0
     else: 
         return -1
@@ -30,66 +31,32 @@ def release_condor_job(job_id):
     return ret
     
 def get_pids(daemon):
-    out = shell_output("ps -ef | grep " + daemon)
-    lines = out.split("\\n")
-    daemons = list()
-    for l in lines[:-3]:
-        cont = [p for p in l.split(" ") if p!='']
-        #print(cont)
-        if 'python' in cont or 'python3' in cont:
-            pid = cont[1] 
-            if not pid.isnumeric():
-                raise AssertionError("pid is not a number")
-            daemons.append(pid)
-			   
-    return daemons
+    # python processes running the script `daemon`
+    return [str(pid) for pid in process_table().pids(daemon)]
 
-def kill_process(pid):
-    ret = os.system("kill -9 {}".format(pid))  
+def kill_process(pid,script=None):
+    # SIGTERM lets the daemon context of the IDEAL daemons exit cleanly; with
+    # `script`, only a process that still runs that script is signaled
+    ret = process_table().kill(pid,script=script)
 #    if ret != 0:
 #        # TODO: don't kill, update logs
 #        raise Exception('Could not kill daemon')
     return ret
        
 def get_job_daemons(job_daemon):
-    out = shell_output("ps -ef | grep " + job_daemon)
-    lines = out.split("\\n")
+    if not job_daemon.endswith(".py"):
+        raise AssertionError("got '{}', expected the name of the job control daemon script".format(job_daemon))
     daemons = dict()
-    for l in lines[:-3]:
-        cont = [p for p in l.split(" ") if p!='']
-        if 'python' in cont or 'python3' in cont:
-            pid = cont[1]
-            if not pid.isnumeric():
-                raise AssertionError("pid is not a number") 
-            wdir = cont[-1]
-            if '/rungate.' not in wdir:
-                raise AssertionError("got wrong or non-existing working directory")
-            daemons[wdir] = pid
+    for wdir,pid in process_table().job_daemons(job_daemon).items():
+        if '/rungate.' not in wdir:
+            raise AssertionError("got wrong or non-existing working directory")
+        daemons[wdir] = str(pid)
     
     return daemons
     
 def get_jobs_status():
-    jobs_status = dict()
-    out = shell_output("condor_q -all -wide")
-    lines = out.split("\\n")
-    header = [i for i in lines if i.startswith('OWNER')][0]
-    start_job_lines = lines.index(header)+1
-    job = lines[start_job_lines]
-    for job in lines[start_job_lines:]:
-        if job == '': break
-        job_info = [j for j in job.split(" ") if j!='']
-        job_id = job_info[-1].split(".")[0]
-        jobs_status[job_id] = dict()
-        jobs_status[job_id]["IDs"] = job_info[-1].split(".")[1]
-        jobs_status[job_id]["RUN"] = job_info[5]
-        jobs_status[job_id]["IDLE"] = job_info[6]
-        jobs_status[job_id]["DONE"] = job_info[4]
-        if 'HOLD' in header:
-            jobs_status[job_id]["HOLD"] = job_info[7]
-        else:
-            jobs_status[job_id]["HOLD"] = "_"
-        
-    return jobs_status
+    # one JSON query of the condor queue, see utils.condor_query
+    return condor_queue().status()
 
 def job_on_hold(all_jobs,job_id):
     if all_jobs[job_id]['HOLD']!='_':
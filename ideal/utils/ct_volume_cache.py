@@ -0,0 +1,263 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module implements a disk cache for CT volumes that were assembled from
+DICOM slices (see `utils.ct_dicom_to_img`). Each cache entry is a directory
+with the HU array in numpy format (which is read back with a memory map) and a
+small configuration file with the geometry and the DICOM meta data.
+
+An entry is keyed by the series instance UID and by a digest of the paths,
+modification times and sizes of the slice files, so any change in the DICOM
+files results in a cache miss instead of a stale CT. The total size of the
+cache is bounded: when a new entry is stored, the least recently used entries
+are removed until the cache fits in its size budget.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import configparser
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+class ct_volume_cache(object):
+    """
+    Size-bounded LRU cache of CT volumes in directory `cache_dir`, using at
+    most `max_bytes` of disk space.
+    """
+    version = 1
+    volume_file = "volume.npy"
+    cfg_file = "ct.cfg"
+    def __init__(self,cache_dir,max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.cache_dir,exist_ok=True)
+        self.nhits = 0
+        self.nmisses = 0
+    @staticmethod
+    def digest(uid,flist):
+        """
+        Digest of the series UID and the path, modification time and size of
+        all files in the series.
+        """
+        h4sh = hashlib.sha1(bytes(str(uid),encoding='utf-8'))
+        for f in sorted(os.path.realpath(f) for f in flist):
+            st = os.stat(f)
+            h4sh.update(bytes("{}\0{}\0{}\n".format(f,st.st_mtime_ns,st.st_size),encoding='utf-8'))
+        return h4sh.hexdigest()
+    def entry_dir(self,uid,digest):
+        return os.path.join(self.cache_dir,"{}.{}".format(uid,digest))
+    def get(self,uid,flist):
+        """
+        Look up the CT volume for series `uid` with slice files `flist`. On a
+        hit, returns a tuple (array, spacing, origin, meta_data, first_slice)
+        with the array memory mapped (read only) from the cache file and
+        `first_slice` the path of the slice with the lowest z. On a miss,
+        returns None.
+        """
+        digest = self.digest(uid,flist)
+        edir = self.entry_dir(uid,digest)
+        cfg = os.path.join(edir,self.cfg_file)
+        if not os.path.exists(cfg):
+            self.nmisses += 1
+            return None
+        try:
+            parser = configparser.RawConfigParser()
+            parser.optionxform = str
+            with open(cfg,"r") as fp:
+                parser.read_file(fp)
+            ct = parser["ct"]
+            if ct.getint("version") != self.version or ct["uid"] != str(uid) or ct["digest"] != digest:
+                raise ValueError("cache entry does not match the DICOM series")
+            shape = tuple(int(n) for n in ct["shape"].split())
+            array = np.load(os.path.join(edir,self.volume_file),mmap_mode='r')
+            if array.shape != shape or array.dtype != np.dtype(ct["dtype"]):
+                raise ValueError("cache entry has array with shape {} and type {}, expected {} and {}".format(array.shape,array.dtype,shape,ct["dtype"]))
+            spacing = tuple(float(v) for v in ct["spacing"].split())
+            origin = tuple(float(v) for v in ct["origin"].split())
+            first_slice = ct["first slice"]
+            meta_data = dict(parser["meta data"].items())
+        except Exception as e:
+            logger.warning("removing corrupt CT cache entry {}: {}".format(edir,e))
+            shutil.rmtree(edir,ignore_errors=True)
+            self.nmisses += 1
+            return None
+        # the modification time of the configuration file is the "last used" time for the LRU policy
+        os.utime(cfg)
+        self.nhits += 1
+        logger.debug("CT volume for series {} found in cache {}".format(uid,edir))
+        return array,spacing,origin,meta_data,first_slice
+    def put(self,uid,flist,array,spacing,origin,meta_data,first_slice):
+        """
+        Store a CT volume. Older entries for the same series UID (with a
+        different file digest) are removed, and then least recently used
+        entries are evicted until the cache fits in `max_bytes`. Volumes larger
+        than `max_bytes` are not stored. Returns the entry directory, or None.
+        """
+        array = np.asarray(array)
+        if array.nbytes > self.max_bytes:
+            logger.debug("CT volume for series {} ({} bytes) is too large for the cache ({} bytes)".format(uid,array.nbytes,self.max_bytes))
+            return None
+        digest = self.digest(uid,flist)
+        edir = self.entry_dir(uid,digest)
+        parser = configparser.RawConfigParser()
+        parser.optionxform = str
+        parser["ct"] = {"version":     str(self.version),
+                        "uid":         str(uid),
+                        "digest":      digest,
+                        "nfiles":      str(len(flist)),
+                        "shape":       " ".join(str(n) for n in array.shape),
+                        "dtype":       array.dtype.str,
+                        "spacing":     " ".join(repr(float(v)) for v in spacing),
+                        "origin":      " ".join(repr(float(v)) for v in origin),
+                        "first slice": str(first_slice)}
+        parser["meta data"] = dict([(str(k),str(v)) for k,v in meta_data.items()])
+        tmpdir = tempfile.mkdtemp(prefix=".tmp.",dir=self.cache_dir)
+        try:
+            np.save(os.path.join(tmpdir,self.volume_file),array)
+            with open(os.path.join(tmpdir,self.cfg_file),"w") as fp:
+                parser.write(fp)
+            os.rename(tmpdir,edir)
+        except OSError as e:
+            # e.g. another process stored the same volume just now
+            logger.debug("could not store CT volume in cache entry {}: {}".format(edir,e))
+            shutil.rmtree(tmpdir,ignore_errors=True)
+            return edir if os.path.isdir(edir) else None
+        for d in os.listdir(self.cache_dir):
+            # entry directories are "<uid>.<digest>"; other series UIDs may start with this UID plus "."
+            if d.rsplit(".",1)[0] == str(uid) and d != os.path.basename(edir):
+                logger.debug("removing outdated CT cache entry {}".format(d))
+                shutil.rmtree(os.path.join(self.cache_dir,d),ignore_errors=True)
+        self.evict(keep=edir)
+        return edir
+    def entries(self):
+        """
+        List of (last used, size in bytes, directory) for all cache entries,
+        least recently used first.
+        """
+        elist = list()
+        for d in os.listdir(self.cache_dir):
+            edir = os.path.join(self.cache_dir,d)
+            try:
+                mtime = os.stat(os.path.join(edir,self.cfg_file)).st_mtime
+                nbytes = sum(os.stat(os.path.join(edir,f)).st_size for f in os.listdir(edir))
+            except OSError:
+                # incomplete entry (being written or being removed)
+                continue
+            elist.append((mtime,nbytes,edir))
+        return sorted(elist)
+    @property
+    def nbytes(self):
+        return sum(nbytes for mtime,nbytes,edir in self.entries())
+    def evict(self,keep=None):
+        """
+        Remove least recently used entries (other than `keep`) until the
+        total size is at most `max_bytes`.
+        """
+        elist = self.entries()
+        total = sum(nbytes for mtime,nbytes,edir in elist)
+        for mtime,nbytes,edir in elist:
+            if total <= self.max_bytes:
+                break
+            if edir == keep:
+                continue
+            logger.debug("evicting CT cache entry {} ({} bytes)".format(edir,nbytes))
+            shutil.rmtree(edir,ignore_errors=True)
+            total -= nbytes
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+
+class Test_CTVolumeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir,"cache")
+        self.flists = dict()
+        for uid in ["1.2.3","1.2.4","1.2.5"]:
+            self.flists[uid] = list()
+            for i in range(3):
+                fname = os.path.join(self.tmpdir,"CT.{}.{}.dcm".format(uid,i))
+                with open(fname,"w") as fp:
+                    fp.write("slice {}".format(i))
+                self.flists[uid].append(fname)
+        self.meta = {"Institution Name":"anonymized","Imaging time":"1-2"}
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_put_get(self):
+        cache = ct_volume_cache(self.cache_dir,2**20)
+        uid = "1.2.3"
+        flist = self.flists[uid]
+        self.assertIsNone(cache.get(uid,flist))
+        a = np.arange(3*4*5,dtype=np.int16).reshape(3,4,5)-1024
+        edir = cache.put(uid,flist,a,(0.1+0.2,1.,2.5),(-250.3,-250.3,1e-17),self.meta,flist[0])
+        self.assertTrue(os.path.isdir(edir))
+        array,spacing,origin,meta,first = cache.get(uid,flist)
+        self.assertIsInstance(array,np.memmap)
+        self.assertTrue(np.array_equal(array,a))
+        self.assertEqual(array.dtype,np.int16)
+        self.assertEqual(spacing,(0.1+0.2,1.,2.5))
+        self.assertEqual(origin,(-250.3,-250.3,1e-17))
+        self.assertEqual(meta,self.meta)
+        self.assertEqual(first,flist[0])
+        self.assertEqual((cache.nhits,cache.nmisses),(1,1))
+        # modified slice: miss, new entry replaces the old one
+        os.utime(flist[1],ns=(0,0))
+        self.assertIsNone(cache.get(uid,flist))
+        edir2 = cache.put(uid,flist,a+1,(1.,1.,1.),(0.,0.,0.),self.meta,flist[0])
+        self.assertNotEqual(edir,edir2)
+        self.assertFalse(os.path.exists(edir))
+        self.assertTrue(np.array_equal(cache.get(uid,flist)[0],a+1))
+        # other file list: miss
+        self.assertIsNone(cache.get(uid,flist[:2]))
+    def test_uid_prefix(self):
+        # replacing the entry of a series does not remove the entries of series with a longer UID that starts with it
+        cache = ct_volume_cache(self.cache_dir,2**20)
+        a = np.zeros((2,3,4),dtype=np.int16)
+        flist = self.flists["1.2.3"]
+        other = self.flists["1.2.4"]
+        cache.put("1.2.3.4",other,a,(1.,1.,1.),(0.,0.,0.),self.meta,other[0])
+        cache.put("1.2.3",flist,a,(1.,1.,1.),(0.,0.,0.),self.meta,flist[0])
+        os.utime(flist[1],ns=(0,0))
+        cache.put("1.2.3",flist,a+1,(1.,1.,1.),(0.,0.,0.),self.meta,flist[0])
+        self.assertTrue(np.array_equal(cache.get("1.2.3",flist)[0],a+1))
+        self.assertIsNotNone(cache.get("1.2.3.4",other))
+        self.assertEqual(len(cache.entries()),2)
+    def test_corrupt_entry(self):
+        cache = ct_volume_cache(self.cache_dir,2**20)
+        uid = "1.2.3"
+        flist = self.flists[uid]
+        edir = cache.put(uid,flist,np.zeros((2,3,4),dtype=np.int16),(1.,1.,1.),(0.,0.,0.),self.meta,flist[0])
+        np.save(os.path.join(edir,ct_volume_cache.volume_file),np.zeros((2,3,5),dtype=np.int16))
+        self.assertIsNone(cache.get(uid,flist))
+        self.assertFalse(os.path.exists(edir))
+    def test_lru_eviction(self):
+        a = np.zeros((10,100,100),dtype=np.int16)
+        # room for two volumes, not for three
+        cache = ct_volume_cache(self.cache_dir,2.5*a.nbytes)
+        t = 1000000000
+        for uid in ["1.2.3","1.2.4"]:
+            edir = cache.put(uid,self.flists[uid],a,(1.,1.,1.),(0.,0.,0.),self.meta,"x")
+            t += 10
+            os.utime(os.path.join(edir,ct_volume_cache.cfg_file),(t,t))
+        # use the first one, so the second one is the least recently used
+        self.assertIsNotNone(cache.get("1.2.3",self.flists["1.2.3"]))
+        cache.put("1.2.5",self.flists["1.2.5"],a,(1.,1.,1.),(0.,0.,0.),self.meta,"x")
+        self.assertIsNotNone(cache.get("1.2.3",self.flists["1.2.3"]))
+        self.assertIsNone(cache.get("1.2.4",self.flists["1.2.4"]))
+        self.assertIsNotNone(cache.get("1.2.5",self.flists["1.2.5"]))
+        self.assertLessEqual(cache.nbytes,cache.max_bytes)
+        self.assertEqual(len(cache.entries()),2)
+        # too large for the cache
+        self.assertIsNone(cache.put("1.2.4",self.flists["1.2.4"],np.zeros((30,100,100),dtype=np.int16),(1.,1.,1.),(0.,0.,0.),self.meta,"x"))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
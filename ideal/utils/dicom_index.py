@@ -0,0 +1,315 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module provides an index of the DICOM files in a directory, based on the
+headers only (the pixel data are not read). For every file with a ".dcm"
+suffix, the modality, SOP class, the instance/series/study UIDs, the UIDs of
+referenced plans, structure sets and CT series and the image position are
+stored, together with the modification time and size of the file. The index
+is kept in a small configuration file in the same directory, such that on the
+next use only new or modified files need to be read.
+"""
+
+import os
+import configparser
+import pydicom
+import logging
+logger=logging.getLogger(__name__)
+
+class dicom_index(object):
+    """
+    Header-only index of the DICOM files (".dcm" suffix) in a directory.
+    The index is stored in `store` (default: ".dicom_index.cfg" in the DICOM
+    directory) if that location is writable; otherwise it is kept in memory only.
+    """
+    version = "1"
+    store_name = ".dicom_index.cfg"
+    keys = ["mtime","size","readable",
+            "SOPClassUID","SOPClassName","Modality",
+            "SOPInstanceUID","SeriesInstanceUID","StudyInstanceUID","FrameOfReferenceUID",
+            "ReferencedRTPlanUID","ReferencedStructureSetUID","ReferencedSeriesUID",
+            "ReferencedBeamNumber","DoseSummationType","DoseType","ImagePositionPatient"]
+    def __init__(self,dirpath,store=None):
+        if not os.path.isdir(dirpath):
+            raise RuntimeError("DICOM directory {} does not exist".format(dirpath))
+        self._dirpath = dirpath
+        self._store = store if store else os.path.join(dirpath,dicom_index.store_name)
+        self._entries = dict()
+        self.nread = 0
+        self.update()
+    @property
+    def dirpath(self):
+        return self._dirpath
+    def __len__(self):
+        return len(self._entries)
+    def __contains__(self,filename):
+        return os.path.basename(filename) in self._entries
+    def path(self,filename):
+        return os.path.join(self._dirpath,filename)
+    def filenames(self):
+        return sorted(self._entries.keys())
+    def header(self,filename):
+        """
+        Return the indexed header information of a file, as a dictionary with
+        string values (empty strings for missing attributes).
+        """
+        return dict(self._entries[os.path.basename(filename)])
+    def update(self):
+        """
+        Bring the index up to date with the directory contents: read the headers
+        of new and modified files, forget about removed files.
+        Returns the number of files for which the header was (re)read.
+        """
+        stored = self._read_store()
+        entries = dict()
+        nread = 0
+        for s in sorted(os.listdir(self._dirpath)):
+            if s[-4:].lower() != '.dcm':
+                continue
+            fpath = os.path.join(self._dirpath,s)
+            if not os.path.isfile(fpath):
+                continue
+            st = os.stat(fpath)
+            mtime,size = repr(st.st_mtime),str(st.st_size)
+            entry = self._entries.get(s,stored.get(s,None))
+            if entry is None or entry["mtime"] != mtime or entry["size"] != size:
+                entry = self._read_header(fpath)
+                entry["mtime"] = mtime
+                entry["size"] = size
+                nread += 1
+            entries[s] = entry
+        changed = (nread > 0) or (set(entries.keys()) != set(stored.keys()))
+        self._entries = entries
+        self.nread += nread
+        logger.debug("DICOM index for {} has {} files, read {} headers".format(self._dirpath,len(entries),nread))
+        if changed:
+            self._write_store()
+        return nread
+    def find(self,**criteria):
+        """
+        Return the (sorted) names of the files for which the indexed values are
+        equal to the given values, e.g. `find(Modality="RTSTRUCT",SOPInstanceUID=uid)`.
+        """
+        for k in criteria.keys():
+            if k not in dicom_index.keys:
+                raise KeyError("unknown DICOM index key '{}', should be one of: {}".format(k,", ".join(dicom_index.keys)))
+        return [s for s in self.filenames() if all([self._entries[s][k]==str(v) for k,v in criteria.items()])]
+    def dose_files(self,rpuid=None):
+        """
+        Return the names of the RT Dose files that refer to the plan with SOP
+        instance UID `rpuid`. Dose files without a plan reference are always included.
+        """
+        return [s for s in self.find(SOPClassName='RT Dose Storage') if not rpuid or self._entries[s]["ReferencedRTPlanUID"] in ("",str(rpuid))]
+    def series_files(self,series_uid):
+        """
+        Return the names of the files in the series with `series_uid`, sorted
+        by the z-coordinate of the image position (if available).
+        """
+        flist = self.find(SeriesInstanceUID=series_uid)
+        return sorted(flist,key=lambda s: self._image_z(s))
+    def plan_files(self,rpuid):
+        """
+        Return a dictionary with the names of the files that belong to the plan
+        with SOP instance UID `rpuid`: the plan file itself ("RTPLAN"), the dose
+        files ("RTDOSE"), the structure set referenced by the plan ("RTSTRUCT") and
+        the CT series referenced by that structure set ("CT").
+        """
+        files = dict(RTPLAN=[],RTDOSE=[],RTSTRUCT=[],CT=[])
+        files["RTPLAN"] = self.find(SOPInstanceUID=rpuid)
+        files["RTDOSE"] = self.dose_files(rpuid)
+        for rp in files["RTPLAN"]:
+            ssuid = self._entries[rp]["ReferencedStructureSetUID"]
+            if ssuid:
+                files["RTSTRUCT"] += self.find(SOPClassName="RT Structure Set Storage",SOPInstanceUID=ssuid)
+        for rs in files["RTSTRUCT"]:
+            ctuid = self._entries[rs]["ReferencedSeriesUID"]
+            if ctuid:
+                files["CT"] += self.series_files(ctuid)
+        return files
+    def _image_z(self,s):
+        ipp = self._entries[s]["ImagePositionPatient"].split()
+        return float(ipp[2]) if len(ipp)==3 else 0.
+    def _read_header(self,fpath):
+        entry = dict([(k,"") for k in dicom_index.keys])
+        try:
+            ds = pydicom.dcmread(fpath,stop_before_pixels=True)
+        except Exception as e:
+            logger.debug("pydicom could not read {}: {}".format(fpath,e))
+            entry["readable"] = "no"
+            return entry
+        entry["readable"] = "yes"
+        for k in ["SOPClassUID","Modality","SOPInstanceUID","SeriesInstanceUID","StudyInstanceUID",
+                  "FrameOfReferenceUID","DoseSummationType","DoseType"]:
+            entry[k] = str(ds.get(k,""))
+        if "SOPClassUID" in ds:
+            entry["SOPClassName"] = str(ds.SOPClassUID.name)
+        if "ImagePositionPatient" in ds:
+            entry["ImagePositionPatient"] = " ".join([repr(float(v)) for v in ds.ImagePositionPatient])
+        try:
+            # dose files (and others) refer to a plan
+            refrtp0 = ds.ReferencedRTPlanSequence[0]
+            entry["ReferencedRTPlanUID"] = str(refrtp0.ReferencedSOPInstanceUID)
+            entry["ReferencedBeamNumber"] = str(refrtp0.ReferencedFractionGroupSequence[0].ReferencedBeamSequence[0].ReferencedBeamNumber)
+        except (AttributeError,IndexError):
+            pass
+        try:
+            # plans refer to a structure set
+            entry["ReferencedStructureSetUID"] = str(ds.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID)
+        except (AttributeError,IndexError):
+            pass
+        try:
+            # structure sets refer to a CT series
+            entry["ReferencedSeriesUID"] = str(ds.ReferencedFrameOfReferenceSequence[0].RTReferencedStudySequence[0].RTReferencedSeriesSequence[0].SeriesInstanceUID)
+        except (AttributeError,IndexError):
+            pass
+        return entry
+    def _read_store(self):
+        stored = dict()
+        if not os.path.exists(self._store):
+            return stored
+        parser = configparser.RawConfigParser()
+        parser.optionxform = str
+        try:
+            with open(self._store,"r") as fp:
+                parser.read_file(fp)
+            if parser.get("dicom_index","version",fallback="") != dicom_index.version:
+                logger.debug("DICOM index store {} has a different version, ignoring it".format(self._store))
+                return stored
+            for s in parser.sections():
+                if s == "dicom_index":
+                    continue
+                stored[s] = dict([(k,parser.get(s,k,fallback="")) for k in dicom_index.keys])
+        except (configparser.Error,OSError) as e:
+            logger.warning("failed to read DICOM index store {}: {}".format(self._store,e))
+            stored = dict()
+        return stored
+    def _write_store(self):
+        parser = configparser.RawConfigParser()
+        parser.optionxform = str
+        parser.add_section("dicom_index")
+        parser.set("dicom_index","version",dicom_index.version)
+        for s,entry in self._entries.items():
+            parser.add_section(s)
+            for k in dicom_index.keys:
+                parser.set(s,k,entry[k])
+        tmp = "{}.{}.tmp".format(self._store,os.getpid())
+        try:
+            with open(tmp,"w") as fp:
+                parser.write(fp)
+            os.replace(tmp,self._store)
+        except OSError as e:
+            logger.debug("could not write DICOM index store {} ({}), keeping the index in memory only".format(self._store,e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+import shutil
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+def _write_test_dicom(fpath,sop_class,modality,**attrs):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = modality
+    for k,v in attrs.items():
+        setattr(ds,k,v)
+    ds.save_as(fpath,enforce_file_format=True)
+    return ds
+
+class Test_DicomIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        ct_class = "1.2.840.10008.5.1.4.1.1.2"
+        rs_class = "1.2.840.10008.5.1.4.1.1.481.3"
+        rp_class = "1.2.840.10008.5.1.4.1.1.481.8"
+        rd_class = "1.2.840.10008.5.1.4.1.1.481.2"
+        self.ct_series_uid = generate_uid()
+        self.ct_files = []
+        for i in range(5):
+            fname = "CT{}.dcm".format(i)
+            # slices written in reversed order
+            _write_test_dicom(os.path.join(self.tmpdir,fname),ct_class,"CT",
+                              SeriesInstanceUID=self.ct_series_uid,ImagePositionPatient=[0.,0.,10.-2.*i],
+                              Rows=2,Columns=2,BitsAllocated=16,BitsStored=16,HighBit=15,
+                              SamplesPerPixel=1,PixelRepresentation=1,PhotometricInterpretation="MONOCHROME2",
+                              PixelData=np.zeros(4,dtype=np.int16).tobytes())
+            self.ct_files.insert(0,fname)
+        refseries = Dataset()
+        refseries.SeriesInstanceUID = self.ct_series_uid
+        refstudy = Dataset()
+        refstudy.RTReferencedSeriesSequence = Sequence([refseries])
+        reffor = Dataset()
+        reffor.RTReferencedStudySequence = Sequence([refstudy])
+        rs = _write_test_dicom(os.path.join(self.tmpdir,"RS.dcm"),rs_class,"RTSTRUCT",
+                               ReferencedFrameOfReferenceSequence=Sequence([reffor]))
+        refss = Dataset()
+        refss.ReferencedSOPInstanceUID = rs.SOPInstanceUID
+        rp = _write_test_dicom(os.path.join(self.tmpdir,"RP.dcm"),rp_class,"RTPLAN",
+                               ReferencedStructureSetSequence=Sequence([refss]))
+        self.rpuid = str(rp.SOPInstanceUID)
+        for label,planuid in [("RD1",self.rpuid),("RD2",self.rpuid),("RDother",generate_uid())]:
+            refrtp = Dataset()
+            refrtp.ReferencedSOPInstanceUID = planuid
+            _write_test_dicom(os.path.join(self.tmpdir,label+".dcm"),rd_class,"RTDOSE",
+                              ReferencedRTPlanSequence=Sequence([refrtp]),DoseSummationType="PLAN",DoseType="PHYSICAL")
+        with open(os.path.join(self.tmpdir,"garbage.dcm"),"w") as fp:
+            fp.write("this is not a DICOM file")
+        with open(os.path.join(self.tmpdir,"README.txt"),"w") as fp:
+            fp.write("not indexed")
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_queries(self):
+        index = dicom_index(self.tmpdir)
+        self.assertEqual(len(index),11)
+        self.assertEqual(index.nread,11)
+        self.assertEqual(index.header("garbage.dcm")["readable"],"no")
+        self.assertEqual(index.dose_files(self.rpuid),["RD1.dcm","RD2.dcm"])
+        self.assertEqual(len(index.dose_files()),3)
+        self.assertEqual(index.series_files(self.ct_series_uid),self.ct_files)
+        plan = index.plan_files(self.rpuid)
+        self.assertEqual(plan["RTPLAN"],["RP.dcm"])
+        self.assertEqual(plan["RTSTRUCT"],["RS.dcm"])
+        self.assertEqual(plan["RTDOSE"],["RD1.dcm","RD2.dcm"])
+        self.assertEqual(plan["CT"],self.ct_files)
+        self.assertEqual(index.find(Modality="CT",ImagePositionPatient="0.0 0.0 10.0"),["CT0.dcm"])
+        with self.assertRaises(KeyError):
+            index.find(PatientName="nobody")
+    def test_store(self):
+        index = dicom_index(self.tmpdir)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir,dicom_index.store_name)))
+        # second index: nothing to read
+        index2 = dicom_index(self.tmpdir)
+        self.assertEqual(index2.nread,0)
+        self.assertEqual(index2.plan_files(self.rpuid),index.plan_files(self.rpuid))
+        # modified and removed files
+        os.remove(os.path.join(self.tmpdir,"RD2.dcm"))
+        with open(os.path.join(self.tmpdir,"garbage.dcm"),"a") as fp:
+            fp.write(", still not a DICOM file")
+        index3 = dicom_index(self.tmpdir)
+        self.assertEqual(index3.nread,1)
+        self.assertEqual(index3.dose_files(self.rpuid),["RD1.dcm"])
+        # other store location
+        store = os.path.join(self.tmpdir,"elsewhere.cfg")
+        index4 = dicom_index(self.tmpdir,store=store)
+        self.assertEqual(index4.nread,10)
+        self.assertTrue(os.path.exists(store))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -10,6 +10,7 @@ import pydicom
 import itk
 import numpy as np
 import os
+from utils.dicom_index import dicom_index
 logger=logging.getLogger(__name__)
 
 class dose_info(object):
@@ -61,17 +62,17 @@ class dose_info(object):
     def refd_beam_number(self):
         return self._beamnr
     @staticmethod
-    def get_dose_files(dirpath,rpuid=None,only_physical=False):
+    def get_dose_files(dirpath,rpuid=None,only_physical=False,index=None):
         doses = dict()
         #beam_numbers = [str(beam.BeamNumber) for beam in self._rp.IonBeamSequence]
         logger.debug("going to find RD dose files in directory {}".format(dirpath))
         logger.debug("for UID={} PLAN".format(rpuid if rpuid else "any/all"))
-        for s in os.listdir(dirpath):
-            if not s[-4:].lower() == ".dcm":
-                logger.debug("NOT DICOM (no dcm suffix): {}".format(s))
-                continue # not dicom
+        # only the RT Dose files for this plan are read completely
+        if index is None:
+            index = dicom_index(dirpath)
+        for s in index.dose_files(rpuid):
             fpath = os.path.join(dirpath,s)
-            dcm = pydicom.read_file(fpath)
+            dcm = pydicom.dcmread(fpath)
             if 'SOPClassUID' not in dcm:
                 logger.debug("NOT A DOSE FILE (SOPClassUID attribute is missing): {}".format(s))
                 continue # not a RD dose file
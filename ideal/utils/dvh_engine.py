@@ -0,0 +1,294 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module computes dose volume histograms (DVH) and dose metrics for many
+regions of interest and many dose distributions at once. The ROIs are given
+either as a label map (see `utils.roi_utils.get_label_map`) or as a list of
+(possibly overlapping, possibly partial volume corrected) mask images on the
+same grid as the dose images. The membership of the voxels in the ROIs is
+computed once; for each dose image, the histograms of all ROIs are then filled
+with one weighted `numpy.bincount`.
+
+The histograms and the Dx values are computed in the same way as in
+`utils.roi_utils.region_of_interest.get_dvh`: Dx is the dose that is received
+by at least x percent of the ROI volume, interpolated in the cumulative
+histogram.
+"""
+
+import itk
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+def _as_array(img):
+    return img if isinstance(img,np.ndarray) else itk.GetArrayViewFromImage(img)
+
+class dvh_table(object):
+    """
+    Results of `dvh_engine.compute`: for `nroi` ROIs and `ndose` dose images,
+    `dvh` has shape (nroi,ndose,nbins) with the cumulative DVH (fraction of the
+    ROI volume with a dose above the upper edge of the bin), `edges` has shape
+    (ndose,nbins+1) and `metrics` is a dictionary with for each metric ("mean",
+    "min", "max", "D2", "V20", etc.) an array with shape (nroi,ndose).
+    `volume` has the volume of each ROI in cm3.
+    """
+    def __init__(self,roi_names,dose_names,edges,dvh,volume,metrics):
+        self.roi_names = list(roi_names)
+        self.dose_names = list(dose_names)
+        self.edges = edges
+        self.dvh = dvh
+        self.volume = volume
+        self.metrics = metrics
+    def get(self,roi,dose,metric):
+        return self.metrics[metric][self.roi_names.index(roi),self.dose_names.index(dose)]
+    def write(self,fname):
+        """
+        Write the metrics and the DVH curves in one tab separated text file,
+        one row per ROI and dose image. The bin edges per dose image are given
+        in comment lines at the top.
+        """
+        mnames = list(self.metrics.keys())
+        with open(fname,"w") as fp:
+            for d,dname in enumerate(self.dose_names):
+                fp.write("# edges\t{}\t{}\n".format(dname,"\t".join("{:g}".format(e) for e in self.edges[d])))
+            fp.write("\t".join(["roi","dose","volume [cm3]"]+mnames+["dvh"])+"\n")
+            for r,rname in enumerate(self.roi_names):
+                for d,dname in enumerate(self.dose_names):
+                    values = ["{:g}".format(self.volume[r])]+["{:g}".format(self.metrics[m][r,d]) for m in mnames]
+                    curve = " ".join("{:.5g}".format(v) for v in self.dvh[r,d])
+                    fp.write("\t".join([rname,dname]+values+[curve])+"\n")
+
+class dvh_engine(object):
+    """
+    DVH calculator for a fixed set of ROIs on a fixed grid. Use `from_label_map`
+    or `from_masks` to create it. The voxel volume (in mm3) is only used for
+    the ROI volumes.
+    """
+    def __init__(self,index,roi,weight,roi_names,shape,voxel_volume=1.):
+        # membership of the voxels in the ROIs, grouped by ROI, voxel order within each ROI
+        self.index = index
+        self.roi = roi
+        self.weight = weight
+        self.roi_names = list(roi_names)
+        self.shape = tuple(shape)
+        self.voxel_volume = voxel_volume
+        self.nroi = len(self.roi_names)
+        self.start = np.searchsorted(self.roi,np.arange(self.nroi+1))
+        self.wsum = np.bincount(self.roi,weights=self.weight,minlength=self.nroi)
+    @staticmethod
+    def from_label_map(labels,roi_names):
+        """
+        ROIs from a label image (or array) in which voxels with value k belong
+        to the ROI with name `roi_names[k-1]`.
+        """
+        alabels = np.asarray(_as_array(labels)).ravel()
+        order = np.argsort(alabels,kind='stable')
+        k = alabels[order].astype(np.intp)
+        inroi = (k>0) & (k<=len(roi_names))
+        index,roi = order[inroi],k[inroi]-1
+        voxel_volume = 1. if isinstance(labels,np.ndarray) else float(np.prod(labels.GetSpacing()))
+        return dvh_engine(index,roi,np.ones(len(index)),roi_names,_as_array(labels).shape,voxel_volume)
+    @staticmethod
+    def from_masks(masks,roi_names):
+        """
+        ROIs from a list of mask images (or arrays) with the same shape; the
+        mask values are used as weights (e.g. partial volume corrected masks).
+        """
+        assert(len(masks)==len(roi_names))
+        indices,rois,weights = list(),list(),list()
+        shape = None
+        for r,mask in enumerate(masks):
+            amask = np.asarray(_as_array(mask))
+            if shape is None:
+                shape = amask.shape
+            elif amask.shape != shape:
+                raise ValueError("mask for ROI '{}' has shape {}, expected {}".format(roi_names[r],amask.shape,shape))
+            flat = amask.ravel()
+            index = np.flatnonzero(flat)
+            indices.append(index)
+            rois.append(np.full(len(index),r,dtype=np.intp))
+            weights.append(flat[index])
+        voxel_volume = 1. if isinstance(masks[0],np.ndarray) else float(np.prod(masks[0].GetSpacing()))
+        return dvh_engine(np.concatenate(indices),np.concatenate(rois),np.concatenate(weights),roi_names,shape,voxel_volume)
+    def compute(self,doses,nbins=100,dx=(2,50,98),vx=(),drange=None):
+        """
+        Compute the DVHs and metrics for the dose images (or arrays) in the
+        dictionary `doses` (name: dose), with `nbins` bins between the minimum
+        and maximum of each dose image (or `drange`, if given). `dx` and `vx`
+        are the percentages for the Dx metrics and the doses for the Vx metrics
+        (in percent of the ROI volume). Returns a `dvh_table` object.
+        """
+        ndose = len(doses)
+        dvh = np.zeros((self.nroi,ndose,nbins))
+        edges = np.zeros((ndose,nbins+1))
+        mnames = ["mean","min","max"]+["D{:g}".format(x) for x in dx]+["V{:g}".format(v) for v in vx]
+        metrics = dict([(m,np.full((self.nroi,ndose),np.nan)) for m in mnames])
+        nonempty = self.start[:-1] < self.start[1:]
+        for d,(dname,dose) in enumerate(doses.items()):
+            adose = np.asarray(_as_array(dose))
+            if adose.shape != self.shape:
+                raise ValueError("dose '{}' has shape {}, expected {}".format(dname,adose.shape,self.shape))
+            flat = adose.ravel()
+            dmin,dmax = (np.min(flat),np.max(flat)) if drange is None else drange
+            a = flat[self.index]
+            nb_negative = np.sum(a<0)
+            if nb_negative:
+                logger.warning("dose '{}' has {} negative voxels in the ROIs, they are counted as zero".format(dname,nb_negative))
+                a = np.where(a<0,0,a)
+            # histogram with the same bins and the same summation order as numpy.histogram
+            first,last = dmin,dmax
+            if first == last:
+                first,last = first-0.5,last+0.5
+            bin_type = np.result_type(first,last,a)
+            if np.issubdtype(bin_type,np.integer):
+                bin_type = np.result_type(bin_type,float)
+            dedges = np.linspace(first,last,nbins+1,dtype=bin_type)
+            edges[d] = dedges
+            ibin = np.searchsorted(dedges,a,side='right')-1
+            ibin[a==dedges[-1]] = nbins-1
+            inrange = (ibin>=0) & (ibin<nbins)
+            hist = np.bincount(self.roi[inrange]*nbins+ibin[inrange],weights=self.weight[inrange],minlength=self.nroi*nbins).reshape(self.nroi,nbins)
+            chist = np.cumsum(hist,axis=1)
+            total = chist[:,-1]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                dvh[:,d,:] = -1.0*chist/total[:,None]+1.0
+                metrics["mean"][:,d] = np.bincount(self.roi,weights=self.weight*a,minlength=self.nroi)/self.wsum
+            if np.any(nonempty):
+                starts = self.start[:-1][nonempty]
+                metrics["min"][nonempty,d] = np.minimum.reduceat(a,starts)
+                metrics["max"][nonempty,d] = np.maximum.reduceat(a,starts)
+            for x in dx:
+                metrics["D{:g}".format(x)][:,d] = self._dx(chist,total,edges[d],(100-x)/100)
+            for v in vx:
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    metrics["V{:g}".format(v)][:,d] = 100.*np.bincount(self.roi,weights=self.weight*(a>=v),minlength=self.nroi)/self.wsum
+        volume = self.wsum*self.voxel_volume/1000.
+        return dvh_table(self.roi_names,list(doses.keys()),edges,dvh,volume,metrics)
+    @staticmethod
+    def _dx(chist,total,edges,q):
+        """
+        Dose below which a fraction `q` of the histogram content is, for all
+        ROIs at once, with the interpolation of `region_of_interest.get_dvh`.
+        """
+        result = np.full(len(total),np.nan)
+        ok = total > 0
+        target = q*total[ok]
+        c = chist[ok]
+        i = np.sum(c<target[:,None],axis=1)
+        rows = np.arange(len(i))
+        ci = c[rows,i]
+        cprev = np.where(i>0,c[rows,np.maximum(i-1,0)],0.)
+        eprev = edges[np.maximum(i-1,0)]
+        result[ok] = ( (ci-target)*eprev + (target-cprev)*edges[i] ) / (ci-cprev)
+        return result
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import os
+import tempfile
+import shutil
+from datetime import datetime
+
+class Test_DVHEngine(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def _rois(self,nroi,shape,seed):
+        # spherical ROIs with random centers and radii, contours in every slice
+        from utils.roi_utils import region_of_interest, contour_layer
+        rng = np.random.default_rng(seed)
+        nz,ny,nx = shape
+        rois = list()
+        for r in range(nroi):
+            c = rng.uniform([0.3*nx,0.3*ny,0.3*nz],[0.7*nx,0.7*ny,0.7*nz])
+            radius = rng.uniform(3.,0.25*min(shape))
+            layers = list()
+            for iz in range(nz):
+                rz2 = radius**2-(iz-c[2])**2
+                if rz2 <= 1.:
+                    continue
+                phi = np.linspace(0,2*np.pi,24,endpoint=False)
+                layers.append(contour_layer(np.stack([c[0]+np.sqrt(rz2)*np.cos(phi),c[1]+np.sqrt(rz2)*np.sin(phi),np.full(len(phi),float(iz))],axis=1)))
+            rois.append(region_of_interest(contours_list=layers))
+        return rois
+    def _dose(self,shape,seed):
+        rng = np.random.default_rng(seed)
+        nz,ny,nx = shape
+        z,y,x = np.meshgrid(np.arange(nz),np.arange(ny),np.arange(nx),indexing='ij')
+        a = 2.*np.exp(-((x-nx/2)**2+(y-ny/2)**2+(z-nz/2)**2)/(0.2*nx*nx))+rng.normal(0,0.01,shape)
+        img = itk.GetImageFromArray(np.clip(a,0,None).astype(np.float32))
+        return img
+    def test_vs_get_dvh(self):
+        shape = (20,40,50)
+        rois = self._rois(5,shape,1)
+        img = itk.GetImageFromArray(np.zeros(shape,dtype=np.float32))
+        doses = dict([("dose{}".format(i),self._dose(shape,10+i)) for i in range(2)])
+        for corrected in [True,False]:
+            masks = [roi.get_mask(img,corrected=corrected) for roi in rois]
+            names = ["roi{}".format(r) for r in range(len(rois))]
+            table = dvh_engine.from_masks(masks,names).compute(doses,dx=(2,50,98),vx=(1.,))
+            for r,roi in enumerate(rois):
+                amask = itk.GetArrayFromImage(masks[r])
+                for d,(dname,dose) in enumerate(doses.items()):
+                    adose = itk.GetArrayFromImage(dose)
+                    if corrected:
+                        dvh,dedges,dhistsum,dsum,d02,d50,d98 = roi.get_dvh(dose)
+                        self.assertTrue(np.array_equal(dvh,table.dvh[r,d]))
+                        self.assertTrue(np.array_equal(dedges,table.edges[d]))
+                        self.assertEqual(d02,table.get(names[r],dname,"D2"))
+                        self.assertEqual(d50,table.get(names[r],dname,"D50"))
+                        self.assertEqual(d98,table.get(names[r],dname,"D98"))
+                    inside = adose[amask>0]
+                    self.assertAlmostEqual(table.get(names[r],dname,"min"),np.min(inside))
+                    self.assertAlmostEqual(table.get(names[r],dname,"max"),np.max(inside))
+                    self.assertAlmostEqual(table.get(names[r],dname,"mean"),np.sum(amask*adose)/np.sum(amask),places=5)
+                    self.assertAlmostEqual(table.get(names[r],dname,"V1"),100.*np.sum(amask*(adose>=1.),dtype=float)/np.sum(amask,dtype=float),places=5)
+    def test_label_map(self):
+        rng = np.random.default_rng(2)
+        labels = rng.integers(0,4,(6,7,8)).astype(np.uint8)
+        labels[0] = 0
+        adose = rng.uniform(0,3,labels.shape)
+        table = dvh_engine.from_label_map(labels,["a","b","c","empty"]).compute({"plan":adose},nbins=10,vx=(1.5,))
+        masks = [(labels==k).astype(np.uint8) for k in range(1,5)]
+        table2 = dvh_engine.from_masks(masks,["a","b","c","empty"]).compute({"plan":adose},nbins=10,vx=(1.5,))
+        self.assertTrue(np.array_equal(table.dvh[:3],table2.dvh[:3]))
+        for k,name in enumerate(["a","b","c"],1):
+            self.assertEqual(table.get(name,"plan","max"),np.max(adose[labels==k]))
+            self.assertAlmostEqual(table.get(name,"plan","V1.5"),100.*np.mean(adose[labels==k]>=1.5))
+        self.assertEqual(table.volume[3],0.)
+        self.assertTrue(np.isnan(table.get("empty","plan","D50")))
+        fname = os.path.join(self.tmpdir,"dvh.txt")
+        table.write(fname)
+        with open(fname) as fp:
+            lines = fp.readlines()
+        self.assertEqual(len(lines),1+1+4)
+        self.assertEqual(lines[1].split("\t")[:4],["roi","dose","volume [cm3]","mean"])
+        self.assertEqual(len(lines[2].split("\t")[-1].split()),10)
+    def test_benchmark(self):
+        print("Test_DVHEngine test_benchmark")
+        shape = (60,128,128)
+        rois = self._rois(40,shape,3)
+        img = itk.GetImageFromArray(np.zeros(shape,dtype=np.float32))
+        masks = [roi.get_mask(img) for roi in rois]
+        doses = dict([("dose{}".format(i),self._dose(shape,20+i)) for i in range(3)])
+        t0 = datetime.now()
+        table = dvh_engine.from_masks(masks,["roi{}".format(r) for r in range(40)]).compute(doses)
+        t1 = datetime.now()
+        for r,roi in enumerate(rois):
+            for d,dose in enumerate(doses.values()):
+                dvh = roi.get_dvh(dose)[0]
+                # numpy.histogram adds the weights in blocks, so the sums may differ in the last bits
+                self.assertTrue(np.allclose(dvh,table.dvh[r,d],rtol=0,atol=1e-12))
+        t2 = datetime.now()
+        print("40 ROIs x 3 doses on a {}x{}x{} grid: batched engine took {}, get_dvh per ROI and dose took {}".format(shape[2],shape[1],shape[0],t1-t0,t2-t1))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
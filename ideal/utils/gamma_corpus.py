@@ -0,0 +1,313 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+Versioned corpus of small synthetic reference/target dose image pairs with known
+gamma pass rates, for validating and benchmarking the gamma index backends in
+`utils.gamma_index`.
+
+The corpus is stored in-repo as compressed MHD files plus a JSON manifest, in
+the subdirectory "v<version>" of `CORPUS_ROOT`. It is generated (deterministically)
+by `write_corpus`. The pass rates of most cases are known analytically:
+
+* "flat_levels": reference dose with two flat levels and a noisy target dose, equal
+  geometries. Within a level, the reference voxel at the same position has the same
+  dose as all others and the levels differ by much more than the dose difference
+  criterion, so a target voxel passes exactly if its (local or global) dose difference does.
+* "ramp_rows": rows of linear dose ramps along x (different slope per row) with the
+  target grid shifted by a fraction of a voxel along x. The rows are further apart
+  than the DTA, so each target voxel passes exactly if its gamma value w.r.t. the
+  reference voxel in its own row at the shift distance does.
+* "gaussian_identical": identical reference and target, every voxel passes.
+
+The pass rate of the "gaussian_mc" case (a noisy target dose on a finer grid, as for
+a Monte Carlo dose vs. a TPS dose) is given by the exhaustive search of
+`gamma_index_3d_extended`; backends with a box search may deviate slightly.
+
+Whenever the images or the cases change, `CORPUS_VERSION` is incremented and the
+new corpus is written next to the old one, so that benchmark results remain
+comparable per corpus version.
+"""
+
+import os
+import json
+import time
+import logging
+import numpy as np
+import itk
+from utils.gamma_index import get_gamma_index, gamma_index_3d_extended, gamma_index_3d_pass_rate, gamma_criteria, gamma_pass_rate
+logger=logging.getLogger(__name__)
+
+CORPUS_VERSION = 1
+CORPUS_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),"gamma_test_corpus")
+MANIFEST = "corpus.json"
+
+# "pass rate" is gamma_index_3d_pass_rate, the others are engines of get_gamma_index
+BACKENDS = ["loop","slabs","kdtree","parallel","extended","pass rate"]
+
+def corpus_directory(version=CORPUS_VERSION,root=CORPUS_ROOT):
+    return os.path.join(root,"v{}".format(version))
+
+def _image(data,spacing,origin):
+    img = itk.GetImageFromArray(np.ascontiguousarray(data.swapaxes(0,2),dtype=np.float32))
+    img.SetSpacing([float(s) for s in spacing])
+    img.SetOrigin([float(o) for o in origin])
+    return img
+
+def _grid(shape,spacing,origin):
+    return np.meshgrid(*[origin[j]+np.arange(shape[j])*spacing[j] for j in range(3)],indexing='ij')
+
+_FLAT_LEVELS_CRITERIA = [gamma_criteria(dd=dd,dta=dd,local=local) for dd in (2.,3.) for local in (False,True)]
+
+def _flat_levels_gamma(aref,atarget,dmax,criteria):
+    """
+    Gamma values of a "flat_levels" target, i.e. the (local or global) dose differences.
+    """
+    dd = 0.01*criteria.dd*(atarget if criteria.local else dmax)
+    return np.abs(atarget-aref)/dd
+
+def _flat_levels_pair(rng):
+    """
+    Reference dose with two flat levels (the maximum 2 Gy and 0.8 Gy, in two halves along x) and a
+    noisy target dose with a low dose corner. The noise is kept away from the pass/fail boundaries of
+    the 2% and 3% criteria, for global and local normalization.
+    """
+    shape,spacing,origin = (16,16,8),(2.5,2.5,2.5),(-20.,-20.,-10.)
+    ref = np.full(shape,2.)
+    ref[shape[0]//2:] = 0.8
+    eps = rng.normal(0.,0.03,shape)
+    while True:
+        target = ref*(1.+eps)
+        bad = np.zeros(shape,dtype=bool)
+        for criteria in _FLAT_LEVELS_CRITERIA:
+            bad |= np.abs(_flat_levels_gamma(ref,target,np.max(ref),criteria)-1.) < 0.02
+        if not bad.any():
+            break
+        eps[bad] = rng.normal(0.,0.03,np.count_nonzero(bad))
+    target[:4,:4,:] = 0.1*(1.+rng.normal(0.,0.01,(4,4,shape[2])))
+    return _image(ref,spacing,origin),_image(target,spacing,origin)
+
+# slopes of the ramp rows are chosen such that the rows have these gamma values for 3%/3mm
+_RAMP_ROW_GAMMAS = [0.5,0.75,0.95,1.1,1.25,1.4,1.5]
+_RAMP_SHIFT = 1.1
+
+def _ramp_rows_pair():
+    """
+    Rows along x (4 mm apart in y) with linear dose ramps, and a first row with the maximum
+    dose (1) everywhere. The target grid is shifted by 1.1 mm along x (reference spacing 2.5 mm).
+    """
+    nx,ny,nz,h = 8,1+len(_RAMP_ROW_GAMMAS),3,2.5
+    slopes = np.array([0.]+[0.03*np.sqrt((g/_RAMP_SHIFT)**2-1./3.**2) for g in _RAMP_ROW_GAMMAS])
+    base = np.array([1.]+[0.25]*len(_RAMP_ROW_GAMMAS))
+    def dose(x):
+        return np.broadcast_to(base[np.newaxis,:,np.newaxis]+slopes[np.newaxis,:,np.newaxis]*x[:,np.newaxis,np.newaxis],(len(x),ny,nz))
+    xref = np.arange(nx)*h
+    xtarget = _RAMP_SHIFT+np.arange(nx-1)*h
+    assert np.max(dose(xref)[:,1:]) < 1.
+    spacing = (h,4.,3.)
+    return _image(dose(xref),spacing,(0.,0.,0.)),_image(dose(xtarget),spacing,(_RAMP_SHIFT,0.,0.)),slopes
+
+def _gaussian(shape,spacing,origin,center,sigma):
+    x,y,z = _grid(shape,spacing,origin)
+    return np.exp(-0.5*((x-center[0])**2+(y-center[1])**2+(z-center[2])**2)/sigma**2)
+
+def _flat_levels_pass_rate(imgref,imgtarget,criteria):
+    """
+    The dose levels differ by much more than the dose difference criterion, so each target voxel
+    passes exactly if the reference voxel at the same position gives gamma<=1.
+    """
+    aref = itk.GetArrayViewFromImage(imgref).astype(float)
+    atarget = itk.GetArrayViewFromImage(imgtarget).astype(float)
+    evaluated = atarget > 0.01*criteria.lower_dose_cutoff*np.max(aref)
+    g = _flat_levels_gamma(aref[evaluated],atarget[evaluated],np.max(aref),criteria)
+    assert np.all(np.abs(g-1.) > 5e-3)
+    return np.count_nonzero(g<=1.)/len(g),len(g)
+
+def _ramp_rows_pass_rate(imgtarget,slopes,criteria):
+    """
+    Each target voxel has gamma w.r.t. the reference voxel at the shift distance in its own row;
+    all other reference voxels are further away in the same row, or further than the DTA.
+    """
+    assert criteria.dta < 4. and not criteria.local and criteria.lower_dose_cutoff < 25.
+    if criteria.max_search_radius > 0. and criteria.max_search_radius < _RAMP_SHIFT:
+        rows = np.zeros(len(slopes),dtype=bool)
+    else:
+        gammas = _RAMP_SHIFT*np.sqrt(1./criteria.dta**2+(slopes/(0.01*criteria.dd))**2)
+        assert np.all(np.abs(gammas-1.) > 0.02)
+        rows = gammas <= 1.
+    nx,ny,nz = imgtarget.GetLargestPossibleRegion().GetSize()
+    return np.count_nonzero(rows)/ny,int(nx*ny*nz)
+
+def write_corpus(directory=None):
+    """
+    Generate the corpus images and the manifest with the known pass rates in `directory`
+    (default: the directory of the current corpus version). Returns the manifest.
+    """
+    if directory is None:
+        directory = corpus_directory()
+    os.makedirs(directory,exist_ok=True)
+    rng = np.random.RandomState(1998)
+    pairs = dict()
+    images = dict()
+    images["flat_levels"] = _flat_levels_pair(rng)
+    pairs["flat_levels"] = "reference dose with two flat levels, noisy target dose with a low dose corner, equal geometries"
+    ref,target,slopes = _ramp_rows_pair()
+    images["ramp_rows"] = (ref,target)
+    pairs["ramp_rows"] = "rows with linear dose ramps, target grid shifted by {} mm along the ramps".format(_RAMP_SHIFT)
+    blob = _gaussian((20,20,12),(2.,2.,2.5),(-20.,-20.,-15.),(0.,0.,0.),8.)
+    images["gaussian_identical"] = (_image(blob,(2.,2.,2.5),(-20.,-20.,-15.)),)*2
+    pairs["gaussian_identical"] = "identical gaussian reference and target doses"
+    tps = _gaussian((16,16,10),(3.,3.,3.),(-24.,-24.,-15.),(0.,0.,0.),9.)
+    mc = _gaussian((32,32,20),(1.5,1.5,1.5),(-23.,-23.,-14.5),(0.8,-0.5,0.3),9.)*rng.normal(1.,0.03,(32,32,20))
+    images["gaussian_mc"] = (_image(tps,(3.,3.,3.),(-24.,-24.,-15.)),_image(mc,(1.5,1.5,1.5),(-23.,-23.,-14.5)))
+    pairs["gaussian_mc"] = "noisy, slightly shifted gaussian target dose on a finer grid than the reference dose"
+    manifest = dict(version=CORPUS_VERSION,pairs=dict(),cases=list())
+    for name,description in pairs.items():
+        ref,target = images[name]
+        files = dict(ref="{}_ref.mhd".format(name),target="{}_target.mhd".format(name))
+        for key,img in zip(["ref","target"],[ref,target]):
+            itk.imwrite(img,os.path.join(directory,files[key]),compression=True)
+        manifest["pairs"][name] = dict(description=description,**files)
+    # reload the stored images, so that the expected pass rates are for the stored (single precision) data
+    images = dict([(name,tuple(itk.imread(os.path.join(directory,manifest["pairs"][name][key])) for key in ["ref","target"]))
+                   for name in pairs])
+    def add_case(name,pair,criteria,expected,origin,tolerance=0.):
+        pass_rate,nevaluated = expected
+        manifest["cases"].append(dict(name=name,pair=pair,criteria=criteria.as_dict(),expected_pass_rate=pass_rate,
+                                      nevaluated=nevaluated,tolerance=tolerance,origin=origin))
+    for name,criteria in [("flat_levels_global",gamma_criteria()),
+                          ("flat_levels_global_cutoff",gamma_criteria(lower_dose_cutoff=10.)),
+                          ("flat_levels_global_2pct_cutoff",gamma_criteria(dd=2.,dta=2.,lower_dose_cutoff=10.)),
+                          ("flat_levels_local",gamma_criteria(local=True)),
+                          ("flat_levels_local_cutoff",gamma_criteria(local=True,lower_dose_cutoff=10.)),
+                          ("flat_levels_local_2pct_cutoff",gamma_criteria(dd=2.,dta=2.,local=True,lower_dose_cutoff=10.)),
+                          ("flat_levels_global_cap",gamma_criteria(lower_dose_cutoff=10.,gamma_cap=1.5))]:
+        add_case(name,"flat_levels",criteria,_flat_levels_pass_rate(*images["flat_levels"],criteria),"analytic")
+    for name,criteria in [("ramp_rows_3pct_3mm",gamma_criteria()),
+                          ("ramp_rows_2pct_2mm",gamma_criteria(dd=2.,dta=2.)),
+                          ("ramp_rows_cap",gamma_criteria(gamma_cap=1.2)),
+                          ("ramp_rows_search_radius",gamma_criteria(max_search_radius=1.))]:
+        add_case(name,"ramp_rows",criteria,_ramp_rows_pass_rate(images["ramp_rows"][1],slopes,criteria),"analytic")
+    nvoxels = int(np.prod(images["gaussian_identical"][1].GetLargestPossibleRegion().GetSize()))
+    add_case("gaussian_identical","gaussian_identical",gamma_criteria(),(1.,nvoxels),"analytic")
+    for name,criteria in [("gaussian_mc_3pct_3mm",gamma_criteria(lower_dose_cutoff=10.)),
+                          ("gaussian_mc_2pct_2mm",gamma_criteria(dd=2.,dta=2.,lower_dose_cutoff=10.)),
+                          ("gaussian_mc_local",gamma_criteria(local=True,lower_dose_cutoff=10.))]:
+        g = gamma_index_3d_extended(*images["gaussian_mc"],criteria)
+        add_case(name,"gaussian_mc",criteria,gamma_pass_rate(g),"exhaustive search",tolerance=0.01)
+    with open(os.path.join(directory,MANIFEST),"w") as fp:
+        json.dump(manifest,fp,indent=2)
+    return manifest
+
+def read_corpus(directory=None):
+    """
+    Read the manifest of the corpus in `directory` (default: the current corpus version).
+    """
+    if directory is None:
+        directory = corpus_directory()
+    with open(os.path.join(directory,MANIFEST),"r") as fp:
+        manifest = json.load(fp)
+    return manifest
+
+def supports(backend,criteria):
+    """
+    Whether the backend can evaluate the criteria: only the "extended" engine supports local
+    normalization, a maximum search radius and a gamma cap. The other backends do not limit
+    their search, which gives the same pass rates for any search radius of at least the DTA.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("unknown gamma backend '{}', should be one of {}".format(backend,", ".join(BACKENDS)))
+    if backend == "extended":
+        return True
+    return not criteria.local and criteria.max_search_radius >= criteria.dta and criteria.gamma_cap == 0.
+
+def run_backend(backend,imgref,imgtarget,criteria):
+    """
+    Pass rate and number of evaluated voxels for the images, with the given backend and criteria.
+    """
+    if backend == "extended":
+        return gamma_pass_rate(gamma_index_3d_extended(imgref,imgtarget,criteria))
+    kwargs = dict(dta=criteria.dta,dd=criteria.dd,ddpercent=True,threshold=criteria.lower_dose_cutoff,threshold_percent=True)
+    if backend == "pass rate":
+        pass_rate,failimg = gamma_index_3d_pass_rate(imgref,imgtarget,**kwargs)
+        # the number of evaluated voxels is not returned by the pass/fail evaluation
+        return pass_rate,None
+    return gamma_pass_rate(get_gamma_index(imgref,imgtarget,engine=backend,**kwargs))
+
+def run_corpus(backends=BACKENDS,directory=None,repeat=1,cases=None):
+    """
+    Run the gamma backends on the corpus cases (default: all cases of the current corpus version).
+    Cases with criteria that a backend does not support are skipped. Returns a list with a result
+    for each backend and case: the pass rate, the expected pass rate, whether they agree within
+    the tolerance of the case and the (shortest of `repeat`) computation time(s) in seconds.
+    """
+    if directory is None:
+        directory = corpus_directory()
+    manifest = read_corpus(directory)
+    images = dict()
+    results = list()
+    for case in manifest["cases"]:
+        if cases and case["name"] not in cases:
+            continue
+        if case["pair"] not in images:
+            files = manifest["pairs"][case["pair"]]
+            images[case["pair"]] = tuple(itk.imread(os.path.join(directory,files[key])) for key in ["ref","target"])
+        criteria = gamma_criteria(**case["criteria"])
+        for backend in backends:
+            if not supports(backend,criteria):
+                continue
+            seconds = list()
+            for i in range(max(int(repeat),1)):
+                t0 = time.perf_counter()
+                pass_rate,nevaluated = run_backend(backend,*images[case["pair"]],criteria)
+                seconds.append(time.perf_counter()-t0)
+            ok = abs(pass_rate-case["expected_pass_rate"]) <= case["tolerance"]+1e-9
+            if nevaluated is not None:
+                ok &= nevaluated == case["nevaluated"]
+            if not ok:
+                logger.warning("backend {} on corpus case {}: pass rate {} ({} voxels), expected {} ({} voxels)".format(
+                    backend,case["name"],pass_rate,nevaluated,case["expected_pass_rate"],case["nevaluated"]))
+            results.append(dict(backend=backend,case=case["name"],criteria=str(criteria),pass_rate=pass_rate,
+                                expected_pass_rate=case["expected_pass_rate"],ok=bool(ok),seconds=min(seconds)))
+    return results
+
+#####################################################################################
+# UNIT TESTS
+#####################################################################################
+import unittest
+import tempfile
+
+class Test_GammaCorpus(unittest.TestCase):
+    def test_corpus_is_up_to_date(self):
+        # the stored corpus should be identical to what the generator writes
+        print('Test_GammaCorpus test_corpus_is_up_to_date')
+        stored = read_corpus()
+        self.assertEqual(stored["version"],CORPUS_VERSION)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            generated = write_corpus(tmpdir)
+            self.assertEqual(json.loads(json.dumps(generated)),stored)
+            for pair in stored["pairs"].values():
+                for key in ["ref","target"]:
+                    a = itk.imread(os.path.join(corpus_directory(),pair[key]))
+                    b = itk.imread(os.path.join(tmpdir,pair[key]))
+                    self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(a),itk.GetArrayViewFromImage(b)))
+                    self.assertTrue(np.allclose(a.GetSpacing(),b.GetSpacing()))
+                    self.assertTrue(np.allclose(a.GetOrigin(),b.GetOrigin()))
+    def test_backends(self):
+        # all backends should reproduce the known pass rates of the cases that they support
+        print('Test_GammaCorpus test_backends')
+        results = run_corpus()
+        for r in results:
+            print("{backend:10s} {case:32s} {pass_rate:8.4f} {expected_pass_rate:8.4f} {seconds:8.3f}s".format(**r))
+            self.assertTrue(r["ok"],"{backend} on {case}".format(**r))
+        # every case is run by at least the extended engine
+        self.assertEqual(set(r["case"] for r in results if r["backend"]=="extended"),set(c["name"] for c in read_corpus()["cases"]))
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            supports("quantum",gamma_criteria())
+
+# vim: set et softtabstop=4 sw=4 smartindent:
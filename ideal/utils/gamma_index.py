@@ -9,9 +9,11 @@
 Compare two 3D images using the gamma index formalism as introduced by Daniel Low (1998).
 """
 
+import os
 import numpy as np
 import itk
 import logging
+from datetime import datetime
 logger=logging.getLogger(__name__)
 
 def _reldiff2(dref,dtarget,ddref):
@@ -24,9 +26,9 @@ def _reldiff2(dref,dtarget,ddref):
     reldd2=(ddiff/ddref)**2
     return reldd2
 
-def get_gamma_index(ref,target,**kwargs):
+def get_gamma_index(ref,target,engine="slabs",**kwargs):
     """
-    Compare two 3D images using the gamma index formalism as introduced by Daniel Low (1998).
+    Compare two 3D (or two 2D) images using the gamma index formalism as introduced by Daniel Low (1998).
     The positional arguments 'ref' and 'target' should behave like ITK image objects.
     Possible keyword arguments include:
     * `dd` indicates "dose difference" scale as a relative value, in units of percent (the dd value is this percentage of the max dose in the reference image)
@@ -35,24 +37,86 @@ def get_gamma_index(ref,target,**kwargs):
     * `threshold` indicates minimum dose value (exclusive) for calculating gamma values
     * `verbose` is a flag, True will result in some chatter, False will keep the computation quiet.
     * `threshold_percent` is a flag, True means that threshold is given in percent, False (default) means that the threshold is absolute.
+    * `engine` selects the implementation: "slabs" (default) evaluates chunks of voxels at once against
+      a precomputed stencil of neighbor offsets, "loop" is the original voxel-by-voxel implementation.
+      Both give identical results. "kdtree" finds the nearest reference voxel in (position,dose) space
+      with a KD-tree; it is the fastest for images with different geometries and large gamma values,
+      and its search is exhaustive (see `gamma_index_3d_kdtree`). "parallel" distributes the "slabs"
+      computation over z-slabs of the target image in a pool of worker processes, with identical results.
+      "extended" supports local dose difference normalization, a maximum search radius and a gamma cap;
+      it takes the arguments of `gamma_criteria` instead of `dd`, `ddpercent`, `threshold` and
+      `threshold_percent` (see `gamma_index_3d_extended`).
+    * `slab_voxels` (only for the "slabs" and "parallel" engines) is the maximum number of target voxels
+      that is processed in one chunk, which bounds the memory use.
+    * `interpolate` and `batch_voxels` (only for the "kdtree" engine): sub-voxel interpolation factor
+      for the reference dose and the number of target voxels per KD-tree query.
+    * `nworkers` and `slab_thickness` (only for the "parallel" engine): number of worker processes
+      (default: number of available CPUs) and number of target z-slices per slab.
 
     Returns an image with the same geometry as the target image.
     For all target voxels in the overlap between ref and target that have d>dmin, a gamma index value is given.
     For all other voxels the "defvalue" is given.
-    TODO: allow 2D images, by creating 3D images with a 1-bin Z dimension. Should be very easy.
-    The 3D gamma image computed using these "fake 3D" images can then be collapsed back to a 2D image.
+    Two 2D images are compared as 3D images with a single slice (see `gamma_index_2d`), the result is a 2D image.
+    For a 2D analysis of each slice of a 3D image, see `gamma_index_per_slice`.
     """
-    if (np.allclose(ref.GetOrigin(),target.GetOrigin())) and \
-       (np.allclose(ref.GetSpacing(),target.GetSpacing())) and \
-       (ref.GetLargestPossibleRegion().GetSize() == ref.GetLargestPossibleRegion().GetSize() ):
+    if ref.GetImageDimension() == 2 and target.GetImageDimension() == 2:
+        return gamma_index_2d(ref,target,engine=engine,**kwargs)
+    if engine == "slabs":
+        equal_impl, unequal_impl = gamma_index_3d_equal_geometry_slabs, gamma_index_3d_unequal_geometry_slabs
+    elif engine == "loop":
+        equal_impl, unequal_impl = gamma_index_3d_equal_geometry, gamma_index_3d_unequal_geometry
+    elif engine == "kdtree":
+        equal_impl, unequal_impl = gamma_index_3d_kdtree, gamma_index_3d_kdtree
+    elif engine == "parallel":
+        equal_impl, unequal_impl = gamma_index_3d_parallel, gamma_index_3d_parallel
+    elif engine == "extended":
+        equal_impl, unequal_impl = gamma_index_3d_extended, gamma_index_3d_extended
+    else:
+        raise ValueError("unknown gamma index engine '{}', should be 'slabs', 'loop', 'kdtree', 'parallel' or 'extended'".format(engine))
+    if _equal_geometry(ref,target):
         if kwargs.get('verbose',False):
             print("Images with equal geometry, using the slightly faster implementation.")
-        return gamma_index_3d_equal_geometry(ref,target,**kwargs)
+        return equal_impl(ref,target,**kwargs)
     else:
         if kwargs.get('verbose',False):
             print("Images with different geometry, using the slightly slower implementation.")
-        return gamma_index_3d_unequal_geometry(ref,target,**kwargs)
+        return unequal_impl(ref,target,**kwargs)
 
+def _equal_geometry(ref,target):
+    """
+    True if the ITK images `ref` and `target` have the same origin, spacing and size.
+    """
+    return np.allclose(ref.GetOrigin(),target.GetOrigin()) and \
+           np.allclose(ref.GetSpacing(),target.GetSpacing()) and \
+           ref.GetLargestPossibleRegion().GetSize() == target.GetLargestPossibleRegion().GetSize()
+
+def _image_2d_as_3d(img):
+    """
+    3D image with a single z-slice (at z=0, unit spacing), with the data and the x,y geometry of the 2D image `img`.
+    """
+    img3d = itk.GetImageFromArray(itk.GetArrayFromImage(img)[np.newaxis].copy())
+    img3d.SetSpacing(list(img.GetSpacing())+[1.])
+    img3d.SetOrigin(list(img.GetOrigin())+[0.])
+    return img3d
+
+def _image_3d_as_2d(img3d,img2d):
+    """
+    2D image with the data of the single-slice 3D image `img3d` and the geometry of the 2D image `img2d`.
+    """
+    img = itk.GetImageFromArray(itk.GetArrayViewFromImage(img3d)[0].copy())
+    img.CopyInformation(img2d)
+    return img
+
+def gamma_index_2d(imgref,imgtarget,engine="slabs",**kwargs):
+    """
+    Compare two 2D images (e.g. a planar measurement with a TPS dose plane), with the same keyword arguments
+    as `get_gamma_index`. The images are handled as 3D images with a single slice, by any of the 3D engines.
+    Returns a 2D image with the same geometry as the target image.
+    """
+    if imgref.GetImageDimension() != 2 or imgtarget.GetImageDimension() != 2:
+        raise ValueError("expected two 2D images, got {}D and {}D".format(imgref.GetImageDimension(),imgtarget.GetImageDimension()))
+    g3d = get_gamma_index(_image_2d_as_3d(imgref),_image_2d_as_3d(imgtarget),engine=engine,**kwargs)
+    return _image_3d_as_2d(g3d,imgtarget)
 
 # FIXME: Should this function remain public or be made private (by prefixing it with an _underscore)?
 # TODO: Discuss whether to keep this function. It is 30% faster than the
@@ -248,6 +312,840 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
         print("100% done!     ")
     return gimg
 
+def _min_over_stencil(center,halfwidth,limit,shape,offsets,bounds,candidates,cutoff=None):
+    """
+    Convenience function for the "slabs" implementations below: for each of
+    the N voxels given by the (N,3) index array `center`, find the minimum of
+    the generalized distance over all neighbors within the box given by the
+    (N,3) array `halfwidth` (and within an image with the given `shape`).
+
+    The (M,3) array `offsets` is the stencil of neighbor index offsets, sorted
+    such that the (M,) array `bounds` is non-decreasing. The bound for an
+    offset should never be larger than any of the candidate values for that
+    offset: then a voxel can be dropped from the search as soon as the bound
+    exceeds the best value found so far, or the (N,) array `limit`, which is
+    the largest bound of any offset within the box of that voxel.
+    The function `candidates(sel,ixyz)` should return the generalized distance
+    of the voxels `sel` to the neighbors with indices `ixyz`.
+    With a `cutoff` (pass/fail evaluation), only the offsets with a bound up to
+    the cutoff are visited and a voxel drops out as soon as a value below or
+    equal to the cutoff is found; the result for such a voxel is then not
+    necessarily the minimum, but it is not larger than the cutoff.
+    """
+    best=np.full(len(center),np.inf)
+    active=np.arange(len(center))
+    acenter,ahalfwidth,alimit=center,halfwidth,limit
+    for offset,bound in zip(offsets,bounds):
+        if cutoff is not None and bound>cutoff:
+            break
+        keep=(best[active]>bound)&(alimit>=bound)
+        if cutoff is not None:
+            keep&=best[active]>cutoff
+        if not keep.all():
+            active,acenter,ahalfwidth,alimit=active[keep],acenter[keep],ahalfwidth[keep],alimit[keep]
+            if active.size==0:
+                break
+        ok=np.ones(active.size,dtype=bool)
+        ixyz=acenter+offset
+        for j in range(3):
+            if offset[j]!=0:
+                ok&=(ahalfwidth[:,j]>=abs(offset[j]))&(ixyz[:,j]>=0)&(ixyz[:,j]<shape[j])
+        if ok.all():
+            sel=active
+        elif ok.any():
+            sel,ixyz=active[ok],ixyz[ok]
+        else:
+            continue
+        best[sel]=np.minimum(best[sel],candidates(sel,ixyz))
+    return best
+
+def _box_offsets(halfwidth):
+    """
+    All index offsets within a box with the given half widths, as an (M,3) array.
+    """
+    ox,oy,oz=np.meshgrid(*[np.arange(-h,h+1) for h in halfwidth],indexing='ij')
+    return np.stack([ox.flat[:],oy.flat[:],oz.flat[:]],axis=1)
+
+def _equal_geometry_bounds(offsets,relspacing,g2dtype):
+    """
+    Distance terms for the index offsets in the (M,3) array `offsets`, summed
+    in the same way as the loop implementation adds them to the dose
+    difference term, with the same precision.
+    """
+    bounds=np.zeros(len(offsets),dtype=g2dtype)
+    for j in range(3):
+        bounds+=(relspacing[j]*offsets[:,j])**2
+    return bounds
+
+def _unequal_geometry_bounds(offsets,spacing,dta2):
+    """
+    Lower bounds for the distance terms for the index offsets in the (M,3)
+    array `offsets`, relative to the reference voxel closest to a target voxel.
+    """
+    # The closest reference voxel center is at most half a spacing away from the target voxel center,
+    # so the distance term for an offset of n voxels is at least (n-0.5) spacings. The bound is made
+    # slightly smaller to allow for rounding of the in-place sums in single precision.
+    return np.sum((np.maximum(np.abs(offsets)-0.5,0.)*spacing)**2,axis=1)/dta2*(1.-1e-6)
+
+def _report_speed(nvoxels,t0,verbose):
+    dt=(datetime.now()-t0).total_seconds()
+    rate=nvoxels/dt if dt>0 else float('inf')
+    logger.info("computed gamma for {} voxels in {:.3f} seconds ({:.0f} voxels per second)".format(nvoxels,dt,rate))
+    if verbose:
+        print("100% done! {} voxels, {:.0f} voxels per second".format(nvoxels,rate))
+    return rate
+
+def _equal_geometry_reach(dref,dtarget,dd,inv_spacing):
+    """
+    Gamma value w.r.t. the reference voxel at the same position (no shift), and the half widths (in voxels)
+    of the search box, for target voxels with dose `dtarget` and reference dose `dref` (equal geometry).
+    """
+    g00=np.sqrt(_reldiff2(dref,dtarget,dd)).astype(float)
+    igmax=np.round(g00[:,np.newaxis]*inv_spacing).astype(int)
+    return g00,igmax
+
+def _unequal_geometry_reach(dref,dtarget,dd,dta,pos,center,areforigin,arefspacing):
+    """
+    Half widths (in voxels) of the search box around the closest reference voxel `center` for target
+    voxels at positions `pos` with dose `dtarget`, where `dref` is the dose in the closest reference voxel.
+    """
+    dta2 = dta**2
+    refpos=areforigin+center*arefspacing
+    gclose2 = _reldiff2(dref,dtarget,dd) + ((pos[:,0]-refpos[:,0])**2+(pos[:,1]-refpos[:,1])**2+(pos[:,2]-refpos[:,2])**2)/dta2
+    return np.floor(np.sqrt(gclose2)[:,np.newaxis]*dta/arefspacing).astype(int)
+
+def _equal_geometry_g2(aref,atarget,ixyz,dd,relspacing,shape,slab_voxels,zoffset=0,verbose=False,cutoff=None):
+    """
+    Squared gamma values for the target voxels with the (N,3) indices `ixyz`, for images with equal geometry.
+    The arrays `aref` and `atarget` are the z-slices of images with the given `shape`, starting at slice
+    `zoffset`. They should include the search box (see `_equal_geometry_reach`) of all voxels `ixyz`.
+    With a `cutoff`, the search stops at the first value up to the cutoff (see `_min_over_stencil`).
+    """
+    inv_spacing = np.ones(3,dtype=float)/relspacing
+    nvoxels=len(ixyz)
+    g2=np.zeros(nvoxels,dtype=float)
+    # The loop implementation adds the distance terms "in place" to the dose
+    # difference term, so the precision of the sum depends on the input data type.
+    # The bound for each offset is computed in the same way, with zero dose difference.
+    g2dtype=_reldiff2(aref[:1,0,0],atarget[0,0,0],dd).dtype
+    for i0 in range(0,nvoxels,slab_voxels):
+        chunk=ixyz[i0:i0+slab_voxels]
+        g2chunk=g2[i0:i0+slab_voxels]
+        ix,iy,iz=chunk.T
+        dtarget=atarget[ix,iy,iz-zoffset]
+        g00,igmax=_equal_geometry_reach(aref[ix,iy,iz-zoffset],dtarget,dd,inv_spacing)
+        trivial=(igmax==0).all(axis=1)
+        g2chunk[trivial]=g00[trivial]**2
+        search=np.logical_not(trivial)
+        if not search.any():
+            continue
+        center=chunk[search]
+        dtarget=dtarget[search]
+        halfwidth=np.max(igmax[search],axis=0)
+        if cutoff is not None:
+            # offsets further away have a bound above the cutoff
+            halfwidth=np.minimum(halfwidth,np.floor(np.sqrt(cutoff)*inv_spacing).astype(int)+1)
+        offsets=_box_offsets(halfwidth)
+        bounds=_equal_geometry_bounds(offsets,relspacing,g2dtype)
+        limit=_equal_geometry_bounds(igmax[search],relspacing,g2dtype)
+        order=np.argsort(bounds,kind='stable')
+        def candidates(sel,jxyz):
+            g2near=_reldiff2(aref[jxyz[:,0],jxyz[:,1],jxyz[:,2]-zoffset],dtarget[sel],dd)
+            for j in range(3):
+                g2near+=(relspacing[j]*(jxyz[:,j]-center[sel,j]))**2
+            return g2near
+        g2chunk[search]=_min_over_stencil(center,igmax[search],limit,shape,offsets[order],bounds[order],candidates,cutoff)
+        if verbose:
+            print("{0:.1f}% done...\r".format(min(i0+slab_voxels,nvoxels)*100.0/nvoxels),end='')
+    return g2
+
+def _unequal_geometry_g2(aref,atarget,ixyz,dd,dta,areforigin,arefspacing,tpos,iref,shape,slab_voxels,zoffset=0,tzoffset=0,verbose=False,cutoff=None):
+    """
+    Squared gamma values for the target voxels with the (N,3) indices `ixyz`, for images with possibly
+    different geometries. `tpos` and `iref` give per axis the target voxel positions and the indices
+    of the closest reference voxels. The array `aref` holds the z-slices of a reference image with the
+    given `shape` starting at slice `zoffset`, and should include the search box (see
+    `_unequal_geometry_reach`) of all voxels `ixyz`. The array `atarget` holds the target z-slices
+    starting at slice `tzoffset`. With a `cutoff`, the search stops at the first value up to the cutoff.
+    """
+    dta2  = dta**2
+    nvoxels=len(ixyz)
+    g2=np.zeros(nvoxels,dtype=float)
+    for i0 in range(0,nvoxels,slab_voxels):
+        ix,iy,iz=ixyz[i0:i0+slab_voxels].T
+        dtarget=atarget[ix,iy,iz-tzoffset]
+        pos=np.stack([tpos[0][ix],tpos[1][iy],tpos[2][iz]],axis=1)
+        center=np.stack([iref[0][ix],iref[1][iy],iref[2][iz]],axis=1)
+        dixyz=_unequal_geometry_reach(aref[center[:,0],center[:,1],center[:,2]-zoffset],dtarget,dd,dta,pos,center,areforigin,arefspacing)
+        halfwidth=np.max(dixyz,axis=0)
+        if cutoff is not None:
+            # offsets further away have a bound above the cutoff
+            halfwidth=np.minimum(halfwidth,np.floor(np.sqrt(cutoff)*dta/arefspacing+0.5).astype(int)+1)
+        offsets=_box_offsets(halfwidth)
+        bounds=_unequal_geometry_bounds(offsets,arefspacing,dta2)
+        limit=_unequal_geometry_bounds(dixyz,arefspacing,dta2)
+        order=np.argsort(bounds,kind='stable')
+        def candidates(sel,jxyz):
+            g2near=_reldiff2(aref[jxyz[:,0],jxyz[:,1],jxyz[:,2]-zoffset],dtarget[sel],dd)
+            for j in range(3):
+                g2near+=(areforigin[j]+jxyz[:,j]*arefspacing[j]-pos[sel,j])**2/dta2
+            return g2near
+        g2[i0:i0+slab_voxels]=_min_over_stencil(center,dixyz,limit,shape,offsets[order],bounds[order],candidates,cutoff)
+        if verbose:
+            print("{0:.1f}% done...\r".format(min(i0+slab_voxels,nvoxels)*100.0/nvoxels),end='')
+    return g2
+
+def gamma_index_3d_equal_geometry_slabs(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False,slab_voxels=2**18):
+    """
+    Vectorized version of `gamma_index_3d_equal_geometry`, with the same arguments and identical results.
+    Instead of looping over the target voxels one by one, the target voxels with dose above threshold are
+    processed in chunks ("slabs") of at most `slab_voxels` voxels. For each chunk, all neighbor offsets
+    (the stencil) are visited in order of increasing distance, and a voxel drops out of the search as
+    soon as the distance term alone is larger than its smallest gamma value so far.
+    """
+    aref=itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
+    atarget=itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
+    if aref.shape != atarget.shape:
+        raise ValueError("input images have different geometries ({} vs {} voxels)".format(aref.shape,atarget.shape))
+    if not np.allclose(imgref.GetSpacing(),imgtarget.GetSpacing()):
+        raise ValueError("input images have different geometries ({} vs {} spacing)".format(imgref.GetSpacing(),imgtarget.GetSpacing()))
+    if not np.allclose(imgref.GetOrigin(),imgtarget.GetOrigin()):
+        raise ValueError("input images have different geometries ({} vs {} origin)".format(imgref.GetOrigin(),imgtarget.GetOrigin()))
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    if threshold_percent:
+        threshold *= 0.01*np.max(aref)
+    t0 = datetime.now()
+    relspacing = np.array(imgref.GetSpacing(),dtype=float)/dta
+    mask=atarget>threshold
+    ixyz=np.stack(np.nonzero(mask),axis=1)
+    nmask=len(ixyz)
+    if verbose:
+        nx,ny,nz = atarget.shape
+        print("Both images have {} x {} x {} = {} voxels.".format(nx,ny,nz,nx*ny*nz))
+        print("{} target voxels have a dose > {}.".format(nmask,threshold))
+    g2=np.zeros(atarget.shape,dtype=float)
+    g2[mask]=_equal_geometry_g2(aref,atarget,ixyz,dd,relspacing,atarget.shape,slab_voxels,verbose=verbose)
+    g=np.sqrt(g2)
+    g[np.logical_not(mask)]=defvalue
+    # ITK does not support double precision images by default => cast down to float32.
+    # Also: only the first few digits of gamma index values are interesting.
+    gimg=itk.GetImageFromArray(g.swapaxes(0,2).astype(np.float32).copy())
+    gimg.CopyInformation(imgtarget)
+    _report_speed(nmask,t0,verbose)
+    return gimg
+
+def gamma_index_3d_unequal_geometry_slabs(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False,slab_voxels=2**18):
+    """
+    Vectorized version of `gamma_index_3d_unequal_geometry`, with the same arguments and identical results.
+    The target voxels with dose above threshold and overlapping with the reference image are processed in
+    chunks ("slabs") of at most `slab_voxels` voxels. For each chunk, the offsets of the reference voxels
+    w.r.t. the reference voxel closest to the target voxel are visited in order of increasing distance,
+    and a voxel drops out of the search as soon as no remaining offset can yield a smaller gamma value.
+    """
+    aref = itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
+    atarget = itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    if threshold_percent:
+        threshold *= 0.01*np.max(aref)
+    if len(aref.shape) != 3 or len(atarget.shape) != 3:
+        return None
+    t0 = datetime.now()
+    areforigin = np.array(imgref.GetOrigin())
+    arefspacing = np.array(imgref.GetSpacing())
+    atargetorigin = np.array(imgtarget.GetOrigin())
+    atargetspacing = np.array(imgtarget.GetSpacing())
+    mask  = atarget>threshold
+    if not mask.any():
+        print("WARNING: target has no dose over threshold.")
+        dummy = itk.GetImageFromArray((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
+        dummy.CopyInformation(imgtarget)
+        return dummy
+    # target voxel center positions and indices of the closest reference voxel centers, per axis
+    tpos = [atargetorigin[j]+np.arange(atarget.shape[j])*atargetspacing[j] for j in range(3)]
+    iref = [np.round((tpos[j]-areforigin[j])/arefspacing[j]).astype(int) for j in range(3)]
+    inside = [(iref[j]>=0)*(iref[j]<aref.shape[j]) for j in range(3)]
+    mask &= inside[0][:,np.newaxis,np.newaxis]*inside[1][np.newaxis,:,np.newaxis]*inside[2][np.newaxis,np.newaxis,:]
+    ixyz=np.stack(np.nonzero(mask),axis=1)
+    nmask=len(ixyz)
+    if nmask==0:
+        print("WARNING: images do not seem to overlap.")
+        dummy = itk.GetImageFromArray((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
+        dummy.CopyInformation(imgtarget)
+        return dummy
+    if verbose:
+        print("Reference image has {} x {} x {} = {} voxels.".format(*aref.shape,aref.size))
+        print("Target image has {} x {} x {} = {} voxels.".format(*atarget.shape,atarget.size))
+        print("{} of the target voxels in the intersection with the reference image have dose > {}.".format(nmask,threshold))
+    g2=np.zeros(atarget.shape,dtype=float)
+    g2[mask]=_unequal_geometry_g2(aref,atarget,ixyz,dd,dta,areforigin,arefspacing,tpos,iref,aref.shape,slab_voxels,verbose=verbose)
+    g=np.sqrt(g2)
+    g[np.logical_not(mask)]=defvalue
+    # ITK does not support double precision images by default => cast down to float32.
+    # Also: only the first few digits of gamma index values are interesting.
+    gimg=itk.GetImageFromArray(g.swapaxes(0,2).astype(np.float32).copy())
+    gimg.CopyInformation(imgtarget)
+    _report_speed(nmask,t0,verbose)
+    return gimg
+
+# arrays in shared memory, attached by the worker processes of gamma_index_3d_parallel
+_shared_arrays = dict()
+
+def _attach_shared_arrays(specs):
+    """
+    Initializer of the worker processes of `gamma_index_3d_parallel`: map the shared memory blocks
+    given as a list of (key,name,shape,dtype) tuples to (x,y,z) arrays in `_shared_arrays`.
+    """
+    from multiprocessing import shared_memory
+    for key,name,shape,dtype in specs:
+        shm = shared_memory.SharedMemory(name=name)
+        # keep a reference to the memory block, as long as the array is in use
+        _shared_arrays[key] = (shm,np.ndarray(shape,dtype=dtype,buffer=shm.buf).swapaxes(0,2))
+
+def _gamma_mask(atarget,threshold,inside=None):
+    """
+    Mask of the target voxels for which a gamma value is computed: dose above threshold and, for images
+    with different geometries, closest reference voxel center inside the reference image (given per axis
+    by the boolean arrays `inside`).
+    """
+    mask = atarget>threshold
+    if inside is not None:
+        mask &= inside[0][:,np.newaxis,np.newaxis]*inside[1][np.newaxis,:,np.newaxis]*inside[2][np.newaxis,np.newaxis,:]
+    return mask
+
+def _zmajor_indices(mask,zoffset=0):
+    """
+    Indices of the nonzero voxels of the (x,y,z) array `mask` as an (N,3) array, ordered by z.
+    """
+    iz,iy,ix = np.nonzero(mask.swapaxes(0,2))
+    return np.stack([ix,iy,iz+zoffset],axis=1)
+
+def _gamma_slab(aref,atarget,task):
+    """
+    Squared gamma values of the target voxels in the z-slab `task["zrange"]`, in z-major order
+    (see `gamma_index_3d_parallel`). The computation only uses the slab and its halo: the z-range
+    of reference slices within the search boxes of the slab voxels.
+    """
+    z0,z1 = task["zrange"]
+    dd = task["dd"]
+    if task["equal_geometry"]:
+        ixyz = _zmajor_indices(_gamma_mask(atarget[:,:,z0:z1],task["threshold"]),z0)
+        ix,iy,iz = ixyz.T
+        zcenter = iz
+        zreach = _equal_geometry_reach(aref[ix,iy,iz],atarget[ix,iy,iz],dd,np.ones(3,dtype=float)/task["relspacing"])[1][:,2]
+    else:
+        tpos,iref,inside = task["tpos"],task["iref"],task["inside"]
+        ixyz = _zmajor_indices(_gamma_mask(atarget[:,:,z0:z1],task["threshold"],inside[:2]+[inside[2][z0:z1]]),z0)
+        ix,iy,iz = ixyz.T
+        pos = np.stack([tpos[0][ix],tpos[1][iy],tpos[2][iz]],axis=1)
+        center = np.stack([iref[0][ix],iref[1][iy],iref[2][iz]],axis=1)
+        zcenter = center[:,2]
+        zreach = _unequal_geometry_reach(aref[center[:,0],center[:,1],center[:,2]],atarget[ix,iy,iz],dd,task["dta"],
+                                         pos,center,task["areforigin"],task["arefspacing"])[:,2]
+    h0 = max(int(np.min(zcenter-zreach)),0)
+    h1 = min(int(np.max(zcenter+zreach))+1,aref.shape[2])
+    logger.debug("gamma slab z=[{},{}) with {} voxels, reference halo z=[{},{})".format(z0,z1,len(ixyz),h0,h1))
+    if task["equal_geometry"]:
+        return _equal_geometry_g2(aref[:,:,h0:h1],atarget[:,:,h0:h1],ixyz,dd,task["relspacing"],aref.shape,task["slab_voxels"],zoffset=h0)
+    return _unequal_geometry_g2(aref[:,:,h0:h1],atarget[:,:,z0:z1],ixyz,dd,task["dta"],task["areforigin"],task["arefspacing"],
+                                tpos,iref,aref.shape,task["slab_voxels"],zoffset=h0,tzoffset=z0)
+
+def _gamma_slab_worker(task):
+    return _gamma_slab(_shared_arrays["ref"][1],_shared_arrays["target"][1],task)
+
+def _available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def gamma_index_3d_parallel(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False,
+                            slab_voxels=2**18,nworkers=0,slab_thickness=0):
+    """
+    Parallel version of the "slabs" implementations, with the same arguments and bit-identical results,
+    for images with equal or different geometries.
+
+    The target image is divided in z-slabs of `slab_thickness` slices (by default up to 16 slabs, with
+    on average at least 2**16 voxels to compute per slab). The slabs are evaluated by a pool of `nworkers`
+    processes (default: the number of available CPUs), which read the input images from copies in shared
+    memory. For each slab only the slab itself and its halo are used: the z-range of reference slices
+    within the search boxes of the slab voxels (about the DTA times the largest gamma value w.r.t. the
+    closest reference voxel). Every target voxel is computed with the same arithmetic as in the serial
+    implementation, so the stitched result does not depend on the number of workers or on the slab thickness.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+    # (z,y,x) arrays, for the shared memory copies, and (x,y,z) views for the computation
+    zref=itk.GetArrayViewFromImage(imgref)
+    ztarget=itk.GetArrayViewFromImage(imgtarget)
+    aref=zref.swapaxes(0,2)
+    atarget=ztarget.swapaxes(0,2)
+    # percentages are resolved w.r.t. the full reference image, exactly as in the serial implementations
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    if threshold_percent:
+        threshold *= 0.01*np.max(aref)
+    t0 = datetime.now()
+    nworkers = nworkers if nworkers > 0 else _available_cpus()
+    equal_geometry = _equal_geometry(imgref,imgtarget)
+    task = dict(equal_geometry=equal_geometry,dd=dd,threshold=threshold,slab_voxels=slab_voxels)
+    if equal_geometry:
+        task.update(relspacing=np.array(imgref.GetSpacing(),dtype=float)/dta)
+        mask = _gamma_mask(atarget,threshold)
+    else:
+        areforigin = np.array(imgref.GetOrigin())
+        arefspacing = np.array(imgref.GetSpacing())
+        atargetorigin = np.array(imgtarget.GetOrigin())
+        atargetspacing = np.array(imgtarget.GetSpacing())
+        tpos = [atargetorigin[j]+np.arange(atarget.shape[j])*atargetspacing[j] for j in range(3)]
+        iref = [np.round((tpos[j]-areforigin[j])/arefspacing[j]).astype(int) for j in range(3)]
+        inside = [(iref[j]>=0)*(iref[j]<aref.shape[j]) for j in range(3)]
+        task.update(dta=dta,areforigin=areforigin,arefspacing=arefspacing,tpos=tpos,iref=iref,inside=inside)
+        mask = _gamma_mask(atarget,threshold,inside)
+    nperslice = np.count_nonzero(mask,axis=(0,1))
+    nmask = int(np.sum(nperslice))
+    if nmask==0:
+        print("WARNING: no target voxels with dose over threshold in the overlap with the reference image.")
+        dummy = itk.GetImageFromArray((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
+        dummy.CopyInformation(imgtarget)
+        return dummy
+    # fixed decomposition of the target in z-slabs, independent of the number of workers
+    # (each slab repeats the loop over the stencil, so by default the slabs are not made very small)
+    nz = atarget.shape[2]
+    nslabs = max(1,min(16,nmask//2**16))
+    thickness = slab_thickness if slab_thickness > 0 else int(np.ceil(nz/nslabs))
+    tasks = [dict(task,zrange=(z0,min(z0+thickness,nz))) for z0 in range(0,nz,thickness) if np.any(nperslice[z0:z0+thickness])]
+    nworkers = min(nworkers,len(tasks))
+    if verbose:
+        print("{} target voxels with dose > {} in {} slabs of {} slices, {} workers.".format(nmask,threshold,len(tasks),thickness,nworkers))
+    if nworkers > 1:
+        blocks = list()
+        try:
+            specs = list()
+            for key,a in [("ref",zref),("target",ztarget)]:
+                shm = shared_memory.SharedMemory(create=True,size=max(a.nbytes,1))
+                blocks.append(shm)
+                np.ndarray(a.shape,dtype=a.dtype,buffer=shm.buf)[...] = a
+                specs.append((key,shm.name,a.shape,a.dtype.str))
+            with ProcessPoolExecutor(max_workers=nworkers,initializer=_attach_shared_arrays,initargs=(specs,)) as pool:
+                results = list(pool.map(_gamma_slab_worker,tasks))
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+    else:
+        results = [_gamma_slab(aref,atarget,t) for t in tasks]
+    # stitch the slabs, in the z-major order of the voxels
+    g2=np.zeros(atarget.shape,dtype=float)
+    g2.swapaxes(0,2)[mask.swapaxes(0,2)] = np.concatenate(results)
+    g=np.sqrt(g2)
+    g[np.logical_not(mask)]=defvalue
+    # ITK does not support double precision images by default => cast down to float32.
+    # Also: only the first few digits of gamma index values are interesting.
+    gimg=itk.GetImageFromArray(g.swapaxes(0,2).astype(np.float32).copy())
+    gimg.CopyInformation(imgtarget)
+    _report_speed(nmask,t0,verbose)
+    return gimg
+
+def gamma_index_3d_pass_rate(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,verbose=False,threshold_percent=False,slab_voxels=2**18):
+    """
+    Gamma pass rate, for images with equal or different geometries, with the same arguments as the
+    "slabs" implementations (except `defvalue`). Instead of the gamma value of each target voxel, only
+    pass (gamma<=1) or fail is determined: the neighbor offsets are visited in shells of increasing
+    distance and the search for a voxel stops at the first neighbor with gamma<=1. Offsets with a
+    distance larger than the DTA are never visited.
+
+    The search boxes are the same as in the "slabs" (and loop) implementations, so a voxel fails
+    exactly if its gamma value computed by `get_gamma_index` is larger than 1.
+
+    Returns the pass rate (the fraction of the target voxels with a gamma value that pass) and an
+    image with the same geometry as the target image, with value 1 for the failing voxels and 0 for
+    all other voxels. If there are no target voxels to evaluate, the pass rate is NaN.
+    """
+    aref = itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
+    atarget = itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    if threshold_percent:
+        threshold *= 0.01*np.max(aref)
+    t0 = datetime.now()
+    if _equal_geometry(imgref,imgtarget):
+        mask = _gamma_mask(atarget,threshold)
+        ixyz=np.stack(np.nonzero(mask),axis=1)
+        relspacing = np.array(imgref.GetSpacing(),dtype=float)/dta
+        g2 = _equal_geometry_g2(aref,atarget,ixyz,dd,relspacing,atarget.shape,slab_voxels,verbose=verbose,cutoff=1.)
+    else:
+        areforigin = np.array(imgref.GetOrigin())
+        arefspacing = np.array(imgref.GetSpacing())
+        atargetorigin = np.array(imgtarget.GetOrigin())
+        atargetspacing = np.array(imgtarget.GetSpacing())
+        tpos = [atargetorigin[j]+np.arange(atarget.shape[j])*atargetspacing[j] for j in range(3)]
+        iref = [np.round((tpos[j]-areforigin[j])/arefspacing[j]).astype(int) for j in range(3)]
+        inside = [(iref[j]>=0)*(iref[j]<aref.shape[j]) for j in range(3)]
+        mask = _gamma_mask(atarget,threshold,inside)
+        ixyz=np.stack(np.nonzero(mask),axis=1)
+        g2 = _unequal_geometry_g2(aref,atarget,ixyz,dd,dta,areforigin,arefspacing,tpos,iref,aref.shape,slab_voxels,verbose=verbose,cutoff=1.)
+    nmask=len(ixyz)
+    fail=np.zeros(atarget.shape,dtype=np.uint8)
+    fail[mask]=g2>1.
+    if nmask==0:
+        print("WARNING: no target voxels with dose over threshold in the overlap with the reference image.")
+        pass_rate=np.nan
+    else:
+        pass_rate=1.-np.count_nonzero(g2>1.)/nmask
+    if verbose:
+        print("{} of the {} target voxels with dose > {} pass, pass rate {:.2f}%".format(nmask-np.count_nonzero(g2>1.),nmask,threshold,100.*pass_rate))
+    failimg=itk.GetImageFromArray(fail.swapaxes(0,2).copy())
+    failimg.CopyInformation(imgtarget)
+    _report_speed(nmask,t0,verbose)
+    return pass_rate,failimg
+
+# spacing along the slice axis for the per-slice gamma analysis: large enough to keep the search boxes within the slices
+_SLICE_DECOUPLING_SPACING = 1e12
+
+def gamma_index_per_slice(imgref,imgtarget,axis=2,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False,slab_voxels=2**18):
+    """
+    2D gamma analysis of all slices of a 3D target image perpendicular to `axis` (0, 1 or 2 for sagittal,
+    coronal or transverse slices), with the same other arguments as the "slabs" implementations. Each target
+    slice is compared with the reference slice that is closest to it, the distance between the two slices
+    is ignored. The images may have different geometries (but are not rotated w.r.t. each other).
+
+    All slices are evaluated at once, by the same vectorized search as in the "slabs" implementations, with a
+    (practically) infinite spacing along `axis`: this keeps the search box of each voxel within its slice.
+    The dose difference and threshold percentages are w.r.t. the maximum dose in the full reference image;
+    for a normalization per slice, use `gamma_index_2d` on the individual slices.
+
+    Returns the gamma image, with the same geometry as the target image, and an array with the pass rate
+    for each target slice: the fraction of the voxels with a gamma value that have gamma<=1 (NaN if there
+    are no such voxels in the slice).
+    """
+    aref = itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
+    atarget = itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
+    if axis not in (0,1,2):
+        raise ValueError("slice axis should be 0, 1 or 2, got {}".format(axis))
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    if threshold_percent:
+        threshold *= 0.01*np.max(aref)
+    t0 = datetime.now()
+    if _equal_geometry(imgref,imgtarget):
+        relspacing = np.array(imgref.GetSpacing(),dtype=float)/dta
+        relspacing[axis] = _SLICE_DECOUPLING_SPACING
+        mask = _gamma_mask(atarget,threshold)
+        ixyz=np.stack(np.nonzero(mask),axis=1)
+        g2s = _equal_geometry_g2(aref,atarget,ixyz,dd,relspacing,atarget.shape,slab_voxels,verbose=verbose)
+    else:
+        areforigin = np.array(imgref.GetOrigin(),dtype=float)
+        arefspacing = np.array(imgref.GetSpacing(),dtype=float)
+        atargetorigin = np.array(imgtarget.GetOrigin())
+        atargetspacing = np.array(imgtarget.GetSpacing())
+        tpos = [atargetorigin[j]+np.arange(atarget.shape[j])*atargetspacing[j] for j in range(3)]
+        iref = [np.round((tpos[j]-areforigin[j])/arefspacing[j]).astype(int) for j in range(3)]
+        inside = [(iref[j]>=0)*(iref[j]<aref.shape[j]) for j in range(3)]
+        mask = _gamma_mask(atarget,threshold,inside)
+        ixyz=np.stack(np.nonzero(mask),axis=1)
+        # stack of the reference slices closest to the target slices, at the same positions as the target slices
+        nslices = atarget.shape[axis]
+        aref = np.take(aref,np.clip(iref[axis],0,aref.shape[axis]-1),axis=axis)
+        areforigin[axis] = 0.
+        arefspacing[axis] = _SLICE_DECOUPLING_SPACING
+        tpos[axis] = np.arange(nslices)*_SLICE_DECOUPLING_SPACING
+        iref[axis] = np.arange(nslices)
+        g2s = _unequal_geometry_g2(aref,atarget,ixyz,dd,dta,areforigin,arefspacing,tpos,iref,aref.shape,slab_voxels,verbose=verbose)
+    nmask=len(ixyz)
+    if nmask==0:
+        print("WARNING: no target voxels with dose over threshold in the overlap with the reference image.")
+    g2=np.zeros(atarget.shape,dtype=float)
+    g2[mask]=g2s
+    passed=np.zeros(atarget.shape,dtype=bool)
+    passed[mask]=g2s<=1.
+    others=tuple(j for j in range(3) if j!=axis)
+    nvoxels=np.count_nonzero(mask,axis=others)
+    pass_rates=np.full(len(nvoxels),np.nan)
+    pass_rates[nvoxels>0]=np.count_nonzero(passed,axis=others)[nvoxels>0]/nvoxels[nvoxels>0]
+    if verbose:
+        print("{} slices with {} target voxels with dose > {}.".format(np.count_nonzero(nvoxels),nmask,threshold))
+    g=np.sqrt(g2)
+    g[np.logical_not(mask)]=defvalue
+    # ITK does not support double precision images by default => cast down to float32.
+    gimg=itk.GetImageFromArray(g.swapaxes(0,2).astype(np.float32).copy())
+    gimg.CopyInformation(imgtarget)
+    _report_speed(nmask,t0,verbose)
+    return gimg,pass_rates
+
+def _refine_axis(a,axis,n):
+    """
+    Linear interpolation of array `a` along `axis` on a grid that is `n` times finer
+    (the original grid points are kept, with n-1 interpolated points in between).
+    """
+    m = a.shape[axis]
+    if n <= 1 or m < 2:
+        return a
+    u = np.arange((m-1)*n+1)/n
+    i0 = np.minimum(np.floor(u).astype(int),m-2)
+    f = (u-i0).reshape([-1 if j==axis else 1 for j in range(a.ndim)])
+    return np.take(a,i0,axis=axis)*(1.-f)+np.take(a,i0+1,axis=axis)*f
+
+def gamma_index_3d_kdtree(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,threshold_percent=False,
+                          interpolate=1,batch_voxels=2**16):
+    """
+    Gamma index for images with possibly different spacing and origin (not rotated w.r.t. each other),
+    with the same arguments as `gamma_index_3d_unequal_geometry`.
+
+    The gamma index of a target voxel is the distance to the nearest reference voxel in the 4D space
+    (x/dta,y/dta,z/dta,dose/dd). The reference voxels are stored in a KD-tree in this space (scipy's
+    cKDTree), which is queried in batches of `batch_voxels` target voxels. Only the reference voxels
+    that can be the nearest point of any target voxel are put in the tree: the gamma value of a target
+    voxel is at most the gamma value w.r.t. the closest reference voxel.
+
+    With `interpolate=n` (n>1), the reference dose is linearly interpolated on a grid that is n times
+    finer than the reference grid in each dimension (sub-voxel interpolation); the memory use of the
+    tree then grows with n**3.
+
+    The search is exhaustive, so the gamma values are never larger than those of the box search in
+    `gamma_index_3d_unequal_geometry` (which can miss a neighbor just outside its box), and usually
+    identical (up to rounding).
+
+    The mask of target voxels for which gamma is computed is the same as for the other implementations:
+    dose above threshold and closest reference voxel center inside the reference image.
+    """
+    from scipy.spatial import cKDTree
+    aref = itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
+    atarget = itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    if threshold_percent:
+        threshold *= 0.01*np.max(aref)
+    if len(aref.shape) != 3 or len(atarget.shape) != 3:
+        return None
+    t0 = datetime.now()
+    areforigin = np.array(imgref.GetOrigin())
+    arefspacing = np.array(imgref.GetSpacing())
+    atargetorigin = np.array(imgtarget.GetOrigin())
+    atargetspacing = np.array(imgtarget.GetSpacing())
+    mask  = atarget>threshold
+    if not mask.any():
+        print("WARNING: target has no dose over threshold.")
+        dummy = itk.GetImageFromArray((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
+        dummy.CopyInformation(imgtarget)
+        return dummy
+    tpos = [atargetorigin[j]+np.arange(atarget.shape[j])*atargetspacing[j] for j in range(3)]
+    iref = [np.round((tpos[j]-areforigin[j])/arefspacing[j]).astype(int) for j in range(3)]
+    inside = [(iref[j]>=0)*(iref[j]<aref.shape[j]) for j in range(3)]
+    mask &= inside[0][:,np.newaxis,np.newaxis]*inside[1][np.newaxis,:,np.newaxis]*inside[2][np.newaxis,np.newaxis,:]
+    ixyz=np.stack(np.nonzero(mask),axis=1)
+    nmask=len(ixyz)
+    if nmask==0:
+        print("WARNING: images do not seem to overlap.")
+        dummy = itk.GetImageFromArray((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
+        dummy.CopyInformation(imgtarget)
+        return dummy
+    # scaled 4D coordinates of the target voxels, and gamma w.r.t. the closest reference voxel
+    ix,iy,iz = ixyz.T
+    query = np.stack([tpos[0][ix]/dta,tpos[1][iy]/dta,tpos[2][iz]/dta,atarget[ix,iy,iz]/dd],axis=1)
+    center = np.stack([iref[0][ix],iref[1][iy],iref[2][iz]],axis=1)
+    closest = np.concatenate([(areforigin+center*arefspacing)/dta,aref[center[:,0],center[:,1],center[:,2]][:,np.newaxis]/dd],axis=1)
+    gclose = np.sqrt(np.sum((query-closest)**2,axis=1))
+    # reference voxels within reach of any target voxel
+    reach = np.max(gclose)*dta
+    pmin = np.array([np.min(tpos[j][ixyz[:,j]]) for j in range(3)])-reach
+    pmax = np.array([np.max(tpos[j][ixyz[:,j]]) for j in range(3)])+reach
+    imin = np.maximum(np.floor((pmin-areforigin)/arefspacing).astype(int),0)
+    imax = np.minimum(np.ceil((pmax-areforigin)/arefspacing).astype(int)+1,aref.shape)
+    sub = np.asarray(aref[imin[0]:imax[0],imin[1]:imax[1],imin[2]:imax[2]],dtype=float)
+    n = max(int(interpolate),1)
+    for j in range(3):
+        sub = _refine_axis(sub,j,n)
+    rpos = [(areforigin[j]+(imin[j]+np.arange(sub.shape[j])/n)*arefspacing[j])/dta for j in range(3)]
+    rx,ry,rz = np.meshgrid(*rpos,indexing='ij')
+    points = np.stack([rx.ravel(),ry.ravel(),rz.ravel(),sub.ravel()/dd],axis=1)
+    if verbose:
+        print("Reference image has {} x {} x {} = {} voxels, {} points in the search tree.".format(*aref.shape,aref.size,len(points)))
+        print("Target image has {} x {} x {} = {} voxels.".format(*atarget.shape,atarget.size))
+        print("{} of the target voxels in the intersection with the reference image have dose > {}.".format(nmask,threshold))
+    tree = cKDTree(points)
+    g = np.full(atarget.shape,defvalue,dtype=float)
+    for i0 in range(0,nmask,batch_voxels):
+        sel = slice(i0,i0+batch_voxels)
+        # the closest reference voxel is always in the tree, so there is always a point within this bound
+        bound = np.max(gclose[sel])*(1.+1e-9)+1e-12
+        dist,_ = tree.query(query[sel],k=1,distance_upper_bound=bound)
+        g[ix[sel],iy[sel],iz[sel]] = np.minimum(dist,gclose[sel])
+        if verbose:
+            print("{0:.1f}% done...\r".format(min(i0+batch_voxels,nmask)*100.0/nmask),end='')
+    # ITK does not support double precision images by default => cast down to float32.
+    # Also: only the first few digits of gamma index values are interesting.
+    gimg=itk.GetImageFromArray(g.swapaxes(0,2).astype(np.float32).copy())
+    gimg.CopyInformation(imgtarget)
+    _report_speed(nmask,t0,verbose)
+    return gimg
+
+class gamma_criteria(object):
+    """
+    Criteria for the extended gamma index computation (see `gamma_index_3d_extended`):
+    * `dta`: distance to agreement in mm
+    * `dd`: dose difference in percent, of the maximum reference dose (global normalization)
+      or of the target dose in the evaluated voxel (local normalization)
+    * `local`: True for local, False (default) for global normalization of the dose difference
+    * `lower_dose_cutoff`: target voxels with a dose up to this percentage of the maximum reference dose are not evaluated
+    * `max_search_radius`: reference voxels further away (in mm) from the target voxel are ignored
+      (default: `DEFAULT_SEARCH_RADIUS_DTA` times the DTA; `float('inf')` for no limit, which with local
+      normalization requires a gamma cap, since the tiny dose difference scale of low dose voxels
+      would extend their search to the whole reference image)
+    * `gamma_cap`: gamma values larger than the cap are not computed but set to the cap (0: no cap)
+
+    A search radius of at least the DTA never changes whether a voxel passes (gamma<=1).
+    """
+    DEFAULT_SEARCH_RADIUS_DTA = 3.
+    def __init__(self,dta=3.,dd=3.,local=False,lower_dose_cutoff=0.,max_search_radius=None,gamma_cap=0.):
+        self.dta = float(dta)
+        self.dd = float(dd)
+        self.local = bool(local)
+        self.lower_dose_cutoff = float(lower_dose_cutoff)
+        self.max_search_radius = self.DEFAULT_SEARCH_RADIUS_DTA*self.dta if max_search_radius is None else float(max_search_radius)
+        self.gamma_cap = float(gamma_cap)
+        if not self.dta > 0.:
+            raise ValueError("distance to agreement should be positive, got {}".format(dta))
+        if not self.dd > 0.:
+            raise ValueError("dose difference should be positive, got {}".format(dd))
+        if not self.max_search_radius > 0.:
+            raise ValueError("max_search_radius should be positive, got {}".format(max_search_radius))
+        for name in ["lower_dose_cutoff","gamma_cap"]:
+            if not getattr(self,name) >= 0.:
+                raise ValueError("{} should not be negative, got {}".format(name,getattr(self,name)))
+        if self.local and np.isinf(self.max_search_radius) and self.gamma_cap == 0.:
+            raise ValueError("local normalization without a search radius limit requires a gamma cap")
+    def as_dict(self):
+        return dict(dta=self.dta,dd=self.dd,local=self.local,lower_dose_cutoff=self.lower_dose_cutoff,
+                    max_search_radius=self.max_search_radius,gamma_cap=self.gamma_cap)
+    def __str__(self):
+        txt = "{:g}%/{:g}mm {}".format(self.dd,self.dta,"local" if self.local else "global")
+        if self.lower_dose_cutoff > 0.:
+            txt += ", cutoff {:g}%".format(self.lower_dose_cutoff)
+        if self.max_search_radius != self.DEFAULT_SEARCH_RADIUS_DTA*self.dta:
+            txt += ", search radius {:g}mm".format(self.max_search_radius)
+        if self.gamma_cap > 0.:
+            txt += ", gamma cap {:g}".format(self.gamma_cap)
+        return txt
+
+def _extended_g2(aref,atarget,ixyz,dd,criteria,areforigin,arefspacing,tpos,iref,slab_voxels,verbose=False):
+    """
+    Squared gamma values for the target voxels with the (N,3) indices `ixyz`, with dose difference scale `dd`
+    (a scalar, or an (N,) array for local normalization). `tpos` and `iref` give per axis the target voxel
+    positions and the indices of the closest reference voxels. The search is exhaustive within the maximum
+    search radius of the `criteria`, up to the gamma cap. Voxels without any reference voxel within the
+    search radius get the squared gamma cap, or infinity.
+    """
+    dta2 = criteria.dta**2
+    radius2 = criteria.max_search_radius**2
+    cap2 = criteria.gamma_cap**2 if criteria.gamma_cap > 0. else np.inf
+    nvoxels=len(ixyz)
+    dd=np.broadcast_to(np.asarray(dd,dtype=float),(nvoxels,))
+    g2=np.zeros(nvoxels,dtype=float)
+    for i0 in range(0,nvoxels,slab_voxels):
+        ix,iy,iz=ixyz[i0:i0+slab_voxels].T
+        dtarget=np.asarray(atarget[ix,iy,iz],dtype=float)
+        ddchunk=dd[i0:i0+slab_voxels]
+        pos=np.stack([tpos[0][ix],tpos[1][iy],tpos[2][iz]],axis=1)
+        center=np.stack([iref[0][ix],iref[1][iy],iref[2][iz]],axis=1)
+        refpos=areforigin+center*arefspacing
+        gclose2=_reldiff2(aref[center[:,0],center[:,1],center[:,2]],dtarget,ddchunk)+np.sum((pos-refpos)**2,axis=1)/dta2
+        # Any reference voxel with a smaller gamma value (below the cap) is within this distance, and
+        # its center is at most half a spacing further away from the closest reference voxel center.
+        reach=np.minimum(np.sqrt(np.minimum(gclose2,cap2))*criteria.dta,np.sqrt(radius2))
+        # the box never needs to extend beyond the reference image
+        dixyz=np.minimum(np.floor(reach[:,np.newaxis]/arefspacing+0.5).astype(int),np.array(aref.shape)-1)
+        offsets=_box_offsets(np.max(dixyz,axis=0))
+        bounds=_unequal_geometry_bounds(offsets,arefspacing,dta2)
+        limit=_unequal_geometry_bounds(dixyz,arefspacing,dta2)
+        order=np.argsort(bounds,kind='stable')
+        def candidates(sel,jxyz):
+            d2=np.zeros(len(sel),dtype=float)
+            for j in range(3):
+                d2+=(areforigin[j]+jxyz[:,j]*arefspacing[j]-pos[sel,j])**2
+            g2near=_reldiff2(aref[jxyz[:,0],jxyz[:,1],jxyz[:,2]],dtarget[sel],ddchunk[sel])+d2/dta2
+            g2near[d2>radius2]=np.inf
+            return g2near
+        best=_min_over_stencil(center,dixyz,limit,aref.shape,offsets[order],bounds[order],candidates)
+        g2[i0:i0+slab_voxels]=np.minimum(best,cap2)
+        if verbose:
+            print("{0:.1f}% done...\r".format(min(i0+slab_voxels,nvoxels)*100.0/nvoxels),end='')
+    return g2
+
+def gamma_index_3d_extended(imgref,imgtarget,criteria=None,defvalue=-1.,verbose=False,slab_voxels=2**18,**kwargs):
+    """
+    Gamma index with extended criteria: local or global normalization of the dose difference, a lower
+    dose cut-off, a maximum search radius and a gamma cap. The `criteria` are given as a `gamma_criteria`
+    object, or as keyword arguments for it (e.g. `dd=2.,dta=2.,local=True`). The images may have
+    different spacing and origin (but are not rotated w.r.t. each other).
+
+    With global normalization, the dose difference criterion is the given percentage of the maximum
+    reference dose; with local normalization it is the percentage of the dose in the target voxel.
+    Target voxels with a dose up to the lower dose cut-off (a percentage of the maximum reference dose),
+    or with the closest reference voxel center outside the reference image, get the `defvalue`.
+
+    Within the search radius (by default 3 times the DTA) the search is exhaustive, like in the "kdtree"
+    engine: all reference voxels that can give a smaller gamma value are visited, with the stencil search
+    of the "slabs" implementations. Gamma values up to the search radius divided by the DTA are therefore
+    exact; larger values are the minimum over the reference voxels within the search radius. With a gamma
+    cap the search stops at the cap, and larger values are set to the cap. A target voxel without any
+    reference voxel within the search radius gets the gamma cap, or infinity if there is no cap.
+    """
+    if criteria is None:
+        criteria = gamma_criteria(**kwargs)
+    elif kwargs:
+        raise ValueError("give the gamma criteria either as a gamma_criteria object or as keyword arguments, not both")
+    aref = itk.GetArrayViewFromImage(imgref).swapaxes(0,2)
+    atarget = itk.GetArrayViewFromImage(imgtarget).swapaxes(0,2)
+    if len(aref.shape) != 3 or len(atarget.shape) != 3:
+        raise ValueError("expected two 3D images, got {}D and {}D".format(len(aref.shape),len(atarget.shape)))
+    t0 = datetime.now()
+    dmax = float(np.max(aref))
+    threshold = 0.01*criteria.lower_dose_cutoff*dmax
+    areforigin = np.array(imgref.GetOrigin(),dtype=float)
+    arefspacing = np.array(imgref.GetSpacing(),dtype=float)
+    atargetorigin = np.array(imgtarget.GetOrigin(),dtype=float)
+    atargetspacing = np.array(imgtarget.GetSpacing(),dtype=float)
+    tpos = [atargetorigin[j]+np.arange(atarget.shape[j])*atargetspacing[j] for j in range(3)]
+    iref = [np.round((tpos[j]-areforigin[j])/arefspacing[j]).astype(int) for j in range(3)]
+    inside = [(iref[j]>=0)*(iref[j]<aref.shape[j]) for j in range(3)]
+    mask = _gamma_mask(atarget,threshold,inside)
+    ixyz = np.stack(np.nonzero(mask),axis=1)
+    nmask = len(ixyz)
+    if verbose:
+        print("Gamma criteria: {}".format(criteria))
+        print("{} target voxels in the intersection with the reference image have dose > {}.".format(nmask,threshold))
+    if nmask == 0:
+        print("WARNING: no target voxels with dose over the cut-off in the overlap with the reference image.")
+    if criteria.local:
+        # the cut-off is not negative, so the target dose is positive in all evaluated voxels
+        dd = 0.01*criteria.dd*np.asarray(atarget[mask],dtype=float)
+    else:
+        dd = 0.01*criteria.dd*dmax
+    g2 = np.zeros(atarget.shape,dtype=float)
+    g2[mask] = _extended_g2(aref,atarget,ixyz,dd,criteria,areforigin,arefspacing,tpos,iref,slab_voxels,verbose)
+    g = np.sqrt(g2)
+    g[np.logical_not(mask)] = defvalue
+    # ITK does not support double precision images by default => cast down to float32.
+    gimg = itk.GetImageFromArray(g.swapaxes(0,2).astype(np.float32).copy())
+    gimg.CopyInformation(imgtarget)
+    _report_speed(nmask,t0,verbose)
+    return gimg
+
+def gamma_pass_rate(gimg,defvalue=-1.):
+    """
+    Fraction of the evaluated voxels (those with a value different from `defvalue`) of the gamma image
+    `gimg` that pass (gamma<=1), and the number of evaluated voxels. The pass rate is NaN if no voxels
+    were evaluated.
+    """
+    g = itk.GetArrayViewFromImage(gimg)
+    evaluated = g != defvalue
+    nevaluated = int(np.count_nonzero(evaluated))
+    if nevaluated == 0:
+        return float('nan'),0
+    return np.count_nonzero(g[evaluated]<=1.)/nevaluated,nevaluated
+
 #####################################################################################
 # TODO: include the unit test in implementation (like here), or have it in a separate test directory?
 #####################################################################################
@@ -255,6 +1153,25 @@ import unittest
 import sys
 from datetime import datetime
 
+def _test_image(data,spacing,origin,dtype=None):
+    """
+    ITK image with the given spacing and origin, from `data` in (x,y) or (x,y,z) index order.
+    """
+    img = itk.GetImageFromArray(np.ascontiguousarray(data.T,dtype=dtype))
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    return img
+
+def _test_blob(n,spacing,origin,sigma=15.,noise=0.,dtype=np.float32,center=(0.,0.,0.)):
+    """
+    3D gaussian dose blob around `center`, with relative noise.
+    """
+    x,y,z = np.meshgrid(*[origin[j]+np.arange(n[j])*spacing[j]-center[j] for j in range(3)],indexing='ij')
+    data = np.exp(-0.5*(x**2+y**2+z**2)/sigma**2)
+    if noise > 0:
+        data *= np.random.normal(1.,noise,data.shape)
+    return _test_image(data,spacing,origin,dtype)
+
 class Test_GammaIndex3dIdenticalMesh(unittest.TestCase):
     def test_identity(self):
         # two identical images should give gamma=0.0 in all voxels
@@ -447,4 +1364,500 @@ class Test_GammaIndex3dUnequalMesh(unittest.TestCase):
                     #print("ok ddp={} dta={} refGRAD={} targetGRAD={}".format(ddp,dta,refGRAD,targetGRAD))
             #print("{}th gradient test finished".format(i))
 
+
+class Test_GammaIndex3dSlabs(unittest.TestCase):
+    # The "slabs" implementations should give exactly the same results as the loop implementations.
+    def _random_images(self,dtype,same_geometry):
+        nxyz=np.random.randint(10,20,3)
+        sxyz=np.random.uniform(0.5,2.5,3)
+        oxyz=np.random.uniform(-100.,100.,3)
+        data=np.random.normal(1.,0.05,nxyz)
+        img_ref = itk.GetImageFromArray(data.swapaxes(0,2).astype(dtype).copy())
+        img_ref.SetSpacing(sxyz)
+        img_ref.SetOrigin(oxyz)
+        if same_geometry:
+            tdata=data*np.random.normal(1.,0.03,nxyz)
+        else:
+            nxyz=np.random.randint(8,16,3)
+            tdata=np.random.normal(1.,0.05,nxyz)
+            sxyz=sxyz*np.random.uniform(0.7,1.3,3)
+            oxyz=oxyz+np.random.uniform(-1.,2.,3)
+        img_target = itk.GetImageFromArray(tdata.swapaxes(0,2).astype(dtype).copy())
+        img_target.SetSpacing(sxyz)
+        img_target.SetOrigin(oxyz)
+        return img_ref,img_target
+    def test_equal_geometry(self):
+        print('Test_GammaIndex3dSlabs test_equal_geometry')
+        np.random.seed(4711)
+        for dtype in [np.float32,np.float64]:
+            for i in range(3):
+                img_ref,img_target = self._random_images(dtype,True)
+                kwargs=dict(dd=np.random.uniform(1.,4.),dta=np.random.uniform(1.,4.),threshold=np.random.uniform(0.,95.),threshold_percent=True)
+                g_loop = gamma_index_3d_equal_geometry(img_ref,img_target,**kwargs)
+                g_slabs = gamma_index_3d_equal_geometry_slabs(img_ref,img_target,slab_voxels=500,**kwargs)
+                self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(g_loop),itk.GetArrayViewFromImage(g_slabs)))
+    def test_unequal_geometry(self):
+        print('Test_GammaIndex3dSlabs test_unequal_geometry')
+        np.random.seed(4712)
+        for dtype in [np.float32,np.float64]:
+            for i in range(3):
+                img_ref,img_target = self._random_images(dtype,False)
+                kwargs=dict(dd=np.random.uniform(1.,4.),dta=np.random.uniform(1.,4.),threshold=np.random.uniform(0.,95.),threshold_percent=True)
+                g_loop = gamma_index_3d_unequal_geometry(img_ref,img_target,**kwargs)
+                g_slabs = gamma_index_3d_unequal_geometry_slabs(img_ref,img_target,slab_voxels=500,**kwargs)
+                self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(g_loop),itk.GetArrayViewFromImage(g_slabs)))
+    def test_engine_selection(self):
+        print('Test_GammaIndex3dSlabs test_engine_selection')
+        np.random.seed(4713)
+        img_ref,img_target = self._random_images(np.float32,True)
+        g_loop = get_gamma_index(img_ref,img_target,engine="loop",dd=3.,dta=3.)
+        g_slabs = get_gamma_index(img_ref,img_target,dd=3.,dta=3.)
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(g_loop),itk.GetArrayViewFromImage(g_slabs)))
+        with self.assertRaises(ValueError):
+            get_gamma_index(img_ref,img_target,engine="magic")
+    def test_large_image(self):
+        print('Test_GammaIndex3dSlabs test_large_image')
+        np.random.seed(4714)
+        for N in [10,20,50,100]:
+            img_ref = itk.GetImageFromArray(np.ones((N,N,N),dtype=np.float32))
+            img_target = itk.GetImageFromArray(np.random.normal(1.,0.02,(N,N,N)).astype(np.float32))
+            t0 = datetime.now()
+            gamma_index_3d_equal_geometry_slabs(img_ref,img_target,dd=2.,dta=2.0)
+            dt = (datetime.now()-t0).total_seconds()
+            print("{}^3 voxels calculating gamma took {} seconds, {:.0f} voxels per second".format(N,dt,N**3/dt))
+
+class Test_GammaIndex3dKDTree(unittest.TestCase):
+    def test_shift(self):
+        # same as Test_GammaIndex3dUnequalMesh.test_Shift, for a smooth dose (so that no other
+        # neighbor than the shifted voxel itself can give a smaller gamma)
+        print('Test_GammaIndex3dKDTree test_shift')
+        np.random.seed(1234570)
+        for i in range(5):
+            nxyz=np.random.randint(5,15,3)
+            sxyz=np.random.uniform(0.5,2.5,3)
+            oxyz=-0.5*nxyz*sxyz
+            txyz=np.random.uniform(-0.5,0.5,3)*sxyz
+            data = 1.+0.01*np.sin(np.arange(np.prod(nxyz))).reshape(nxyz)
+            img_ref = _test_image(data,sxyz,oxyz)
+            img_target = _test_image(data,sxyz,oxyz+txyz)
+            img_gamma = gamma_index_3d_kdtree(img_ref,img_target,dd=0.1,dta=2.)
+            agamma = itk.GetArrayViewFromImage(img_gamma)
+            self.assertTrue( np.allclose(agamma,np.sqrt(np.sum((txyz/2.)**2))) )
+    def test_gradient(self):
+        # 1D gradients, with the exact minimum over all reference voxels computed "by hand"
+        print('Test_GammaIndex3dKDTree test_gradient')
+        np.random.seed(1234571)
+        refN,refS,refO = (100,10,10),(1.,1.,1.),(-50.,0.,0.)
+        targetN = (10,3,3)
+        for i in range(5):
+            refGRAD,targetGRAD = np.random.uniform(-1.,1.),np.random.uniform(-10.,10.)
+            xref = refO[0]+np.arange(refN[0])*refS[0]
+            dref = refGRAD*np.arange(refN[0])
+            dref += 0.5-np.min(dref)
+            targetO = np.random.uniform(-0.5,0.5,3)
+            targetS = (np.random.uniform(1.5,2.0),3.,3.)
+            xtarget = targetO[0]+np.arange(targetN[0])*targetS[0]
+            dtarget = targetGRAD*np.arange(targetN[0])
+            dtarget += 0.5-np.min(dtarget)
+            img_ref = _test_image(np.broadcast_to(dref[:,np.newaxis,np.newaxis],refN),refS,refO)
+            img_target = _test_image(np.broadcast_to(dtarget[:,np.newaxis,np.newaxis],targetN),targetS,targetO)
+            for ddp,dta in [(1.,1.),(3.,3.),(5.,2.)]:
+                dr2 = ((xtarget[:,np.newaxis]-xref[np.newaxis,:])**2 + np.sum(targetO[1:]**2))/dta**2
+                dd2 = (dtarget[:,np.newaxis]-dref[np.newaxis,:])**2/(0.01*ddp*np.max(dref))**2
+                expected = np.sqrt(np.min(dr2+dd2,axis=1))
+                img_gamma = gamma_index_3d_kdtree(img_ref,img_target,dd=ddp,dta=dta,batch_voxels=7)
+                agamma = itk.GetArrayViewFromImage(img_gamma).swapaxes(0,2)
+                self.assertTrue( np.allclose(agamma,np.broadcast_to(expected[:,np.newaxis,np.newaxis],targetN),rtol=1e-5) )
+    def test_compare_with_loop(self):
+        # the KD-tree search is exhaustive, the box search of the loop implementation is not
+        print('Test_GammaIndex3dKDTree test_compare_with_loop')
+        np.random.seed(1234572)
+        for i in range(3):
+            img_ref = _test_blob(np.random.randint(15,25,3),np.random.uniform(1.,2.5,3),np.random.uniform(-20.,-15.,3),noise=0.05,dtype=np.float64)
+            img_target = _test_blob(np.random.randint(10,15,3),np.random.uniform(1.5,3.,3),np.random.uniform(-15.,-12.,3),noise=0.05,dtype=np.float64)
+            kwargs = dict(dd=3.,dta=3.,threshold=10.,threshold_percent=True)
+            g_loop = itk.GetArrayViewFromImage(gamma_index_3d_unequal_geometry(img_ref,img_target,**kwargs))
+            g_tree = itk.GetArrayViewFromImage(gamma_index_3d_kdtree(img_ref,img_target,**kwargs))
+            self.assertTrue( np.array_equal(g_loop<0,g_tree<0) )
+            self.assertTrue( (g_tree <= g_loop+1e-5).all() )
+            self.assertGreater( np.mean(np.isclose(g_tree,g_loop,rtol=1e-5)), 0.97 )
+            inside = g_loop >= 0
+            self.assertAlmostEqual( np.mean(g_tree[inside]<=1.), np.mean(g_loop[inside]<=1.), delta=0.005 )
+    def test_interpolation(self):
+        # linear dose gradient, target grid shifted by half a voxel: with 2x sub-voxel
+        # interpolation of the reference dose every target voxel finds its exact dose.
+        print('Test_GammaIndex3dKDTree test_interpolation')
+        n,s = (20,5,5),(2.,2.,2.)
+        oref = np.zeros(3)
+        otarget = oref+(1.,0.,0.)
+        x = np.arange(n[0])*s[0]
+        img_ref = _test_image(np.broadcast_to((10.+x)[:,np.newaxis,np.newaxis],n),s,oref)
+        img_target = _test_image(np.broadcast_to((11.+x)[:,np.newaxis,np.newaxis],n),s,otarget)
+        g1 = itk.GetArrayViewFromImage(gamma_index_3d_kdtree(img_ref,img_target,dd=1.,dta=3.))
+        g2 = itk.GetArrayViewFromImage(gamma_index_3d_kdtree(img_ref,img_target,dd=1.,dta=3.,interpolate=2))
+        inside = g2 >= 0
+        self.assertTrue( inside.any() )
+        self.assertTrue( (g1[inside] > 0.1).all() )
+        self.assertTrue( np.allclose(g2[inside],0.,atol=1e-6) )
+    def test_engine_selection(self):
+        print('Test_GammaIndex3dKDTree test_engine_selection')
+        np.random.seed(1234573)
+        img_ref = _test_blob((20,20,20),(2.,2.,2.),(-20.,-20.,-20.),noise=0.02,dtype=np.float64)
+        img_target = _test_blob((20,20,20),(2.,2.,2.),(-20.,-20.,-20.),noise=0.02,dtype=np.float64)
+        g_tree = get_gamma_index(img_ref,img_target,engine="kdtree",dd=2.,dta=2.,threshold=5.,threshold_percent=True)
+        g_slabs = get_gamma_index(img_ref,img_target,dd=2.,dta=2.,threshold=5.,threshold_percent=True)
+        self.assertTrue( (itk.GetArrayViewFromImage(g_tree) <= itk.GetArrayViewFromImage(g_slabs)+1e-5).all() )
+    def test_benchmark(self):
+        # MC dose on a CT-like grid versus TPS dose on a coarser grid with another origin,
+        # with noise and a small shift between the two dose distributions
+        print('Test_GammaIndex3dKDTree test_benchmark')
+        np.random.seed(1234574)
+        from scipy.spatial import cKDTree # import before timing
+        for N in [10,20,30]:
+            img_target = _test_blob((2*N,2*N,N),(1.5,1.5,2.5),(-1.5*N+0.3,-1.5*N-0.4,-1.25*N+0.2),noise=0.03,center=(2.,-1.,1.),dtype=np.float64)
+            img_ref = _test_blob((N,N,N),(3.,3.,3.),(-1.5*N,-1.5*N,-1.5*N),dtype=np.float64)
+            kwargs = dict(dd=2.,dta=2.,threshold=10.,threshold_percent=True)
+            timings = list()
+            for name,impl in [("loop",gamma_index_3d_unequal_geometry),("slabs",gamma_index_3d_unequal_geometry_slabs),("kdtree",gamma_index_3d_kdtree)]:
+                t0 = datetime.now()
+                impl(img_ref,img_target,**kwargs)
+                timings.append((name,(datetime.now()-t0).total_seconds()))
+            print("{} target voxels: ".format(4*N**3) + ", ".join(["{} {:.3f} s".format(name,dt) for name,dt in timings]) +
+                  ", kdtree speedup w.r.t. loop {:.1f}".format(timings[0][1]/timings[2][1]))
+
+class Test_GammaIndex3dParallel(unittest.TestCase):
+    # The parallel implementation should give exactly the same results as the "slabs" implementations,
+    # for any number of workers and any slab thickness.
+    def _check(self,g_serial,img_ref,img_target,**kwargs):
+        a_serial = itk.GetArrayViewFromImage(g_serial)
+        for nworkers,slab_thickness in [(1,0),(2,0),(3,0),(2,1),(3,4)]:
+            g_par = gamma_index_3d_parallel(img_ref,img_target,nworkers=nworkers,slab_thickness=slab_thickness,**kwargs)
+            self.assertTrue(np.array_equal(a_serial,itk.GetArrayViewFromImage(g_par)))
+    def test_equal_geometry(self):
+        print('Test_GammaIndex3dParallel test_equal_geometry')
+        np.random.seed(4721)
+        for dtype in [np.float32,np.float64]:
+            n = np.random.randint(10,20,3)
+            s = np.random.uniform(1.,2.5,3)
+            img_ref = _test_blob(n,s,-0.5*n*s,noise=0.05,dtype=dtype)
+            img_target = _test_blob(n,s,-0.5*n*s,noise=0.05,dtype=dtype)
+            kwargs=dict(dd=np.random.uniform(1.,4.),dta=np.random.uniform(1.,4.),threshold=np.random.uniform(0.,50.),threshold_percent=True)
+            g_slabs = gamma_index_3d_equal_geometry_slabs(img_ref,img_target,**kwargs)
+            self._check(g_slabs,img_ref,img_target,**kwargs)
+    def test_unequal_geometry(self):
+        print('Test_GammaIndex3dParallel test_unequal_geometry')
+        np.random.seed(4722)
+        for dtype in [np.float32,np.float64]:
+            img_ref = _test_blob(np.random.randint(15,25,3),np.random.uniform(1.,2.5,3),np.random.uniform(-20.,-15.,3),noise=0.05,dtype=dtype)
+            img_target = _test_blob(np.random.randint(10,15,3),np.random.uniform(1.5,3.,3),np.random.uniform(-15.,-12.,3),noise=0.05,dtype=dtype)
+            kwargs=dict(dd=np.random.uniform(1.,4.),dta=np.random.uniform(1.,4.),threshold=np.random.uniform(0.,50.),threshold_percent=True)
+            g_slabs = gamma_index_3d_unequal_geometry_slabs(img_ref,img_target,slab_voxels=500,**kwargs)
+            self._check(g_slabs,img_ref,img_target,slab_voxels=500,**kwargs)
+    def test_engine_selection(self):
+        print('Test_GammaIndex3dParallel test_engine_selection')
+        np.random.seed(4723)
+        img_ref = _test_blob((20,20,20),(2.,2.,2.),(-20.,-20.,-20.),noise=0.02)
+        img_target = _test_blob((20,20,20),(2.,2.,2.),(-20.,-20.,-20.),noise=0.02)
+        g_slabs = get_gamma_index(img_ref,img_target,dd=2.,dta=2.,threshold=5.,threshold_percent=True)
+        g_par = get_gamma_index(img_ref,img_target,engine="parallel",nworkers=2,dd=2.,dta=2.,threshold=5.,threshold_percent=True)
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(g_slabs),itk.GetArrayViewFromImage(g_par)))
+        g_none = gamma_index_3d_parallel(img_ref,img_target,nworkers=2,threshold=2.)
+        self.assertTrue((itk.GetArrayViewFromImage(g_none)==-1.).all())
+    def test_benchmark(self):
+        # speedup w.r.t. the serial implementation, versus the number of workers
+        print('Test_GammaIndex3dParallel test_benchmark')
+        np.random.seed(4724)
+        ncpu = _available_cpus()
+        for N in [20,40,80]:
+            img_target = _test_blob((2*N,2*N,N),(1.5,1.5,2.5),(-1.5*N+0.3,-1.5*N-0.4,-1.25*N+0.2),sigma=N,noise=0.03)
+            img_ref = _test_blob((N,N,N),(3.,3.,3.),(-1.5*N,-1.5*N,-1.5*N),sigma=N)
+            kwargs = dict(dd=2.,dta=2.,threshold=10.,threshold_percent=True)
+            t0 = datetime.now()
+            gamma_index_3d_unequal_geometry_slabs(img_ref,img_target,**kwargs)
+            t_serial = (datetime.now()-t0).total_seconds()
+            timings = list()
+            for nworkers in [1,2,4,8]:
+                t0 = datetime.now()
+                gamma_index_3d_parallel(img_ref,img_target,nworkers=nworkers,**kwargs)
+                timings.append((nworkers,(datetime.now()-t0).total_seconds()))
+            print("{} target voxels, {} CPUs available: serial {:.3f} s, ".format(4*N**3,ncpu,t_serial) +
+                  ", ".join(["{} workers {:.3f} s (speedup {:.2f})".format(n,dt,t_serial/dt) for n,dt in timings]))
+
+class Test_GammaIndex3dPassRate(unittest.TestCase):
+    # The pass/fail evaluation should agree with the full gamma map of the "slabs" implementations.
+    def _check(self,g_map,pass_rate,img_fail):
+        g = itk.GetArrayViewFromImage(g_map)
+        fail = itk.GetArrayViewFromImage(img_fail)
+        inside = g>=0
+        # the gamma map is rounded to single precision, which can only matter for values very close to 1
+        differ = (fail==1)!=(g>1)
+        self.assertTrue((np.abs(g[differ]-1.)<1e-6).all())
+        self.assertFalse(fail[np.logical_not(inside)].any())
+        self.assertAlmostEqual(pass_rate,np.mean(g[inside]<=1.),delta=np.sum(differ)/np.sum(inside)+1e-12)
+    def test_equal_geometry(self):
+        print('Test_GammaIndex3dPassRate test_equal_geometry')
+        np.random.seed(4731)
+        for dtype in [np.float32,np.float64]:
+            for i in range(3):
+                n = np.random.randint(10,20,3)
+                s = np.random.uniform(1.,2.5,3)
+                img_ref = _test_blob(n,s,-0.5*n*s,noise=0.05,dtype=dtype)
+                img_target = _test_blob(n,s,-0.5*n*s,noise=0.05,dtype=dtype)
+                kwargs=dict(dd=np.random.uniform(1.,4.),dta=np.random.uniform(1.,4.),threshold=np.random.uniform(0.,50.),threshold_percent=True)
+                g_slabs = gamma_index_3d_equal_geometry_slabs(img_ref,img_target,**kwargs)
+                pass_rate,img_fail = gamma_index_3d_pass_rate(img_ref,img_target,slab_voxels=500,**kwargs)
+                self.assertTrue(0.<pass_rate<1.)
+                self._check(g_slabs,pass_rate,img_fail)
+    def test_unequal_geometry(self):
+        print('Test_GammaIndex3dPassRate test_unequal_geometry')
+        np.random.seed(4732)
+        for dtype in [np.float32,np.float64]:
+            for i in range(3):
+                img_ref = _test_blob(np.random.randint(15,25,3),np.random.uniform(1.,2.5,3),np.random.uniform(-20.,-15.,3),noise=0.05,dtype=dtype)
+                img_target = _test_blob(np.random.randint(10,15,3),np.random.uniform(1.5,3.,3),np.random.uniform(-15.,-12.,3),noise=0.05,dtype=dtype)
+                kwargs=dict(dd=np.random.uniform(1.,4.),dta=np.random.uniform(1.,4.),threshold=np.random.uniform(0.,50.),threshold_percent=True)
+                g_slabs = gamma_index_3d_unequal_geometry_slabs(img_ref,img_target,**kwargs)
+                pass_rate,img_fail = gamma_index_3d_pass_rate(img_ref,img_target,slab_voxels=500,**kwargs)
+                self._check(g_slabs,pass_rate,img_fail)
+    def test_shift(self):
+        # a shifted copy of a dose with large local dose differences: gamma is the shift divided by the DTA
+        print('Test_GammaIndex3dPassRate test_shift')
+        np.random.seed(4733)
+        for i in range(5):
+            nxyz=np.random.randint(5,15,3)
+            sxyz=np.random.uniform(0.5,2.5,3)
+            oxyz=-0.5*nxyz*sxyz
+            txyz=np.random.uniform(0.1,0.5,3)*sxyz*np.random.choice([-1,1],3)
+            data = 1.+0.01*np.sin(np.arange(np.prod(nxyz))).reshape(nxyz)
+            img_ref = _test_image(data,sxyz,oxyz)
+            img_target = _test_image(data,sxyz,oxyz+txyz)
+            shift = np.sqrt(np.sum(txyz**2))
+            pass_rate,img_fail = gamma_index_3d_pass_rate(img_ref,img_target,dd=0.1,dta=1.25*shift)
+            self.assertEqual(pass_rate,1.)
+            self.assertFalse(itk.GetArrayViewFromImage(img_fail).any())
+            pass_rate,img_fail = gamma_index_3d_pass_rate(img_ref,img_target,dd=0.1,dta=0.8*shift)
+            self.assertEqual(pass_rate,0.)
+            self.assertTrue(itk.GetArrayViewFromImage(img_fail).all())
+        # nothing above threshold
+        pass_rate,img_fail = gamma_index_3d_pass_rate(img_ref,img_target,threshold=2.)
+        self.assertTrue(np.isnan(pass_rate))
+    def test_benchmark(self):
+        # pass/fail evaluation versus the full gamma map, for MC-like dose (noise, small shift) vs TPS-like dose
+        print('Test_GammaIndex3dPassRate test_benchmark')
+        np.random.seed(4734)
+        for N in [20,40]:
+            for equal in [True,False]:
+                img_target = _test_blob((2*N,2*N,N),(1.5,1.5,2.5),(-1.5*N,-1.5*N,-1.25*N),sigma=N,noise=0.03,center=(1.,-1.,0.5))
+                if equal:
+                    img_ref = _test_blob((2*N,2*N,N),(1.5,1.5,2.5),(-1.5*N,-1.5*N,-1.25*N),sigma=N)
+                else:
+                    img_ref = _test_blob((N,N,N),(3.,3.,3.),(-1.5*N+0.3,-1.5*N-0.4,-1.5*N+0.2),sigma=N)
+                kwargs = dict(dd=3.,dta=3.,threshold=10.,threshold_percent=True)
+                t0 = datetime.now()
+                g_map = get_gamma_index(img_ref,img_target,**kwargs)
+                t_map = (datetime.now()-t0).total_seconds()
+                t0 = datetime.now()
+                pass_rate,img_fail = gamma_index_3d_pass_rate(img_ref,img_target,**kwargs)
+                t_pass = (datetime.now()-t0).total_seconds()
+                self._check(g_map,pass_rate,img_fail)
+                print("{} target voxels, {} geometry, pass rate {:.2f}%: full gamma map {:.3f} s, pass/fail {:.3f} s (speedup {:.1f})".format(
+                      4*N**3,"equal" if equal else "different",100*pass_rate,t_map,t_pass,t_map/t_pass))
+
+class Test_GammaIndex2d(unittest.TestCase):
+    def test_shift(self):
+        # shifted copy of a dose with large local dose differences: gamma is the shift divided by the DTA
+        print('Test_GammaIndex2d test_shift')
+        np.random.seed(4741)
+        for i in range(5):
+            nxy=np.random.randint(5,15,2)
+            sxy=np.random.uniform(0.5,2.5,2)
+            oxy=-0.5*nxy*sxy
+            txy=np.random.uniform(-0.5,0.5,2)*sxy
+            data = 1.+0.01*np.sin(np.arange(np.prod(nxy))).reshape(nxy)
+            img_ref = _test_image(data,sxy,oxy)
+            img_target = _test_image(data,sxy,oxy+txy)
+            for engine in ["slabs","loop","kdtree"]:
+                img_gamma = get_gamma_index(img_ref,img_target,engine=engine,dd=0.1,dta=2.)
+                self.assertEqual(img_gamma.GetImageDimension(),2)
+                self.assertTrue(np.allclose(img_gamma.GetOrigin(),oxy+txy))
+                self.assertTrue(np.allclose(itk.GetArrayViewFromImage(img_gamma),np.sqrt(np.sum((txy/2.)**2))))
+    def test_gradient(self):
+        # reference dose with a linear gradient along x, target with a constant dose difference: the minimum
+        # over all reference voxels can be computed by hand and is within the search box
+        print('Test_GammaIndex2d test_gradient')
+        np.random.seed(4742)
+        for i in range(5):
+            n,s = (40,7),np.random.uniform(0.5,1.5,2)
+            x = np.arange(n[0])*s[0]
+            grad,diff = np.random.uniform(0.05,0.5),np.random.uniform(-1.,1.)
+            dref = 10.+grad*x
+            dtarget = dref+diff
+            img_ref = _test_image(np.broadcast_to(dref[:,np.newaxis],n),s,(0.,0.))
+            img_target = _test_image(np.broadcast_to(dtarget[:,np.newaxis],n),s,(0.,0.))
+            dd,dta = np.random.uniform(0.5,2.),np.random.uniform(1.,4.)
+            expected = np.sqrt(np.min((x[:,np.newaxis]-x[np.newaxis,:])**2/dta**2+(dtarget[:,np.newaxis]-dref[np.newaxis,:])**2/dd**2,axis=1))
+            g = itk.GetArrayViewFromImage(gamma_index_2d(img_ref,img_target,dd=dd,dta=dta,ddpercent=False)).T
+            self.assertTrue(np.allclose(g,np.broadcast_to(expected[:,np.newaxis],n),rtol=1e-5))
+    def test_wrong_dimension(self):
+        print('Test_GammaIndex2d test_wrong_dimension')
+        img2d = _test_image(np.ones((5,5)),(1.,1.),(0.,0.))
+        img3d = _test_image(np.ones((5,5,5)),(1.,1.,1.),(0.,0.,0.))
+        with self.assertRaises(ValueError):
+            gamma_index_2d(img2d,img3d)
+
+class Test_GammaIndexPerSlice(unittest.TestCase):
+    def test_decoupled_slices(self):
+        # uniform dose per slice, different in each slice; the target dose is a bit higher, by an amount that
+        # alternates between passing and failing. In 3D, the target dose would match the next reference slice.
+        print('Test_GammaIndexPerSlice test_decoupled_slices')
+        for axis in range(3):
+            n = [6,7,8]
+            nslices = n[axis]
+            shape = [1,1,1]
+            shape[axis] = nslices
+            dref = np.broadcast_to((10.+np.arange(nslices)).reshape(shape),n)
+            diff = np.where(np.arange(nslices)%2==0,0.2,1.).reshape(shape)
+            img_ref = _test_image(dref,(1.,1.,1.),(0.,0.,0.))
+            img_target = _test_image(dref+diff,(1.,1.,1.),(0.,0.,0.))
+            kwargs = dict(dd=0.5,ddpercent=False,dta=3.)
+            # in 3D, the target dose in the failing slices matches the dose in the next reference slice
+            g3d = np.moveaxis(itk.GetArrayViewFromImage(get_gamma_index(img_ref,img_target,**kwargs)).T,axis,0)
+            self.assertTrue(np.allclose(g3d[1:-1:2],1./3.))
+            img_gamma,pass_rates = gamma_index_per_slice(img_ref,img_target,axis=axis,**kwargs)
+            g = itk.GetArrayViewFromImage(img_gamma).T
+            self.assertTrue(np.allclose(g,np.broadcast_to(diff/0.5,n)))
+            self.assertTrue(np.array_equal(pass_rates,np.where(np.arange(nslices)%2==0,1.,0.)))
+    def test_compare_with_2d(self):
+        # for equal geometries and absolute dose scales, each slice should be the same as the 2D gamma of that slice
+        print('Test_GammaIndexPerSlice test_compare_with_2d')
+        np.random.seed(4743)
+        n,s,o = (12,10,8),np.random.uniform(1.,2.,3),np.random.uniform(-10.,10.,3)
+        x,y,z = np.meshgrid(*[np.arange(n[j])*s[j] for j in range(3)],indexing='ij')
+        dref = np.exp(-0.5*((x-10.)**2+(y-8.)**2+(z-6.)**2)/8.**2)
+        dtarget = dref*np.random.normal(1.,0.05,n)
+        img_ref = _test_image(dref,s,o)
+        img_target = _test_image(dtarget,s,o)
+        kwargs = dict(dd=0.03,ddpercent=False,dta=2.,threshold=0.1)
+        img_gamma,pass_rates = gamma_index_per_slice(img_ref,img_target,axis=2,**kwargs)
+        g = itk.GetArrayViewFromImage(img_gamma).T
+        for k in range(n[2]):
+            g2d = gamma_index_2d(_test_image(dref[:,:,k],s[:2],o[:2]),_test_image(dtarget[:,:,k],s[:2],o[:2]),**kwargs)
+            a2d = itk.GetArrayViewFromImage(g2d).T
+            self.assertTrue(np.array_equal(g[:,:,k],a2d))
+            inside = a2d>=0
+            if inside.any():
+                self.assertAlmostEqual(pass_rates[k],np.mean(a2d[inside]<=1.))
+            else:
+                self.assertTrue(np.isnan(pass_rates[k]))
+    def test_unequal_geometry(self):
+        # target slices at every other reference slice, in-plane grid shifted by a fraction of a voxel
+        print('Test_GammaIndexPerSlice test_unequal_geometry')
+        nref,ntarget = (10,10,10),(8,8,4)
+        zref = np.arange(nref[2])*1.
+        dref = np.broadcast_to((10.+zref)[np.newaxis,np.newaxis,:],nref)
+        img_ref = _test_image(dref,(1.,1.,1.),(0.,0.,0.))
+        zt = 2.*np.arange(ntarget[2])+1.1
+        dtarget = np.broadcast_to((10.+np.round(zt)+0.3)[np.newaxis,np.newaxis,:],ntarget)
+        img_target = _test_image(dtarget,(1.2,1.2,2.),(0.25,0.25,1.1))
+        img_gamma,pass_rates = gamma_index_per_slice(img_ref,img_target,dd=0.5,ddpercent=False,dta=3.)
+        g = itk.GetArrayViewFromImage(img_gamma).T
+        # dose is uniform within the slices, so the closest in-plane reference voxel gives the smallest gamma
+        dxy = [0.25+1.2*np.arange(ntarget[j]) for j in range(2)]
+        dxy = [d-np.round(d) for d in dxy]
+        expected = np.sqrt((0.3/0.5)**2+(dxy[0][:,np.newaxis]**2+dxy[1][np.newaxis,:]**2)/3.**2)
+        self.assertTrue(np.allclose(g,expected[:,:,np.newaxis]))
+        self.assertTrue(np.array_equal(pass_rates,np.ones(ntarget[2])))
+
+class Test_GammaIndex3dExtended(unittest.TestCase):
+    def _blob_pair(self):
+        np.random.seed(5150)
+        nref,sref,oref = (16,14,12),(2.,2.5,3.),(0.,0.,0.)
+        ntarget,starget,otarget = (24,22,16),(1.3,1.4,2.),(0.7,0.4,1.1)
+        x,y,z = np.meshgrid(*[oref[j]+np.arange(nref[j])*sref[j] for j in range(3)],indexing='ij')
+        dref = np.exp(-0.5*((x-15.)**2+(y-17.)**2+(z-16.)**2)/8.**2)
+        x,y,z = np.meshgrid(*[otarget[j]+np.arange(ntarget[j])*starget[j] for j in range(3)],indexing='ij')
+        dtarget = np.exp(-0.5*((x-16.)**2+(y-17.)**2+(z-16.)**2)/8.**2)*np.random.normal(1.,0.04,ntarget)
+        return _test_image(dref,sref,oref,dtype=np.float32),_test_image(dtarget,starget,otarget,dtype=np.float32)
+    def test_global_matches_kdtree(self):
+        # both searches are exhaustive
+        print('Test_GammaIndex3dExtended test_global_matches_kdtree')
+        img_ref,img_target = self._blob_pair()
+        g_ext = itk.GetArrayViewFromImage(get_gamma_index(img_ref,img_target,engine="extended",dd=2.,dta=2.,lower_dose_cutoff=10.))
+        g_kd = itk.GetArrayViewFromImage(get_gamma_index(img_ref,img_target,engine="kdtree",dd=2.,dta=2.,threshold=10.,threshold_percent=True))
+        self.assertTrue(np.array_equal(g_ext<0,g_kd<0))
+        # the default search radius is 3 DTA: gamma values up to 3 are exact, larger values are larger than 3
+        self.assertTrue(np.allclose(np.minimum(g_ext,3.),np.minimum(g_kd,3.),atol=1e-5))
+        self.assertTrue((g_kd>3.).any())
+        g_ext = itk.GetArrayViewFromImage(get_gamma_index(img_ref,img_target,engine="extended",dd=2.,dta=2.,lower_dose_cutoff=10.,max_search_radius=np.inf))
+        self.assertTrue(np.allclose(g_ext,g_kd,atol=1e-5))
+    def test_local_normalization(self):
+        # uniform relative dose difference: with local normalization, every voxel has the same gamma value
+        print('Test_GammaIndex3dExtended test_local_normalization')
+        x = np.arange(10)*2.
+        dref = np.broadcast_to((0.1+x)[:,np.newaxis,np.newaxis],(10,4,3))
+        img_ref = _test_image(dref,(2.,2.,2.),(0.,0.,0.),dtype=np.float32)
+        img_target = _test_image(dref*1.05,(2.,2.,2.),(0.,0.,0.),dtype=np.float32)
+        criteria = gamma_criteria(dd=10.,dta=0.01,local=True)
+        g = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,criteria))
+        self.assertTrue(np.allclose(g,0.05/(0.1*1.05),rtol=1e-5))
+        # with global normalization, the gamma value grows with the dose
+        g = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,dd=10.,dta=0.01)).T
+        self.assertTrue(np.allclose(g,(0.05*dref/(0.1*np.max(dref)))),"{}".format(g[:,0,0]))
+        # with a cut-off, the low dose voxels are not evaluated
+        g = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,dd=10.,dta=0.01,lower_dose_cutoff=50.,defvalue=-2.)).T
+        self.assertTrue(np.array_equal(g<0,dref*1.05<=0.5*np.max(dref)))
+        self.assertTrue(np.all(g[g<0]==-2.))
+    def test_local_without_cutoff(self):
+        # low dose voxels have a tiny local dose difference scale; the search radius keeps their search boxes small
+        print('Test_GammaIndex3dExtended test_local_without_cutoff')
+        np.random.seed(5151)
+        n,s = (60,60,40),(2.,2.,2.)
+        x,y,z = np.meshgrid(*[np.arange(n[j])*s[j] for j in range(3)],indexing='ij')
+        dref = np.exp(-0.5*((x-60.)**2+(y-60.)**2+(z-40.)**2)/10.**2)
+        img_ref = _test_image(dref,s,(0.,0.,0.),dtype=np.float32)
+        img_target = _test_image(dref*np.random.normal(1.,0.02,n),s,(0.,0.,0.),dtype=np.float32)
+        self.assertGreater(np.mean(dref<1e-6),0.5)
+        g = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,local=True))
+        self.assertTrue(np.all(np.isfinite(g)))
+        # a larger search radius does not change which voxels pass
+        g9 = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,local=True,max_search_radius=15.))
+        self.assertTrue(np.array_equal(g<=1.,g9<=1.))
+        self.assertTrue(np.array_equal(np.minimum(g,3.),np.minimum(g9,3.)))
+    def test_cap_and_search_radius(self):
+        print('Test_GammaIndex3dExtended test_cap_and_search_radius')
+        img_ref,img_target = self._blob_pair()
+        g = itk.GetArrayFromImage(gamma_index_3d_extended(img_ref,img_target,lower_dose_cutoff=10.))
+        evaluated = g>=0
+        g_cap = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,lower_dose_cutoff=10.,gamma_cap=0.5))
+        self.assertTrue(np.allclose(g_cap[evaluated],np.minimum(g[evaluated],0.5)))
+        self.assertTrue(np.array_equal(g_cap<0,g<0))
+        # with a small search radius, only the target voxels that (almost) coincide with a reference voxel have any neighbors
+        sref,oref = np.array(img_ref.GetSpacing()),np.array(img_ref.GetOrigin())
+        tpos = [img_target.GetOrigin()[j]+np.arange(img_target.GetLargestPossibleRegion().GetSize()[j])*img_target.GetSpacing()[j] for j in range(3)]
+        dxyz = [tpos[j]-oref[j]-np.round((tpos[j]-oref[j])/sref[j])*sref[j] for j in range(3)]
+        dist = np.sqrt(dxyz[2][:,np.newaxis,np.newaxis]**2+dxyz[1][np.newaxis,:,np.newaxis]**2+dxyz[0][np.newaxis,np.newaxis,:]**2)
+        isolated = evaluated&(dist>0.1)
+        self.assertTrue(isolated.any() and (evaluated&(dist<=0.1)).any())
+        g_r = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,lower_dose_cutoff=10.,max_search_radius=0.1))
+        self.assertTrue(np.all(np.isinf(g_r[isolated])))
+        self.assertTrue(np.all(np.isfinite(g_r[evaluated&(dist<=0.1)])))
+        g_r = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,lower_dose_cutoff=10.,max_search_radius=0.1,gamma_cap=2.))
+        self.assertTrue(np.all(g_r[isolated]==2.))
+        # a generous search radius does not change anything for the voxels with gamma<=3 (the default radius is 3 DTA)
+        g_r = itk.GetArrayViewFromImage(gamma_index_3d_extended(img_ref,img_target,lower_dose_cutoff=10.,max_search_radius=1000.))
+        self.assertTrue(np.array_equal(g_r[g<=3.],g[g<=3.]))
+        self.assertTrue(np.all(g_r[g>3.]>3.))
+    def test_criteria(self):
+        print('Test_GammaIndex3dExtended test_criteria')
+        self.assertEqual(str(gamma_criteria(dd=2.,dta=2.,local=True,lower_dose_cutoff=10.)),"2%/2mm local, cutoff 10%")
+        self.assertEqual(gamma_criteria(dta=2.).max_search_radius,6.)
+        self.assertEqual(str(gamma_criteria(max_search_radius=np.inf,gamma_cap=2.)),"3%/3mm global, search radius infmm, gamma cap 2")
+        for kwargs in [dict(dta=0.),dict(dd=-1.),dict(gamma_cap=-1.),dict(max_search_radius=-2.),dict(max_search_radius=0.),
+                       dict(local=True,max_search_radius=np.inf)]:
+            with self.assertRaises(ValueError):
+                gamma_criteria(**kwargs)
+        img_ref,img_target = self._blob_pair()
+        with self.assertRaises(ValueError):
+            gamma_index_3d_extended(img_ref,img_target,gamma_criteria(),local=True)
+
 # vim: set et softtabstop=4 sw=4 smartindent:
@@ -10,6 +10,7 @@ import logging
 import numpy as np
 from utils.beamset_info import beamset_info
 from utils.beamset_info import spot_info
+from utils.spot_store import spot_store
 from impl.system_configuration import system_configuration
 logger=logging.getLogger(__name__)
 
@@ -33,6 +34,7 @@ class gate_pbs_field:
         self.bml = bml
         self.radiation_type = radtype.upper()
         self.control_points = list()
+        self._spot_store = None
         self.gantry_angle = gantry_angle
         self.patient_angle = patient_angle
         self.range_shifter_ids = list()
@@ -42,6 +44,12 @@ class gate_pbs_field:
     def nspots(self):
         return sum([len(cpt.spots) for cpt in self.control_points])
     @property
+    def spot_store(self):
+        # created only once, on first use (after the plan file was read)
+        if self._spot_store is None:
+            self._spot_store = spot_store.from_layers(self.control_points)
+        return self._spot_store
+    @property
     def layers(self):
         return self.control_points
     @property
@@ -347,26 +355,49 @@ class gate_pbs_plan_file:
             logger.error("did NOT write header, but got nlayer={}, nspots={}, nspots_ignored={}, which SHOULD all be zero...".format(self.nlayers,self.nspots,self.nspots_ignored))
         else:
             logger.info("did write anything into plan file")
-    def import_from(self,plan):
-        syscfg = system_configuration.getInstance()
+    def import_from(self,plan,msw_scaling=None,engine="columnar"):
+        """
+        Write the spots of all beams in `plan` into the Gate plan file. The
+        meterset weights are scaled with an energy dependent polynomial, with
+        coefficients from `msw_scaling` (a dictionary with the coefficients per
+        "<beamline>_<radiation type>" and a "default"; by default the "msw
+        scaling" from the system configuration).
+
+        With the default `engine="columnar"`, the spots of each beam are taken
+        from its `spot_store` and scaled and written with numpy, with
+        `engine="spots"` the spots are scaled and written one by one. Both
+        engines write identical files.
+        """
+        if msw_scaling is None:
+            syscfg = system_configuration.getInstance()
+            msw_scaling = syscfg['msw scaling']
+        if engine not in ["columnar","spots"]:
+            raise ValueError("unknown plan file engine '{}', should be 'columnar' or 'spots'".format(engine))
         self.planname = plan.name
         logger.debug("STARTING filling plan {} into GATE plan file {}".format(self.planname,self.filename))
         msw_tot_plan = 0
+        beam_msw = list()
         for j,beam in enumerate(plan.beams):
-            def_msw_scaling=syscfg['msw scaling']["default"]
+            def_msw_scaling=msw_scaling["default"]
             dose_corr_key=(beam.TreatmentMachineName+"_"+beam.RadiationType).lower()
-            params_msw_scaling = syscfg['msw scaling'].get(dose_corr_key,def_msw_scaling)
-            conversion = lambda msw, energy : msw*np.polyval(params_msw_scaling,energy)
+            params_msw_scaling = msw_scaling.get(dose_corr_key,def_msw_scaling)
+            conversion = lambda msw, energy, params=params_msw_scaling : msw*np.polyval(params,energy)
             beam.msw_conv_func = conversion
-            msw_tot_plan += self.calc_msw_tot_beam(beam, conversion)
+            if engine == "columnar":
+                store = beam.spot_store
+                scaled = store.scaled_weights(params_msw_scaling)
+                beam_msw.append((store,scaled,spot_store.total(scaled)))
+            else:
+                beam_msw.append((None,None,self.calc_msw_tot_beam(beam, conversion)))
+            msw_tot_plan += beam_msw[-1][2]
         
         self.write_file_header(msw_tot_plan,plan.beams)
-        for j,f in enumerate(plan.beams):
+        for f,(store,scaled,mswtot) in zip(plan.beams,beam_msw):
             # clitkDicomRT2Gate uses beam *number*, but Alessio says that *name* is better, more reliable
-            self.write_field_header(f)
-            # def_msw_scaling=syscfg['msw scaling']["default"]
-            # dose_corr_key=(f.TreatmentMachineName+"_"+f.RadiationType).lower()
-            # msw_scaling=syscfg['msw scaling'].get(dose_corr_key,def_msw_scaling)          
+            self.write_field_header(f,mswtot)
+            if engine == "columnar":
+                self.write_spots(store,scaled)
+                continue
             for i,l in enumerate(f.layers):
                 self.write_layer_header(i,l)
                 for spot in l.spots:
@@ -408,8 +439,10 @@ class gate_pbs_plan_file:
         self.filehandle.write("#TotalMetersetWeightOfAllFields\n{0:f}\n\n".format(mswtot))
         self.wrote_header = True
 
-    def write_field_header(self,field):
+    def write_field_header(self,field,mswtot=None):
         isoc=field.IsoCenter
+        if mswtot is None:
+            mswtot = self.calc_msw_tot_beam(field, field.msw_conv_func) #field.mswtot
         self.filehandle.write(
 """#FIELD-DESCRIPTION
 ###FieldID
@@ -426,7 +459,7 @@ class gate_pbs_plan_file:
 {ncp:d}
 #SPOTS-DESCRIPTION
 """.format(fid=field.Number,
-           mswtot= self.calc_msw_tot_beam(field, field.msw_conv_func), #field.mswtot,
+           mswtot=mswtot,
            ga=field.gantry_angle,
            psa=field.PatientSupportAngle,
            isox=isoc[0],
@@ -472,12 +505,143 @@ class gate_pbs_plan_file:
         else:
             self.nspots_ignored += 1
 
+    def write_spots(self,store,msw):
+        """
+        Write the layer headers and spots of one field, for all spots at once:
+        `store` is the `spot_store` of the field and `msw` are the (scaled)
+        meterset weights of its spots. Produces the same text as calling
+        `write_layer_header` and `write_spot` for each layer and spot.
+        """
+        written = np.ones(store.nspots,dtype=bool) if self.allow0 else (store.w>0)
+        # running sum of the written weights, in the same order as write_spot would add them
+        cumsum = np.cumsum(np.where(written,msw,0.))
+        xyw = np.stack([store.x,store.y,msw],axis=1)
+        for i in range(store.nlayers):
+            i0,i1 = store.layer_start[i],store.layer_start[i+1]
+            self.msw_cumsum = float(cumsum[i0-1]) if i0>0 else 0.
+            self.filehandle.write(
+"""####ControlPointIndex
+{cpi:d}
+####SpotTuneID
+{stid:s}
+####CumulativeMetersetWeight
+{mswtot:g}
+####Energy (MeV)
+{energy:g}
+####NbOfScannedSpots
+{nspot:g}
+####X Y Weight (spot position at isocenter in mm, with weight in MU (default) or number of protons "setSpotIntensityAsNbProtons true")
+""".format(cpi=i,stid=store.layer_tuneID[i],mswtot=self.msw_cumsum,energy=store.layer_energy[i],nspot=int(i1-i0)))
+            self.nlayers += 1
+            lines = xyw[i0:i1][written[i0:i1]]
+            self.filehandle.write(("%g %g %g\n"*len(lines)) % tuple(lines.ravel().tolist()))
+            self.nspots_written += len(lines)
+            self.nspots += len(lines)
+            self.nspots_ignored += (i1-i0)-len(lines)
+        if store.nspots > 0:
+            self.msw_cumsum = float(cumsum[-1])
+        logger.debug("wrote {} layers with {} spots for plan={}".format(store.nlayers,store.nspots,self.planname))
+
 
 ################################################################################
 # UNIT TESTS
 ################################################################################
 
 import unittest
+from datetime import datetime
+import pydicom
+from utils.beamset_info import layer_info
+
+class _test_beam(object):
+    """
+    Minimal beam with real `layer_info` layers, made from synthetic DICOM control points.
+    """
+    def __init__(self,number,machine,nlayers,nspots,rng,zero_fraction=0.):
+        self.number = self.Number = number
+        self.TreatmentMachineName = machine
+        self.RadiationType = "PROTON"
+        self.IsoCenter = [1.5,-2.25,100.]
+        self.gantry_angle = 90.*number
+        self.PatientSupportAngle = 0.
+        self.layers = list()
+        cumsumchk = [0.]
+        for j,energy in enumerate(np.linspace(220.,70.,nlayers)):
+            n = int(rng.integers(1,2*nspots))
+            w = rng.uniform(0.,3.,n)*(rng.uniform(0.,1.,n)>=zero_fraction)
+            cp = pydicom.Dataset()
+            cp.NumberOfScanSpotPositions = n
+            cp.ScanSpotMetersetWeights = [float(v) for v in w] if n>1 else float(w[0])
+            cp.ScanSpotPositionMap = [float(v) for v in np.round(rng.uniform(-150.,150.,2*n),3)]
+            cp.CumulativeMetersetWeight = cumsumchk[0]
+            cp.NominalBeamEnergy = float(np.round(energy,2))
+            cp.ScanSpotTuneID = "3.0"
+            self.layers.append(layer_info(cp,j,cumsumchk,keep0=zero_fraction>0))
+        self.spot_store = spot_store.from_layers(self.layers)
+    @property
+    def nlayers(self):
+        return len(self.layers)
+
+class _test_plan(object):
+    def __init__(self,beams):
+        self.name = "TestPlan"
+        self.beams = beams
+
+class test_gate_pbs_plan_writing(unittest.TestCase):
+    def setUp(self):
+        self.planfiles = list()
+        self.msw_scaling = dict(default=[0.0,1.0],ir2hbl_proton=[1.3e-7,-4.2e-5,1.8e-3,0.97])
+    def tearDown(self):
+        for f in self.planfiles:
+            if os.path.exists(f):
+                os.remove(f)
+    def _write(self,plan,engine,allow0=False):
+        fname = ".test.gatepbs.{}.{}.{}.txt".format(os.getpid(),engine,len(self.planfiles))
+        self.planfiles.append(fname)
+        gpf = gate_pbs_plan_file(fname,allow0=allow0)
+        t0 = datetime.now()
+        gpf.import_from(plan,msw_scaling=self.msw_scaling,engine=engine)
+        t1 = datetime.now()
+        with open(fname,"r") as fp:
+            text = fp.read()
+        return text,gpf,t1-t0
+    def test_columnar_vs_spots(self):
+        rng = np.random.default_rng(1234)
+        for allow0 in [False,True]:
+            plan = _test_plan([_test_beam(1,"IR2HBL",20,30,rng,0.2*allow0),_test_beam(2,"IR3VBL",15,20,rng,0.2*allow0)])
+            text_col,gpf_col,dt = self._write(plan,"columnar",allow0)
+            text_spots,gpf_spots,dt = self._write(plan,"spots",allow0)
+            self.assertEqual(text_col,text_spots)
+            for attr in ["nlayers","nspots","nspots_ignored","nspots_written","msw_cumsum"]:
+                self.assertEqual(getattr(gpf_col,attr),getattr(gpf_spots,attr))
+        # the scaling of the first beam is applied to its spots
+        self.assertTrue("{:g}".format(plan.beams[0].spot_store.scaled_weights(self.msw_scaling["ir2hbl_proton"])[0]) in text_col)
+        with self.assertRaises(ValueError):
+            self._write(plan,"dataframes")
+    def test_benchmark(self):
+        # synthetic plan with 100k spots
+        print("test_gate_pbs_plan_writing test_benchmark")
+        rng = np.random.default_rng(4321)
+        plan = _test_plan([_test_beam(i+1,"IR2HBL",50,500,rng) for i in range(4)])
+        nspots = sum([b.spot_store.nspots for b in plan.beams])
+        text_col,gpf_col,dt_col = self._write(plan,"columnar")
+        text_spots,gpf_spots,dt_spots = self._write(plan,"spots")
+        self.assertEqual(text_col,text_spots)
+        print("plan with {} spots: 'columnar' engine took {}, 'spots' engine took {}".format(nspots,dt_col,dt_spots))
+
+class test_gate_pbs_field(unittest.TestCase):
+    def test_spot_store(self):
+        field = gate_pbs_field(1,None)
+        for i,energy in enumerate([146.3,143.]):
+            cpt = gate_pbs_control_point(i+1)
+            cpt.energy = energy
+            cpt.spots = [spot_info(1.*j,-2.*j,0.5+j) for j in range(i+2)]
+            field.control_points.append(cpt)
+        store = field.spot_store
+        self.assertEqual(store.nspots,5)
+        self.assertEqual(store.nlayers,2)
+        self.assertAlmostEqual(float(np.sum(store.w)),field.mswtot)
+        # the spot store is created only once
+        self.assertIs(field.spot_store,store)
 
 class test_gate_pbs_plan_reading(unittest.TestCase):
     def test_read(self):
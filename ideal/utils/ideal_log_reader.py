@@ -0,0 +1,338 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module provides an incremental reader for the global IDEAL log file, in
+which every job submission writes a short record starting with an "IdealID:"
+line. The reader remembers up to which byte the log file was processed (in a
+small state file), such that on every call only the newly appended lines are
+read and parsed. Rotation (the log file is replaced by a new file) and
+truncation of the log file are detected, in which case the new file is read
+from the start. The state is only written when the caller commits it, after
+it saved the records, such that no records are lost if the caller stops in
+between.
+"""
+
+import os
+import configparser
+from filelock import Timeout, SoftFileLock
+import logging
+logger=logging.getLogger(__name__)
+
+class ideal_log_reader(object):
+    """
+    Tail-following reader of the global IDEAL log file. Each call of
+    `read_new_records` returns the submission records (one dictionary per
+    IdealID) that were completed since the previous call. The byte offset up to
+    which the log was processed and the identity (inode) of the log file are
+    kept in `statefile` (default: the log file name with an added ".state"
+    suffix) by `commit`, so that also after a restart of the log daemon only
+    new lines are read.
+    """
+    version = "1"
+    # how many lines after the IdealID line the working directory, submission
+    # date, user settings and condor id are written in the log file
+    nw = 1
+    nd = 3
+    ns = 5
+    nc = 6
+    def __init__(self,logfilename,statefile=None,lock_timeout=3):
+        self.logfilename = logfilename
+        self.statefile = statefile if statefile else logfilename + ".state"
+        self.lock_timeout = lock_timeout
+        self.inode = None
+        self.offset = 0
+        self.last_id = 0
+        self.nlines = 0
+        self._fp = None
+        self._read_state()
+        self._committed = (self.inode,self.offset,self.last_id)
+    def read_new_records(self):
+        """
+        Read the lines that were appended to the log file since the last call
+        and return the list of the submission records that were completed in
+        those lines. A record is a dictionary with the keys 'IdealID',
+        'Work_dir', 'Submission date', 'Simulation settings' and 'Condor id'.
+        For failed submissions the date, settings and condor id are '-'.
+        A record of which not all lines have been written yet is returned by a
+        later call, when the rest of its lines have been appended.
+        The new position in the log file is only stored by `commit`.
+        """
+        self.nlines = 0
+        if not os.path.exists(self.logfilename):
+            logger.debug("IDEAL log file {} does not exist (yet)".format(self.logfilename))
+            return list()
+        lockfile = self.logfilename + '.lock'
+        lock = SoftFileLock(lockfile)
+        try:
+            with lock.acquire(timeout=self.lock_timeout):
+                records = self._read()
+        except Timeout:
+            logger.warning("failed to acquire lock file {} for {} seconds, will read new log lines later".format(lockfile,self.lock_timeout))
+            return list()
+        return records
+    def commit(self):
+        """
+        Store the position up to which the log file was read, to be called
+        after the records returned by `read_new_records` have been saved.
+        The state file is only written if the position changed.
+        """
+        state = (self.inode,self.offset,self.last_id)
+        if state != self._committed and self._write_state():
+            self._committed = state
+    def _read(self):
+        records = list()
+        st = os.stat(self.logfilename)
+        if self._fp is not None and os.fstat(self._fp.fileno()).st_ino != st.st_ino:
+            # the log file was rotated while we were following it: first
+            # process what was appended to the old file after the last call
+            logger.info("IDEAL log file {} was rotated".format(self.logfilename))
+            records += self._parse(self._fp,self.offset)
+            self._close()
+            self.offset = 0
+        elif self.inode is not None and self.inode != st.st_ino:
+            logger.info("IDEAL log file {} was replaced, reading it from the start".format(self.logfilename))
+            self.offset = 0
+        elif st.st_size < self.offset:
+            logger.info("IDEAL log file {} was truncated, reading it from the start".format(self.logfilename))
+            self.offset = 0
+        self.inode = st.st_ino
+        if st.st_size == self.offset:
+            return records
+        if self._fp is None:
+            self._fp = open(self.logfilename,'rb')
+        records += self._parse(self._fp,self.offset)
+        return records
+    def _parse(self,fp,offset):
+        """
+        Parse the complete lines from byte `offset` until the end of file.
+        The offset is moved to the end of the last complete record; lines of
+        a record that is not yet complete are read again in the next call.
+        """
+        fp.seek(offset)
+        data = fp.read()
+        end = data.rfind(b'\n')+1 # an incomplete last line is left for the next call
+        pos = offset
+        pending = None
+        records = list()
+        for raw in data[:end].splitlines(keepends=True):
+            line = raw.decode('utf-8',errors='replace')[:-1]
+            self.nlines += 1
+            tokens = line.split(" ")
+            if "IdealID:" in tokens:
+                if pending is not None:
+                    # the previous submission ended before all its lines were written
+                    records.append(self._record(*pending))
+                try:
+                    idealID = int(tokens[tokens.index("IdealID:")+1])
+                except (IndexError,ValueError):
+                    logger.warning("could not parse IdealID line in {}: '{}'".format(self.logfilename,line))
+                    pending = None
+                    pos += len(raw)
+                    continue
+                self.last_id = max(self.last_id,idealID)
+                pending = (idealID,pos,list())
+            elif pending is not None:
+                pending[2].append(line)
+                if self._is_complete(pending[2]):
+                    records.append(self._record(*pending))
+                    pending = None
+            pos += len(raw)
+        self.offset = pending[1] if pending is not None else pos
+        return records
+    @staticmethod
+    def _is_error(line):
+        return "error" in line.lower() or "NOT RUNNING" in line
+    def _is_complete(self,lines):
+        n = len(lines)
+        if n >= self.nc:
+            return True
+        # failed submissions (condor not running, or a submit error) write fewer lines
+        return any([self._is_error(l) for l in lines[self.nw:self.nd]])
+    def _record(self,idealID,pos,lines):
+        record = {'IdealID': idealID,
+                  'Work_dir': '-',
+                  'Submission date': '-',
+                  'Simulation settings': '-',
+                  'Condor id': '-'}
+        if len(lines) >= self.nw:
+            work_dir_line = lines[self.nw-1].split(" ")
+            if len(work_dir_line) > 2:
+                record['Work_dir'] = work_dir_line[2]
+        if len(lines) >= self.nc and not any([self._is_error(l) for l in lines[self.nw:self.nd]]):
+            date_line = lines[self.nd-1].split(" ")
+            record['Submission date'] = date_line[3]+" "+date_line[4]
+            record['Simulation settings'] = lines[self.ns-1]
+            record['Condor id'] = lines[self.nc-1].split(" ")[-1]
+        return record
+    def _close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+    def _read_state(self):
+        if not os.path.exists(self.statefile):
+            return
+        parser = configparser.RawConfigParser()
+        parser.optionxform = str
+        try:
+            with open(self.statefile,"r") as fp:
+                parser.read_file(fp)
+            if parser.get("reader","version",fallback="") != ideal_log_reader.version:
+                logger.debug("IDEAL log reader state {} has a different version, ignoring it".format(self.statefile))
+                return
+            self.inode = parser.getint("reader","inode")
+            self.offset = parser.getint("reader","offset")
+            self.last_id = parser.getint("reader","last id")
+        except (configparser.Error,OSError,ValueError) as e:
+            logger.warning("failed to read IDEAL log reader state {}: {}".format(self.statefile,e))
+            self.inode = None
+            self.offset = 0
+            self.last_id = 0
+    def _write_state(self):
+        parser = configparser.RawConfigParser()
+        parser.optionxform = str
+        parser.add_section("reader")
+        parser.set("reader","version",ideal_log_reader.version)
+        parser.set("reader","logfile",self.logfilename)
+        parser.set("reader","inode",str(self.inode))
+        parser.set("reader","offset",str(self.offset))
+        parser.set("reader","last id",str(self.last_id))
+        tmp = "{}.{}.tmp".format(self.statefile,os.getpid())
+        try:
+            with open(tmp,"w") as fp:
+                parser.write(fp)
+            os.replace(tmp,self.statefile)
+        except OSError as e:
+            logger.warning("could not write IDEAL log reader state {}: {}".format(self.statefile,e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+import shutil
+from datetime import datetime
+
+def _write_test_submission(fp,idealID,ok=True):
+    fp.write("IdealID: {}\n".format(idealID))
+    fp.write("Working dir: /tmp/work/job_{}/rungate.0\n".format(idealID))
+    fp.write("Condor master and scheduler OK\n")
+    if ok:
+        fp.write("Job submitted at 2022-09-19 08:12:{:02d}\n".format(idealID%60))
+        fp.write("User settings are summarized in \n")
+        fp.write("/tmp/output/job_{}/settings.cfg\n".format(idealID))
+        fp.write("Condor ID: {}\n\n".format(800+idealID))
+    else:
+        fp.write("Job submit error: return value 1\n")
+
+class Test_IdealLogReader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.tmpdir,"IDEAL_general.log")
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_incremental(self):
+        with open(self.logfile,"w") as fp:
+            _write_test_submission(fp,1)
+            _write_test_submission(fp,2,ok=False)
+        reader = ideal_log_reader(self.logfile)
+        records = reader.read_new_records()
+        self.assertEqual([r['IdealID'] for r in records],[1,2])
+        self.assertEqual(records[0]['Work_dir'],"/tmp/work/job_1/rungate.0")
+        self.assertEqual(records[0]['Submission date'],"2022-09-19 08:12:01")
+        self.assertEqual(records[0]['Simulation settings'],"/tmp/output/job_1/settings.cfg")
+        self.assertEqual(records[0]['Condor id'],"801")
+        self.assertEqual(records[1]['Work_dir'],"/tmp/work/job_2/rungate.0")
+        self.assertEqual(records[1]['Submission date'],"-")
+        self.assertEqual(records[1]['Condor id'],"-")
+        self.assertEqual(reader.read_new_records(),[])
+        self.assertEqual(reader.nlines,0)
+        # a record that is written in several pieces is returned once complete
+        with open(self.logfile,"a") as fp:
+            fp.write("IdealID: 3\nWorking dir: /tmp/work/job_3/rungate.0\nCondor master and sch")
+        self.assertEqual(reader.read_new_records(),[])
+        with open(self.logfile,"a") as fp:
+            fp.write("eduler OK\nJob submitted at 2022-09-19 09:12:57\n")
+        self.assertEqual(reader.read_new_records(),[])
+        reader.commit()
+        # a new reader continues from the stored state
+        reader = ideal_log_reader(self.logfile)
+        with open(self.logfile,"a") as fp:
+            fp.write("User settings are summarized in \n/tmp/output/job_3/settings.cfg\nCondor ID: 803\n\n")
+            # condor not running: no date, and the record ends at the next IdealID
+            fp.write("IdealID: 4\nWorking dir: /tmp/work/job_4/rungate.0\n")
+            fp.write("Condor_master or condor_schedd NOT RUNNING! Exit the program.\n")
+        records = reader.read_new_records()
+        self.assertEqual([r['IdealID'] for r in records],[3,4])
+        self.assertEqual(records[0]['Submission date'],"2022-09-19 09:12:57")
+        self.assertEqual(records[0]['Condor id'],"803")
+        self.assertEqual(records[1]['Submission date'],"-")
+        self.assertEqual(reader.last_id,4)
+        # without a commit (e.g. the caller stopped before saving the records) they are read again
+        reader = ideal_log_reader(self.logfile)
+        self.assertEqual([r['IdealID'] for r in reader.read_new_records()],[3,4])
+        reader.commit()
+        reader = ideal_log_reader(self.logfile)
+        self.assertEqual(reader.read_new_records(),[])
+        self.assertEqual(reader.last_id,4)
+        # the state does not grow with the number of records
+        with open(reader.statefile) as fp:
+            self.assertEqual(len(fp.read().splitlines()),7)
+    def test_rotation_and_truncation(self):
+        with open(self.logfile,"w") as fp:
+            for i in range(1,4):
+                _write_test_submission(fp,i)
+        reader = ideal_log_reader(self.logfile)
+        self.assertEqual([r['IdealID'] for r in reader.read_new_records()],[1,2,3])
+        # rotation: lines appended to the old file are still read, then the new file from the start
+        with open(self.logfile,"a") as fp:
+            _write_test_submission(fp,4)
+        os.rename(self.logfile,self.logfile+".1")
+        with open(self.logfile,"w") as fp:
+            _write_test_submission(fp,5)
+        self.assertEqual([r['IdealID'] for r in reader.read_new_records()],[4,5])
+        reader.commit()
+        # rotation while the daemon was not running: new file is read from the start
+        reader = ideal_log_reader(self.logfile)
+        os.rename(self.logfile,self.logfile+".2")
+        with open(self.logfile,"w") as fp:
+            _write_test_submission(fp,6)
+        self.assertEqual([r['IdealID'] for r in reader.read_new_records()],[6])
+        # truncation
+        with open(self.logfile,"w") as fp:
+            _write_test_submission(fp,7,ok=False)
+        self.assertEqual([r['IdealID'] for r in reader.read_new_records()],[7])
+        self.assertEqual(reader.last_id,7)
+    def test_large_log(self):
+        # the cost of a cycle should only depend on the number of new lines
+        print("Test_IdealLogReader test_large_log")
+        with open(self.logfile,"w") as fp:
+            for i in range(1,50001):
+                _write_test_submission(fp,i)
+        reader = ideal_log_reader(self.logfile)
+        t0 = datetime.now()
+        self.assertEqual(len(reader.read_new_records()),50000)
+        t1 = datetime.now()
+        nlines_all = reader.nlines
+        reader.commit()
+        with open(self.logfile,"a") as fp:
+            for i in range(50001,50011):
+                _write_test_submission(fp,i)
+        reader = ideal_log_reader(self.logfile)
+        t2 = datetime.now()
+        records = reader.read_new_records()
+        t3 = datetime.now()
+        self.assertEqual([r['IdealID'] for r in records],list(range(50001,50011)))
+        self.assertEqual(reader.nlines,80)
+        print("reading {} log lines took {}, reading 80 new lines took {}".format(nlines_all,t1-t0,t3-t2))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
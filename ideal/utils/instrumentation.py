@@ -0,0 +1,345 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module provides timers and resource counters for the stages of an IDEAL
+job (executor, PRE, daemon, POST). A "span" measures the wall clock time, CPU
+time, peak resident memory and I/O bytes of a piece of code; it is used as a
+context manager or (via `timed`) as a decorator:
+
+    with instrumentation.span("resampling",beam=beamname) as s:
+        ...
+    logger.debug("resampling took {} seconds".format(s.wall))
+
+Spans of the same process are nested: the name of a span within another span
+is the path "outer/inner". Each finished span is appended as one JSON line to
+the metrics file of the job (`ideal_metrics.jsonl` in the work directory of
+the job), once the process has called `start_job_metrics`. Without metrics
+file, the spans are measured but not recorded.
+
+The `summarize_jobs` function computes percentiles of the span metrics over
+many jobs, see also `bin/query_job_metrics.py`.
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+import functools
+from glob import glob
+from datetime import datetime
+import numpy as np
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+import logging
+logger=logging.getLogger(__name__)
+
+METRICS_FILENAME = "ideal_metrics.jsonl"
+STAGES = ["EXECUTOR","PRE","DAEMON","POST"]
+
+def _ideal_version():
+    try:
+        from impl.version import tag
+        return tag
+    except ImportError:
+        return ""
+
+def resource_usage():
+    """
+    Current resource usage of this process: CPU time (seconds), peak resident
+    memory (MB) and the number of bytes read from and written to storage (if
+    the operating system provides the /proc/self/io counters, otherwise None).
+    """
+    usage = dict(cpu=time.process_time(),peak_rss_mb=None,read_bytes=None,write_bytes=None)
+    if resource is not None:
+        # ru_maxrss is in kB on Linux
+        usage["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+    try:
+        with open("/proc/self/io","r") as fp:
+            counters = dict([line.split(":") for line in fp if ":" in line])
+        usage["read_bytes"] = int(counters["read_bytes"])
+        usage["write_bytes"] = int(counters["write_bytes"])
+    except (OSError,KeyError,ValueError):
+        pass
+    return usage
+
+class span(object):
+    """
+    Measurement of a named piece of code in a job stage. The results are
+    available after the span has finished: `wall` and `cpu` (seconds),
+    `peak_rss_mb` (peak resident memory of the process, until the end of the
+    span), `read_bytes` and `write_bytes` (I/O during the span) and `ok`
+    (False if the span was left with an exception, or if the code in the
+    span set `ok` to False to mark a failure that was handled).
+    """
+    _stack = threading.local()
+    def __init__(self,name,metrics=None,**attrs):
+        self.name = name
+        self.metrics = metrics
+        self.attrs = attrs
+        self.path = name
+        self.wall = None
+        self.cpu = None
+        self.peak_rss_mb = None
+        self.read_bytes = None
+        self.write_bytes = None
+        self.ok = None
+    def __enter__(self):
+        stack = span._stack.__dict__.setdefault("spans",[])
+        if stack:
+            self.path = stack[-1].path + "/" + self.name
+        stack.append(self)
+        self.start = datetime.now()
+        self._usage0 = resource_usage()
+        self._t0 = time.perf_counter()
+        return self
+    def __exit__(self,exc_type,exc_value,tb):
+        self.wall = time.perf_counter()-self._t0
+        usage = resource_usage()
+        self.cpu = usage["cpu"]-self._usage0["cpu"]
+        self.peak_rss_mb = usage["peak_rss_mb"]
+        for k in ["read_bytes","write_bytes"]:
+            if usage[k] is not None and self._usage0[k] is not None:
+                setattr(self,k,usage[k]-self._usage0[k])
+        self.ok = exc_type is None and self.ok is not False
+        span._stack.spans.remove(self)
+        metrics = self.metrics if self.metrics is not None else _current
+        metrics.record(self)
+        return False
+    def as_dict(self):
+        return dict(span=self.path,start=self.start.isoformat(timespec="milliseconds"),
+                    wall=self.wall,cpu=self.cpu,peak_rss_mb=self.peak_rss_mb,
+                    read_bytes=self.read_bytes,write_bytes=self.write_bytes,
+                    ok=self.ok,attrs=self.attrs)
+
+class job_metrics(object):
+    """
+    Recorder of the spans of job stage `stage` in the metrics file `path`.
+    The records are appended, one JSON line per span, such that the stages
+    (separate processes) of a job can write to the same file. With an empty
+    path the spans are not recorded.
+    """
+    def __init__(self,path,stage):
+        self.path = path
+        self.stage = stage
+        self._info = dict(stage=stage,pid=os.getpid(),host=socket.gethostname(),version=_ideal_version())
+    def span(self,name,**attrs):
+        return span(name,self,**attrs)
+    def timed(self,name=None):
+        """
+        Decorator that runs the decorated function in a span (by default named after the function).
+        """
+        return _timed(name,lambda : self)
+    def record(self,s):
+        if not self.path:
+            return
+        rec = dict(self._info)
+        rec.update(s.as_dict())
+        try:
+            # a single write of one line, such that concurrent writers do not mix their lines
+            with open(self.path,"a") as fp:
+                fp.write(json.dumps(rec)+"\n")
+        except OSError as e:
+            # instrumentation should never break a job
+            logger.warning("could not write metrics to {}: {}".format(self.path,e))
+
+def _timed(name,get_metrics):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with get_metrics().span(name or func.__name__):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorator
+
+_current = job_metrics("","")
+
+def get_job_metrics(workdir,stage):
+    """
+    Recorder for stage `stage` in the metrics file of the job with work
+    directory `workdir`, for processes that run several jobs (e.g. the
+    executor, in the GUI or API server); its spans are created with its
+    `span` method.
+    """
+    return job_metrics(os.path.join(workdir,METRICS_FILENAME),stage)
+
+def start_job_metrics(workdir,stage):
+    """
+    Record the spans of this process (see `span` and `timed`) as stage `stage`
+    in the metrics file of the job with work directory `workdir`.
+    """
+    global _current
+    _current = get_job_metrics(workdir,stage)
+    logger.debug("recording {} metrics in {}".format(stage,_current.path))
+    return _current
+
+def stop_job_metrics():
+    global _current
+    _current = job_metrics("","")
+
+def current_job_metrics():
+    return _current
+
+def timed(name=None):
+    """
+    Decorator that runs the decorated function in a span of the job metrics
+    of this process (by default the span is named after the function).
+    """
+    return _timed(name,current_job_metrics)
+
+def read_job_metrics(path):
+    """
+    Span records in metrics file `path`; lines that cannot be parsed (e.g. a
+    line that was being written while the job was killed) are skipped.
+    """
+    records = list()
+    with open(path,"r") as fp:
+        for line in fp:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.debug("skipping bad line in {}".format(path))
+    return records
+
+def find_job_metrics_files(path):
+    """
+    Metrics files in `path`, which can be a work directory, a job directory
+    or a directory with job directories (such as the 'tmpdir jobs' directory).
+    """
+    patterns = [[METRICS_FILENAME],["rungate.*",METRICS_FILENAME],["*","rungate.*",METRICS_FILENAME]]
+    return sorted(sum([glob(os.path.join(path,*pattern)) for pattern in patterns],[]))
+
+def job_completed(records):
+    """
+    A job is completed if the postprocessing finished successfully.
+    """
+    return any(r.get("stage")=="POST" and r.get("span")=="postprocessing" and r.get("ok") for r in records)
+
+def job_totals(records):
+    """
+    Metrics per (stage, span) of one job: wall and CPU time and I/O bytes are
+    summed over all occurrences of the span (e.g. for all beams or polls),
+    for the peak memory the maximum is taken.
+    """
+    totals = dict()
+    for r in records:
+        key = (r.get("stage",""),r.get("span",""))
+        t = totals.setdefault(key,dict(count=0,wall=None,cpu=None,peak_rss_mb=None,read_bytes=None,write_bytes=None))
+        t["count"] += 1
+        for k in ["wall","cpu","read_bytes","write_bytes"]:
+            if r.get(k) is not None:
+                t[k] = (t[k] or 0) + r[k]
+        if r.get("peak_rss_mb") is not None:
+            t["peak_rss_mb"] = max(t["peak_rss_mb"] or 0.,r["peak_rss_mb"])
+    return totals
+
+def summarize_jobs(jobs,percentiles=(50,90,95),quantities=("wall","cpu","peak_rss_mb","read_bytes","write_bytes"),group_by=None):
+    """
+    Percentiles over jobs of the per-job span totals (see `job_totals`).
+    `jobs` is a dictionary with a list of span records for each job. If a
+    record key `group_by` is given (e.g. 'version' or 'host'), the jobs are
+    grouped by the value of that key in their first record.
+
+    Returns a dictionary {group: {(stage,span): {"njobs": n, quantity: {"p50": ...}}}},
+    the group is None if `group_by` is None.
+    """
+    grouped = dict()
+    for records in jobs.values():
+        if not records:
+            continue
+        group = records[0].get(group_by) if group_by else None
+        for key,t in job_totals(records).items():
+            grouped.setdefault(group,dict()).setdefault(key,list()).append(t)
+    summary = dict()
+    for group,spans in grouped.items():
+        summary[group] = dict()
+        for key,totals in sorted(spans.items(),key=lambda kv : (STAGES.index(kv[0][0]) if kv[0][0] in STAGES else len(STAGES),kv[0][1])):
+            stats = dict(njobs=len(totals))
+            for q in quantities:
+                values = np.array([t[q] for t in totals if t[q] is not None],dtype=float)
+                if len(values):
+                    stats[q] = dict([("p{:g}".format(p),float(v)) for p,v in zip(percentiles,np.percentile(values,percentiles))])
+            summary[group][key] = stats
+    return summary
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+
+class Test_Instrumentation(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    def tearDown(self):
+        stop_job_metrics()
+        import shutil
+        shutil.rmtree(self.tmpdir)
+    def test_span_measures(self):
+        with span("sleep") as s:
+            time.sleep(0.05)
+            blob = bytearray(20*1024*1024)
+        self.assertTrue(s.ok)
+        self.assertGreaterEqual(s.wall,0.05)
+        self.assertGreaterEqual(s.cpu,0.)
+        if resource is not None:
+            self.assertGreater(s.peak_rss_mb,20.)
+        del blob
+    def test_recording_and_nesting(self):
+        m = start_job_metrics(self.tmpdir,"POST")
+        @timed()
+        def inner():
+            return 42
+        with span("postprocessing"):
+            with span("beam",beam="F1"):
+                self.assertEqual(inner(),42)
+            with span("beam",beam="F2") as s:
+                s.ok = False
+        with self.assertRaises(ValueError):
+            with span("failing"):
+                raise ValueError("oops")
+        records = read_job_metrics(m.path)
+        self.assertEqual([r["span"] for r in records],["postprocessing/beam/inner","postprocessing/beam","postprocessing/beam","postprocessing","failing"])
+        self.assertTrue(all(r["stage"]=="POST" for r in records))
+        self.assertEqual(records[1]["attrs"],{"beam":"F1"})
+        self.assertEqual([r["ok"] for r in records],[True,True,False,True,False])
+        self.assertTrue(job_completed(records))
+        stop_job_metrics()
+        with span("not recorded"):
+            pass
+        self.assertEqual(len(read_job_metrics(m.path)),5)
+    def test_summary(self):
+        jobs = dict()
+        for i in range(1,11):
+            workdir = os.path.join(self.tmpdir,"job{}".format(i),"rungate.0")
+            os.makedirs(workdir)
+            with open(os.path.join(workdir,METRICS_FILENAME),"w") as fp:
+                for stage,name,wall in [("PRE","preprocessing",i),("POST","beam",i),("POST","beam",i),("POST","postprocessing",3*i)]:
+                    fp.write(json.dumps(dict(stage=stage,span=name,wall=float(wall),cpu=None,peak_rss_mb=10.*i,ok=True,version="1.1" if i<6 else "1.2"))+"\n")
+                fp.write("{truncated\n")
+        for path in find_job_metrics_files(self.tmpdir):
+            jobs[path] = read_job_metrics(path)
+        self.assertEqual(len(jobs),10)
+        self.assertTrue(all(job_completed(r) for r in jobs.values()))
+        summary = summarize_jobs(jobs,percentiles=(50,100))[None]
+        self.assertEqual(list(summary.keys()),[("PRE","preprocessing"),("POST","beam"),("POST","postprocessing")])
+        self.assertEqual(summary[("PRE","preprocessing")]["njobs"],10)
+        self.assertAlmostEqual(summary[("PRE","preprocessing")]["wall"]["p50"],5.5)
+        self.assertAlmostEqual(summary[("POST","beam")]["wall"]["p100"],20.)
+        self.assertAlmostEqual(summary[("POST","postprocessing")]["peak_rss_mb"]["p100"],100.)
+        self.assertNotIn("cpu",summary[("POST","beam")])
+        by_version = summarize_jobs(jobs,percentiles=(50,),group_by="version")
+        self.assertEqual(sorted(by_version.keys()),["1.1","1.2"])
+        self.assertAlmostEqual(by_version["1.1"][("PRE","preprocessing")]["wall"]["p50"],3.)
+        self.assertAlmostEqual(by_version["1.2"][("PRE","preprocessing")]["wall"]["p50"],8.)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -0,0 +1,269 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module provides functions to read the outputs of the Gate subjobs of a
+beam (dose MHD file, statistics actor file, exit value) and to sum the dose
+distributions. The dose files are read by a bounded pool of worker threads and
+accumulated (in the order of the given list of files) into a single
+preallocated buffer; the statistics are collected in the same pass.
+"""
+
+import os, re
+import itk
+import numpy as np
+from glob import glob
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger=logging.getLogger(__name__)
+
+def get_job_stats(mhd):
+    """
+    This function assumes that each output directory contains the output of
+    exactly one GATE run, with one dose actor output (mhd file) and one stat
+    actor output (txt file).
+    """
+    stats=glob(os.path.join(os.path.dirname(mhd),"stat*.txt"))
+    gate_exit_value_txt=glob(os.path.join(os.path.dirname(mhd),"gate_exit_value.txt"))
+    logger.debug("stat files: {}".format("\n".join(stats)))
+    if not 1 == len(stats):
+        raise RuntimeError("cannot retrieve number of primaries for {}".format(mhd) + \
+                           "got {} associated stat actor files: {}".format(len(stats),"\n".join(stats)))
+    if not 1 == len(gate_exit_value_txt):
+        raise RuntimeError("cannot retrieve gate exit value for {}".format(mhd))
+    gate_exit_value=0
+    with open(gate_exit_value_txt[0],"r") as gev:
+        line=gev.readline()
+        gate_exit_value=int(line.strip())
+    statfilepath=stats[0]
+    stats_dict={"StatsFile":statfilepath}
+    hash_key_val=re.compile(r'^#\s*(\b.*\S)\s*=\s*(\b.*\b)\s*$')
+    with open(statfilepath,"r") as sf:
+        stats_dict.update(dict([hash_key_val.search(line).groups() for line in sf if hash_key_val.search(line) is not None ]))
+        n = int(stats_dict.get('NumberOfEvents',-1))
+        if n>=0:
+            logger.info("{} got {} primaries".format(mhd,n))
+            return stats_dict,gate_exit_value
+    raise RuntimeError("N primaries not found for {}".format(mhd))
+
+_met_types = {"MET_FLOAT":np.float32, "MET_DOUBLE":np.float64,
+              "MET_SHORT":np.int16, "MET_USHORT":np.uint16,
+              "MET_INT":np.int32, "MET_UINT":np.uint32,
+              "MET_CHAR":np.int8, "MET_UCHAR":np.uint8}
+
+def read_mhd(mhd):
+    """
+    Read a 3D MHD image, return a tuple (array,origin,spacing) with the voxel
+    values (numpy array with index order z,y,x) and the origin and spacing
+    (numpy arrays with x,y,z order).
+
+    Uncompressed images with the data in a single raw file (like Gate writes
+    them) are read directly with numpy, other images are read with ITK.
+    """
+    header=dict()
+    with open(mhd,"r") as fp:
+        for line in fp:
+            if "=" in line:
+                k,v = line.split("=",1)
+                header[k.strip()] = v.strip()
+    rawfile = header.get("ElementDataFile","")
+    simple = header.get("NDims","") == "3" and \
+             header.get("BinaryData","True").lower() == "true" and \
+             header.get("CompressedData","False").lower() == "false" and \
+             header.get("ElementNumberOfChannels","1") == "1" and \
+             header.get("HeaderSize","0") == "0" and \
+             header.get("ElementType","") in _met_types and \
+             rawfile not in ("","LOCAL","LIST") and len(rawfile.split())==1
+    if simple:
+        dims = [int(v) for v in header["DimSize"].split()]
+        msb = header.get("BinaryDataByteOrderMSB",header.get("ElementByteOrderMSB","False")).lower() == "true"
+        dtype = np.dtype(_met_types[header["ElementType"]]).newbyteorder(">" if msb else "<")
+        origin = np.array([float(v) for v in header.get("Offset",header.get("Origin","0 0 0")).split()])
+        spacing = np.array([float(v) for v in header.get("ElementSpacing","1 1 1").split()])
+        a = np.fromfile(os.path.join(os.path.dirname(mhd),rawfile),dtype=dtype)
+        if a.size != np.prod(dims):
+            raise RuntimeError("raw data file for {} has {} values, expected {}".format(mhd,a.size,np.prod(dims)))
+        return a.reshape(dims[::-1]).astype(dtype.newbyteorder("="),copy=False),origin,spacing
+    logger.debug("{} is not a simple uncompressed MHD file, reading it with ITK".format(mhd))
+    img = itk.imread(mhd)
+    return itk.array_from_image(img),np.array(img.GetOrigin()),np.array(img.GetSpacing())
+
+class job_output_sum(object):
+    """
+    Sum of the dose distributions and statistics of the Gate subjobs of a beam.
+    The `dose` attribute is an ITK image, or None if no dose file could be read.
+    """
+    def __init__(self):
+        self.dose = None
+        self.nMC = 0
+        self.nBADretval = 0
+        self.nBADzeronmc = 0
+        self.nfailed = 0
+        self.nsummed = 0
+        self.tCPUbrutto = 0.
+        self.tCPUnetto = 0.
+        self.statfiles = list()
+        self.nbytes = 0
+        self.tread = 0.
+
+def _read_job_output(mhd):
+    """
+    Read the dose and statistics of one subjob. Exceptions are returned (not
+    raised), such that a failed subjob does not stop the summation.
+    """
+    t0 = datetime.now()
+    try:
+        adose,origin,spacing = read_mhd(mhd)
+        statdict,retval = get_job_stats(mhd)
+    except Exception as e:
+        return mhd,e,None,None,None,None
+    dt = (datetime.now()-t0).total_seconds()
+    return mhd,(adose,origin,spacing),statdict,retval,adose.nbytes,dt
+
+def sum_job_outputs(mhdlist,nworkers=4):
+    """
+    Sum the doses and the statistics of the subjob outputs in `mhdlist`.
+    At most `nworkers` dose files are read (and kept in memory) at the same
+    time. The doses are added in the order of `mhdlist` into a preallocated
+    buffer with the data type of the first dose image, so the result does not
+    depend on the number of workers. Subjobs with a nonzero Gate exit value,
+    zero primaries or a geometry that differs from the first dose are skipped.
+    Returns a `job_output_sum` object.
+    """
+    result = job_output_sum()
+    adose = None
+    t0 = datetime.now()
+    with ThreadPoolExecutor(max_workers=max(1,nworkers)) as pool:
+        # bounded window of submitted reads, results are consumed in order
+        pending = [pool.submit(_read_job_output,mhd) for mhd in mhdlist[:max(1,nworkers)]]
+        inext = len(pending)
+        while pending:
+            mhd,data,statdict,retval,nbytes,dt = pending.pop(0).result()
+            if inext < len(mhdlist):
+                pending.append(pool.submit(_read_job_output,mhdlist[inext]))
+                inext += 1
+            if isinstance(data,Exception):
+                result.nfailed += 1
+                logger.error("something went wrong while processing {}: {}".format(mhd,data))
+                continue
+            result.statfiles.append(statdict['StatsFile'])
+            result.nbytes += nbytes
+            result.tread += dt
+            logger.debug("read {} ({:.1f} MB) in {:.3f} seconds ({:.1f} MB/s)".format(mhd,nbytes/1024.**2,dt,nbytes/1024.**2/max(dt,1e-9)))
+            nMCjob = int(statdict['NumberOfEvents'])
+            logger.debug("adding dose from {} primaries, Gate return value was {}".format(nMCjob,retval))
+            # FIXME: such errors should be reported in the final result
+            if retval != 0:
+                result.nBADretval += 1
+                logger.error("return value {} means that something went WRONG, Gate did not terminate normally, skipping {}".format(retval,mhd))
+                continue
+            elif nMCjob <= 0:
+                result.nBADzeronmc += 1
+                logger.error("ZERO ({}) primaries from mhd={}".format(nMCjob,mhd))
+                continue
+            a,origin,spacing = data
+            if adose is None:
+                adose = np.empty_like(a)
+                adose[:] = a
+                origin0,spacing0 = origin,spacing
+                result.nsummed += 1
+            elif a.shape != adose.shape or not np.allclose(origin,origin0) or not np.allclose(spacing,spacing0):
+                result.nfailed += 1
+                logger.error("geometry of {} (size {}, origin {}, spacing {}) does not match the first dose (size {}, origin {}, spacing {})".format(
+                    mhd,a.shape[::-1],origin,spacing,adose.shape[::-1],origin0,spacing0))
+                continue
+            else:
+                adose += a
+                result.nsummed += 1
+            result.nMC += nMCjob
+            result.tCPUbrutto += float(statdict['ElapsedTime'])
+            result.tCPUnetto += float(statdict['ElapsedTimeWoInit'])
+    dt = (datetime.now()-t0).total_seconds()
+    MB = result.nbytes/1024.**2
+    logger.info("summed {} out of {} dose files ({:.1f} MB) in {:.3f} seconds with {} worker(s): {:.1f} MB/s, {:.3f} seconds per file on average".format(
+        result.nsummed,len(mhdlist),MB,dt,nworkers,MB/max(dt,1e-9),result.tread/max(1,len(result.statfiles))))
+    if adose is not None:
+        result.dose = itk.image_from_array(adose)
+        result.dose.SetOrigin(origin0)
+        result.dose.SetSpacing(spacing0)
+    return result
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import tempfile
+import shutil
+
+class Test_SumJobOutputs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        np.random.seed(2024)
+        self.mhdlist = list()
+        self.adoses = list()
+        for i in range(7):
+            outdir = os.path.join(self.tmpdir,"output.{}".format(i))
+            os.mkdir(outdir)
+            adose = np.random.exponential(1.,(12,15,17)).astype(np.float32)
+            dose = itk.image_from_array(adose)
+            dose.SetOrigin((-1.,2.,3.5))
+            dose.SetSpacing((1.,2.,2.5))
+            mhd = os.path.join(outdir,"idc-Dose.mhd")
+            itk.imwrite(dose,mhd)
+            with open(os.path.join(outdir,"gate_exit_value.txt"),"w") as fp:
+                fp.write("{}\n".format(1 if i==5 else 0))
+            with open(os.path.join(outdir,"statistics.txt"),"w") as fp:
+                fp.write("# NumberOfRun    = 1\n")
+                fp.write("# NumberOfEvents = {}\n".format(1000*(i+1)))
+                fp.write("# ElapsedTime    = {}\n".format(10.+i))
+                fp.write("# ElapsedTimeWoInit = {}\n".format(8.+i))
+            self.mhdlist.append(mhd)
+            self.adoses.append(adose)
+        # subjob 6 has no stat file
+        os.remove(os.path.join(self.tmpdir,"output.6","statistics.txt"))
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_read_mhd(self):
+        a,origin,spacing = read_mhd(self.mhdlist[0])
+        self.assertTrue(np.array_equal(a,self.adoses[0]))
+        self.assertTrue(np.allclose(origin,(-1.,2.,3.5)))
+        self.assertTrue(np.allclose(spacing,(1.,2.,2.5)))
+        # compressed file: read with ITK
+        mhdz = os.path.join(self.tmpdir,"compressed.mhd")
+        itk.imwrite(itk.imread(self.mhdlist[0]),mhdz,compression=True)
+        az,originz,spacingz = read_mhd(mhdz)
+        self.assertTrue(np.array_equal(az,self.adoses[0]))
+    def test_sum(self):
+        # serial reference sum, like the POST script did before
+        expected = np.array(self.adoses[0])
+        for i in range(1,5):
+            expected += self.adoses[i]
+        # subjob with a different geometry: skipped
+        outdir = os.path.join(self.tmpdir,"output.7")
+        shutil.copytree(os.path.join(self.tmpdir,"output.0"),outdir)
+        itk.imwrite(itk.image_from_array(self.adoses[0][1:].copy()),os.path.join(outdir,"idc-Dose.mhd"))
+        mhdlist = self.mhdlist+[os.path.join(outdir,"idc-Dose.mhd")]
+        for nworkers in [1,3,8]:
+            result = sum_job_outputs(mhdlist,nworkers=nworkers)
+            self.assertTrue(np.array_equal(itk.array_view_from_image(result.dose),expected))
+            self.assertTrue(np.allclose(result.dose.GetSpacing(),(1.,2.,2.5)))
+            self.assertEqual(result.nMC,15000)
+            self.assertEqual(result.nBADretval,1)
+            self.assertEqual(result.nBADzeronmc,0)
+            self.assertEqual(result.nfailed,2)
+            self.assertEqual(result.nsummed,5)
+            self.assertEqual(len(result.statfiles),7)
+            self.assertAlmostEqual(result.tCPUbrutto,60.)
+            self.assertAlmostEqual(result.tCPUnetto,50.)
+    def test_nothing(self):
+        result = sum_job_outputs(self.mhdlist[5:])
+        self.assertIsNone(result.dose)
+        self.assertEqual(result.nMC,0)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
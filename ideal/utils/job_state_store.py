@@ -0,0 +1,379 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module provides a job state store for the log daemon and the API, in an
+sqlite database (in WAL mode, so that readers do not block the writer). Each
+job is one row, with the IDEAL ID as primary key and indexed columns for the
+job ID (the name of the job directory), the IDEAL status, the condor status
+and the submission date. The complete set of fields of a job, as it appears in
+the history cfg file of the log daemon, is kept with the row.
+
+Updating the state of one job touches one row only, so it takes the same time
+no matter how many jobs are in the history. The store can be exported to (and
+imported from) the configparser layout of the history cfg file. Field names
+are stored with the case used by the log daemon ('Work_dir', 'Status', ...),
+also when they are read from a history file in which configparser lowercased
+them.
+"""
+
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+import configparser
+import logging
+logger=logging.getLogger(__name__)
+
+# names of the job fields in the history cfg file, with their canonical case
+FIELD_NAMES = ['Submission date','Work_dir','Simulation settings','Status','Condor id','Condor status',
+               'Job control daemon','On hold since','Last checked','results uploaded']
+_canonical_names = dict([(name.lower(),name) for name in FIELD_NAMES])
+
+def canonical_fields(fields):
+    """
+    Copy of the job `fields` with string keys and values, in which the known
+    field names have their canonical case.
+    """
+    return dict([(_canonical_names.get(str(k).lower(),str(k)),str(v)) for k,v in fields.items()])
+
+def get_job_state_db(paths):
+    """
+    Path of the job state database, from the [Paths] section of the log daemon
+    configuration: the 'job_state_db' option, or by default the history cfg
+    file name with a '.sqlite' suffix.
+    """
+    return paths.get('job_state_db',fallback='') or paths['cfg_log_file'] + '.sqlite'
+
+def job_id_from_workdir(workdir):
+    """
+    The job ID is the name of the job directory, which contains the rungate.* work directory.
+    """
+    return workdir.rstrip('/').split('/')[-2] if workdir.count('/') > 1 else ''
+
+class job_state_store(object):
+    """
+    Job states in sqlite database `dbfile`. The fields of a job are given and
+    returned as dictionaries with the same keys as the sections of the log
+    daemon history file ('Submission date', 'Work_dir', 'Status', 'Condor
+    id', 'Condor status', ...).
+    """
+    version = 1
+    def __init__(self,dbfile,timeout=30.):
+        self.dbfile = dbfile
+        self._lock = threading.Lock()
+        # autocommit mode, transactions are started explicitly
+        self._db = sqlite3.connect(dbfile,timeout=timeout,isolation_level=None,check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction() as c:
+            c.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                             ideal_id INTEGER PRIMARY KEY,
+                             job_id TEXT NOT NULL,
+                             submission_date TEXT NOT NULL,
+                             status TEXT NOT NULL,
+                             condor_status TEXT NOT NULL,
+                             fields TEXT NOT NULL)""")
+            c.execute("CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs (job_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            c.execute("CREATE INDEX IF NOT EXISTS jobs_condor_status ON jobs (condor_status)")
+            c.execute("CREATE INDEX IF NOT EXISTS jobs_submission_date ON jobs (submission_date)")
+            c.execute("PRAGMA user_version")
+            v = c.fetchone()[0]
+            if v == 0:
+                c.execute("PRAGMA user_version={}".format(self.version))
+            elif v != self.version:
+                raise RuntimeError("job state database {} has version {}, expected {}".format(dbfile,v,self.version))
+    def close(self):
+        self._db.close()
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            c = self._db.cursor()
+            # take the write lock right away, so that read-check-write sequences are atomic
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                yield c
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+    @staticmethod
+    def _row(ideal_id,fields):
+        fields = canonical_fields(fields)
+        return (int(ideal_id),
+                job_id_from_workdir(fields.get('Work_dir','')),
+                fields.get('Submission date','-'),
+                fields.get('Status',''),
+                fields.get('Condor status',''),
+                json.dumps(fields))
+    def add_job(self,ideal_id,fields):
+        """
+        Add (or replace) the job with IDEAL ID `ideal_id` and fields `fields`.
+        """
+        with self._transaction() as c:
+            c.execute("INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?)",self._row(ideal_id,fields))
+    def add_jobs(self,jobs):
+        """
+        Add (or replace) several jobs, given as (ideal_id,fields) pairs, in one transaction.
+        """
+        with self._transaction() as c:
+            c.executemany("INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?)",[self._row(i,f) for i,f in jobs])
+    def get(self,ideal_id):
+        """
+        Fields of job `ideal_id`, or None if there is no such job.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT fields FROM jobs WHERE ideal_id=?",(int(ideal_id),)).fetchone()
+        return None if row is None else json.loads(row[0])
+    def update(self,ideal_id,changes,expected=None):
+        """
+        Apply the field changes (dictionary) to job `ideal_id`, atomically. If
+        `expected` is a dictionary, the changes are only applied if the current
+        values of these fields are as expected. Returns True if the job was
+        updated, False if the job does not exist or has unexpected values.
+        """
+        with self._transaction() as c:
+            row = c.execute("SELECT fields FROM jobs WHERE ideal_id=?",(int(ideal_id),)).fetchone()
+            if row is None:
+                return False
+            fields = json.loads(row[0])
+            if expected and any(fields.get(k) != v for k,v in expected.items()):
+                return False
+            fields.update(canonical_fields(changes))
+            c.execute("UPDATE jobs SET job_id=?,submission_date=?,status=?,condor_status=?,fields=? WHERE ideal_id=?",self._row(ideal_id,fields)[1:]+(int(ideal_id),))
+        return True
+    def transition(self,ideal_id,status,expected_status=None,changes=dict()):
+        """
+        Set the IDEAL status of job `ideal_id` to `status` (and apply other
+        field `changes`), but only if the current status is `expected_status`
+        (if given). Returns True if the transition was made.
+        """
+        new = dict(changes)
+        new['Status'] = status
+        expected = None if expected_status is None else {'Status':expected_status}
+        return self.update(ideal_id,new,expected)
+    def last_id(self):
+        """
+        Highest IDEAL ID in the store, 0 if the store is empty.
+        """
+        with self._lock:
+            return self._db.execute("SELECT MAX(ideal_id) FROM jobs").fetchone()[0] or 0
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+    def find(self,job_id=None,status=None,condor_status=None,not_status=None,since=None,until=None,limit=None,newest_first=False):
+        """
+        List of (ideal_id,fields) for the jobs with the given job ID, IDEAL
+        status, condor status, not having IDEAL status `not_status` and a
+        submission date in [`since`,`until`) (strings in the format
+        "YYYY-mm-dd HH:MM:SS"), ordered by IDEAL ID. At most `limit` jobs are
+        returned, the newest ones first if `newest_first` is True.
+        """
+        where = list()
+        values = list()
+        for column,value in [("job_id",job_id),("status",status),("condor_status",condor_status)]:
+            if value is not None:
+                where.append("{}=?".format(column))
+                values.append(value)
+        if not_status is not None:
+            where.append("status!=?")
+            values.append(not_status)
+        if since is not None:
+            where.append("submission_date>=?")
+            values.append(since)
+        if until is not None:
+            where.append("submission_date<?")
+            values.append(until)
+        query = "SELECT ideal_id,fields FROM jobs"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY ideal_id" + (" DESC" if newest_first else "")
+        if limit is not None:
+            query += " LIMIT ?"
+            values.append(int(limit))
+        with self._lock:
+            rows = self._db.execute(query,values).fetchall()
+        return [(ideal_id,json.loads(fields)) for ideal_id,fields in rows]
+    def load_sections(self,not_status=None):
+        """
+        Configparser with one section per job not having IDEAL status
+        `not_status`, for the log daemon. The field names keep their case.
+        """
+        parser = configparser.ConfigParser()
+        parser.optionxform = str
+        for ideal_id,fields in self.find(not_status=not_status):
+            parser[str(ideal_id)] = fields
+        return parser
+    def save_sections(self,parser,loaded):
+        """
+        Store the sections of `parser` that are new or differ from the fields
+        in `loaded` (dictionary of the fields per section name, as they were
+        loaded), one row per job. Returns the list of the saved section names.
+        """
+        saved = list()
+        for i in parser.sections():
+            fields = dict(parser[i])
+            if i not in loaded:
+                self.add_job(i,fields)
+            elif fields != loaded[i]:
+                self.update(i,fields)
+            else:
+                continue
+            saved.append(i)
+        return saved
+    def export_cfg(self,fname):
+        """
+        Write all jobs to `fname` in the layout of the log daemon history
+        file (one section per IDEAL ID). The file is replaced atomically.
+        """
+        parser = configparser.ConfigParser()
+        for ideal_id,fields in self.find():
+            parser[str(ideal_id)] = fields
+        fd,tmpf = tempfile.mkstemp(prefix=".tmp.",dir=os.path.dirname(os.path.abspath(fname)))
+        with os.fdopen(fd,"w") as fp:
+            parser.write(fp)
+        os.replace(tmpf,fname)
+    def import_cfg(self,fname):
+        """
+        Add all jobs from a log daemon history file `fname`. Returns the number of jobs.
+        """
+        parser = configparser.ConfigParser()
+        with open(fname,"r") as fp:
+            parser.read_file(fp)
+        jobs = [(int(s),dict(parser[s])) for s in parser.sections()]
+        self.add_jobs(jobs)
+        logger.info("imported {} jobs from {} into {}".format(len(jobs),fname,self.dbfile))
+        return len(jobs)
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import shutil
+from datetime import datetime
+
+def _test_fields(i,status='FINISHED',condor_status='DONE'):
+    return {'Submission date':'2024-03-{:02d} 10:{:02d}:00'.format(1+i%28,i%60),
+            'Work_dir':'/data/work/user_pat{}_2024_03_01_10_00_00/rungate.{}'.format(i,i),
+            'Simulation settings':'/data/output/user_pat{}/settings.cfg'.format(i),
+            'Status':status,
+            'Condor id':str(1000+i),
+            'Condor status':condor_status,
+            'Job control daemon':'Daemon successfully finished'}
+
+class Test_JobStateStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir,"jobs.sqlite")
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_add_get_find(self):
+        store = job_state_store(self.dbfile)
+        self.assertEqual(store.last_id(),0)
+        store.add_jobs([(i,_test_fields(i,'ARCHIVED' if i < 5 else 'RUNNING GATE')) for i in range(1,11)])
+        self.assertEqual(store.last_id(),10)
+        self.assertEqual(store.get(3),_test_fields(3,'ARCHIVED'))
+        self.assertIsNone(store.get(11))
+        self.assertEqual([i for i,f in store.find(status='ARCHIVED')],[1,2,3,4])
+        self.assertEqual([i for i,f in store.find(not_status='ARCHIVED',limit=3,newest_first=True)],[10,9,8])
+        self.assertEqual([i for i,f in store.find(job_id='user_pat7_2024_03_01_10_00_00')],[7])
+        self.assertEqual([i for i,f in store.find(since='2024-03-03',until='2024-03-05')],[2,3])
+        # the journal mode is persistent
+        store.close()
+        db = sqlite3.connect(self.dbfile)
+        self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0],"wal")
+        db.close()
+    def test_transition(self):
+        store = job_state_store(self.dbfile)
+        store.add_job(1,_test_fields(1,'submitted',''))
+        other = job_state_store(self.dbfile)
+        self.assertTrue(store.transition(1,'RUNNING GATE',expected_status='submitted',changes={'Condor status':"{'RUN': '10'}"}))
+        # a second transition from the same state fails
+        self.assertFalse(other.transition(1,'RUNNING GATE',expected_status='submitted'))
+        self.assertEqual(other.get(1)['Status'],'RUNNING GATE')
+        self.assertEqual([i for i,f in other.find(condor_status="{'RUN': '10'}")],[1])
+        self.assertTrue(other.update(1,{'On hold since':'2024-03-02 10:00:00'}))
+        self.assertEqual(store.get(1)['On hold since'],'2024-03-02 10:00:00')
+        self.assertFalse(store.update(2,{'Status':'FINISHED'}))
+        # failed updates leave the job alone
+        with self.assertRaises(ZeroDivisionError):
+            with store._transaction() as c:
+                c.execute("UPDATE jobs SET status='FAILED' WHERE ideal_id=1")
+                1/0
+        self.assertEqual(store.find(status='RUNNING GATE')[0][0],1)
+    def test_indexed_lookups(self):
+        store = job_state_store(self.dbfile)
+        for column in ["job_id","status","condor_status","submission_date"]:
+            plan = " ".join(str(r) for r in store._db.execute("EXPLAIN QUERY PLAN SELECT fields FROM jobs WHERE {}=?".format(column),("x",)).fetchall())
+            self.assertIn("jobs_{}".format(column),plan)
+        plan = " ".join(str(r) for r in store._db.execute("EXPLAIN QUERY PLAN UPDATE jobs SET status=? WHERE ideal_id=?",("x",1)).fetchall())
+        self.assertIn("INTEGER PRIMARY KEY",plan)
+    def test_cfg_export_import(self):
+        cfg = os.path.join(self.tmpdir,"ideal_history.cfg")
+        parser = configparser.ConfigParser()
+        for i in range(1,4):
+            parser[str(i)] = _test_fields(i)
+        parser['2']['Last checked'] = '2024-03-03 10:02:00'
+        with open(cfg,"w") as fp:
+            parser.write(fp)
+        with open(cfg) as fp:
+            expected = fp.read()
+        store = job_state_store(self.dbfile)
+        self.assertEqual(store.import_cfg(cfg),3)
+        os.remove(cfg)
+        store.export_cfg(cfg)
+        with open(cfg) as fp:
+            self.assertEqual(fp.read(),expected)
+        # configparser lowercased the field names in the file, the store has the canonical names
+        self.assertEqual(store.get(2),dict(_test_fields(2),**{'Last checked':'2024-03-03 10:02:00'}))
+        self.assertEqual([i for i,f in store.find(job_id='user_pat3_2024_03_01_10_00_00',status='FINISHED')],[3])
+    def test_daemon_round_trip(self):
+        # one cycle of the log daemon: load the jobs that are not archived, update them and add a new one
+        cfg = os.path.join(self.tmpdir,"ideal_history.cfg")
+        store = job_state_store(self.dbfile)
+        store.add_jobs([(i,_test_fields(i,'RUNNING GATE','')) for i in range(1,4)])
+        parser = store.load_sections(not_status='ARCHIVED')
+        loaded = dict([(i,dict(parser[i])) for i in parser.sections()])
+        self.assertEqual(store.save_sections(parser,loaded),[])
+        parser['1']['Status'] = 'ARCHIVED'
+        parser['2']['Condor status'] = 'DONE'
+        parser['2']['On hold since'] = '2024-03-02 10:00:00'
+        parser['4'] = _test_fields(4,'','')
+        self.assertEqual(store.save_sections(parser,loaded),['1','2','4'])
+        self.assertEqual([i for i,f in store.find(status='ARCHIVED')],[1])
+        self.assertEqual([i for i,f in store.find(not_status='ARCHIVED')],[2,3,4])
+        self.assertEqual([i for i,f in store.find(condor_status='DONE')],[2])
+        self.assertEqual(store.get(2),dict(_test_fields(2,'RUNNING GATE','DONE'),**{'On hold since':'2024-03-02 10:00:00'}))
+        self.assertEqual(store.get(4),_test_fields(4,'',''))
+        # the next cycle only loads the jobs that are not archived, and exporting works every time
+        parser = store.load_sections(not_status='ARCHIVED')
+        self.assertEqual(parser.sections(),['2','3','4'])
+        store.export_cfg(cfg)
+        store.export_cfg(cfg)
+        other = job_state_store(os.path.join(self.tmpdir,"other.sqlite"))
+        self.assertEqual(other.import_cfg(cfg),4)
+        self.assertEqual(other.find(),store.find())
+    def test_benchmark(self):
+        print("Test_JobStateStore test_benchmark")
+        store = job_state_store(self.dbfile)
+        nupdates = 200
+        for njobs in [100,10000]:
+            store.add_jobs([(i,_test_fields(i)) for i in range(store.last_id()+1,njobs+1)])
+            t0 = datetime.now()
+            for k in range(nupdates):
+                store.transition(njobs//2,'RUNNING GATE' if k%2 else 'FINISHED')
+            t1 = datetime.now()
+            cfg = os.path.join(self.tmpdir,"history.cfg")
+            store.export_cfg(cfg)
+            t2 = datetime.now()
+            print("{} jobs: {:.3f} ms per status update, {:.3f} s for the cfg export".format(njobs,(t1-t0).total_seconds()*1000./nupdates,(t2-t1).total_seconds()))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -0,0 +1,247 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module provides a bounded cache for ROI masks (see `utils.roi_utils`).
+Masks are kept in memory up to a given number of bytes; when a new mask does
+not fit, the least recently used masks are dropped. Optionally the masks are
+also saved in a directory, such that a mask for the same ROI contours on the
+same image grid does not need to be computed again in a later process.
+
+The cache keys are tuples with a digest of the ROI contours, the image
+geometry (origin, spacing, size), the z-range, the correction mode, the
+mask engine and the image direction. The cached mask images are shared by
+all users of the cache and should not be modified; `roi_utils` returns copies.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import itk
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+class mask_cache(object):
+    """
+    LRU cache of mask images with a budget of `max_bytes` bytes in memory.
+    If `cache_dir` is given, masks are also stored there (as numpy files) and
+    masks that are not in memory are looked up in that directory, which is
+    also limited to `max_bytes`.
+    """
+    def __init__(self,max_bytes=2**30,cache_dir=None):
+        self.max_bytes = int(max_bytes)
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir,exist_ok=True)
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.nhits = 0
+        self.ndiskhits = 0
+        self.nmisses = 0
+        self.nevictions = 0
+    def __len__(self):
+        return len(self._masks)
+    def __contains__(self,key):
+        return key in self._masks
+    @staticmethod
+    def _filename(key):
+        return hashlib.sha1(bytes(repr(key),encoding='utf-8')).hexdigest()+".npy"
+    @staticmethod
+    def _nbytes(img):
+        return itk.array_view_from_image(img).nbytes
+    def get(self,key):
+        """
+        Return the mask for `key`, or None if it is not in the cache.
+        The mask image is the cached object itself, it should not be modified.
+        """
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                self.nhits += 1
+                return self._masks[key]
+        img = self._load(key)
+        with self._lock:
+            if img is None:
+                self.nmisses += 1
+                return None
+            self.ndiskhits += 1
+            self._store(key,img)
+        return img
+    def put(self,key,img):
+        """
+        Store mask image `img` for `key`, evicting least recently used masks if
+        necessary. Masks larger than the budget are not stored.
+        """
+        with self._lock:
+            if not self._store(key,img):
+                return
+        self._save(key,img)
+    def _store(self,key,img):
+        nbytes = self._nbytes(img)
+        if nbytes > self.max_bytes:
+            logger.debug("mask with {} bytes does not fit in the mask cache ({} bytes)".format(nbytes,self.max_bytes))
+            return False
+        if key in self._masks:
+            self.nbytes -= self._nbytes(self._masks.pop(key))
+        while self._masks and self.nbytes+nbytes > self.max_bytes:
+            oldkey,oldimg = self._masks.popitem(last=False)
+            self.nbytes -= self._nbytes(oldimg)
+            self.nevictions += 1
+        self._masks[key] = img
+        self.nbytes += nbytes
+        return True
+    def _load(self,key):
+        if self.cache_dir is None:
+            return None
+        fpath = os.path.join(self.cache_dir,self._filename(key))
+        try:
+            amask = np.load(fpath)
+        except (OSError,ValueError):
+            return None
+        os.utime(fpath)
+        # the key contains the geometry, see roi_utils.region_of_interest.mask_key
+        origin,spacing,dims,direction = key[1],key[2],key[3],key[7]
+        if amask.shape != tuple(dims[::-1]):
+            logger.warning("mask cache file {} has shape {}, expected {}".format(fpath,amask.shape,tuple(dims[::-1])))
+            return None
+        img = itk.GetImageFromArray(amask)
+        img.SetOrigin(origin)
+        img.SetSpacing(spacing)
+        img.SetDirection(itk.GetMatrixFromArray(np.array(direction,dtype=float).reshape(3,3)))
+        return img
+    def _save(self,key,img):
+        if self.cache_dir is None:
+            return
+        fpath = os.path.join(self.cache_dir,self._filename(key))
+        fd,tmpf = tempfile.mkstemp(prefix=".tmp.",suffix=".npy",dir=self.cache_dir)
+        with os.fdopen(fd,"wb") as fp:
+            np.save(fp,itk.array_view_from_image(img))
+        os.replace(tmpf,fpath)
+        # keep the directory within the budget, too
+        files = list()
+        for f in os.listdir(self.cache_dir):
+            try:
+                st = os.stat(os.path.join(self.cache_dir,f))
+            except OSError:
+                continue
+            if not f.startswith(".tmp."):
+                files.append((st.st_mtime,st.st_size,f))
+        total = sum(size for mtime,size,f in files)
+        for mtime,size,f in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if f == os.path.basename(fpath):
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir,f))
+            except OSError:
+                pass
+            total -= size
+    def clear(self):
+        """
+        Remove all masks from memory (not from the cache directory).
+        """
+        with self._lock:
+            self._masks.clear()
+            self.nbytes = 0
+    def stats(self):
+        """
+        Dictionary with the number of masks, bytes, hits, disk hits, misses and evictions.
+        """
+        return {"masks":len(self._masks),
+                "bytes":self.nbytes,
+                "hits":self.nhits,
+                "disk hits":self.ndiskhits,
+                "misses":self.nmisses,
+                "evictions":self.nevictions}
+
+_default_mask_cache = mask_cache()
+
+def get_default_mask_cache():
+    """
+    The mask cache that is used by ROI objects that were not given one explicitly.
+    """
+    return _default_mask_cache
+
+def set_default_mask_cache(max_bytes=2**30,cache_dir=None):
+    """
+    Replace the default mask cache, e.g. with a different budget or with disk persistence.
+    """
+    global _default_mask_cache
+    _default_mask_cache = mask_cache(max_bytes,cache_dir)
+    return _default_mask_cache
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+import shutil
+
+def _test_mask(value,shape=(4,5,6),origin=(0.,0.,0.),spacing=(1.,1.,1.)):
+    img = itk.GetImageFromArray(np.full(shape,value,dtype=np.uint8))
+    img.SetOrigin(origin)
+    img.SetSpacing(spacing)
+    return img
+
+def _test_key(name,shape=(4,5,6),origin=(0.,0.,0.),spacing=(1.,1.,1.),direction=tuple(np.eye(3).flat)):
+    return (name,origin,spacing,shape[::-1],None,False,"scanline",direction)
+
+class Test_MaskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_lru(self):
+        nbytes = 4*5*6
+        cache = mask_cache(max_bytes=3*nbytes)
+        for i in range(3):
+            cache.put(_test_key(str(i)),_test_mask(i))
+        self.assertEqual(len(cache),3)
+        self.assertEqual(cache.nbytes,3*nbytes)
+        # use "0", then "1" is the least recently used
+        self.assertIsNotNone(cache.get(_test_key("0")))
+        cache.put(_test_key("3"),_test_mask(3))
+        self.assertIsNone(cache.get(_test_key("1")))
+        for i in [0,2,3]:
+            self.assertEqual(itk.array_view_from_image(cache.get(_test_key(str(i))))[0,0,0],i)
+        self.assertEqual(cache.stats(),{"masks":3,"bytes":3*nbytes,"hits":4,"disk hits":0,"misses":1,"evictions":1})
+        # too large
+        cache.put(_test_key("big",(10,10,10)),_test_mask(1,(10,10,10)))
+        self.assertFalse(_test_key("big",(10,10,10)) in cache)
+        self.assertEqual(len(cache),3)
+    def test_disk(self):
+        key = _test_key("roi",origin=(-1.5,2.25,3.),spacing=(0.5,1.,2.))
+        cache = mask_cache(max_bytes=2**20,cache_dir=self.tmpdir)
+        cache.put(key,_test_mask(7,origin=(-1.5,2.25,3.),spacing=(0.5,1.,2.)))
+        # new process: empty memory cache, same directory
+        cache2 = mask_cache(max_bytes=2**20,cache_dir=self.tmpdir)
+        img = cache2.get(key)
+        self.assertEqual(cache2.ndiskhits,1)
+        self.assertTrue(np.all(itk.array_view_from_image(img)==7))
+        self.assertEqual(tuple(img.GetOrigin()),(-1.5,2.25,3.))
+        self.assertEqual(tuple(img.GetSpacing()),(0.5,1.,2.))
+        self.assertIs(cache2.get(key),img)
+        self.assertEqual(cache2.nhits,1)
+        self.assertIsNone(cache2.get(_test_key("other")))
+        # oblique image: the direction is restored as well
+        direction = (0.,-1.,0.,1.,0.,0.,0.,0.,1.)
+        key = _test_key("oblique",direction=direction)
+        cache.put(key,_test_mask(3))
+        img = mask_cache(max_bytes=2**20,cache_dir=self.tmpdir).get(key)
+        self.assertEqual(tuple(itk.GetArrayFromMatrix(img.GetDirection()).flat),direction)
+        # directory budget
+        cache3 = mask_cache(max_bytes=500,cache_dir=self.tmpdir)
+        for i in range(5):
+            cache3.put(_test_key(str(i)),_test_mask(i))
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.tmpdir,f)) for f in os.listdir(self.tmpdir)),500)
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -15,7 +15,7 @@ import itk
 import logging
 logger=logging.getLogger(__name__)
 
-def create_mass_image(ct,hlut_path,overrides=dict()):
+def create_mass_image(ct,hlut_path,overrides=dict(),engine="lut"):
     """
     This function creates a mass image based on the HU values in a ct image, a
     Hounsfield-to-density lookup table and (optionally) a dictionary of
@@ -26,7 +26,21 @@ def create_mass_image(ct,hlut_path,overrides=dict()):
     If the HU-to-density lookup table has 3 columns, then it is interpreted as
     a step-wise density table, with a constant density within each successive
     interval (no interpolation).
+
+    With the default `engine="lut"`, the HU table and the overrides are first
+    turned into one density value per integer HU value in the range of the CT,
+    and then the CT is mapped with a single lookup. With `engine="masks"`, a
+    mask is computed for each interval in the HU table (which can be slow for
+    tables with many intervals). Both engines give identical results; CT images
+    with non-integer voxel values are always handled with the "masks" engine.
     """
+    if engine == "lut":
+        act=itk.GetArrayViewFromImage(ct)
+        if np.issubdtype(act.dtype,np.integer):
+            return _create_mass_image_lut(ct,act,np.loadtxt(hlut_path),overrides)
+        logger.debug("CT image has non-integer voxel type {}, using 'masks' engine".format(act.dtype))
+    elif engine != "masks":
+        raise ValueError("unknown mass image engine '{}', should be 'lut' or 'masks'".format(engine))
     HLUT = np.loadtxt(hlut_path)
     logger.debug("table shape is {}".format(HLUT.shape))
     logger.debug("table data type is {}".format(HLUT.dtype))
@@ -81,12 +95,82 @@ def create_mass_image(ct,hlut_path,overrides=dict()):
     mass.CopyInformation(ct)
     return mass
 
+def _create_mass_image_lut(ct,act,HLUT,overrides):
+    """
+    Implementation of `create_mass_image` for CT images with integer HU values.
+    A lookup table with a density value for every integer HU value between the
+    minimum and maximum HU value in the CT is computed in the same way (with the
+    same floating point operations) as the "masks" implementation computes them
+    per voxel, then the lookup table is applied to the CT in a single pass.
+    """
+    logger.debug("table shape is {}".format(HLUT.shape))
+    logger.debug("table data type is {}".format(HLUT.dtype))
+    assert len(HLUT.shape)==2, "HU lookup table has wrong dimension (should be 2D)"
+    assert HLUT.shape[1]//2==1, "HU lookup table has wrong number of columns (should be 2 or 3)"
+    humin=int(np.min(act))
+    humax=int(np.max(act))
+    hu=np.arange(humin,humax+1)
+    lut=np.zeros(hu.shape,dtype=np.float32)
+    done=np.zeros(hu.shape,dtype=bool)
+    if HLUT.shape[1]==2:
+        HU=HLUT[:,0]
+        rho=HLUT[:,1]
+        assert (np.diff(HU)>0).all(), "HU table is not monotonic in HU"
+        assert (rho>=0).all(), "all densities in HU lookup table should be non-negative"
+        m=hu<HU[0]
+        lut[m]=rho[0]
+        m=hu>=HU[-1]
+        lut[m]=rho[-1]
+        m=(hu>=HU[0])*(hu<HU[-1])
+        i=np.searchsorted(HU,hu[m],side='right')-1
+        hu0,hu1,rho0,rho1=HU[i],HU[i+1],rho[i],rho[i+1]
+        lut[m]=rho0
+        # assign first and then add in place, like the "masks" implementation
+        interpolated=lut[m]
+        interpolated+=(hu[m]-hu0)*(rho1-rho0)/(hu1-hu0)
+        lut[m]=interpolated
+        done[:]=True
+    else:
+        n=HLUT.shape[0]
+        HUfrom=HLUT[:,0]
+        HUtill=HLUT[:,1]
+        rho=HLUT[:,2]
+        assert (HUfrom<HUtill).all(),"inconsistent HU interval"
+        assert (rho>0).all(),"rho should be positive"
+        if n>1:
+            assert (HUfrom[1:]==HUtill[:-1]).all(),"HU intervals should be contiguous"
+        assert humin>=HUfrom[0],"Some HU values in the CT are less than the minimum in the HU table."
+        m=hu<HUtill[-1]
+        i=np.searchsorted(HUtill,hu[m],side='right')
+        lut[m]=rho[i]
+        done|=m
+    for ovhu,ovrho in overrides.items():
+        assert ovhu==int(ovhu), "overrides must be given for integer HU values"
+        assert ovrho>=0, "override density values must be non-negative"
+        if humin<=ovhu<=humax:
+            lut[int(ovhu)-humin]=ovrho
+            done[int(ovhu)-humin]=True
+    # map the CT in chunks of slices, to limit the memory used for the lookup indices
+    amass=np.empty(act.shape,dtype=np.float32)
+    complete=done.all()
+    nslices=max(1,2**22//max(1,act[0].size))
+    for i0 in range(0,act.shape[0],nslices):
+        index=act[i0:i0+nslices].astype(np.intp)-humin
+        np.take(lut,index,out=amass[i0:i0+nslices])
+        if not complete and not np.take(done,index).all():
+            logger.warn("not all voxels got a mass, some voxels are 0")
+            complete=True
+    mass=itk.GetImageFromArray(amass)
+    mass.CopyInformation(ct)
+    return mass
+
 ################################################################################
 # UNIT TESTS                                                                   #
 ################################################################################
 
 import unittest
 import os
+from datetime import datetime
 
 class mass_image_test(unittest.TestCase):
     def test_normal_use(self):
@@ -102,4 +186,41 @@ class mass_image_test(unittest.TestCase):
         self.assertTrue(np.allclose(amass[10:60],np.arange(50)*0.1/50))
         self.assertTrue(np.allclose(amass[60:110],np.arange(50)*0.9/50+0.1))
 
+    def test_lut_vs_masks(self):
+        # the "lut" and "masks" engines should give identical results
+        np.random.seed(1234)
+        ct=itk.GetImageFromArray(np.random.randint(-1024,3000,(20,30,40)).astype(np.int16))
+        hlut_fname=".mass_image_test.{}.txt".format(os.getpid())
+        for i in range(4):
+            n=np.random.randint(2,300)
+            HU=np.sort(np.random.choice(np.arange(-1000,2500),n,replace=False)).astype(float)
+            HU+=np.random.uniform(0.,1.,n)*(i%2) # also try non-integer HU values in the table
+            rho=np.random.uniform(0.001,3.,n)
+            edges=np.concatenate([[-1024.],HU[1:],[3100. if i<2 else 2600.]]) # last step table does not cover the CT
+            overrides=dict([(int(hu),np.random.uniform(0.,2.)) for hu in np.random.randint(-1024,3000,20)])
+            for hlut in [np.stack([HU,rho],axis=1),np.stack([edges[:-1],edges[1:],rho],axis=1)]:
+                np.savetxt(hlut_fname,hlut)
+                mass_lut=create_mass_image(ct,hlut_fname,overrides)
+                mass_masks=create_mass_image(ct,hlut_fname,overrides,engine="masks")
+                self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(mass_lut),itk.GetArrayViewFromImage(mass_masks)))
+        os.remove(hlut_fname)
+    def test_large_ct(self):
+        # timing benchmark for a CT with the typical size of a clinical CT
+        print("mass_image_test test_large_ct")
+        np.random.seed(1235)
+        ct=itk.GetImageFromArray(np.random.randint(-1024,3000,(300,512,512)).astype(np.int16))
+        hlut_fname=".mass_image_test.{}.txt".format(os.getpid())
+        for n in [10,1000]:
+            np.savetxt(hlut_fname,np.stack([np.linspace(-1024.,3000.,n),np.linspace(0.001,3.,n)],axis=1))
+            t0=datetime.now()
+            mass_lut=create_mass_image(ct,hlut_fname)
+            t1=datetime.now()
+            print("512x512x300 CT, {} HU table entries: 'lut' engine took {}".format(n,t1-t0))
+            if n<=10:
+                mass_masks=create_mass_image(ct,hlut_fname,engine="masks")
+                t2=datetime.now()
+                print("512x512x300 CT, {} HU table entries: 'masks' engine took {}".format(n,t2-t1))
+                self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(mass_lut),itk.GetArrayViewFromImage(mass_masks)))
+        os.remove(hlut_fname)
+
 # vim: set et softtabstop=4 sw=4 smartindent:
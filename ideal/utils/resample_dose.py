@@ -22,6 +22,12 @@ If you choose to run the multithreaded version, then it is your own
 responsibility to make wise choice for the number of threads, based on (e.g.)
 the number of physical cores, the available RAM and the current workload on the
 machine.
+
+The default implementation stores the per-axis overlaps as band matrices
+(typically only one or two nonzero overlaps per output voxel) and processes
+the volume in tiles along the z-axis, such that the memory use is bounded by
+the tile size instead of being a multiple of the input volume size. The tiles
+can be processed by several threads.
 """
 
 # -----------------------------------------------------------------------------
@@ -35,11 +41,12 @@ machine.
 import numpy as np
 import itk
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from utils.bounding_box import bounding_box
 import logging
 logger=logging.getLogger(__name__)
 
-def mass_weighted_resampling(dose,mass,newgrid):
+def mass_weighted_resampling(dose,mass,newgrid,engine="tiles",nthreads=1,tile_voxels=2**22):
     """
     This function computes a dose distribution using the geometry (origin,
     size, spacing) of the `newgrid` image, using the energy deposition and mass
@@ -53,7 +60,16 @@ def mass_weighted_resampling(dose,mass,newgrid):
     implementation is given by `_mwr_wit_loops(dose,mass,newgrid)`; the unit
     tests are verifying that these two implementation indeed yield the same
     result. 
+
+    With the default `engine="tiles"`, the overlaps are stored as band matrices
+    and the volume is resampled in z-tiles, each tile reading at most about
+    `tile_voxels` input voxels. With `nthreads>1` the tiles are processed in
+    parallel. With `engine="tensordot"` the dense overlap matrices are contracted
+    with the full volumes at once (this needs several times more memory than
+    the input dose and mass images).
     """
+    if engine not in ("tiles","tensordot"):
+        raise ValueError("unknown resampling engine '{}', should be 'tiles' or 'tensordot'".format(engine))
     assert(equal_geometry(dose,mass))
     if equal_geometry(dose,newgrid):
         # If input and output geometry are equal, then we don't need to do anything, just copy the input dose.
@@ -63,6 +79,8 @@ def mass_weighted_resampling(dose,mass,newgrid):
     if not enclosing_geometry(dose,newgrid):
         # In a later release we may provide some smart code to deal with dose resampling outside of the input geometry.
         raise RuntimeError("new grid must be inside the old one")
+    if engine == "tiles":
+        return _mwr_with_tiles(dose,mass,newgrid,nthreads,tile_voxels)
     # start the timer
     t0=datetime.now()
     xol,yol,zol = [ _overlaps(*xyz) for xyz in zip(dose.GetOrigin(),
@@ -215,6 +233,96 @@ def _mwr_with_loops(dose,mass,newgrid):
     return newdose
     
 
+def _mwr_with_tiles(dose,mass,newgrid,nthreads=1,tile_voxels=2**22):
+    """
+    Implementation of `mass_weighted_resampling` with band matrices and z-tiles.
+
+    For each axis, the overlaps of every output interval with the input intervals
+    are stored in a band matrix (see `_band_overlaps`). The output grid is divided
+    in tiles of consecutive z-slices. For each tile only the input slices that
+    overlap with it are read, the energy deposition and the mass in those
+    slices are contracted with the x, y and z band matrices (in that order)
+    and the result is written in the corresponding output slices.
+    """
+    t0=datetime.now()
+    xband,yband,zband = [ _band_overlaps(*xyz) for xyz in zip(dose.GetOrigin(),
+                                                              dose.GetSpacing(),
+                                                              dose.GetLargestPossibleRegion().GetSize(),
+                                                              newgrid.GetOrigin(),
+                                                              newgrid.GetSpacing(),
+                                                              newgrid.GetLargestPossibleRegion().GetSize()) ]
+    adose = itk.array_view_from_image(dose)
+    amass = itk.array_view_from_image(mass)
+    mzyx = tuple(np.array(newgrid.GetLargestPossibleRegion().GetSize())[::-1])
+    anew = np.zeros(mzyx,dtype=float)
+    # number of output slices per tile, such that the input slab has about tile_voxels voxels
+    izlo,zweights = zband
+    nz_in_per_out = max(1.,adose.shape[0]/float(mzyx[0]))
+    nz_tile = max(1,int(tile_voxels/(adose.shape[1]*adose.shape[2]*(nz_in_per_out+zweights.shape[1]))))
+    tiles = [(iz0,min(iz0+nz_tile,mzyx[0])) for iz0 in range(0,mzyx[0],nz_tile)]
+    def resample_tile(tile):
+        iz0,iz1 = tile
+        # range of input slices needed for this tile
+        izs0 = int(np.min(izlo[iz0:iz1]))
+        izs1 = int(min(adose.shape[0],np.max(izlo[iz0:iz1])+zweights.shape[1]))
+        slab_mass = np.array(amass[izs0:izs1],dtype=float)
+        slab_edep = slab_mass*adose[izs0:izs1]
+        tile_zband = (izlo[iz0:iz1]-izs0,zweights[iz0:iz1])
+        edep = _band_contract(_band_contract(_band_contract(slab_edep,xband,2),yband,1),tile_zband,0)
+        wsum = _band_contract(_band_contract(_band_contract(slab_mass,xband,2),yband,1),tile_zband,0)
+        # dose=edep/mass, but only if mass>0
+        mask=(wsum>0)
+        edep[mask]/=wsum[mask]
+        anew[iz0:iz1]=edep
+    if nthreads>1 and len(tiles)>1:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            list(pool.map(resample_tile,tiles))
+    else:
+        for tile in tiles:
+            resample_tile(tile)
+    newdose=itk.image_from_array(anew)
+    newdose.CopyInformation(newgrid)
+    t1=datetime.now()
+    dt=(t1-t0).total_seconds()
+    logger.debug(f"resampling using band matrices in {len(tiles)} z-tiles with {nthreads} thread(s) took {dt:.3f} seconds")
+    return newdose
+
+def _band_overlaps(a0,da,na,b0,db,nb):
+    """
+    Band matrix version of `_overlaps`: returns a tuple (ilo,w) with two arrays.
+    The integer array `ilo` with shape (nb,) contains for each interval j of B the
+    index of the first interval of A that it overlaps with, the float array `w`
+    with shape (nb,K) contains the overlaps of interval j of B with the
+    intervals ilo[j], ilo[j]+1, ..., ilo[j]+K-1 of A (zero-padded).
+
+    This is an auxiliary function for `mass_weighted_resampling`.
+    """
+    o=_overlaps(a0,da,na,b0,db,nb)
+    nonzero=(o!=0)
+    anyoverlap=nonzero.any(axis=0)
+    ilo=np.where(anyoverlap,np.argmax(nonzero,axis=0),0)
+    ihi=np.where(anyoverlap,na-np.argmax(nonzero[::-1],axis=0),0)
+    K=max(1,int(np.max(ihi-ilo)))
+    # near the end of range A, shift the band to stay inside (includes some zero overlaps)
+    ilo=np.minimum(ilo,na-K)
+    w=np.stack([o[ilo+k,np.arange(nb)] for k in range(K)],axis=1)
+    return ilo,w
+
+def _band_contract(a,band,axis):
+    """
+    Contract the array `a` along `axis` with a band matrix `(ilo,w)` as returned
+    by `_band_overlaps`. Returns an array with the same shape as `a`, except along
+    `axis`, where the length is the number of rows in the band matrix.
+
+    This is an auxiliary function for `mass_weighted_resampling`.
+    """
+    ilo,w=band
+    a=np.moveaxis(a,axis,-1)
+    out=np.zeros(a.shape[:-1]+(len(ilo),),dtype=float)
+    for k in range(w.shape[1]):
+        out+=w[:,k]*a[...,ilo+k]
+    return np.moveaxis(out,-1,axis)
+
 def _overlaps(a0,da,na,b0,db,nb,label="",center=True):
     """
     This function returns an (na,nb) array with the length of the overlaps in
@@ -276,6 +384,8 @@ def _overlaps(a0,da,na,b0,db,nb,label="",center=True):
 ################################################################################
 
 import unittest
+import resource
+import multiprocessing
 try:
     from .logging_conf import LoggedTestCase
 except:
@@ -399,11 +509,51 @@ class dose_resampling_tests(LoggedTestCase):
     def test_big(self):
         resampled_loops=_mwr_with_loops(self.dose,self.mass,self.newdose)
         resampled=mass_weighted_resampling(self.dose,self.mass,self.newdose)
+        resampled_tensordot=mass_weighted_resampling(self.dose,self.mass,self.newdose,engine="tensordot")
+        resampled_threads=mass_weighted_resampling(self.dose,self.mass,self.newdose,nthreads=4,tile_voxels=2**16)
         self.assertTrue(equal_geometry(resampled_loops,self.newdose))
         self.assertTrue(equal_geometry(resampled,self.newdose))
         ar0=itk.array_from_image(resampled_loops)
         ar1=itk.array_from_image(resampled)
         self.assertTrue(np.allclose(ar0,ar1))
+        self.assertTrue(np.allclose(ar0,itk.array_from_image(resampled_tensordot)))
+        # the tiled implementation agrees with the loops up to rounding errors
+        self.assertTrue(np.allclose(ar0,ar1,rtol=1e-12,atol=0.))
+        self.assertTrue(np.array_equal(ar1,itk.array_from_image(resampled_threads)))
+        with self.assertRaises(ValueError):
+            mass_weighted_resampling(self.dose,self.mass,self.newdose,engine="nonsense")
+    def test_benchmark(self):
+        # time and peak memory (resident set size) of the "tiles" and "tensordot" engines
+        # for a CT-sized dose distribution; every run is done in a separate process
+        print("dose_resampling_tests test_benchmark")
+        dims = (300,300,200)
+        adose = np.random.normal(1.,0.05,dims[::-1]).astype(np.float32)
+        amass = np.random.uniform(0.5,2.,dims[::-1]).astype(np.float32)
+        dose = itk.image_from_array(adose)
+        mass = itk.image_from_array(amass)
+        for img in [dose,mass]:
+            img.SetSpacing((1.2,1.2,1.5))
+            img.SetOrigin((-180.,-180.,-150.))
+        newgrid = itk.image_from_array(np.zeros((100,150,150),dtype=np.float32))
+        newgrid.SetSpacing((2.,2.,2.5))
+        newgrid.SetOrigin((-150.,-150.,-120.))
+        def run(engine,queue):
+            rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            t0 = datetime.now()
+            anew = itk.array_from_image(mass_weighted_resampling(dose,mass,newgrid,engine=engine))
+            t1 = datetime.now()
+            rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            queue.put(((t1-t0).total_seconds(),(rss1-rss0)/1024.,anew))
+        ctx = multiprocessing.get_context("fork")
+        results = dict()
+        for engine in ["tiles","tensordot"]:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run,args=(engine,queue))
+            proc.start()
+            results[engine] = queue.get()
+            proc.join()
+            print("300x300x200 dose to 150x150x100: '{}' engine took {:.3f} seconds, peak RSS increase {:.1f} MB".format(engine,*results[engine][:2]))
+        self.assertTrue(np.allclose(results["tiles"][2],results["tensordot"][2]))
     def test_single_voxel(self):
         # source grid is 2x2x2 voxels with spacing 1x1x1, centered on (0,0,0)
         # dest grid is 1x1x1 voxels with spacing 1x1x1, centered on (0,0,0)
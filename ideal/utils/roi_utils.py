@@ -14,6 +14,8 @@ Authors: David Boersma and Pierre Granger
 """
 
 from utils.bounding_box import bounding_box
+from utils.mask_cache import get_default_mask_cache
+import hashlib
 import logging
 logger=logging.getLogger(__name__)
 
@@ -300,6 +302,27 @@ class contour_layer(object):
                     mask[i, j] = (1 - area/ref_area) if (mask[i,j]==1.) else (area/ref_area)
         return mask.flat
 
+    def fill_slice(self,xpoints,ypoints):
+        """
+        Vectorized equivalent of `contains_points` for all points of the
+        rectangular grid with (ascending) voxel center coordinates `xpoints`
+        and `ypoints`. Returns a boolean array with shape (ny,nx).
+        """
+        inside = np.zeros((len(ypoints),len(xpoints)),dtype=bool)
+        for q in self.inclusion:
+            inside |= _scanline_fill(q,xpoints,ypoints)
+        for p in self.exclusion:
+            inside &= np.logical_not(_scanline_fill(p,xpoints,ypoints))
+        return inside
+
+    def correct_slice(self,xpoints,ypoints,inside,spacing):
+        """
+        Vectorized equivalent of `correct_mask`: for the voxels that are cut by
+        the inclusion contours, replace the binary value in `inside` (shape (ny,nx))
+        by the partial volume fraction. Returns a float array with shape (ny,nx).
+        """
+        return _partial_volume_fractions(self.inclusion,xpoints,ypoints,inside,spacing)
+
     def check(self):
         assert(len(self.inclusion)>0) # really?
         for p in self.exclusion:
@@ -343,8 +366,19 @@ def check_roi(ds,roi_id):
     logger.error("ROI with id {} not found; structure set contains: ".format(roi_id) + ", ".join(list_roinames(ds)))
     raise ValueError("ROI with id {} not found".format(roi_id))
 
+def _copy_mask(img):
+    """
+    Copy of mask image `img` (data and geometry), e.g. for returning a cached mask to a caller that may modify it.
+    """
+    mask = itk.GetImageFromArray(itk.GetArrayFromImage(img))
+    mask.CopyInformation(img)
+    return mask
+
 class region_of_interest(object):
-    def __init__(self,ds=None,roi_id=None,verbose=False, contours_list = None):
+    def __init__(self,ds=None,roi_id=None,verbose=False, contours_list = None, mask_cache = None):
+        # masks are cached in the given `utils.mask_cache.mask_cache` object, or in the default one
+        self._mask_cache = mask_cache
+        self._digest = None
         if contours_list is not None:
             self.from_contours(contours_list)
             return
@@ -358,8 +392,6 @@ class region_of_interest(object):
         self.zlist = []
         self.dz = 0.
         self.z_precision = 3
-        self.maskparameters = []
-        self.masklist = []
         #self.contour_refs=[]
         for contour in roi.ContourSequence:
             ref = contour.ContourImageSequence[0].ReferencedSOPInstanceUID
@@ -394,23 +426,16 @@ class region_of_interest(object):
                 logger.warn("{} not one single z step: {}".format(self.roiname,", ".join([str(d) for d in dz])))
                 self.dz = 0.
 
-    def get_mask_from_parameters(self, img_params):           
-        if(img_params in self.maskparameters):
-            return self.masklist[self.maskparameters.index(img_params)]
-        else:
-            return None
-
     def from_contours(self, contours_list):
         self.roiname = "Arficial roi created from scratch"
         self.roinr = 1337
+        self.z_precision = 3
         self.ncontours = len(contours_list)
         self.npoints_total = 0
         self.bb = bounding_box()
         self.contour_layers=[]
         self.zlist=[]
         self.dz=0.
-        self.maskparameters = []
-        self.masklist = []
         for contour_layer in contours_list:
             z = round(contour_layer.z, self.z_precision)
             self.zlist.append(z)
@@ -439,6 +464,36 @@ class region_of_interest(object):
         return "roi {} defined by contours in {} layers, {}".format(self.roiname,len(self.contour_layers), self.bb)
     def have_mask(self):
         return self.dz != 0.
+    @property
+    def mask_cache(self):
+        return get_default_mask_cache() if self._mask_cache is None else self._mask_cache
+    @property
+    def digest(self):
+        """
+        Digest of the contours (z values and inclusion/exclusion paths) of this ROI.
+        """
+        if self._digest is None:
+            h4sh = hashlib.sha1()
+            for layer in self.contour_layers:
+                h4sh.update(np.float64(layer.z).tobytes())
+                for tag,paths in [(b"i",layer.inclusion),(b"e",layer.exclusion)]:
+                    for path in paths:
+                        h4sh.update(tag)
+                        h4sh.update(np.ascontiguousarray(path.vertices,dtype=float).tobytes())
+            self._digest = h4sh.hexdigest()
+        return self._digest
+    def mask_key(self,img,zrange=None,corrected=True,engine="scanline"):
+        """
+        Key of the mask of this ROI for the geometry of image `img` in the mask cache.
+        """
+        return (self.digest,
+                tuple(float(v) for v in img.GetOrigin()),
+                tuple(float(v) for v in img.GetSpacing()),
+                tuple(int(n) for n in img.GetLargestPossibleRegion().GetSize()),
+                None if zrange is None else tuple(float(z) for z in zrange),
+                bool(corrected),
+                engine,
+                tuple(float(v) for v in itk.GetArrayFromMatrix(img.GetDirection()).flat))
     def get_volume(self):
         vol = 0.
         for i,layer in enumerate(self.contour_layers,1):
@@ -447,12 +502,25 @@ class region_of_interest(object):
             vol += cvol
             logger.debug("{}. got volume = dz * area = {} * {} = {}, sum={}".format(i,self.dz,area,cvol,vol))
         return vol
-    def get_mask(self,img,zrange=None, corrected=True):
+    def get_mask(self,img,zrange=None, corrected=True, engine="scanline"):
         """
         For a given image, compute for every voxel whether it is inside the ROI or not.
         The `zrange` can be used to limit the z-range of the ROI.
         If specified, the `zrange` should be contained in the z-range of the given image.
+
+        With the default `engine="scanline"` each slice is filled with an
+        edge-crossing scanline algorithm and (if `corrected` is True) the partial
+        volume fractions of the voxels on the contour are computed with vectorized
+        segment-voxel intersections. With `engine="path"` the voxel centers are
+        tested one slice at a time with matplotlib and the partial volume fractions
+        are computed with loops over contour segments and voxels. Both engines give
+        identical masks; the "scanline" engine is much faster for large contours.
+
+        The masks are cached (see `utils.mask_cache`); the returned mask is a copy
+        of the cached mask, so the caller may modify it.
         """
+        if engine not in ("scanline","path"):
+            raise ValueError("unknown ROI mask engine '{}', should be 'scanline' or 'path'".format(engine))
         if not self.have_mask():
             logger.warn("Irregular z-values, masking not yet supported")
             return None
@@ -460,6 +528,11 @@ class region_of_interest(object):
         if len(dims)!=3:
             logger.error("ERROR only 3d images supported")
             return None
+        key = self.mask_key(img,zrange,corrected,engine)
+        cached = self.mask_cache.get(key)
+        if cached is not None:
+            logger.debug("{} using cached mask".format(self.roiname))
+            return _copy_mask(cached)
         #logger.debug("create roi mask image object with dims={}".format(dims))
         if corrected:
             logger.debug("{} going to get mask with 'corrected' float weights".format(self.roiname))
@@ -487,17 +560,77 @@ class region_of_interest(object):
         else:
             logger.debug('YAY: roi "{}" is contained in image'.format(self.roiname))
         #logger.debug("copied infor orig={} spacing={}".format(orig,space))
+        slice_layers = self._slice_layers(orig,space,dims,zrange)
+        if not slice_layers:
+            return roimask
+        # xpoints and ypoints contain the x/y coordinates of the voxel centers
+        xpoints=np.linspace(orig[0],orig[0]+space[0]*dims[0],dims[0],False)
+        ypoints=np.linspace(orig[1],orig[1]+space[1]*dims[1],dims[1],False)
+        if engine == "path":
+            xymesh = np.meshgrid(xpoints,ypoints)
+            xyflat = np.array([(x,y) for x,y in zip(xymesh[0].flat,xymesh[1].flat)])
+        for iz,icz in slice_layers:
+            logger.debug("INSIDE roi: z index mask/image iz={} layer index icz={} (z={})".format(iz,icz,self.contour_layers[icz].z))
+            if engine == "scanline":
+                inside = self.contour_layers[icz].fill_slice(xpoints,ypoints)
+                logger.debug("got {} points inside".format(np.sum(inside)))
+                if corrected:
+                    aroimask[iz,:,:] = self.contour_layers[icz].correct_slice(xpoints,ypoints,inside,space)
+                else:
+                    aroimask[iz,:,:] = inside
+                continue
+            flatmask = self.contour_layers[icz].contains_points(xyflat)
+            logger.debug("got {} points inside".format(np.sum(flatmask)))
+            if corrected:
+                flatmask = flatmask.astype(float)
+                flatmask = self.contour_layers[icz].correct_mask(xymesh, flatmask, space)
+                for iflat,b in enumerate(flatmask):
+                    if not b:
+                        continue
+                    ix = iflat % dims[0]
+                    iy = iflat // dims[0]
+                    #x = orig[0]+space[0]*ix # x coordinate in image/mask
+                    #y = orig[1]+space[1]*iy # y coordinate in image/mask
+                    #assert(self.contour_layers[icz].contains_point(point=(x,y)))
+                    try:
+                        roimask.SetPixel((int(ix),int(iy),int(iz)),float(b))
+                    except IndexError as inderr:
+                        logger.error("iflat={} ix={} iy={} iz={}, error={}".format(iflat,ix,iy,iz,inderr))
+                        raise
+            else:
+                flatmask = flatmask.astype(int)
+                aroimask[iz,:,:] = flatmask.reshape(dims[1],dims[0])[:,:]
+        logger.debug("got mask with {} enabled voxels out of {}".format(np.sum(aroimask>0),np.prod(aroimask.shape)))
+        if not corrected or engine == "scanline":
+            roimask = itk.GetImageFromArray(aroimask)
+            roimask.CopyInformation(img)
+            #achk = sitk.GetArrayFromImage(roimask)
+            #ndiff = np.sum(achk!=aroimask)
+            #nsame = np.sum(achk==aroimask)
+            #nboth = np.sum((achk>0)*(aroimask>0))
+            #nachk = np.sum(achk>0)
+            #naroi = np.sum(aroimask>0)
+            #logger.debug("N(chk)={} N(aroi)={} ndiff={} nsame={} nboth={}".format(nachk,naroi,ndiff,nsame,nboth))
+        self.mask_cache.put(key,roimask)
+        logger.debug("returning mask")
+        return _copy_mask(roimask)
+    def _slice_layers(self,orig,space,dims,zrange=None):
+        """
+        For an image with origin `orig`, spacing `space` and size `dims`, list
+        the pairs (iz,icz) of the index iz of an image slice and the index icz
+        of the contour layer that covers it. Only slices with their center in
+        `zrange` (if given) are included; the list is empty if the z-range of
+        the image (or `zrange`) does not overlap with the ROI.
+        """
         # ITK: the "origin" has the coordinates of the *center* of the corner voxel
         # zmin and zmax are the z coordinates of the boundary of the volume
         zmin = orig[2] - 0.5*space[2]
         zmax = orig[2] + (dims[2]-0.5)*space[2]
         eps=0.001*np.abs(self.dz)
-        #logger.debug("got point mesh")
         if zmin-eps>self.bb.zmax+self.dz or zmax+eps<self.bb.zmin-self.dz:
             logger.warn("WARNING: no overlap in z ranges")
             logger.warn("WARNING: img z range [{}-{}], roi z range [{}-{}]".format(zmin,zmax,self.bb.zmin,self.bb.zmax))
-            return roimask
-        img_params = [orig, space, dims, zrange]
+            return []
         if zrange is None:
             zrange=(zmin,zmax)
         else:
@@ -506,65 +639,17 @@ class region_of_interest(object):
             assert(zrange[1]<=zmax)
             if zrange[0]-eps>self.bb.zmax+self.dz or zrange[1]+eps<self.bb.zmin-self.dz:
                 logger.warn("WARNING: no overlap in (restricted) z ranges")
-                return roimask
-        # logger.debug("zmin={} zmax={}".format(zmin,zmax))
-        # xpoints and ypoints contain the x/y coordinates of the voxel centers
-        xpoints=np.linspace(orig[0],orig[0]+space[0]*dims[0],dims[0],False)
-        ypoints=np.linspace(orig[1],orig[1]+space[1]*dims[1],dims[1],False)
-        xymesh = np.meshgrid(xpoints,ypoints)
-        xyflat = np.array([(x,y) for x,y in zip(xymesh[0].flat,xymesh[1].flat)])
-        clayer0 = self.contour_layers[0]
-        #logger.debug contour0pts.shape
-        z0 = clayer0.z
-        #logger.debug("z0={}".format(z0))
-        #logger.debug("going to loop over z planes in image")
+                return []
+        z0 = self.contour_layers[0].z
+        slice_layers = []
         for iz in range(dims[2]):
             z = orig[2]+space[2]*iz # z coordinate in image/mask
             if z<zrange[0] or z>zrange[1]:
                 continue
             icz = int(np.round((z-z0)/self.dz)) # layer index
             if icz>=0 and icz<len(self.contour_layers):
-                logger.debug("INSIDE roi: z index mask/image iz={} (z={}) layer index icz={} (z={})".format(iz,z,icz,self.contour_layers[icz].z))
-                flatmask = self.contour_layers[icz].contains_points(xyflat)
-                logger.debug("got {} points inside".format(np.sum(flatmask)))
-                if corrected:
-                    flatmask = flatmask.astype(float)
-                    flatmask = self.contour_layers[icz].correct_mask(xymesh, flatmask, space)
-                    for iflat,b in enumerate(flatmask):
-                        if not b:
-                            continue
-                        ix = iflat % dims[0]
-                        iy = iflat // dims[0]
-                        #x = orig[0]+space[0]*ix # x coordinate in image/mask
-                        #y = orig[1]+space[1]*iy # y coordinate in image/mask
-                        #assert(self.contour_layers[icz].contains_point(point=(x,y)))
-                        try:
-                            roimask[ix,iy,iz]=b
-                        except IndexError as inderr:
-                            logger.error("iflat={} ix={} iy={} iz={}, error={}".format(iflat,ix,iy,iz,inderr))
-                            raise
-                else:
-                    flatmask = flatmask.astype(int)
-                    aroimask[iz,:,:] = flatmask.reshape(dims[1],dims[0])[:,:]
-            elif icz<0:
-                logger.debug("BELOWroi: z index mask/image iz={} (z={}) layer index icz={} (z0={} dz={})".format(iz,z,icz,z0,self.dz))
-            else:
-                logger.debug("ABOVE roi: z index mask/image iz={} (z={}) layer index icz={} (z0={} dz={} nlayer={})".format(iz,z,icz,z0,self.dz,len(self.contour_layers)))
-        logger.debug("got mask with {} enabled voxels out of {}".format(np.sum(aroimask>0),np.prod(aroimask.shape)))
-        if not corrected:
-            roimask = itk.GetImageFromArray(aroimask)
-            roimask.CopyInformation(img)
-            #achk = sitk.GetArrayFromImage(roimask)
-            #ndiff = np.sum(achk!=aroimask)
-            #nsame = np.sum(achk==aroimask)
-            #nboth = np.sum((achk>0)*(aroimask>0))
-            #nachk = np.sum(achk>0)
-            #naroi = np.sum(aroimask>0)
-            #logger.debug("N(chk)={} N(aroi)={} ndiff={} nsame={} nboth={}".format(nachk,naroi,ndiff,nsame,nboth))
-        self.maskparameters.append(img_params)
-        self.masklist.append(roimask)
-        logger.debug("returning mask")
-        return roimask
+                slice_layers.append((iz,icz))
+        return slice_layers
     def get_dvh(self,img,nbins=100,dmin=None,dmax=None,zrange=None,debuglabel=None):
         logger.debug("starting dvh calculation")
         dims=np.array(img.GetLargestPossibleRegion().GetSize())
@@ -574,12 +659,7 @@ class region_of_interest(object):
         logger.debug("got size = {}".format(dims.tolist()))
         aimg = itk.GetArrayFromImage(img)
         logger.debug("got array with shape {}".format(list(aimg.shape)))
-        img_params = [img.GetOrigin(), img.GetSpacing(), np.array(img.GetLargestPossibleRegion().GetSize()), zrange]
-        itkmask = self.get_mask_from_parameters(img_params)
-        if(itkmask):
-            logger.debug("Using already computed mask for these dimensions")
-        else:
-            itkmask=self.get_mask(img,zrange)
+        itkmask=self.get_mask(img,zrange)
         logger.debug("got mask with size {}".format(itkmask.GetLargestPossibleRegion().GetSize()))
         amask=(itk.GetArrayFromImage(itkmask))
 
@@ -597,13 +677,13 @@ class region_of_interest(object):
         if nb_negative:
             logger.warning("There are {} negative voxels in the mask !! OK because below {}".format(nb_negative, nb_negative_tol))
     
-        dhist,dedges = np.histogram(a,bins=nbins,range=(dmin,dmax), weights=amask[np.nonzero(amask)])
+        dhist,dedges = np.histogram(a,bins=nbins,range=(dmin,dmax), weights=amask[np.nonzero(amask)].astype(float))
         logger.debug("got histogram with {} edges for {} bins".format(len(dedges),nbins))
         adhist=np.array(dhist,dtype=float)
         adedges=np.array(dedges,dtype=float)
         dsum=0.5*np.sum(adhist*adedges[:-1]+adhist*adedges[1:])
         dhistsum=np.sum(adhist)
-        amasksum=np.sum(amask)
+        amasksum=np.sum(amask,dtype=float)
         adchist=np.cumsum(adhist)
         logger.debug("dhistsum={} amasksum={} adchist[-1]={}".format(dhistsum,amasksum,adchist[-1]))
         assert(round(amasksum, 7)==round(dhistsum,7))
@@ -696,6 +776,41 @@ def get_intersection_volume(roilist,xvoxel=1.,yvoxel=1.):
         itkmask *= itk.GetArrayFromImage(roi.get_mask(img))
     return np.sum(itkmask)*np.prod(spacing)
 
+def get_label_map(rois,img):
+    """
+    Rasterize the (uncorrected) masks of all ROIs in the list `rois` on the
+    grid of image `img` in one pass over the slices. Returns an integer label
+    image and an array with the number of voxels in each ROI mask. In the label
+    image, a voxel has the value k (1-based index in `rois`) of the last ROI in
+    the list that contains it, or 0 if no ROI contains it. Hence, assigning a
+    value per label gives the same result as applying the masks one after the
+    other, in the order of the list.
+    """
+    for roi in rois:
+        if not roi.have_mask():
+            raise RuntimeError("cannot compute a mask for ROI '{}', irregular z-values".format(roi.roiname))
+    dims=np.array(img.GetLargestPossibleRegion().GetSize())
+    if len(dims)!=3:
+        raise ValueError("only 3d images supported, got {}d image".format(len(dims)))
+    orig = img.GetOrigin()
+    space = img.GetSpacing()
+    alabels = np.zeros(dims[::-1],dtype=np.uint8 if len(rois)<256 else np.uint16)
+    counts = np.zeros(len(rois),dtype=int)
+    xpoints=np.linspace(orig[0],orig[0]+space[0]*dims[0],dims[0],False)
+    ypoints=np.linspace(orig[1],orig[1]+space[1]*dims[1],dims[1],False)
+    roi_slice_layers = [dict(roi._slice_layers(orig,space,dims)) for roi in rois]
+    for iz in range(dims[2]):
+        for k,(roi,slice_layers) in enumerate(zip(rois,roi_slice_layers)):
+            if iz not in slice_layers:
+                continue
+            inside = roi.contour_layers[slice_layers[iz]].fill_slice(xpoints,ypoints)
+            alabels[iz][inside] = k+1
+            counts[k] += np.sum(inside)
+    logger.debug("label map for {} ROIs with {} labeled voxels out of {}".format(len(rois),np.sum(alabels>0),alabels.size))
+    labels = itk.GetImageFromArray(alabels)
+    labels.CopyInformation(img)
+    return labels, counts
+
 def intersect_segments(S1, S2, eps = 1e-10):
     perp = lambda u,v: (u[0]*v[1]-v[0]*u[1])
     u = S1[1] - S1[0]
@@ -715,4 +830,313 @@ def intersect_segments(S1, S2, eps = 1e-10):
         return np.array([])
     return(S1[0] + sI * u)
 
+def _scanline_fill(path,xpoints,ypoints):
+    """
+    Even-odd fill of the closed contour `path` on the grid of voxel centers
+    with (ascending) coordinates `xpoints` and `ypoints`. Only the contour edges
+    that cross a grid row are considered for that row. Each crossing toggles
+    the voxels on the left of the edge; the position of the crossing is found
+    with the same floating point comparison that matplotlib's
+    `Path.contains_points` uses, so the result is identical.
+    Returns a boolean array with shape (ny,nx).
+    """
+    nx,ny = len(xpoints),len(ypoints)
+    if path.codes is not None:
+        # curves and multiple subpaths: let matplotlib do the work
+        xymesh = np.meshgrid(xpoints,ypoints)
+        xyflat = np.stack([xymesh[0].flat,xymesh[1].flat],axis=1)
+        return path.contains_points(xyflat).reshape(ny,nx)
+    if len(path.vertices)<3:
+        return np.zeros((ny,nx),dtype=bool)
+    # edges from vertex k-1 to vertex k, including the closing edge
+    x1,y1 = np.array(path.vertices,dtype=float).T
+    x0,y0 = np.roll(x1,1),np.roll(y1,1)
+    # row r is crossed by an edge if (y0>=ypoints[r]) != (y1>=ypoints[r])
+    r0 = np.searchsorted(ypoints,y0,side='right')
+    r1 = np.searchsorted(ypoints,y1,side='right')
+    nrows = np.abs(r1-r0)
+    iedge = np.repeat(np.arange(len(x1)),nrows)
+    row = np.repeat(np.minimum(r0,r1),nrows) + np.arange(len(iedge)) - np.repeat(np.cumsum(nrows)-nrows,nrows)
+    x0,y0,x1,y1 = x0[iedge],y0[iedge],x1[iedge],y1[iedge]
+    ty = ypoints[row]
+    yflag1 = (y1>=ty)
+    lhs = (y1-ty)*(x0-x1)
+    dy = y0-y1
+    def toggles(j):
+        return (lhs >= (x1-xpoints[j])*dy) == yflag1
+    # the toggled voxel centers in a row are a prefix [0,t) of the row: find t,
+    # starting from the analytic crossing and correcting for rounding effects
+    t = np.searchsorted(xpoints,x1-lhs/dy)
+    while True:
+        down = (t>0) & ~toggles(np.maximum(t-1,0))
+        up = (t<nx) & toggles(np.minimum(t,nx-1))
+        if not (down.any() or up.any()):
+            break
+        t += up.astype(t.dtype) - down.astype(t.dtype)
+    ncross = np.bincount(row*(nx+1)+t,minlength=ny*(nx+1)).reshape(ny,nx+1)
+    # voxel j is toggled by all crossings with t>j
+    ntoggles = np.cumsum(ncross[:,:0:-1],axis=1)[:,::-1]
+    return (ntoggles%2).astype(bool)
+
+def _partial_volume_fractions(paths,xpoints,ypoints,inside,spacing,max_pairs=2**20):
+    """
+    Vectorized version of the partial volume correction in `contour_layer.correct_mask`.
+    For every contour segment, the voxels in the same search window as in
+    `correct_mask` are intersected with the segment (all voxel sides at once).
+    Voxels with exactly two intersection points get the fraction of their area
+    that is inside the contour, computed with the same formulas as `correct_mask`.
+    Returns a float array with shape (ny,nx).
+    """
+    nx,ny = len(xpoints),len(ypoints)
+    mask = np.array(inside,dtype=float).reshape(ny,nx)
+    if len(paths)==0:
+        return mask
+    ref_area = spacing[0] * spacing[1]
+    hx,hy = 0.5*spacing[0],0.5*spacing[1]
+    # segment k goes from vertex k to vertex k-1 (as in correct_mask)
+    s0 = np.concatenate([np.array(q.vertices,dtype=float) for q in paths])
+    s1 = np.concatenate([np.roll(np.array(q.vertices,dtype=float),1,axis=0) for q in paths])
+    vx,vy = s1[:,0]-s0[:,0],s1[:,1]-s0[:,1]
+    jmin = np.maximum(xpoints.searchsorted(np.minimum(s0[:,0],s1[:,0]))-2,0)
+    jmax = xpoints.searchsorted(np.maximum(s0[:,0],s1[:,0])+2)
+    imin = np.maximum(ypoints.searchsorted(np.minimum(s0[:,1],s1[:,1]))-2,0)
+    imax = ypoints.searchsorted(np.maximum(s0[:,1],s1[:,1])+2)
+    nj = np.maximum(jmax-jmin,0)
+    npairs = np.maximum(imax-imin,0)*nj
+    # voxels further from the segment than half the voxel diagonal cannot intersect it
+    rmax2 = (np.hypot(hx,hy)*(1+1e-6)+1e-6)**2
+    vv = vx*vx+vy*vy
+    hits_vid,hits_px,hits_py,hits_side = [],[],[],[]
+    ends = np.cumsum(npairs)
+    iseg0 = 0
+    while iseg0 < len(npairs):
+        # process chunks of segments with a limited number of segment-voxel pairs
+        iseg1 = max(iseg0+1,int(np.searchsorted(ends,ends[iseg0]-npairs[iseg0]+max_pairs,side='right')))
+        counts = npairs[iseg0:iseg1]
+        iseg = np.repeat(np.arange(iseg0,iseg1),counts)
+        local = np.arange(len(iseg)) - np.repeat(np.cumsum(counts)-counts,counts)
+        i = imin[iseg] + local//nj[iseg]
+        j = jmin[iseg] + local%nj[iseg]
+        iseg0 = iseg1
+        xc,yc = xpoints[j],ypoints[i]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            tproj = np.clip(np.where(vv[iseg]>0,((xc-s0[iseg,0])*vx[iseg]+(yc-s0[iseg,1])*vy[iseg])/vv[iseg],0.),0.,1.)
+        near = (xc-s0[iseg,0]-tproj*vx[iseg])**2+(yc-s0[iseg,1]-tproj*vy[iseg])**2 <= rmax2
+        iseg,i,j,xc,yc = iseg[near],i[near],j[near],xc[near],yc[near]
+        if len(iseg)==0:
+            continue
+        # voxel corners and sides (in the same order as in correct_mask)
+        bl = (xc-hx, yc-hy)
+        br = (xc+hx, yc-hy)
+        tl = (xc-hx, yc+hy)
+        tr = (xc+hx, yc+hy)
+        segments = [(bl, br), (br, tr), (tr, tl), (tl, bl)]
+        px = np.empty((len(iseg),4))
+        py = np.empty((len(iseg),4))
+        hit = np.empty((len(iseg),4),dtype=bool)
+        v0,v1 = vx[iseg],vy[iseg]
+        for n,(p0,p1) in enumerate(segments):
+            # same arithmetic as intersect_segments(np.array(side),np.array(segment))
+            u0,u1 = p1[0]-p0[0],p1[1]-p0[1]
+            w0,w1 = p0[0]-s0[iseg,0],p0[1]-s0[iseg,1]
+            D = u0*v1-v0*u1
+            with np.errstate(divide='ignore',invalid='ignore'):
+                sI = (v0*w1-v1*w0)/D
+                tI = (u0*w1-u1*w0)/D
+                px[:,n] = p0[0]+sI*u0
+                py[:,n] = p0[1]+sI*u1
+            hit[:,n] = ~(np.abs(D)<1e-10) & ~((sI<0)|(sI>1)) & ~((tI<0)|(tI>1)) & ((px[:,n]!=0)|(py[:,n]!=0))
+        # correct_mask keeps at most two intersections per segment and voxel
+        hit &= (np.cumsum(hit,axis=1)<=2)
+        ipair,side = np.nonzero(hit)
+        hits_vid.append(i[ipair]*nx+j[ipair])
+        hits_px.append(px[ipair,side])
+        hits_py.append(py[ipair,side])
+        hits_side.append(side)
+    if not hits_vid:
+        return mask
+    vid = np.concatenate(hits_vid)
+    order = np.argsort(vid,kind='stable')
+    vid = vid[order]
+    nhits = np.bincount(vid,minlength=nx*ny)
+    two = (nhits[vid]==2)
+    vid = vid[two][::2]
+    qx = np.concatenate(hits_px)[order][two].reshape(-1,2)
+    qy = np.concatenate(hits_py)[order][two].reshape(-1,2)
+    side = np.concatenate(hits_side)[order][two].reshape(-1,2)
+    i,j = vid//nx,vid%nx
+    xc,yc = xpoints[j],ypoints[i]
+    blx,bly = xc-hx,yc-hy
+    brx,tly = xc+hx,yc+hy
+    area = np.empty(len(vid))
+    opposite = (np.abs(side[:,0]-side[:,1])==2)
+    # contour crosses the left and right sides
+    m = opposite & (side[:,0]%2==1)
+    area[m] = 0.5 * np.minimum(np.abs(qy[m,0] - 2*bly[m] + qy[m,1]), np.abs(qy[m,0] - 2*tly[m] + qy[m,1])) * spacing[0]
+    # contour crosses the bottom and top sides
+    m = opposite & (side[:,0]%2==0)
+    area[m] = 0.5 * np.minimum(np.abs(qx[m,0] - 2*blx[m] + qx[m,1]), np.abs(qx[m,0] - 2*brx[m] + qx[m,1])) * spacing[1]
+    # contour crosses two adjacent sides (or the same side twice): triangle with
+    # the end point of the lowest numbered side as corner, like in correct_mask
+    m = ~opposite
+    nfirst = np.min(side[m],axis=1)
+    cx = np.where((nfirst==0)|(nfirst==1),brx[m],blx[m])
+    cy = np.where((nfirst==1)|(nfirst==2),tly[m],bly[m])
+    area[m] = 0.5 * np.maximum(np.abs(cx - qx[m,0]), np.abs(cx - qx[m,1])) * np.maximum(np.abs(cy - qy[m,0]), np.abs(cy - qy[m,1]))
+    mask[i,j] = np.where(mask[i,j]==1., 1 - area/ref_area, area/ref_area)
+    return mask
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+from datetime import datetime
+
+def _random_contour(n,radius,jaggedness,z=0.):
+    phi=np.sort(np.random.uniform(0,2*np.pi,n))
+    r=radius*(1+jaggedness*np.random.uniform(-1,1,n))
+    return np.stack([r*np.cos(phi),r*np.sin(phi),np.full(n,z)],axis=1)
+
+class Test_ROIMask(unittest.TestCase):
+    def setUp(self):
+        self.spacing=np.array([1.,1.5,2.])
+        self.xpoints=np.linspace(-60,-60+self.spacing[0]*121,121,False)
+        self.ypoints=np.linspace(-51,-51+self.spacing[1]*71,71,False)
+        self.xymesh=np.meshgrid(self.xpoints,self.ypoints)
+        self.xyflat=np.stack([self.xymesh[0].flat,self.xymesh[1].flat],axis=1)
+    def check_layer(self,layer):
+        shape=(len(self.ypoints),len(self.xpoints))
+        inside_path=layer.contains_points(self.xyflat).reshape(shape)
+        inside_scanline=layer.fill_slice(self.xpoints,self.ypoints)
+        self.assertTrue(np.array_equal(inside_path,inside_scanline))
+        corrected_path=np.array(layer.correct_mask(self.xymesh,inside_path.astype(float).flat[:],self.spacing)).reshape(shape)
+        corrected_scanline=layer.correct_slice(self.xpoints,self.ypoints,inside_scanline,self.spacing)
+        self.assertTrue(np.array_equal(corrected_path,corrected_scanline))
+    def test_random_contours(self):
+        np.random.seed(4321)
+        for i in range(12):
+            points=_random_contour(np.random.randint(3,200),40.,0.15*(i%3))
+            if i%4==0:
+                # vertices on voxel centers and voxel boundaries
+                points[:,0]=np.round(points[:,0]*2)/2
+                points[:,1]=np.round(points[:,1]/0.75)*0.75
+            self.check_layer(contour_layer(points))
+    def test_exclusion(self):
+        np.random.seed(4322)
+        layer=contour_layer(_random_contour(100,45.,0.05),ignore_orientation=False)
+        layer.add_contour(_random_contour(50,15.,0.05)[::-1])
+        self.assertEqual(len(layer.exclusion),1)
+        self.check_layer(layer)
+    def test_get_mask(self):
+        np.random.seed(4323)
+        layers=[contour_layer(_random_contour(60,30.+5*iz,0.1,z=-10.+2.*iz)) for iz in range(11)]
+        roi=region_of_interest(contours_list=layers)
+        img=itk.GetImageFromArray(np.zeros((15,71,121),dtype=np.float32))
+        img.SetOrigin((self.xpoints[0],self.ypoints[0],-14.))
+        img.SetSpacing(self.spacing)
+        for corrected in [False,True]:
+            mask_path=itk.GetArrayFromImage(roi.get_mask(img,corrected=corrected,engine="path"))
+            mask_scanline=itk.GetArrayFromImage(roi.get_mask(img,corrected=corrected))
+            self.assertEqual(mask_path.dtype,mask_scanline.dtype)
+            self.assertTrue(np.array_equal(mask_path,mask_scanline))
+            self.assertEqual(np.sum(mask_scanline[:2]),0)
+            self.assertEqual(np.sum(mask_scanline[-2:]),0)
+            self.assertTrue(np.all(np.sum(mask_scanline[2:-2],axis=(1,2))>0))
+        with self.assertRaises(ValueError):
+            roi.get_mask(img,engine="nonsense")
+    def test_mask_cache(self):
+        from utils.mask_cache import mask_cache
+        np.random.seed(4325)
+        layers=[contour_layer(_random_contour(60,30.,0.1,z=-10.+2.*iz)) for iz in range(11)]
+        cache=mask_cache(max_bytes=2**22)
+        roi=region_of_interest(contours_list=layers,mask_cache=cache)
+        img=itk.GetImageFromArray(np.zeros((15,71,121),dtype=np.float32))
+        img.SetOrigin((self.xpoints[0],self.ypoints[0],-14.))
+        img.SetSpacing(self.spacing)
+        mask_bin=roi.get_mask(img,corrected=False)
+        mask_cor=roi.get_mask(img,corrected=True)
+        # the correction mode is part of the key
+        self.assertEqual(itk.GetArrayViewFromImage(mask_bin).dtype,np.uint8)
+        self.assertEqual(itk.GetArrayViewFromImage(mask_cor).dtype,np.float32)
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(roi.get_mask(img,corrected=False)),itk.GetArrayViewFromImage(mask_bin)))
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(roi.get_mask(img,corrected=True)),itk.GetArrayViewFromImage(mask_cor)))
+        self.assertEqual((cache.nhits,cache.nmisses,len(cache)),(2,2,2))
+        # other z-range, other grid: other masks
+        mask_z=roi.get_mask(img,zrange=(-5.,5.))
+        self.assertEqual(np.sum(itk.GetArrayViewFromImage(mask_z)[:4]),0)
+        img.SetOrigin((self.xpoints[0]+0.5,self.ypoints[0],-14.))
+        roi.get_mask(img,corrected=True)
+        self.assertEqual((cache.nhits,cache.nmisses,len(cache)),(2,4,4))
+        # same contours, other ROI object: same key
+        roi2=region_of_interest(contours_list=layers,mask_cache=cache)
+        self.assertEqual(roi2.digest,roi.digest)
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(roi2.get_mask(img)),itk.GetArrayViewFromImage(roi.get_mask(img))))
+        self.assertEqual(cache.nhits,4)
+        # modifying a returned mask does not change the cached mask
+        mask_shifted=roi2.get_mask(img)
+        expected=itk.GetArrayFromImage(mask_shifted)
+        itk.GetArrayViewFromImage(mask_shifted)[:] = -1.
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(roi.get_mask(img)),expected))
+        # the direction is part of the key, and of the returned mask
+        direction = np.array([[0.,1.,0.],[1.,0.,0.],[0.,0.,1.]])
+        img.SetDirection(itk.GetMatrixFromArray(direction))
+        mask_dir = roi.get_mask(img)
+        self.assertTrue(np.array_equal(itk.GetArrayFromMatrix(mask_dir.GetDirection()),direction))
+        self.assertEqual(cache.nmisses,5)
+        self.assertTrue(np.array_equal(itk.GetArrayViewFromImage(mask_dir),expected))
+    def test_label_map(self):
+        np.random.seed(4324)
+        img=itk.GetImageFromArray(np.zeros((15,71,121),dtype=np.float32))
+        img.SetOrigin((self.xpoints[0],self.ypoints[0],-14.))
+        img.SetSpacing(self.spacing)
+        # overlapping ROIs with different z ranges, the last one partly outside the first one
+        rois=list()
+        for iroi,(r,z0,nz) in enumerate([(45.,-12.,14),(20.,-8.,6),(25.,-4.,4),(15.,0.,12)]):
+            layers=[contour_layer(_random_contour(50,r,0.1,z=z0+2.*iz)+[10.*(iroi==3),5.*iroi,0.]) for iz in range(nz)]
+            rois.append(region_of_interest(contours_list=layers))
+        labels,counts=get_label_map(rois,img)
+        alabels=itk.GetArrayFromImage(labels)
+        self.assertEqual(alabels.dtype,np.uint8)
+        self.assertTrue(np.array_equal(labels.GetOrigin(),img.GetOrigin()))
+        # same as applying the masks one after the other
+        expected=np.zeros(alabels.shape,dtype=int)
+        for k,roi in enumerate(rois,1):
+            amask=itk.GetArrayFromImage(roi.get_mask(img,corrected=False))>0
+            expected[amask]=k
+            self.assertEqual(counts[k-1],np.sum(amask))
+        self.assertTrue(np.array_equal(alabels,expected))
+        self.assertEqual(set(np.unique(alabels)),set([0,1,2,3,4]))
+        # override values per label, like in the CT preprocessing
+        act=np.random.randint(-1000,3000,alabels.shape).astype(np.int16)
+        act_seq=act.copy()
+        act_seq[itk.GetArrayFromImage(rois[0].get_mask(img,corrected=False))==0]=-1000
+        for k,roi in enumerate(rois[1:],2):
+            act_seq[itk.GetArrayFromImage(roi.get_mask(img,corrected=False))>0]=100.5*k
+        hu=np.array([-1000,0]+[100.5*k for k in range(2,5)]).astype(np.int16)
+        override=(alabels!=1)
+        act[override]=hu[alabels[override]]
+        self.assertTrue(np.array_equal(act,act_seq))
+    def test_large_contour(self):
+        # timing benchmark for a body contour with many points on a typical CT slice
+        print("Test_ROIMask test_large_contour")
+        n=3000
+        phi=np.linspace(0,2*np.pi,n,endpoint=False)
+        r=200*(1+0.05*np.sin(7*phi))
+        layer=contour_layer(np.stack([r*np.cos(phi),0.7*r*np.sin(phi),np.zeros(n)],axis=1))
+        spacing=np.array([0.97,0.97,2.])
+        xpoints=np.linspace(-250,-250+spacing[0]*512,512,False)
+        ypoints=np.linspace(-250,-250+spacing[1]*512,512,False)
+        xymesh=np.meshgrid(xpoints,ypoints)
+        xyflat=np.stack([xymesh[0].flat,xymesh[1].flat],axis=1)
+        t0=datetime.now()
+        inside_scanline=layer.fill_slice(xpoints,ypoints)
+        corrected_scanline=layer.correct_slice(xpoints,ypoints,inside_scanline,spacing)
+        t1=datetime.now()
+        inside_path=layer.contains_points(xyflat).reshape(512,512)
+        corrected_path=np.array(layer.correct_mask(xymesh,inside_path.astype(float).flat[:],spacing)).reshape(512,512)
+        t2=datetime.now()
+        print("512x512 slice, {} contour points: 'scanline' engine took {}, 'path' engine took {}".format(n,t1-t0,t2-t1))
+        self.assertTrue(np.array_equal(corrected_path,corrected_scanline))
+
 # vim: set et softtabstop=4 sw=4 smartindent:
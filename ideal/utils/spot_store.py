@@ -0,0 +1,163 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): MedAustron GmbH, ACMIT Gmbh and Medical University Vienna
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module provides a "columnar" storage of the spots of a single pencil beam
+scanning field: instead of one python object per spot, the layer index, energy,
+position and weight of all spots are kept in numpy arrays. This makes it cheap
+to apply an energy dependent meterset weight scaling to all spots and to write
+the spots in the Gate plan text format (see `utils.gate_pbs_plan_file`), also
+for plans with many thousands of spots.
+"""
+
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+class spot_store(object):
+    """
+    Spots of one field (beam), sorted by layer. For every spot, the arrays
+    `layer`, `energy`, `x`, `y` and `w` give the layer index, layer energy,
+    position at isocenter (IEC gantry coordinates, mm) and meterset weight.
+    The per-layer arrays `layer_energy` and `layer_tuneID` have one entry per
+    layer, also for layers without spots.
+    """
+    def __init__(self,layer_energy,layer_tuneID,nspots_per_layer,x,y,w):
+        self.layer_energy = np.array(layer_energy,dtype=float)
+        self.layer_tuneID = [str(t) for t in layer_tuneID]
+        nspots_per_layer = np.array(nspots_per_layer,dtype=int)
+        nlayers = len(self.layer_energy)
+        assert len(self.layer_tuneID) == nlayers, "got {} tune IDs for {} layers".format(len(self.layer_tuneID),nlayers)
+        assert len(nspots_per_layer) == nlayers, "got {} spot numbers for {} layers".format(len(nspots_per_layer),nlayers)
+        self.layer_start = np.zeros(nlayers+1,dtype=int)
+        np.cumsum(nspots_per_layer,out=self.layer_start[1:])
+        self.layer = np.repeat(np.arange(nlayers),nspots_per_layer)
+        self.energy = self.layer_energy[self.layer]
+        self.x = np.array(x,dtype=float)
+        self.y = np.array(y,dtype=float)
+        self.w = np.array(w,dtype=float)
+        nspots = self.layer_start[-1]
+        if not (len(self.x) == len(self.y) == len(self.w) == nspots):
+            raise ValueError("inconsistent number of spots: {} per layer, {} x, {} y and {} weight values".format(
+                nspots,len(self.x),len(self.y),len(self.w)))
+    @staticmethod
+    def from_layers(layers):
+        """
+        Create the spot store from a list of layer objects with an `energy`
+        attribute and either `x`, `y` and `w` arrays (like
+        `beamset_info.layer_info`) or a list of `spots` with `xiec`, `yiec` and
+        `msw` attributes (like `gate_pbs_plan_file.gate_pbs_control_point`).
+        """
+        energies = list()
+        tuneIDs = list()
+        nspots = list()
+        xyw = list()
+        for l in layers:
+            energies.append(float(l.energy))
+            tuneIDs.append(getattr(l,"tuneID","3.0"))
+            if hasattr(l,"w"):
+                xyw.append(np.stack([l.x,l.y,l.w],axis=1) if len(l.w) else np.zeros((0,3)))
+            else:
+                xyw.append(np.array([(s.xiec,s.yiec,s.msw) for s in l.spots],dtype=float).reshape(-1,3))
+            nspots.append(len(xyw[-1]))
+        xyw = np.concatenate(xyw) if xyw else np.zeros((0,3))
+        return spot_store(energies,tuneIDs,nspots,xyw[:,0],xyw[:,1],xyw[:,2])
+    @property
+    def nspots(self):
+        return len(self.w)
+    @property
+    def nlayers(self):
+        return len(self.layer_energy)
+    @property
+    def nspots_per_layer(self):
+        return np.diff(self.layer_start)
+    @property
+    def mswtot(self):
+        return np.sum(self.w)
+    def layer_slice(self,i):
+        """
+        Index range (slice) of the spots in layer `i`.
+        """
+        return slice(self.layer_start[i],self.layer_start[i+1])
+    def scaled_weights(self,msw_scaling=None):
+        """
+        Meterset weights multiplied with an energy dependent factor, given by
+        the polynomial coefficients `msw_scaling` (highest power first, like
+        for `numpy.polyval`), for all spots at once. The values are the same
+        (to the last bit) as when the polynomial is evaluated spot by spot.
+        """
+        if msw_scaling is None:
+            return self.w.copy()
+        return self.w*np.polyval(msw_scaling,self.energy)
+    @staticmethod
+    def total(values):
+        """
+        Sum of `values`, added in the order of the spots (the same sequence
+        of additions as a python loop over the spots would do).
+        """
+        return float(np.cumsum(values)[-1]) if len(values) else 0.
+
+################################################################################
+# UNIT TESTS                                                                   #
+################################################################################
+
+import unittest
+
+class _test_layer(object):
+    def __init__(self,energy,x,y,w,tuneID="1"):
+        self.energy = energy
+        self.x = np.array(x,dtype=float)
+        self.y = np.array(y,dtype=float)
+        self.w = np.array(w,dtype=float)
+        self.tuneID = tuneID
+
+class _test_spot(object):
+    def __init__(self,x,y,w):
+        self.xiec,self.yiec,self.msw = x,y,w
+
+class _test_control_point(object):
+    def __init__(self,energy,spots):
+        self.energy = energy
+        self.spots = spots
+
+class Test_SpotStore(unittest.TestCase):
+    def test_from_layers(self):
+        layers = [_test_layer(150.,[1.,2.],[3.,4.],[0.5,1.5]),
+                  _test_layer(140.,[],[],[]),
+                  _test_layer(130.,[5.],[6.],[2.])]
+        store = spot_store.from_layers(layers)
+        self.assertEqual(store.nspots,3)
+        self.assertEqual(store.nlayers,3)
+        self.assertEqual(list(store.layer),[0,0,2])
+        self.assertEqual(list(store.energy),[150.,150.,130.])
+        self.assertEqual(list(store.nspots_per_layer),[2,0,1])
+        self.assertEqual(list(store.x[store.layer_slice(2)]),[5.])
+        self.assertEqual(store.layer_tuneID,["1","1","1"])
+        self.assertEqual(store.mswtot,4.)
+        cps = [_test_control_point(100.,[_test_spot(1.,2.,3.),_test_spot(4.,5.,6.)])]
+        store = spot_store.from_layers(cps)
+        self.assertEqual(list(store.w),[3.,6.])
+        self.assertEqual(store.layer_tuneID,["3.0"])
+        with self.assertRaises(ValueError):
+            spot_store([100.],["1"],[2],[1.],[2.],[3.])
+    def test_scaled_weights(self):
+        np.random.seed(42)
+        nlayers = 50
+        layers = [_test_layer(e,*np.random.uniform(0,100,(3,n))) for e,n in zip(np.linspace(70.,230.,nlayers),np.random.randint(0,100,nlayers))]
+        store = spot_store.from_layers(layers)
+        params = [1.2e-7,-3.4e-5,2.1e-3,0.98]
+        scaled = store.scaled_weights(params)
+        # same values as a spot-by-spot evaluation
+        expected = [w*np.polyval(params,l.energy) for l in layers for w in l.w]
+        self.assertTrue(np.array_equal(scaled,expected))
+        total = 0
+        for v in expected:
+            total += v
+        self.assertEqual(spot_store.total(scaled),total)
+        self.assertTrue(np.array_equal(store.scaled_weights(),store.w))
+
+# vim: set et softtabstop=4 sw=4 smartindent:
@@ -86,6 +86,17 @@ class TestUpdateJobStatus(unittest.TestCase):
         self.manager.update_job_status(self.parser_sec,self.all_jobs)
         self.assertEqual(self.parser_sec['Condor status'],self.stati['unsuccessfull'])  
 
+    def test_local_job(self):
+        # jobs of the local scheduler backend are not looked up in the condor queue
+        self.parser_sec['Condor id']='local.800'
+        self.all_jobs['local.800'] = self.all_jobs['800']
+        self.parser_sec['Status']='FINISHED'
+        self.manager.update_job_status(self.parser_sec,self.all_jobs)
+        self.assertEqual(self.parser_sec['Condor status'],self.stati['done'])
+        self.parser_sec['Status']='RUNNING GATE'
+        self.manager.update_job_status(self.parser_sec,self.all_jobs)
+        self.assertEqual(self.parser_sec['Condor status'],self.stati['checking'])
+
     @unittest.expectedFailure
     def test_unexpected_behaviour(self):
         self.parser_sec['Condor id']='810' #job not in the queue